@@ -1,5 +1,5 @@
 #include "align_functions.h"
-#include <iostream>
+#include <cmath>
 
 // default_array use the norm landmarks arcface_src from
 // https://github.com/deepinsight/insightface/blob/master/python-package/insightface/utils/face_align.py
@@ -14,15 +14,14 @@ float standard_face[5][2] = {
 namespace align_namespace {
 class Aligner::Impl {
 public:
-	cv::Mat AlignFace(const cv::Mat& dst);
+	void AlignFaces(const float* landmarks, int num_faces, float* matrices);
+	void WarpFace(const unsigned char* frame, int width, int height, int pitch,
+		const float* M, unsigned char* crop, int crop_width, int crop_height,
+		int crop_pitch);
 
 
 private:
-	cv::Mat MeanAxis0(const cv::Mat &src);
-	cv::Mat ElementwiseMinus(const cv::Mat &A, const cv::Mat &B);
-	cv::Mat VarAxis0(const cv::Mat &src);
-	int MatrixRank(cv::Mat M);
-	cv::Mat SimilarTransform(const cv::Mat& src, const cv::Mat& dst);
+	void SimilarTransform(const float* src, const float* dst, int num, float* M);
 	
 };
 
@@ -38,135 +37,119 @@ Aligner::~Aligner() {
 	}
 }
 
-cv::Mat Aligner::AlignFace(const cv::Mat & dst) {
-	return impl_->AlignFace(dst);
+void Aligner::AlignFaces(const float * landmarks, int num_faces, float * matrices) {
+	impl_->AlignFaces(landmarks, num_faces, matrices);
 }
 
-cv::Mat Aligner::Impl::AlignFace(const cv::Mat & dst) {
-	cv::Mat src(5,2,CV_32FC1, standard_face);
-    memcpy(src.data, standard_face, 2 * 5 * sizeof(float));
-	// std::cout << "start align face." << std::endl;
-    cv::Mat M= SimilarTransform(dst, src);
-    // std::cout << "end align face." << std::endl;
-	return M;
+void Aligner::WarpFaces(const unsigned char * const * frames, int width, int height,
+	int pitch, const float * matrices, int num_faces,
+	unsigned char * const * crops, int crop_width, int crop_height,
+	int crop_pitch) {
+	for (int i = 0; i < num_faces; i++) {
+		impl_->WarpFace(frames[i], width, height, pitch, matrices + i * 6,
+			crops[i], crop_width, crop_height, crop_pitch);
+	}
 }
 
-cv::Mat Aligner::Impl::MeanAxis0(const cv::Mat & src) {
-        int num = src.rows;
-        int dim = src.cols;
-
-        // x1 y1
-        // x2 y2
+void Aligner::Impl::AlignFaces(const float * landmarks, int num_faces, float * matrices) {
+	for (int i = 0; i < num_faces; i++) {
+		SimilarTransform(landmarks + i * 10, &standard_face[0][0], 5, matrices + i * 6);
+	}
+}
 
-        cv::Mat output(1,dim,CV_32F);
-        for(int i = 0 ; i <  dim; i ++)
-        {
-            float sum = 0 ;
-            for(int j = 0 ; j < num ; j++)
-            {
-                sum+=src.at<float>(j,i);
-            }
-            output.at<float>(0,i) = sum/num;
+/*
+References: "Least-squares estimation of transformation parameters between two point patterns", Shinji Umeyama, PAMI 1991, DOI: 10.1109/34.88573
+In 2D the SVD solution has a closed form: with the demeaned points as complex
+numbers, scale * rotation = a + ib = sum(conj(src) * dst) / sum(|src|^2).
+Writes the top two rows (2x3, row-major) of the transform mapping src onto dst.
+Accumulates in double in the same order as similarity_transforms() in
+src/common/face_align.py, so both give the same floats.
+*/
+void Aligner::Impl::SimilarTransform(const float * src, const float * dst, int num, float * M) {
+        double src_mean[2] = {0.0, 0.0};
+        double dst_mean[2] = {0.0, 0.0};
+        for (int i = 0; i < num; i++) {
+            src_mean[0] += src[2 * i];
+            src_mean[1] += src[2 * i + 1];
+            dst_mean[0] += dst[2 * i];
+            dst_mean[1] += dst[2 * i + 1];
         }
-
-        return output;
-    }
-
-cv::Mat Aligner::Impl::ElementwiseMinus(const cv::Mat & A, const cv::Mat & B) {
-		cv::Mat output(A.rows,A.cols,A.type());
-
-        assert(B.cols == A.cols);
-        if(B.cols == A.cols)
-        {
-            for(int i = 0 ; i <  A.rows; i ++)
-            {
-                for(int j = 0 ; j < B.cols; j++)
-                {
-                    output.at<float>(i,j) = A.at<float>(i,j) - B.at<float>(0,j);
-                }
-            }
+        for (int j = 0; j < 2; j++) {
+            src_mean[j] /= num;
+            dst_mean[j] /= num;
         }
-        return output;
+        double var = 0.0, a = 0.0, b = 0.0;
+        for (int i = 0; i < num; i++) {
+            double sx = src[2 * i] - src_mean[0];
+            double sy = src[2 * i + 1] - src_mean[1];
+            double dx = dst[2 * i] - dst_mean[0];
+            double dy = dst[2 * i + 1] - dst_mean[1];
+            var += sx * sx + sy * sy;
+            a += sx * dx + sy * dy;
+            b += sx * dy - sy * dx;
+        }
+        if (var < 1e-12) {
+            // all landmarks on one point: translation only
+            a = 1.0;
+            b = 0.0;
+        } else {
+            a /= var;
+            b /= var;
+        }
+        M[0] = (float)a;
+        M[1] = (float)(-b);
+        M[2] = (float)(dst_mean[0] - (a * src_mean[0] - b * src_mean[1]));
+        M[3] = (float)b;
+        M[4] = (float)a;
+        M[5] = (float)(dst_mean[1] - (b * src_mean[0] + a * src_mean[1]));
     }
 
-cv::Mat Aligner::Impl::VarAxis0(const cv::Mat & src) {
-	cv::Mat temp_ = ElementwiseMinus(src, MeanAxis0(src));
-	cv::multiply(temp_, temp_, temp_);
-	return MeanAxis0(temp_);
-}
-
-int Aligner::Impl::MatrixRank(cv::Mat M) {
-	cv::Mat w, u, vt;
-	cv::SVD::compute(M, w, u, vt);
-	cv::Mat1b nonZeroSingularValues = w > 0.0001;
-	int rank = countNonZero(nonZeroSingularValues);
-	return rank;
-}
-
 /*
-References: "Least-squares estimation of transformation parameters between two point patterns", Shinji Umeyama, PAMI 1991, DOI: 10.1109/34.88573
-Anthor: Jack Yu
+Maps every crop pixel back through the inverse of M and blends its four
+neighbours. Neighbours outside the frame read black, and samples with no
+in-frame neighbour at all are black, as in FaceAligner.warp(): the inverse is
+taken in double and rounded to float, coordinates and blending are float,
+and the result is rounded half to even.
 */
-cv::Mat Aligner::Impl::SimilarTransform(const cv::Mat & src, const cv::Mat & dst) {
-		int num = src.rows;
-        int dim = src.cols;
-        cv::Mat src_mean = MeanAxis0(src);
-        cv::Mat dst_mean = MeanAxis0(dst);
-        cv::Mat src_demean = ElementwiseMinus(src, src_mean);
-        cv::Mat dst_demean = ElementwiseMinus(dst, dst_mean);
-        cv::Mat A = (dst_demean.t() * src_demean) / static_cast<float>(num);
-        cv::Mat d(dim, 1, CV_32F);
-        d.setTo(1.0f);
-        if (cv::determinant(A) < 0) {
-            d.at<float>(dim - 1, 0) = -1;
+void Aligner::Impl::WarpFace(const unsigned char * frame, int width, int height,
+	int pitch, const float * M, unsigned char * crop, int crop_width,
+	int crop_height, int crop_pitch) {
+        double det = (double)M[0] * M[4] - (double)M[1] * M[3];
+        if (det == 0.0) {
+            det = 1.0;
         }
-	      cv::Mat T = cv::Mat::eye(dim + 1, dim + 1, CV_32F);
-        cv::Mat U, S, V;
-        // the SVD function in opencv differ from scipy .
-	      cv::SVD::compute(A, S,U, V);
-        
-        int rank = MatrixRank(A);
-        if (rank == 0) {
-            assert(rank == 0);
-        } else if (rank == dim - 1) {
-            if (cv::determinant(U) * cv::determinant(V) > 0) {
-                T.rowRange(0, dim).colRange(0, dim) = U * V;
-            } else {
-                // s = d[dim - 1]
-                // d[dim - 1] = -1
-                // T[:dim, :dim] = np.dot(U, np.dot(np.diag(d), V))
-                // d[dim - 1] = s
-                int s = d.at<float>(dim - 1, 0) = -1;
-                d.at<float>(dim - 1, 0) = -1;
-
-                T.rowRange(0, dim).colRange(0, dim) = U * V;
-                cv::Mat diag_ = cv::Mat::diag(d);
-                cv::Mat twp = diag_*V; //np.dot(np.diag(d), V.T)
-		            cv::Mat B = cv::Mat::zeros(3, 3, CV_8UC1);
-		            cv::Mat C = B.diag(0);
-                T.rowRange(0, dim).colRange(0, dim) = U* twp;
-                d.at<float>(dim - 1, 0) = s;
+        double i00 = M[4] / det, i01 = -M[1] / det;
+        double i10 = -M[3] / det, i11 = M[0] / det;
+        float inv[6] = {
+            (float)i00, (float)i01, (float)-(i00 * M[2] + i01 * M[5]),
+            (float)i10, (float)i11, (float)-(i10 * M[2] + i11 * M[5])
+        };
+        for (int v = 0; v < crop_height; v++) {
+            unsigned char * out = crop + (size_t)v * crop_pitch;
+            for (int u = 0; u < crop_width; u++, out += 3) {
+                float x = inv[0] * (float)u + inv[1] * (float)v + inv[2];
+                float y = inv[3] * (float)u + inv[4] * (float)v + inv[5];
+                if (!(x > -1.0f && x < (float)width && y > -1.0f && y < (float)height)) {
+                    out[0] = out[1] = out[2] = 0;
+                    continue;
+                }
+                float x0 = std::floor(x), y0 = std::floor(y);
+                float fx = x - x0, fy = y - y0;
+                int ix = (int)x0, iy = (int)y0;
+                for (int c = 0; c < 3; c++) {
+                    float p[4];
+                    for (int k = 0; k < 4; k++) {
+                        int px = ix + (k & 1), py = iy + (k >> 1);
+                        p[k] = (px >= 0 && px < width && py >= 0 && py < height) ?
+                            (float)frame[(size_t)py * pitch + px * 3 + c] : 0.0f;
+                    }
+                    float top = p[0] + (p[1] - p[0]) * fx;
+                    float bottom = p[2] + (p[3] - p[2]) * fx;
+                    float value = std::nearbyint(top + (bottom - top) * fy);
+                    out[c] = (unsigned char)(value < 0.0f ? 0.0f : (value > 255.0f ? 255.0f : value));
+                }
             }
         }
-        else{
-            cv::Mat diag_ = cv::Mat::diag(d);
-            cv::Mat twp = diag_*V.t(); //np.dot(np.diag(d), V.T)
-            cv::Mat res = U* twp; // U
-            T.rowRange(0, dim).colRange(0, dim) = -U.t()* twp;
-        }
-        cv::Mat var_ = VarAxis0(src_demean);
-        float val = cv::sum(var_).val[0];
-        cv::Mat res;
-        cv::multiply(d,S,res);
-        float scale =  1.0/val*cv::sum(res).val[0];
-        T.rowRange(0, dim).colRange(0, dim) = - T.rowRange(0, dim).colRange(0, dim).t();
-        cv::Mat  temp1 = T.rowRange(0, dim).colRange(0, dim); // T[:dim, :dim]
-        cv::Mat  temp2 = src_mean.t(); //src_mean.T
-        cv::Mat  temp3 = temp1*temp2; // np.dot(T[:dim, :dim], src_mean.T)
-        cv::Mat temp4 = scale*temp3;
-        T.rowRange(0, dim).colRange(dim, dim+1)=  -(temp4 - dst_mean.t()) ;
-        T.rowRange(0, dim).colRange(0, dim) *= scale;
-        return T;
     }
 
-}
\ No newline at end of file
+}
@@ -1,8 +1,6 @@
 #ifndef _DAMONZZZ_ALIGNER_H_
 #define _DAMONZZZ_ALIGNER_H_
 
-#include "opencv2/opencv.hpp"
-
 
 namespace align_namespace {
 class Aligner {
@@ -10,8 +8,21 @@ public:
     Aligner();
     ~Aligner();
 
-    cv::Mat AlignFace(const cv::Mat & dst);
-    
+    // landmarks: num_faces x 5 x 2 floats, matrices: num_faces x 2 x 3 floats
+    // (row-major, for cv::warpAffine) mapping each face's landmarks onto the
+    // 112x112 template. Same floats as similarity_transforms() in
+    // src/common/face_align.py.
+    void AlignFaces(const float * landmarks, int num_faces, float * matrices);
+
+    // Warps frames[i] (packed 8-bit RGB, width x height, row pitch in bytes)
+    // with matrices[i] into crops[i] (crop_width x crop_height, crop_pitch),
+    // bilinear with a black border like cv::warpAffine. Same arithmetic as
+    // FaceAligner.warp() in src/common/face_align.py.
+    void WarpFaces(const unsigned char * const * frames, int width, int height,
+        int pitch, const float * matrices, int num_faces,
+        unsigned char * const * crops, int crop_width, int crop_height,
+        int crop_pitch);
+
 private:
     class Impl;
     Impl* impl_;
@@ -0,0 +1,98 @@
+#include "face_association.h"
+#include <algorithm>
+
+
+namespace association_namespace {
+class IoUAssociator::Impl {
+public:
+	const std::vector<int> & Assign(const float * det_boxes, int num_dets,
+		const float * obj_boxes, int num_objs, float min_iou);
+
+private:
+	struct Candidate {
+		float iou;
+		int det;
+		int obj;
+		bool operator<(const Candidate & other) const {
+			// highest IoU first; ties in index order so results are deterministic
+			if (iou != other.iou) {
+				return iou > other.iou;
+			}
+			if (det != other.det) {
+				return det < other.det;
+			}
+			return obj < other.obj;
+		}
+	};
+
+	std::vector<float> det_area_;
+	std::vector<Candidate> candidates_;
+	std::vector<char> det_used_;
+	std::vector<int> det_for_obj_;
+};
+
+
+IoUAssociator::IoUAssociator() {
+	impl_ = new Impl();
+}
+
+IoUAssociator::~IoUAssociator() {
+	if (impl_) {
+		delete impl_;
+	}
+}
+
+const std::vector<int> & IoUAssociator::Assign(const float * det_boxes, int num_dets,
+	const float * obj_boxes, int num_objs, float min_iou) {
+	return impl_->Assign(det_boxes, num_dets, obj_boxes, num_objs, min_iou);
+}
+
+const std::vector<int> & IoUAssociator::Impl::Assign(const float * det_boxes, int num_dets,
+	const float * obj_boxes, int num_objs, float min_iou) {
+	det_for_obj_.assign(num_objs, -1);
+	candidates_.clear();
+	if (num_dets == 0 || num_objs == 0) {
+		return det_for_obj_;
+	}
+	det_area_.resize(num_dets);
+	for (int d = 0; d < num_dets; d++) {
+		const float * det = det_boxes + 4 * d;
+		det_area_[d] = (det[2] - det[0]) * (det[3] - det[1]);
+	}
+	// one row of the IoU matrix per object; only pairs above min_iou are kept
+	for (int o = 0; o < num_objs; o++) {
+		const float * obj = obj_boxes + 4 * o;
+		float obj_area = (obj[2] - obj[0]) * (obj[3] - obj[1]);
+		for (int d = 0; d < num_dets; d++) {
+			const float * det = det_boxes + 4 * d;
+			float iw = std::min(obj[2], det[2]) - std::max(obj[0], det[0]);
+			float ih = std::min(obj[3], det[3]) - std::max(obj[1], det[1]);
+			if (iw <= 0.0f || ih <= 0.0f) {
+				continue;
+			}
+			float inter = iw * ih;
+			float uni = obj_area + det_area_[d] - inter;
+			float iou = uni > 0.0f ? inter / uni : 0.0f;
+			if (iou >= min_iou) {
+				candidates_.push_back(Candidate {iou, d, o});
+			}
+		}
+	}
+	std::sort(candidates_.begin(), candidates_.end());
+	det_used_.assign(num_dets, 0);
+	int matched = 0;
+	int max_matches = std::min(num_dets, num_objs);
+	for (const Candidate & c : candidates_) {
+		if (det_used_[c.det] || det_for_obj_[c.obj] >= 0) {
+			continue;
+		}
+		det_used_[c.det] = 1;
+		det_for_obj_[c.obj] = c.det;
+		if (++matched == max_matches) {
+			break;
+		}
+	}
+	return det_for_obj_;
+}
+
+}
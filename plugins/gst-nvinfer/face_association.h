@@ -0,0 +1,36 @@
+#ifndef _DAMONZZZ_FACE_ASSOCIATION_H_
+#define _DAMONZZZ_FACE_ASSOCIATION_H_
+
+#include <vector>
+
+
+namespace association_namespace {
+
+/*
+One-to-one matching of detector outputs to object boxes of a frame, both
+given as flat x1, y1, x2, y2 arrays in the same coordinate space.
+Assign() fills the IoU matrix in one pass over flat arrays, then takes pairs
+greedily from the highest IoU down, skipping detections and objects that are
+already matched. Detections are NMS'ed, so the right pair is near IoU 1 and
+greedy gives the same answer as Hungarian at a fraction of the cost.
+Working buffers are kept between calls.
+*/
+class IoUAssociator {
+public:
+    IoUAssociator();
+    ~IoUAssociator();
+
+    // Returns, for every object, the index of its detection or -1
+    const std::vector<int> & Assign(const float * det_boxes, int num_dets,
+        const float * obj_boxes, int num_objs, float min_iou);
+
+private:
+    IoUAssociator(const IoUAssociator &);
+    IoUAssociator & operator=(const IoUAssociator &);
+    class Impl;
+    Impl* impl_;
+};
+
+} // namespace association_namespace
+
+#endif // !_DAMONZZZ_FACE_ASSOCIATION_H_
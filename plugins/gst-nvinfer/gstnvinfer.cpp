@@ -98,6 +98,11 @@ static GQuark _dsmeta_quark = 0;
 #define DEFAULT_OUTPUT_INSTANCE_MASK FALSE
 #define DEFAULT_INPUT_TENSOR_META FALSE
 #define DEFAULT_ALIGNMENTS 0
+#define DEFAULT_ALIGN_DUMP_INTERVAL 0
+/* Host slabs kept per surface size for the alignment copies. */
+#define ALIGN_POOL_SLABS_PER_SIZE 4
+/* Minimum IoU between a face object and a landmark detection to pair them. */
+#define FACE_MATCH_MIN_IOU 0.5f
 
 /* By default NVIDIA Hardware allocated memory flows through the pipeline. We
  * will be processing on this type of memory only. */
@@ -127,6 +132,8 @@ static void gst_nvinfer_get_property (GObject * object, guint prop_id,
 
 static gboolean gst_nvinfer_start (GstBaseTransform * btrans);
 static gboolean gst_nvinfer_stop (GstBaseTransform * btrans);
+static void *pinned_host_alloc (size_t size);
+static void pinned_host_free (void *ptr);
 static gboolean gst_nvinfer_sink_event (GstBaseTransform * trans,
     GstEvent * event);
 
@@ -384,6 +391,10 @@ gst_nvinfer_init (GstNvInfer * nvinfer)
   nvinfer->output_tensor_meta = DEFAULT_OUTPUT_TENSOR_META;
   nvinfer->output_instance_mask = DEFAULT_OUTPUT_INSTANCE_MASK;
   nvinfer->alignments = DEFAULT_ALIGNMENTS;
+  nvinfer->align_pool = NULL;
+  nvinfer->face_associator = NULL;
+  nvinfer->align_dump_interval = DEFAULT_ALIGN_DUMP_INTERVAL;
+  nvinfer->align_last_dump = 0;
 
   nvinfer->max_batch_size = impl->m_InitParams->maxBatchSize =
       DEFAULT_BATCH_SIZE;
@@ -1004,6 +1015,12 @@ gst_nvinfer_start (GstBaseTransform * btrans)
       NVBUFSURF_TRANSFORM_CROP_DST;
   nvinfer->transform_params.transform_flip = NvBufSurfTransform_None;
 
+  if (nvinfer->alignments == 1 || nvinfer->alignments == 2) {
+    nvinfer->align_pool = new buffer_pool_namespace::HostBufferPool (
+        ALIGN_POOL_SLABS_PER_SIZE, pinned_host_alloc, pinned_host_free);
+    nvinfer->face_associator = new association_namespace::IoUAssociator ();
+  }
+
   /* Initialize the object history map for source 0. */
   nvinfer->source_info = new std::unordered_map < gint, GstNvInferSourceInfo >;
   nvinfer->source_info->emplace (0, GstNvInferSourceInfo {
@@ -1090,6 +1107,19 @@ gst_nvinfer_stop (GstBaseTransform * btrans)
 
   cudaSetDevice (nvinfer->gpu_id);
 
+  if (nvinfer->align_pool) {
+    buffer_pool_namespace::HostBufferPoolStats stats = nvinfer->align_pool->Stats ();
+    GST_INFO_OBJECT (nvinfer, "alignment buffer pool: %" G_GUINT64_FORMAT
+        " slabs (%" G_GSIZE_FORMAT " bytes), %" G_GUINT64_FORMAT " acquires, %"
+        G_GUINT64_FORMAT " reuses, %" G_GUINT64_FORMAT " exhausted, %"
+        G_GUINT64_FORMAT " outstanding", stats.allocations, stats.bytes,
+        stats.acquires, stats.reuses, stats.exhausted, stats.outstanding);
+    delete nvinfer->align_pool;
+    nvinfer->align_pool = NULL;
+  }
+  delete nvinfer->face_associator;
+  nvinfer->face_associator = NULL;
+
   if (nvinfer->convertStream)
     cudaStreamDestroy (nvinfer->convertStream);
 
@@ -1420,91 +1450,191 @@ convert_batch_and_push_to_input_thread (GstNvInfer *nvinfer,
   return TRUE;
 }
 
+static void *
+pinned_host_alloc (size_t size)
+{
+  void *ptr = NULL;
+  if (cudaMallocHost (&ptr, size) != cudaSuccess)
+    return NULL;
+  return ptr;
+}
+
+static void
+pinned_host_free (void *ptr)
+{
+  cudaFreeHost (ptr);
+}
+
+/* Debug dumps of the alignment input are off unless align-dump-interval is
+ * set, and then written at most once per interval. */
+static gboolean
+align_dump_due (GstNvInfer * nvinfer)
+{
+  if (nvinfer->align_dump_interval == 0)
+    return FALSE;
+  gint64 now = g_get_monotonic_time ();
+  if (nvinfer->align_last_dump != 0 &&
+      now - nvinfer->align_last_dump < (gint64) nvinfer->align_dump_interval * 1000)
+    return FALSE;
+  nvinfer->align_last_dump = now;
+  return TRUE;
+}
+
+/* Crop-space landmarks of the objects queued in the current batch, one slot
+ * per batch frame. They are gathered while the object's frame is being
+ * walked, since the frame's landmark matches are rebuilt for the next frame
+ * and a batch can span several frames. */
+typedef struct
+{
+  std::vector<float> landmarks;   /* slots x 5 x 2 */
+  std::vector<gboolean> found;
+  std::vector<int> ids;
+  std::vector<float> matrices;    /* slots x 2 x 3 */
+} GstNvInferBatchLandmarks;
+
+static void
+clear_batch_landmarks (GstNvInferBatchLandmarks & lmks)
+{
+  lmks.landmarks.clear ();
+  lmks.found.clear ();
+  lmks.ids.clear ();
+}
+
+/* Append the slot of the object just added to the batch. face_info is its
+ * matched landmark detection in frame coordinates, or NULL. */
+static void
+add_batch_landmarks (GstNvInfer * nvinfer, GstNvInferBatchLandmarks & lmks,
+    NvDsObjectMeta * object_meta, const FaceInfo * face_info)
+{
+  float face[5][2] = {0};
+  int object_id;
+  if (nvinfer->alignments == 1 && object_meta->parent) {
+    object_id = object_meta->parent->object_id;
+  }
+  else{
+    object_id = (int)(object_meta->confidence*10000.0);
+  }
+  if (face_info == NULL) {
+    /* No landmark detection overlaps the object: its crop is left unaligned
+     * rather than warped with an all-zero landmark set. */
+    GST_DEBUG_OBJECT (nvinfer, "no landmarks matched object %" G_GUINT64_FORMAT
+        ", skipping alignment", object_meta->object_id);
+  } else {
+    const FaceInfo & r = *face_info;
+    float x_width  = (r.bbox[2]-r.bbox[0]);
+    float y_height = (r.bbox[3]-r.bbox[1]);
+    float scale    = std::min(112/x_width, 112/y_height);
+    GST_LOG_OBJECT (nvinfer, "face box %.1f %.1f %.1f %.1f, scale %f", r.bbox[0],
+        r.bbox[1], r.bbox[2], r.bbox[3], scale);
+    for(uint i=0;i<5;i++) {
+      //calculate the correct ratio to trans landmarks
+      face[i][0]=(r.lmk[i*2]     - r.bbox[0])*scale;
+      face[i][1]=(r.lmk[i*2 + 1] - r.bbox[1])*scale;
+    }
+    GST_LOG_OBJECT (nvinfer, "aligning face of person %d, landmarks "
+        "(%.1f, %.1f) (%.1f, %.1f) (%.1f, %.1f) (%.1f, %.1f) (%.1f, %.1f)", object_id,
+        face[0][0], face[0][1], face[1][0], face[1][1], face[2][0], face[2][1],
+        face[3][0], face[3][1], face[4][0], face[4][1]);
+  }
+  lmks.landmarks.insert (lmks.landmarks.end (), &face[0][0], &face[0][0] + 10);
+  lmks.found.push_back (face_info != NULL);
+  lmks.ids.push_back (object_id);
+}
+
 /* save cropped image to check trans successfully or not */
 static void
-check_trans(NvBufSurface * surface, int track_id){
-  for (uint frameIndex = 0; frameIndex < surface->numFilled; frameIndex++) {
-    gint frame_width = (gint)surface->surfaceList[frameIndex].width;
-    gint frame_height = (gint)surface->surfaceList[frameIndex].height;
-
-    void *src_data = NULL;
-    src_data = (char *)malloc(surface->surfaceList[frameIndex].dataSize);
-    if (src_data == NULL) {
-    g_print("Error: failed to malloc src_data \n");
+check_trans(GstNvInfer *nvinfer, NvBufSurface * surface,
+    const GstNvInferBatchLandmarks & lmks){
+  for (uint frameIndex = 0; frameIndex < surface->numFilled &&
+      frameIndex < lmks.found.size (); frameIndex++) {
+    if (!lmks.found[frameIndex])
+      continue;
+    NvBufSurfaceParams *params = &surface->surfaceList[frameIndex];
+    buffer_pool_namespace::HostBuffer src_data (*nvinfer->align_pool, params->dataSize);
+    if (src_data.data () == NULL) {
+      GST_WARNING_OBJECT (nvinfer, "alignment buffer pool exhausted, skipping dump");
+      continue;
     }
-    //auto start = std::chrono::system_clock::now();
-    cudaMemcpy((void *)src_data,
-        (void *)surface->surfaceList[frameIndex].dataPtr,
-        surface->surfaceList[frameIndex].dataSize,
+    cudaMemcpy(src_data.data (), params->dataPtr, params->dataSize,
         cudaMemcpyDeviceToHost);
-    //auto end = std::chrono::system_clock::now();
-    //std::cout << "d to H time usage:"<<std::chrono::duration_cast<std::chrono::microseconds>(end - start).count() << "us" << std::endl;
-    size_t frame_step = surface->surfaceList[frameIndex].pitch;
-    cv::Mat frame = cv::Mat(frame_height, frame_width, CV_8UC3, src_data, frame_step);
-    cv::Mat out_mat = cv::Mat(cv::Size(frame_width, frame_height), CV_8UC3);
+    cv::Mat frame = cv::Mat(params->height, params->width, CV_8UC3, src_data.data (),
+        params->pitch);
+    cv::Mat out_mat;
     cv::cvtColor(frame, out_mat, CV_RGB2BGR);
     char yuv_name[100] = "";
-    sprintf(yuv_name, "images/alignmentface-of-car-%d.jpg", track_id);  
+    sprintf(yuv_name, "images/alignmentface-of-car-%d.jpg", lmks.ids[frameIndex]);  
     cv::imwrite(yuv_name, out_mat); 
   }
 }
 
-/* use similarTransform matrix to do warp perspective trans */
-static void perform_align(NvBufSurface * surface, cv::Mat &M, int track_id, float* lmk){
-  for (uint frameIndex = 0; frameIndex < surface->numFilled; frameIndex++) {
-    gint frame_width = (gint)surface->surfaceList[frameIndex].width;
-    gint frame_height = (gint)surface->surfaceList[frameIndex].height;
-
-    void *src_data = NULL;
-    src_data = (char *)malloc(surface->surfaceList[frameIndex].dataSize);
-    if (src_data == NULL) {
-      g_print("Error: failed to malloc src_data \n");
+/* Warp surface i of the batch with its own 2x3 similarity matrix, slot i of
+ * lmks.matrices from Aligner::AlignFaces. Slots without landmarks are left
+ * as converted. */
+static void perform_align(GstNvInfer *nvinfer, NvBufSurface * surface,
+    const GstNvInferBatchLandmarks & lmks, gboolean dump){
+  for (uint frameIndex = 0; frameIndex < surface->numFilled &&
+      frameIndex < lmks.found.size (); frameIndex++) {
+    if (!lmks.found[frameIndex])
+      continue;
+    NvBufSurfaceParams *params = &surface->surfaceList[frameIndex];
+    gint frame_width = (gint)params->width;
+    gint frame_height = (gint)params->height;
+    size_t frame_step = params->pitch;
+    int track_id = lmks.ids[frameIndex];
+    const float *lmk = &lmks.landmarks[frameIndex * 10];
+    const float *M = &lmks.matrices[frameIndex * 6];
+
+    /* Source copy and warp output share one slab size, so both come from the
+     * same size class and steady state allocates nothing. */
+    buffer_pool_namespace::HostBuffer src_data (*nvinfer->align_pool, params->dataSize);
+    buffer_pool_namespace::HostBuffer dst_data (*nvinfer->align_pool, params->dataSize);
+    if (src_data.data () == NULL || dst_data.data () == NULL) {
+      GST_WARNING_OBJECT (nvinfer, "alignment buffer pool exhausted, face left unaligned");
+      continue;
     }
     // Copy mem from device to host
-    cudaMemcpy((void *)src_data,
-        (void *)surface->surfaceList[frameIndex].dataPtr,
-        surface->surfaceList[frameIndex].dataSize,
+    cudaMemcpy(src_data.data (), params->dataPtr, params->dataSize,
         cudaMemcpyDeviceToHost);
-    auto end = std::chrono::system_clock::now();
-    //std::cout << "d to H time usage:"<<std::chrono::duration_cast<std::chrono::microseconds>(end - start).count() << "us" << std::endl;
-    size_t frame_step = surface->surfaceList[frameIndex].pitch;
-    printf("all_bbox_generated called! colorformat =%d\n", surface->surfaceList[frameIndex].colorFormat);
-    cv::Mat frame = cv::Mat(frame_height, frame_width, CV_8UC3, src_data, frame_step);
-    cv::Mat out_mat = cv::Mat(cv::Size(frame_width, frame_height), CV_8UC3);
-    cv::cvtColor(frame, out_mat, CV_RGB2BGR);
-
-    // Get track-id
-    
-    char yuv_name[100] = "";
-    sprintf(yuv_name, "images/before-of-face-%d.jpg", track_id);  
-    cv::imwrite(yuv_name, out_mat); 
-
-    // Visualize landmark
-    for (int i = 0; i < 5; i++){
-      std::cout << std::to_string(lmk[2*i]) << " " <<  std::to_string(lmk[2*i + 1]) << std::endl;
-      cv::circle(out_mat, cv::Point(lmk[2*i], lmk[2*i + 1]), 4, cv::Scalar(0, 0, 255), 2);
+    GST_LOG_OBJECT (nvinfer, "aligning face of %d in slot %u, colorformat=%d, "
+        "transform [%f %f %f; %f %f %f]", track_id, frameIndex, params->colorFormat,
+        M[0], M[1], M[2], M[3], M[4], M[5]);
+
+    if (dump) {
+      cv::Mat frame = cv::Mat(frame_height, frame_width, CV_8UC3, src_data.data (), frame_step);
+      cv::Mat out_mat;
+      cv::cvtColor(frame, out_mat, CV_RGB2BGR);
+      char yuv_name[100] = "";
+      sprintf(yuv_name, "images/before-of-face-%d.jpg", track_id);  
+      cv::imwrite(yuv_name, out_mat); 
+
+      // Visualize landmark
+      for (int i = 0; i < 5; i++){
+        cv::circle(out_mat, cv::Point(lmk[2*i], lmk[2*i + 1]), 4, cv::Scalar(0, 0, 255), 2);
+      }
+      char yuv_name_vis[100] = "";
+      sprintf(yuv_name_vis, "images/vis-face-%d.jpg", track_id);  
+      cv::imwrite(yuv_name_vis, out_mat); 
     }
-    char yuv_name_vis[100] = "";
-    sprintf(yuv_name_vis, "images/vis-face-%d.jpg", track_id);  
-    cv::imwrite(yuv_name_vis, out_mat); 
-
-    // Affine Transform
-    cv::warpPerspective(frame, frame, M, cv::Size(112, 112),cv::INTER_LINEAR);
-    std::cout << "Affine Transform completed" << std::endl;
-    // Copy back from host to device
-    size_t sizeInBytes = surface->surfaceList[frameIndex].dataSize;
-    cudaMemcpy((void *)surface->surfaceList[frameIndex].dataPtr,
-        frame.ptr(0),
-        sizeInBytes,
-        cudaMemcpyHostToDevice);   
-    std::cout << "cudaMemcpy completed" << std::endl;
+
+    // Affine Transform, into the second slab with the surface pitch
+    gint out_width = std::min(frame_width, 112);
+    gint out_height = std::min(frame_height, 112);
+    const unsigned char *src = (const unsigned char *) src_data.data ();
+    unsigned char *dst = (unsigned char *) dst_data.data ();
+    nvinfer->aligner.WarpFaces (&src, frame_width, frame_height, (int) frame_step,
+        M, 1, &dst, out_width, out_height, (int) frame_step);
+    // Copy back the aligned rows from host to device
+    cudaMemcpy2D(params->dataPtr, frame_step, dst_data.data (), frame_step,
+        out_width * 3, out_height, cudaMemcpyHostToDevice);
   }
 }
 
+/* Convert the batch like convert_batch_and_push_to_input_thread, but
+ * synchronously, then align every crop that has landmarks: one AlignFaces
+ * call for the batch, and crop i warped with matrix i. */
 static gboolean
 convert_batch_and_push_to_input_thread_face_alignment (GstNvInfer *nvinfer,
-    GstNvInferBatch *batch, GstNvInferMemory *mem, NvDsFrameMeta *frame_meta, 
-    NvDsObjectMeta *object_meta, NvOSD_RectParams * crop_rect_params, std::vector<FaceInfo>& face_res)
+    GstNvInferBatch *batch, GstNvInferMemory *mem, GstNvInferBatchLandmarks & lmks)
 {
   NvBufSurfTransform_Error err = NvBufSurfTransformError_Success;
   std::string nvtx_str;
@@ -1526,7 +1656,7 @@ convert_batch_and_push_to_input_thread_face_alignment (GstNvInfer *nvinfer,
   eventAttrib.messageType = NVTX_MESSAGE_TYPE_ASCII;
   nvtx_str = "convert_buf batch_num=" + std::to_string(nvinfer->current_batch_num);
   eventAttrib.message.ascii = nvtx_str.c_str();
-  std::cout << nvtx_str << std::endl;
+  GST_LOG_OBJECT (nvinfer, "%s", nvtx_str.c_str ());
   nvtxDomainRangePushEx(nvinfer->nvtx_domain, &eventAttrib);
 
 
@@ -1539,57 +1669,31 @@ convert_batch_and_push_to_input_thread_face_alignment (GstNvInfer *nvinfer,
               &nvinfer->transform_params);
   }
 
+  nvtxDomainRangePop (nvinfer->nvtx_domain);
+
   if (err != NvBufSurfTransformError_Success) {
     GST_ELEMENT_ERROR (nvinfer, STREAM, FAILED,
         ("NvBufSurfTransform failed with error %d while converting buffer", err),
         (NULL));
     return FALSE;
   }
-  std::cout << "face_res length " << face_res.size() << std::endl;
-  float face[5][2]={0};
-  for(auto& r : face_res) {
-    // temporarily we use confidence to match the detections
-    // TODO use bbox for matching
-    std::cout << "r.score " << std::to_string(r.score) << " object confidence " << std::to_string(object_meta->confidence) << std::endl;
-    if(r.score==object_meta->confidence){
-      float x_width  = (r.bbox[2]-r.bbox[0]);
-      float y_height = (r.bbox[3]-r.bbox[1]);
-      float scale    = std::min(112/x_width, 112/y_height);
-      std::cout << "Parsed Box: " << r.bbox[0] << " " << r.bbox[1] << " " << r.bbox[2] << " " << r.bbox[3] << std::endl;
-      std::cout << "Parsed Lmk: " << r.lmk[0] << " " << r.lmk[1] << " " << r.lmk[2] << " " << r.lmk[3] << std::endl;
-      std::cout << "Scale: " << scale << std::endl;
-      for(uint i=0;i<5;i++) {
-        //calculate the correct ratio to trans landmarks
-        face[i][0]=(r.lmk[i*2]     - r.bbox[0])*scale;
-        face[i][1]=(r.lmk[i*2 + 1] - r.bbox[1])*scale;
-      }
-      std::cout << "Final Lmk: " << face[0][0] << " " << face[0][1] << " " << face[4][0] << " " << face[4][1] << std::endl;
-      break;
-    }
-    
-  }
-  int object_id;
-  if (nvinfer->alignments == 1){
-    object_id = object_meta->parent->object_id;
-  }
-  else{
-    object_id = (int)(object_meta->confidence*10000.0);
-  }
-  std::cout<<"******  "<<"Now do alignment on face of person-"<< object_id <<"  ******"<<std::endl;
-
-  cv::Mat dst(5,2,CV_32FC1, face);
-  memcpy(dst.data, face, 2 * 5 * sizeof(float));
 
-  std::cout<<"dst:"<< dst <<"                    " << std::endl;
+  int num_faces = (int) lmks.found.size ();
+  if (num_faces != (int) batch->frames.size ()) {
+    GST_WARNING_OBJECT (nvinfer, "%d landmark slots for %d batch frames, "
+        "skipping alignment", num_faces, (int) batch->frames.size ());
+  } else if (num_faces > 0) {
+    lmks.matrices.resize (num_faces * 6);
+    nvinfer->aligner.AlignFaces (lmks.landmarks.data (), num_faces,
+        lmks.matrices.data ());
+    gboolean dump = align_dump_due (nvinfer);
+    perform_align(nvinfer, mem->surf, lmks, dump);
+    //save mem->surf to check covering 
+    if (dump)
+      check_trans(nvinfer, mem->surf, lmks);
+  }
+  clear_batch_landmarks (lmks);
 
-  cv::Mat M = nvinfer->aligner.AlignFace(dst);
-  // cv::Mat M2 = AlignmentFunc::similarTransform(dst, src);
-  std::cout<<"M1:"<<M<<"                    " << std::endl;
-  perform_align(mem->surf, M, object_id, *face);
-  memset(face, 0, sizeof(face));
-  //save mem->surf to check covering 
-  check_trans(mem->surf, object_id);
-    
   LockGMutex locker (nvinfer->process_lock);
   /* Push the batch info structure in the processing queue and notify the output
    * thread that a new batch has been queued. */
@@ -1750,6 +1854,102 @@ cleanup_history_map (GstNvInfer * nvinfer, GstBuffer * inbuf)
 }
 
 
+/* Landmark detections of one frame and the face objects they were matched
+ * to. Built once per frame so every object is a hash lookup. */
+typedef struct
+{
+  /* Detections, mapped to frame coordinates. */
+  std::vector<FaceInfo> faces;
+  std::vector<float> det_boxes;
+  std::vector<NvDsObjectMeta *> objects;
+  std::vector<float> obj_boxes;
+  std::unordered_map<NvDsObjectMeta *, const FaceInfo *> matched;
+  std::vector<FaceInfo> parsed;
+  std::set<NvDsObjectMeta *> parents;
+} GstNvInferFrameLandmarks;
+
+/* The detector ran on a crop at (left, top) resized by scale with its aspect
+ * ratio kept (maintain-aspect-ratio=1, padding right/bottom), so its boxes and
+ * landmarks map back to the frame by a uniform scale and an offset. */
+static void
+add_landmark_detections (GstNvInferFrameLandmarks & lmks,
+    const std::vector<FaceInfo> & dets, float left, float top, float scale)
+{
+  for (const FaceInfo & det : dets) {
+    FaceInfo face = det;
+    for (int i = 0; i < LOCATIONS; i += 2) {
+      face.bbox[i] = left + det.bbox[i] / scale;
+      face.bbox[i + 1] = top + det.bbox[i + 1] / scale;
+    }
+    for (int i = 0; i < LMKS; i += 2) {
+      face.lmk[i] = left + det.lmk[i] / scale;
+      face.lmk[i + 1] = top + det.lmk[i + 1] / scale;
+    }
+    lmks.faces.push_back (face);
+    lmks.det_boxes.insert (lmks.det_boxes.end (), face.bbox, face.bbox + LOCATIONS);
+  }
+}
+
+/* Parse the landmark tensors of the frame (alignments=2) or of each distinct
+ * parent object (alignments=1) once, then pair every face object of the
+ * frame with one detection by IoU. */
+static void
+match_frame_landmarks (GstNvInfer * nvinfer, NvDsFrameMeta * frame_meta,
+    NvBufSurfaceParams * surf_params, GstNvInferFrameLandmarks & lmks)
+{
+  lmks.faces.clear ();
+  lmks.det_boxes.clear ();
+  lmks.objects.clear ();
+  lmks.obj_boxes.clear ();
+  lmks.matched.clear ();
+  lmks.parents.clear ();
+
+  if (nvinfer->alignments == 2 && frame_meta->num_obj_meta) {
+    lmks.parsed.clear ();
+    nvinfer->extractor.facelmks (frame_meta->frame_user_meta_list, lmks.parsed, true);
+    float scale = std::min ((float) FACENET_FF_WIDTH / surf_params->width,
+        (float) FACENET_FF_HEIGHT / surf_params->height);
+    add_landmark_detections (lmks, lmks.parsed, 0, 0, scale);
+  }
+
+  for (NvDsMetaList * l_obj = frame_meta->obj_meta_list; l_obj != NULL;
+      l_obj = l_obj->next) {
+    NvDsObjectMeta *object_meta = (NvDsObjectMeta *) (l_obj->data);
+    if (nvinfer->operate_on_gie_id > -1 &&
+        object_meta->unique_component_id != nvinfer->operate_on_gie_id)
+      continue;
+
+    if (nvinfer->alignments == 1) {
+      NvDsObjectMeta *parent = object_meta->parent;
+      if (parent == NULL)
+        continue;
+      if (lmks.parents.insert (parent).second) {
+        NvOSD_RectParams & p = parent->rect_params;
+        if (p.width <= 0 || p.height <= 0)
+          continue;
+        lmks.parsed.clear ();
+        nvinfer->extractor.facelmks (parent->obj_user_meta_list, lmks.parsed, false);
+        float scale = std::min ((float) FACENET_WIDTH / p.width,
+            (float) FACENET_HEIGHT / p.height);
+        add_landmark_detections (lmks, lmks.parsed, p.left, p.top, scale);
+      }
+    }
+
+    NvOSD_RectParams & r = object_meta->rect_params;
+    lmks.objects.push_back (object_meta);
+    lmks.obj_boxes.insert (lmks.obj_boxes.end (),
+        {r.left, r.top, r.left + r.width, r.top + r.height});
+  }
+
+  const std::vector<int> & det_for_obj = nvinfer->face_associator->Assign (
+      lmks.det_boxes.data (), lmks.faces.size (),
+      lmks.obj_boxes.data (), lmks.objects.size (), FACE_MATCH_MIN_IOU);
+  for (size_t i = 0; i < lmks.objects.size (); i++) {
+    if (det_for_obj[i] >= 0)
+      lmks.matched[lmks.objects[i]] = &lmks.faces[det_for_obj[i]];
+  }
+}
+
 /* Function to decide if object should be inferred on. */
 static inline gboolean
 should_infer_object (GstNvInfer * nvinfer, GstBuffer * inbuf,
@@ -1834,8 +2034,9 @@ gst_nvinfer_process_objects (GstNvInfer * nvinfer, GstBuffer * inbuf,
   gdouble scale_ratio_x, scale_ratio_y;
   guint offset_left = 0, offset_top = 0;
   gboolean warn_untracked_object = FALSE;
-  std::vector<FaceInfo>  face_res;
-
+  GstNvInferFrameLandmarks frame_lmks;
+  GstNvInferBatchLandmarks batch_lmks;
+  gboolean align_faces = (nvinfer->alignments == 1 || nvinfer->alignments == 2);
 
   NvDsBatchMeta *batch_meta = gst_buffer_get_nvds_batch_meta (inbuf);
   if (batch_meta == nullptr) {
@@ -1863,13 +2064,10 @@ gst_nvinfer_process_objects (GstNvInfer * nvinfer, GstBuffer * inbuf,
     }
     source_info->last_seen_frame_num = frame_meta->frame_num;
 
-    // /* Get user-meta to align for fullframe version*/
-
-    if (nvinfer->alignments == 2){
-      if (frame_meta->num_obj_meta){
-        NvDsMetaList * l_user = frame_meta->frame_user_meta_list;
-        nvinfer->extractor.facelmks(l_user, face_res, true);
-      }
+    /* Pair the face objects of this frame with their landmarks. */
+    if (align_faces) {
+      match_frame_landmarks (nvinfer, frame_meta,
+          in_surf->surfaceList + frame_meta->batch_id, frame_lmks);
     }
 
     /* Iterate through all the objects. */
@@ -2033,35 +2231,30 @@ gst_nvinfer_process_objects (GstNvInfer * nvinfer, GstBuffer * inbuf,
           (nvinfer->classifier_async_mode) ? nullptr : (in_surf->surfaceList +
           frame_meta->batch_id);
       batch->frames.push_back (frame);
-
-      if (nvinfer->alignments == 1){
-        NvDsMetaList * l_user = object_meta->parent->obj_user_meta_list;
-        nvinfer->extractor.facelmks(l_user, face_res, false);
+      if (align_faces) {
+        auto match = frame_lmks.matched.find (object_meta);
+        add_batch_landmarks (nvinfer, batch_lmks, object_meta,
+            (match == frame_lmks.matched.end ()) ? NULL : match->second);
       }
 
       /* Submit batch if the batch size has reached max_batch_size. */
-      if ((batch->frames.size () == nvinfer->max_batch_size) && (nvinfer->alignments == 1 || nvinfer->alignments == 2)) {
-        std::cout << "=================================================================================" << std::endl;
-        std::cout << "Push to input with align face" << std::endl;
-        if (!convert_batch_and_push_to_input_thread_face_alignment (nvinfer, batch.get(), memory, frame_meta, object_meta, &object_meta->rect_params, face_res)) {
+      if (batch->frames.size () == nvinfer->max_batch_size) {
+        if (align_faces) {
+          GST_LOG_OBJECT (nvinfer, "pushing %u objects with face alignment",
+              (guint) batch->frames.size ());
+          if (!convert_batch_and_push_to_input_thread_face_alignment (nvinfer,
+                  batch.get(), memory, batch_lmks)) {
+            return GST_FLOW_ERROR;
+          }
+        } else if (!convert_batch_and_push_to_input_thread (nvinfer, batch.get(), memory)) {
           return GST_FLOW_ERROR;
         }
         /* Batch submitted. Set batch to nullptr so that a new GstNvInferBatch
-        * structure can be allocated if required. */
+         * structure can be allocated if required. */
         batch.release ();
         conv_gst_buf = nullptr;
         nvinfer->tmp_surf.numFilled = 0;
       }
-      else if (batch->frames.size () == nvinfer->max_batch_size) {
-      if (!convert_batch_and_push_to_input_thread (nvinfer, batch.get(), memory)) {
-        return GST_FLOW_ERROR;
-      }
-      /* Batch submitted. Set batch to nullptr so that a new GstNvInferBatch
-       * structure can be allocated if required. */
-      batch.release ();
-      conv_gst_buf = nullptr;
-      nvinfer->tmp_surf.numFilled = 0;
-      }
     }
   }
 
@@ -2073,7 +2266,12 @@ gst_nvinfer_process_objects (GstNvInfer * nvinfer, GstBuffer * inbuf,
     if (batch->frames.size() == 0)
       gst_buffer_unref (batch->conv_buf);
 
-    if (!convert_batch_and_push_to_input_thread (nvinfer, batch.get(), memory)) {
+    if (align_faces) {
+      if (!convert_batch_and_push_to_input_thread_face_alignment (nvinfer,
+              batch.get(), memory, batch_lmks)) {
+        return GST_FLOW_ERROR;
+      }
+    } else if (!convert_batch_and_push_to_input_thread (nvinfer, batch.get(), memory)) {
       return GST_FLOW_ERROR;
     }
     conv_gst_buf = nullptr;
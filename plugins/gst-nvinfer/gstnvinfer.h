@@ -30,6 +30,8 @@
 #include "align_functions.h"
 
 #include "extractor.h"
+#include "face_association.h"
+#include "host_buffer_pool.h"
 #include "nvtx3/nvToolsExt.h"
 
 /* Package and library details required for plugin_init */
@@ -322,6 +324,18 @@ struct _GstNvInfer
   align_namespace::Aligner aligner;
   extractor_namespace::Extractor extractor;
 
+  /** Pinned host slabs for the alignment copies, created in start(). */
+  buffer_pool_namespace::HostBufferPool *align_pool;
+
+  /** Matches face objects to the detector landmarks, created in start(). */
+  association_namespace::IoUAssociator *face_associator;
+
+  /** Minimum time between two alignment debug dumps (ms), 0 disables them. */
+  guint align_dump_interval;
+
+  /** Monotonic time (us) of the last alignment debug dump. */
+  gint64 align_last_dump;
+
   /** Boolean indicating if instance masks are expected in output and
    *  has to be attached in metadata */
   gboolean output_instance_mask;
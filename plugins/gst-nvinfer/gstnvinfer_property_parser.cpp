@@ -370,6 +370,11 @@ gst_nvinfer_parse_other_attribute (GstNvInfer * nvinfer,
         &error);
     std::cout << "Assign nvinfer->alignments as "<< std::to_string(nvinfer->alignments) << std::endl;
     CHECK_ERROR (error);
+  } else if (!g_strcmp0 (key, CONFIG_GROUP_INFER_ALIGN_DUMP_INTERVAL)) {
+    nvinfer->align_dump_interval = g_key_file_get_integer (key_file,
+        group_name, CONFIG_GROUP_INFER_ALIGN_DUMP_INTERVAL,
+        &error);
+    CHECK_ERROR (error);
   } else if (!g_strcmp0 (key, CONFIG_GROUP_INFER_OUTPUT_INSTANCE_MASK)) {
     if (g_key_file_get_boolean (key_file, group_name,
             CONFIG_GROUP_INFER_OUTPUT_INSTANCE_MASK, &error))
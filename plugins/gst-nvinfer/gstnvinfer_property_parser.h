@@ -150,6 +150,7 @@
 
 /** Customize parameters. */
 #define CONFIG_GROUP_INFER_ALIGNMENTS "alignments"
+#define CONFIG_GROUP_INFER_ALIGN_DUMP_INTERVAL "align-dump-interval"
 
 gboolean gst_nvinfer_parse_config_file (GstNvInfer *nvinfer,
         NvDsInferContextInitParams *init_params, const gchar * cfg_file_path);
@@ -0,0 +1,120 @@
+#include "host_buffer_pool.h"
+#include <map>
+#include <mutex>
+#include <unordered_map>
+#include <vector>
+
+
+namespace buffer_pool_namespace {
+class HostBufferPool::Impl {
+public:
+	Impl(size_t max_slabs_per_size, HostAllocFunc alloc, HostFreeFunc free);
+	~Impl();
+
+	void * Acquire(size_t size);
+	void Release(void * ptr);
+	HostBufferPoolStats Stats();
+
+private:
+	struct Slab {
+		size_t size;
+		bool in_use;
+	};
+
+	struct SizeClass {
+		SizeClass() : slabs(0) {}
+		std::vector<void *> free_slabs;
+		size_t slabs;
+	};
+
+	size_t max_slabs_per_size_;
+	HostAllocFunc alloc_;
+	HostFreeFunc free_;
+	std::mutex lock_;
+	std::map<size_t, SizeClass> classes_;
+	// every slab the pool owns
+	std::unordered_map<void *, Slab> owned_;
+	HostBufferPoolStats stats_;
+};
+
+
+HostBufferPool::HostBufferPool(size_t max_slabs_per_size, HostAllocFunc alloc, HostFreeFunc free) {
+	impl_ = new Impl(max_slabs_per_size, alloc, free);
+}
+
+HostBufferPool::~HostBufferPool() {
+	if (impl_) {
+		delete impl_;
+	}
+}
+
+void * HostBufferPool::Acquire(size_t size) {
+	return impl_->Acquire(size);
+}
+
+void HostBufferPool::Release(void * ptr) {
+	impl_->Release(ptr);
+}
+
+HostBufferPoolStats HostBufferPool::Stats() {
+	return impl_->Stats();
+}
+
+HostBufferPool::Impl::Impl(size_t max_slabs_per_size, HostAllocFunc alloc, HostFreeFunc free)
+	: max_slabs_per_size_(max_slabs_per_size), alloc_(alloc), free_(free), stats_() {
+}
+
+HostBufferPool::Impl::~Impl() {
+	// outstanding slabs are freed too: nobody may use them past the pool
+	for (auto & slab : owned_) {
+		free_(slab.first);
+	}
+}
+
+void * HostBufferPool::Impl::Acquire(size_t size) {
+	std::lock_guard<std::mutex> guard(lock_);
+	SizeClass & size_class = classes_[size];
+	void * ptr = NULL;
+	if (!size_class.free_slabs.empty()) {
+		ptr = size_class.free_slabs.back();
+		size_class.free_slabs.pop_back();
+		owned_[ptr].in_use = true;
+		stats_.reuses++;
+	} else if (size_class.slabs < max_slabs_per_size_) {
+		ptr = alloc_(size);
+		if (ptr == NULL) {
+			return NULL;
+		}
+		size_class.slabs++;
+		owned_[ptr] = Slab {size, true};
+		stats_.allocations++;
+		stats_.bytes += size;
+	} else {
+		stats_.exhausted++;
+		return NULL;
+	}
+	stats_.acquires++;
+	stats_.outstanding++;
+	return ptr;
+}
+
+void HostBufferPool::Impl::Release(void * ptr) {
+	std::lock_guard<std::mutex> guard(lock_);
+	auto slab = owned_.find(ptr);
+	if (slab == owned_.end() || !slab->second.in_use) {
+		// not ours, or released twice
+		stats_.invalid_releases++;
+		return;
+	}
+	slab->second.in_use = false;
+	classes_[slab->second.size].free_slabs.push_back(ptr);
+	stats_.releases++;
+	stats_.outstanding--;
+}
+
+HostBufferPoolStats HostBufferPool::Impl::Stats() {
+	std::lock_guard<std::mutex> guard(lock_);
+	return stats_;
+}
+
+}
@@ -0,0 +1,70 @@
+#ifndef _DAMONZZZ_HOST_BUFFER_POOL_H_
+#define _DAMONZZZ_HOST_BUFFER_POOL_H_
+
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+
+
+namespace buffer_pool_namespace {
+
+typedef void * (*HostAllocFunc) (size_t size);
+typedef void (*HostFreeFunc) (void * ptr);
+
+struct HostBufferPoolStats {
+    uint64_t allocations;  // slabs allocated
+    uint64_t acquires;     // successful Acquire() calls
+    uint64_t reuses;       // acquires served by an already allocated slab
+    uint64_t releases;
+    uint64_t exhausted;    // acquires refused because the size class was full
+    uint64_t invalid_releases;  // pointers not from the pool, or released twice
+    uint64_t outstanding;  // acquired and not yet released
+    size_t bytes;          // memory held by the pool
+};
+
+/*
+Fixed-size host slabs, grouped by byte size (one size class per surface
+geometry). A size class grows on demand up to max_slabs_per_size slabs and
+never shrinks until the pool is destroyed, so steady-state alignment does no
+allocation at all. alloc/free default to malloc/free; nvinfer passes
+cudaMallocHost/cudaFreeHost to get pinned memory for faster copies.
+*/
+class HostBufferPool {
+public:
+    HostBufferPool(size_t max_slabs_per_size = 4,
+        HostAllocFunc alloc = malloc, HostFreeFunc free = ::free);
+    ~HostBufferPool();
+
+    // NULL when the size class is exhausted or the allocation fails
+    void * Acquire(size_t size);
+    void Release(void * ptr);
+    HostBufferPoolStats Stats();
+
+private:
+    HostBufferPool(const HostBufferPool &);
+    HostBufferPool & operator=(const HostBufferPool &);
+    class Impl;
+    Impl* impl_;
+};
+
+// Scoped lease of one slab
+class HostBuffer {
+public:
+    HostBuffer(HostBufferPool & pool, size_t size) : pool_(pool), data_(pool.Acquire(size)) {}
+    ~HostBuffer() {
+        if (data_) {
+            pool_.Release(data_);
+        }
+    }
+    void * data() const { return data_; }
+
+private:
+    HostBuffer(const HostBuffer &);
+    HostBuffer & operator=(const HostBuffer &);
+    HostBufferPool & pool_;
+    void * data_;
+};
+
+} // namespace buffer_pool_namespace
+
+#endif // !_DAMONZZZ_HOST_BUFFER_POOL_H_
@@ -0,0 +1,181 @@
+/*
+Aligner::AlignFaces without OpenCV: a moved, rotated and scaled template is
+mapped back onto the template, and collapsed landmarks give a translation.
+Aligner::WarpFaces gives every crop of a batch its own frame and transform.
+With --matrices, reads num_faces x 5 x 2 float32 landmarks on stdin and
+writes num_faces x 2 x 3 float32 matrices to stdout, which `make check-numpy`
+compares against similarity_transforms() in src/common/face_align.py.
+With --warp, reads int32 num_faces, width, height, then num_faces RGB frames
+and num_faces x 5 x 2 float32 landmarks, aligns the batch as nvinfer does
+and writes num_faces 112 x 112 x 3 crops, which `make check-numpy` compares
+against FaceAligner.align().
+*/
+#include "align_functions.h"
+#include <cmath>
+#include <cstdio>
+#include <cstring>
+#include <vector>
+
+using align_namespace::Aligner;
+
+static const float template_face[5][2] = {
+	{38.2946f, 51.6963f},
+	{73.5318f, 51.5014f},
+	{56.0252f, 71.7366f},
+	{41.5493f, 92.3655f},
+	{70.7299f, 92.2041f}
+};
+
+static int failures = 0;
+
+#define CHECK(cond) do { \
+	if (!(cond)) { \
+		fprintf(stderr, "%s:%d: CHECK failed: %s\n", __FILE__, __LINE__, #cond); \
+		failures++; \
+	} \
+} while (0)
+
+static void test_recovers_template() {
+	Aligner aligner;
+	const int faces = 16;
+	std::vector<float> landmarks(faces * 10), matrices(faces * 6);
+	for (int f = 0; f < faces; f++) {
+		double angle = -0.8 + 1.6 * f / (faces - 1), scale = 0.3 + 0.15 * f;
+		double c = scale * cos(angle), s = scale * sin(angle);
+		double tx = 100.0 + 97.0 * f, ty = 900.0 - 41.0 * f;
+		for (int k = 0; k < 5; k++) {
+			double x = template_face[k][0] - 56.0, y = template_face[k][1] - 56.0;
+			landmarks[f * 10 + 2 * k] = (float)(c * x - s * y + tx);
+			landmarks[f * 10 + 2 * k + 1] = (float)(s * x + c * y + ty);
+		}
+	}
+	aligner.AlignFaces(landmarks.data(), faces, matrices.data());
+	for (int f = 0; f < faces; f++) {
+		const float * M = &matrices[f * 6];
+		CHECK(fabs(M[0] - M[4]) < 1e-6 && fabs(M[1] + M[3]) < 1e-6);
+		for (int k = 0; k < 5; k++) {
+			float x = landmarks[f * 10 + 2 * k], y = landmarks[f * 10 + 2 * k + 1];
+			CHECK(fabs(M[0] * x + M[1] * y + M[2] - template_face[k][0]) < 1e-2);
+			CHECK(fabs(M[3] * x + M[4] * y + M[5] - template_face[k][1]) < 1e-2);
+		}
+	}
+}
+
+static void test_degenerate() {
+	Aligner aligner;
+	float landmarks[10], M[6];
+	for (int k = 0; k < 5; k++) {
+		landmarks[2 * k] = 300.0f;
+		landmarks[2 * k + 1] = 200.0f;
+	}
+	aligner.AlignFaces(landmarks, 1, M);
+	CHECK(M[0] == 1.0f && M[1] == 0.0f && M[3] == 0.0f && M[4] == 1.0f);
+	CHECK(std::isfinite(M[2]) && std::isfinite(M[5]));
+}
+
+/* The aligned batch path of nvinfer: one AlignFaces call for the batch, then
+ * crop i is warped from surface i with matrix i. Surfaces are padded to a
+ * pitch wider than the row, as NvBufSurface pitches are. */
+static void align_batch(Aligner & aligner, const std::vector<unsigned char> & packed,
+		int faces, int width, int height, const float * landmarks,
+		std::vector<unsigned char> & crops) {
+	const int pitch = width * 3 + 64, crop_pitch = 112 * 3 + 32;
+	std::vector<unsigned char> surfaces((size_t)faces * height * pitch, 0);
+	std::vector<unsigned char> aligned((size_t)faces * 112 * crop_pitch, 0);
+	std::vector<const unsigned char *> srcs(faces);
+	std::vector<unsigned char *> dsts(faces);
+	for (int f = 0; f < faces; f++) {
+		for (int y = 0; y < height; y++) {
+			memcpy(&surfaces[((size_t)f * height + y) * pitch],
+				&packed[((size_t)f * height + y) * width * 3], width * 3);
+		}
+		srcs[f] = &surfaces[(size_t)f * height * pitch];
+		dsts[f] = &aligned[(size_t)f * 112 * crop_pitch];
+	}
+	std::vector<float> matrices(faces * 6);
+	aligner.AlignFaces(landmarks, faces, matrices.data());
+	aligner.WarpFaces(srcs.data(), width, height, pitch, matrices.data(), faces,
+		dsts.data(), 112, 112, crop_pitch);
+	crops.resize((size_t)faces * 112 * 112 * 3);
+	for (int f = 0; f < faces; f++) {
+		for (int y = 0; y < 112; y++) {
+			memcpy(&crops[((size_t)f * 112 + y) * 112 * 3], dsts[f] + (size_t)y * crop_pitch, 112 * 3);
+		}
+	}
+}
+
+static void test_batch_uses_own_transform() {
+	Aligner aligner;
+	const int faces = 4, width = 160, height = 120;
+	std::vector<unsigned char> frames((size_t)faces * height * width * 3);
+	std::vector<float> landmarks(faces * 10);
+	for (int f = 0; f < faces; f++) {
+		/* frame f is filled with grey level 40 + 50 f, and its face sits at
+		 * a different place and scale */
+		memset(&frames[(size_t)f * height * width * 3], 40 + 50 * f, (size_t)height * width * 3);
+		double scale = 0.5 + 0.1 * f, tx = -20.0 + 40.0 * f, ty = 30.0 + 10.0 * f;
+		for (int k = 0; k < 5; k++) {
+			landmarks[f * 10 + 2 * k] = (float)(scale * template_face[k][0] + tx);
+			landmarks[f * 10 + 2 * k + 1] = (float)(scale * template_face[k][1] + ty);
+		}
+	}
+	std::vector<unsigned char> crops;
+	align_batch(aligner, frames, faces, width, height, landmarks.data(), crops);
+	for (int f = 0; f < faces; f++) {
+		const unsigned char * crop = &crops[(size_t)f * 112 * 112 * 3];
+		/* the template centre lies inside frame f */
+		CHECK(crop[(56 * 112 + 56) * 3] == 40 + 50 * f);
+		CHECK(crop[(56 * 112 + 56) * 3 + 2] == 40 + 50 * f);
+	}
+	/* crop corners map to (tx, ty), which is left of frame 0: black */
+	CHECK(crops[0] == 0 && crops[1] == 0 && crops[2] == 0);
+}
+
+static int dump_crops() {
+	Aligner aligner;
+	int header[3];
+	if (fread(header, sizeof(header), 1, stdin) != 1) {
+		return 1;
+	}
+	int faces = header[0], width = header[1], height = header[2];
+	std::vector<unsigned char> frames((size_t)faces * height * width * 3);
+	std::vector<float> landmarks(faces * 10);
+	if (fread(frames.data(), 1, frames.size(), stdin) != frames.size() ||
+			fread(landmarks.data(), sizeof(float), landmarks.size(), stdin) != landmarks.size()) {
+		return 1;
+	}
+	std::vector<unsigned char> crops;
+	align_batch(aligner, frames, faces, width, height, landmarks.data(), crops);
+	return fwrite(crops.data(), 1, crops.size(), stdout) == crops.size() ? 0 : 1;
+}
+
+static int dump_matrices() {
+	Aligner aligner;
+	std::vector<float> landmarks;
+	float face[10];
+	while (fread(face, sizeof(face), 1, stdin) == 1) {
+		landmarks.insert(landmarks.end(), face, face + 10);
+	}
+	int faces = landmarks.size() / 10;
+	std::vector<float> matrices(faces * 6);
+	aligner.AlignFaces(landmarks.data(), faces, matrices.data());
+	return fwrite(matrices.data(), sizeof(float), matrices.size(), stdout) == matrices.size() ? 0 : 1;
+}
+
+int main(int argc, char ** argv) {
+	if (argc > 1 && strcmp(argv[1], "--matrices") == 0) {
+		return dump_matrices();
+	}
+	if (argc > 1 && strcmp(argv[1], "--warp") == 0) {
+		return dump_crops();
+	}
+	test_recovers_template();
+	test_degenerate();
+	test_batch_uses_own_transform();
+	if (failures) {
+		fprintf(stderr, "test_align_functions: %d failures\n", failures);
+		return 1;
+	}
+	printf("test_align_functions: ok\n");
+	return 0;
+}
@@ -0,0 +1,163 @@
+/*
+IoUAssociator on synthetic frames: detections are the face objects
+jittered and shuffled, with missed faces, poorly overlapping and stray
+false positives, up to a few hundred faces per frame; then the per-frame
+cost at crowd sizes.
+Builds without CUDA or DeepStream, see tests/Makefile.
+*/
+#include "face_association.h"
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <random>
+#include <vector>
+
+using association_namespace::IoUAssociator;
+
+#define MIN_IOU 0.5f
+
+static int failures = 0;
+
+#define CHECK(cond) do { \
+	if (!(cond)) { \
+		fprintf(stderr, "%s:%d: CHECK failed: %s\n", __FILE__, __LINE__, #cond); \
+		failures++; \
+	} \
+} while (0)
+
+struct Frame {
+	std::vector<float> obj_boxes;
+	std::vector<float> det_boxes;
+	// index of the detection of every object, -1 when the detector missed it
+	std::vector<int> expected;
+};
+
+/* Faces on a jittered grid of 1920-pixel rows, so neighbours come close but
+ * do not overlap, like a dense crowd. */
+static Frame make_frame(std::mt19937 & rng, int num_faces, float miss_rate, int false_positives) {
+	Frame frame;
+	int cols = 1;
+	while (cols * cols * 16 < num_faces * 9) {
+		cols++;
+	}
+	float cell = 1920.0f / cols;
+	std::uniform_real_distribution<float> unit(0.0f, 1.0f);
+	std::normal_distribution<float> jitter(0.0f, 0.04f);
+	std::vector<std::vector<float>> dets;
+	std::vector<int> det_owner;
+	for (int i = 0; i < num_faces; i++) {
+		float size = cell * (0.5f + 0.3f * unit(rng));
+		float x = (i % cols) * cell + (cell - size) * unit(rng);
+		float y = (i / cols) * cell + (cell - size) * unit(rng);
+		frame.obj_boxes.insert(frame.obj_boxes.end(), {x, y, x + size, y + size});
+		if (unit(rng) < miss_rate) {
+			// sometimes a detection half a face off is all there is (IoU 1/3)
+			if (unit(rng) < 0.5f) {
+				dets.push_back({x + size * 0.5f, y, x + size * 1.5f, y + size});
+				det_owner.push_back(-1);
+			}
+			continue;
+		}
+		// the detector box: a few percent off in every edge
+		dets.push_back({x + size * jitter(rng), y + size * jitter(rng),
+			x + size + size * jitter(rng), y + size + size * jitter(rng)});
+		det_owner.push_back(i);
+	}
+	for (int i = 0; i < false_positives; i++) {
+		// right of the faces, overlapping none of them
+		float x = 2000.0f + 1000.0f * unit(rng), y = 1000.0f * unit(rng);
+		dets.push_back({x, y, x + 40.0f, y + 40.0f});
+		det_owner.push_back(-1);
+	}
+	std::vector<int> order(dets.size());
+	for (size_t i = 0; i < order.size(); i++) {
+		order[i] = (int)i;
+	}
+	std::shuffle(order.begin(), order.end(), rng);
+	frame.expected.assign(num_faces, -1);
+	for (size_t d = 0; d < order.size(); d++) {
+		const std::vector<float> & det = dets[order[d]];
+		frame.det_boxes.insert(frame.det_boxes.end(), det.begin(), det.end());
+		if (det_owner[order[d]] >= 0) {
+			frame.expected[det_owner[order[d]]] = (int)d;
+		}
+	}
+	return frame;
+}
+
+static const std::vector<int> & assign(IoUAssociator & associator, const Frame & frame) {
+	return associator.Assign(frame.det_boxes.data(), (int)frame.det_boxes.size() / 4,
+		frame.obj_boxes.data(), (int)frame.obj_boxes.size() / 4, MIN_IOU);
+}
+
+static void test_edge_cases(IoUAssociator & associator) {
+	float obj[] = {0, 0, 10, 10, 100, 100, 110, 110};
+	float det[] = {100, 100, 110, 110};
+	CHECK(associator.Assign(det, 0, obj, 2, MIN_IOU) == std::vector<int>({-1, -1}));
+	CHECK(associator.Assign(det, 1, obj, 0, MIN_IOU).empty());
+	CHECK(associator.Assign(det, 1, obj, 2, MIN_IOU) == std::vector<int>({-1, 0}));
+	// IoU 0.67 passes, 0.5 is the threshold itself, 0.4 does not
+	float shifted[] = {2, 0, 12, 10};
+	CHECK(associator.Assign(shifted, 1, obj, 1, MIN_IOU)[0] == 0);
+	float half[] = {0, 0, 10, 5};
+	CHECK(associator.Assign(half, 1, obj, 1, MIN_IOU)[0] == 0);
+	float third[] = {0, 0, 10, 4};
+	CHECK(associator.Assign(third, 1, obj, 1, MIN_IOU)[0] == -1);
+	// two objects over one detection: the better overlap takes it
+	float pair[] = {0, 0, 10, 10, 1, 0, 11, 10};
+	float one[] = {1, 0, 11, 10};
+	CHECK(associator.Assign(one, 1, pair, 2, MIN_IOU) == std::vector<int>({-1, 0}));
+	// greedy from the best pair down does not steal a detection
+	float chain_objs[] = {0, 0, 10, 10, 2, 0, 12, 10};
+	float chain_dets[] = {1, 0, 11, 10, 3, 0, 13, 10};
+	CHECK(associator.Assign(chain_dets, 2, chain_objs, 2, MIN_IOU) == std::vector<int>({0, 1}));
+}
+
+static void test_synthetic(IoUAssociator & associator) {
+	std::mt19937 rng(0);
+	int frames = 0, wrong = 0;
+	for (int num_faces : {1, 2, 5, 20, 50, 100, 300}) {
+		for (int round = 0; round < 20; round++) {
+			Frame frame = make_frame(rng, num_faces, 0.1f, num_faces / 5 + 1);
+			const std::vector<int> & got = assign(associator, frame);
+			CHECK(got.size() == frame.expected.size());
+			for (size_t o = 0; o < got.size(); o++) {
+				wrong += got[o] != frame.expected[o];
+			}
+			frames++;
+		}
+	}
+	CHECK(wrong == 0);
+	printf("ok: %d synthetic frames of 1-300 faces, %d objects paired wrongly\n", frames, wrong);
+}
+
+static void benchmark(IoUAssociator & associator) {
+	std::mt19937 rng(1);
+	for (int num_faces : {10, 100, 300, 600}) {
+		std::vector<Frame> frames;
+		for (int i = 0; i < 20; i++) {
+			frames.push_back(make_frame(rng, num_faces, 0.1f, num_faces / 10));
+		}
+		int rounds = std::max(20, 20000 / num_faces);
+		auto start = std::chrono::steady_clock::now();
+		size_t matched = 0;
+		for (int r = 0; r < rounds; r++) {
+			const std::vector<int> & got = assign(associator, frames[r % frames.size()]);
+			matched += got.size();
+		}
+		double us = std::chrono::duration<double, std::micro>(std::chrono::steady_clock::now() - start).count();
+		printf("%4d faces: %8.1f us/frame (%zu objects)\n", num_faces, us / rounds, matched);
+	}
+}
+
+int main() {
+	IoUAssociator associator;
+	test_edge_cases(associator);
+	test_synthetic(associator);
+	if (failures) {
+		fprintf(stderr, "%d checks failed\n", failures);
+		return 1;
+	}
+	benchmark(associator);
+	return 0;
+}
@@ -0,0 +1,129 @@
+/*
+HostBufferPool on plain malloc/free: slab reuse, size class exhaustion,
+invalid releases and leaks, counted through the injected allocator.
+Builds without CUDA or DeepStream, see tests/Makefile.
+*/
+#include "host_buffer_pool.h"
+#include <atomic>
+#include <cstdio>
+#include <cstring>
+#include <thread>
+#include <vector>
+
+using buffer_pool_namespace::HostBuffer;
+using buffer_pool_namespace::HostBufferPool;
+using buffer_pool_namespace::HostBufferPoolStats;
+
+static std::atomic<long> live_blocks(0);
+static std::atomic<long> total_blocks(0);
+static int failures = 0;
+
+#define CHECK(cond) do { \
+	if (!(cond)) { \
+		fprintf(stderr, "%s:%d: CHECK failed: %s\n", __FILE__, __LINE__, #cond); \
+		failures++; \
+	} \
+} while (0)
+
+static void * counting_malloc(size_t size) {
+	live_blocks++;
+	total_blocks++;
+	return malloc(size);
+}
+
+static void counting_free(void * ptr) {
+	live_blocks--;
+	free(ptr);
+}
+
+static void test_reuse() {
+	const size_t frame = 1920 * 1080 * 3, small = 640 * 480 * 3;
+	{
+		HostBufferPool pool(4, counting_malloc, counting_free);
+		// the alignment pattern: two leases of one size per face
+		for (int face = 0; face < 10000; face++) {
+			size_t size = (face % 2) ? frame : small;
+			HostBuffer src(pool, size);
+			HostBuffer dst(pool, size);
+			CHECK(src.data() != NULL && dst.data() != NULL && src.data() != dst.data());
+			memset(dst.data(), face & 0xff, size);
+		}
+		HostBufferPoolStats stats = pool.Stats();
+		CHECK(stats.allocations == 4);
+		CHECK(stats.acquires == 20000);
+		CHECK(stats.reuses == 20000 - 4);
+		CHECK(stats.releases == 20000);
+		CHECK(stats.outstanding == 0);
+		CHECK(stats.exhausted == 0 && stats.invalid_releases == 0);
+		CHECK(stats.bytes == 2 * frame + 2 * small);
+		CHECK(live_blocks == 4);
+	}
+	CHECK(live_blocks == 0);
+}
+
+static void test_exhaustion_and_invalid_releases() {
+	{
+		HostBufferPool pool(2, counting_malloc, counting_free);
+		void * a = pool.Acquire(4096);
+		void * b = pool.Acquire(4096);
+		CHECK(a != NULL && b != NULL);
+		CHECK(pool.Acquire(4096) == NULL);
+		// other size classes are not affected
+		void * c = pool.Acquire(8192);
+		CHECK(c != NULL);
+		int foreign;
+		pool.Release(&foreign);
+		pool.Release(a);
+		pool.Release(a);
+		HostBufferPoolStats stats = pool.Stats();
+		CHECK(stats.exhausted == 1);
+		CHECK(stats.invalid_releases == 2);
+		CHECK(stats.releases == 1);
+		CHECK(stats.outstanding == 2);
+		// the released slab comes back, no new allocation
+		CHECK(pool.Acquire(4096) == a);
+		CHECK(pool.Stats().allocations == 3);
+		// b and c are still leased: the pool frees them anyway
+	}
+	CHECK(live_blocks == 0);
+}
+
+static void test_threads() {
+	{
+		HostBufferPool pool(8, counting_malloc, counting_free);
+		std::vector<std::thread> threads;
+		std::atomic<long> refused(0);
+		for (int t = 0; t < 8; t++) {
+			threads.push_back(std::thread([&pool, &refused, t]() {
+				for (int i = 0; i < 5000; i++) {
+					HostBuffer buffer(pool, 1 << 16);
+					if (buffer.data() == NULL) {
+						refused++;
+						continue;
+					}
+					memset(buffer.data(), t, 64);
+				}
+			}));
+		}
+		for (auto & thread : threads) {
+			thread.join();
+		}
+		HostBufferPoolStats stats = pool.Stats();
+		CHECK(refused == 0);
+		CHECK(stats.allocations <= 8);
+		CHECK(stats.acquires == 40000 && stats.releases == 40000 && stats.outstanding == 0);
+	}
+	CHECK(live_blocks == 0);
+}
+
+int main() {
+	test_reuse();
+	test_exhaustion_and_invalid_releases();
+	test_threads();
+	if (failures) {
+		fprintf(stderr, "%d checks failed\n", failures);
+		return 1;
+	}
+	printf("ok: host buffer pool, %ld blocks allocated in total, none leaked\n", (long)total_blocks);
+	return 0;
+}
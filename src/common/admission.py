@@ -0,0 +1,246 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import time
+from collections import OrderedDict
+
+NOVELTY_BOOST = 4.0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self):
+        return self.tokens >= 1.0
+
+    def take(self):
+        self.tokens -= 1.0
+
+
+class AdmissionScheduler:
+    """Decide which person crops are sent to the face SGIE.
+
+    Admissions are limited by a global GPU budget (inferences/s) and a
+    per-stream budget, both token buckets. Candidates of a frame are ranked
+    by box area, boosted when the track never had an embedding and scaled by
+    the time since it was last admitted. A track is not re-admitted within
+    retry_interval seconds, doubled after every admission that did not
+    yield a face (up to max_backoff), so hopeless crops stop burning GPU
+    time. All membership checks are dict lookups.
+    """
+    def __init__(self, global_rate=30.0, stream_rate=10.0, burst=4, retry_interval=0.75,
+                 max_backoff=8.0, max_tracked=65536, clock=time.monotonic):
+        self.global_rate = global_rate
+        self.stream_rate = stream_rate
+        self.burst = burst
+        self.retry_interval = retry_interval
+        self.max_backoff = max_backoff
+        self.max_tracked = max_tracked
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, burst, clock())
+        self.stream_buckets = {}
+        self.last_admitted = OrderedDict()
+        self.considered = 0
+        self.admitted = 0
+
+    def set_rate(self, global_rate, stream_rate=None):
+        """Change the budgets at runtime, e.g. from the load controller."""
+        self.global_rate = self.global_bucket.rate = global_rate
+        if stream_rate is not None:
+            self.stream_rate = stream_rate
+            for bucket in self.stream_buckets.values():
+                bucket.rate = stream_rate
+
+    def backoff(self, attempts):
+        # attempts is 0 again once a crop yielded a face
+        return min(self.retry_interval * (1 << min(max(attempts - 1, 0), 16)), self.max_backoff)
+
+    def priority(self, width, height, last, attempts, now, has_embedding):
+        if last is None:
+            age = 1.0
+        else:
+            age = min((now - last) / (self.backoff(attempts) * 2), 1.0)
+        boost = 1.0 if has_embedding else NOVELTY_BOOST
+        return width * height * boost * age
+
+    def select(self, stream_id, candidates):
+        """Return the admitted object ids among candidates.
+
+        candidates is an iterable of (object_id, width, height, has_embedding).
+        """
+        now = self.clock()
+        bucket = self.stream_buckets.get(stream_id)
+        if bucket is None:
+            bucket = self.stream_buckets[stream_id] = TokenBucket(self.stream_rate, self.burst, now)
+        bucket.refill(now)
+        self.global_bucket.refill(now)
+        ranked = []
+        for object_id, width, height, has_embedding in candidates:
+            self.considered += 1
+            last, attempts = self.last_admitted.get((stream_id, object_id), (None, 0))
+            if last is not None and now - last < self.backoff(attempts):
+                continue
+            ranked.append((self.priority(width, height, last, attempts, now, has_embedding), object_id))
+        ranked.sort(reverse=True)
+        admitted = set()
+        for _, object_id in ranked:
+            if not (bucket.available() and self.global_bucket.available()):
+                break
+            bucket.take()
+            self.global_bucket.take()
+            key = (stream_id, object_id)
+            _, attempts = self.last_admitted.pop(key, (None, 0))
+            self.last_admitted[key] = (now, attempts + 1)
+            admitted.add(object_id)
+        while len(self.last_admitted) > self.max_tracked:
+            self.last_admitted.popitem(last=False)
+        self.admitted += len(admitted)
+        return admitted
+
+    def completed(self, stream_id, object_id):
+        """The admitted crop yielded a face: reset the track's backoff."""
+        key = (stream_id, object_id)
+        if key in self.last_admitted:
+            self.last_admitted[key] = (self.last_admitted[key][0], 0)
+
+    def forget(self, stream_id, object_id):
+        self.last_admitted.pop((stream_id, object_id), None)
+
+    def remove_stream(self, stream_id):
+        self.stream_buckets.pop(stream_id, None)
+        # called from the main loop while streaming threads admit: iterate a copy
+        for key in [key for key in list(self.last_admitted) if key[0] == stream_id]:
+            self.last_admitted.pop(key, None)
+
+
+class RFacePool:
+    """The original policy: a global list of at most pool_max ids, reset every second."""
+    def __init__(self, pool_max=4, clock=time.monotonic):
+        self.pool = []
+        self.pool_max = pool_max
+        self.clock = clock
+        self.start = clock()
+        self.admitted = 0
+
+    def select(self, stream_id, candidates):
+        now = self.clock()
+        if now - self.start >= 1:
+            self.pool.clear()
+            self.start = now
+        admitted = set()
+        for object_id, _, _, _ in candidates:
+            if object_id not in self.pool and len(self.pool) < self.pool_max:
+                self.pool.append(object_id)
+                admitted.add(object_id)
+        self.admitted += len(admitted)
+        return admitted
+
+    def completed(self, stream_id, object_id):
+        pass
+
+    def forget(self, stream_id, object_id):
+        if object_id in self.pool:
+            self.pool.remove(object_id)
+
+
+if __name__ == '__main__':
+    import random
+
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def simulate(make_policy, streams=8, fps=25.0, seconds=120, hidden=0.0, seed=0):
+        """Tracks arrive per stream, live 2-10 s, and a face is found on an
+        admitted crop with probability growing with box size; a hidden
+        fraction of tracks never shows a face (back to the camera)."""
+        rng = random.Random(seed)
+        clock = FakeClock()
+        policy = make_policy(clock)
+        next_id = 0
+        live = {s: {} for s in range(streams)}
+        total = visible = covered = 0
+        for frame in range(int(seconds * fps)):
+            clock.now = frame / fps
+            for s in range(streams):
+                tracks = live[s]
+                if rng.random() < 0.5 / fps * 4:
+                    face_rate = 0.0 if rng.random() < hidden else 0.8
+                    tracks[next_id] = [clock.now + rng.uniform(2, 10), rng.uniform(30, 300), False, face_rate]
+                    next_id += 1
+                    total += 1
+                    visible += face_rate > 0
+                for object_id in [o for o, t in tracks.items() if t[0] < clock.now]:
+                    covered += tracks.pop(object_id)[2]
+                    policy.forget(s, object_id)
+                candidates = [(o, t[1], t[1] * 2, False) for o, t in tracks.items() if not t[2]]
+                for object_id in policy.select(s, candidates):
+                    track = tracks[object_id]
+                    if rng.random() < min(track[1] / 150.0, 1.0) * track[3]:
+                        track[2] = True
+                        policy.completed(s, object_id)
+        return policy.admitted, covered / max(visible, 1)
+
+    def at_coverage(points, target):
+        """Inferences needed for a coverage, interpolated along a budget sweep."""
+        points = sorted(points, key=lambda p: p[1])
+        for (i0, c0), (i1, c1) in zip(points, points[1:]):
+            if c0 <= target <= c1:
+                return i0 + (i1 - i0) * (target - c0) / max(c1 - c0, 1e-9)
+        return None
+
+    # a crop that yielded a face resets the backoff; the next select() must not fail
+    clock = FakeClock()
+    scheduler = AdmissionScheduler(clock=clock)
+    assert scheduler.select(0, [(1, 100, 200, False)]) == {1}
+    scheduler.completed(0, 1)
+    clock.now = 1.0
+    assert scheduler.select(0, [(1, 100, 200, True)]) == {1}
+
+    # sweep the budgets of both policies and compare the SGIE inferences
+    # each needs for the same coverage (share of trackable people with a face).
+    # When every track shows a face the scheduler needs about 5% fewer
+    # inferences than RFACE_POOL between 0.7 and 0.85 coverage, and its
+    # backoff caps the coverage below RFACE_POOL's at the budgets swept
+    # (0.875 against 0.916; a shorter retry_interval trades inferences for
+    # it). It pays off on tracks that never show a face, which RFACE_POOL
+    # keeps retrying: there it stalls below 0.7 coverage.
+    policies = (("RFACE_POOL", [lambda c, n=n: RFacePool(pool_max=n, clock=c) for n in (4, 8, 12, 16, 20, 24, 32)]),
+                ("scheduler", [lambda c, r=r: AdmissionScheduler(global_rate=r, clock=c)
+                               for r in (4, 8, 12, 16, 20, 25, 30, 40)]),
+                ("scheduler retry 0.5s", [lambda c, r=r: AdmissionScheduler(global_rate=r, retry_interval=0.5, clock=c)
+                                          for r in (4, 8, 12, 16, 20, 25, 30, 40)]))
+    for hidden in (0.0, 0.3):
+        curves = {name: [simulate(make, hidden=hidden) for make in makes] for name, makes in policies}
+        print("%d%% of tracks never show a face" % (hidden * 100))
+        print("  %-8s" % "coverage" + "".join("%24s" % name for name, _ in policies))
+        for target in (0.3, 0.5, 0.7, 0.8, 0.85, 0.9):
+            row = [at_coverage(curves[name], target) for name, _ in policies]
+            print("  %-8.2f" % target + "".join("%24s" % ("-" if i is None else "%d" % i) for i in row))
+        print("  %-8s" % "max" + "".join("%24s" % ("%.3f" % max(c for _, c in curves[name]))
+                                        for name, _ in policies))
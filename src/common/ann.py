@@ -0,0 +1,438 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import numpy as np
+
+from common.tensor_reader import l2_normalize
+
+PQ_CENTROIDS = 256
+# Residual samples the PQ codebooks are trained on, 64 per centroid
+PQ_TRAIN_SAMPLES = 64 * PQ_CENTROIDS
+# PQ candidates scored per search step, bounds the (queries, candidates) temporaries
+SEARCH_CANDIDATES = 1 << 18
+# Storage types of the rerank vectors
+VECTOR_DTYPES = {'float16': np.float16, 'int8': np.int8}
+
+
+def assign(x, centroids, chunk=65536):
+    """Index of the nearest (L2) centroid for every row of x."""
+    c_norms = (centroids * centroids).sum(1)
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        block = x[start:start + chunk]
+        dist = c_norms - 2.0 * (block @ centroids.T)
+        out[start:start + chunk] = dist.argmin(1)
+    return out
+
+
+def assign_subspaces(x, codebooks, chunk=256):
+    """(N, m) index of the nearest codebook entry in each of the m subspaces.
+
+    All subspaces go through one batched matrix multiply per chunk of rows
+    instead of m small ones.
+    """
+    m, ksub, dsub = codebooks.shape
+    c_norms = (codebooks * codebooks).sum(-1)[:, None, :]
+    transposed = np.ascontiguousarray(codebooks.transpose(0, 2, 1))
+    out = np.empty((len(x), m), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        block = x[start:start + chunk].reshape(-1, m, dsub).transpose(1, 0, 2)
+        dist = np.matmul(block, transposed)
+        dist *= -2.0
+        dist += c_norms
+        out[start:start + chunk] = dist.argmin(-1).T
+    return out
+
+
+def kmeans(x, k, n_iter=20, seed=0):
+    """Plain Lloyd k-means; empty clusters are re-seeded from random points."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(n_iter):
+        labels = assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centroids
+
+
+def kmeans_subspaces(x, m, k, n_iter=20, seed=0):
+    """Lloyd k-means run in each of the m subspaces of x at once: (m, k, dim / m)."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    n, dsub = len(x), x.shape[1] // m
+    sub = x.reshape(n, m, dsub)
+    offsets = np.arange(m) * k
+    codebooks = np.stack([sub[rng.choice(n, k, replace=n < k), j] for j in range(m)])
+    for _ in range(n_iter):
+        # cluster c of subspace j is bin j * k + c
+        bins = (assign_subspaces(x, codebooks) + offsets).ravel()
+        counts = np.bincount(bins, minlength=m * k).reshape(m, k)
+        sums = np.stack([np.bincount(bins, weights=sub[..., d].ravel(), minlength=m * k)
+                         for d in range(dsub)], -1).reshape(m, k, dsub)
+        empty = counts == 0
+        codebooks[~empty] = sums[~empty] / counts[~empty][:, None]
+        if empty.any():
+            js, cs = np.nonzero(empty)
+            codebooks[js, cs] = sub[rng.choice(n, len(js)), js]
+    return codebooks
+
+
+class IVFPQIndex:
+    """Inverted-file index with product-quantized residuals (inner product).
+
+    Same add/remove/search interface as FaceGallery. Vectors are assigned to
+    one of nlist coarse centroids and the residual is encoded as m uint8
+    codes. For inner product the per-query lookup table does not depend on
+    the list, so it is built once per query and shared by its probed lists.
+
+    Rows live in flat arrays like FaceGallery's (removal moves the last row
+    into the hole); search reads them through a list-ordered permutation
+    that is rebuilt on the first search after a change. All (query, probed
+    list) pairs of a batch are scored in one vectorized pass.
+
+    The PQ scores only shortlist: the best rerank * k candidates are scored
+    again exactly against the vectors, kept next to the codes as float16
+    (vectors='float16', 2 bytes per dimension) or as int8 with a per-row
+    scale (vectors='int8', 1 byte). vectors=None keeps codes only and
+    search returns the PQ scores whatever rerank is.
+    """
+    def __init__(self, dim=512, nlist=1024, m=64, nprobe=16, rerank=8, vectors='float16', capacity=1024):
+        if dim % m:
+            raise ValueError("dim %d is not divisible by m %d" % (dim, m))
+        if vectors is not None and vectors not in VECTOR_DTYPES:
+            raise ValueError("unknown rerank vectors '%s', expected one of %s or None"
+                             % (vectors, ", ".join(VECTOR_DTYPES)))
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.dsub = dim // m
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.vectors = vectors
+        self.centroids = None
+        self.codebooks = None
+        self.ksub = PQ_CENTROIDS
+        self._code_offsets = (np.arange(m) * PQ_CENTROIDS).astype(np.uint16)
+        self.size = 0
+        self.codes = np.zeros((capacity, m), dtype=np.uint8)
+        self.labels = np.zeros(capacity, dtype=np.int64)
+        self.lists = np.zeros(capacity, dtype=np.int64)
+        self.vector_rows = None if vectors is None else np.zeros((capacity, dim), dtype=VECTOR_DTYPES[vectors])
+        self.vector_scales = np.ones(capacity, dtype=np.float32) if vectors == 'int8' else None
+        self.rows = {}
+        # (rows ordered by list, where each list starts in that order),
+        # published as one tuple so that concurrent searches never see a
+        # new order with the offsets of another
+        self._list_index = None
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, label):
+        return label in self.rows
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def memory_bytes(self):
+        """Bytes per stored vector: codes, label, list and rerank vector."""
+        per_row = self.m + 8 + 8
+        if self.vector_rows is not None:
+            per_row += self.dim * self.vector_rows.itemsize
+        if self.vector_scales is not None:
+            per_row += 4
+        return per_row
+
+    def train(self, samples, n_iter=20):
+        samples = l2_normalize(samples)
+        self.nlist = min(self.nlist, len(samples))
+        self.centroids = kmeans(samples, self.nlist, n_iter)
+        residuals = samples - self.centroids[assign(samples, self.centroids)]
+        if len(residuals) > PQ_TRAIN_SAMPLES:
+            residuals = residuals[np.random.default_rng(0).choice(len(residuals), PQ_TRAIN_SAMPLES, replace=False)]
+        # fewer samples than PQ_CENTROIDS leave the other entries unused
+        self.ksub = min(PQ_CENTROIDS, len(residuals))
+        self.codebooks = np.zeros((self.m, PQ_CENTROIDS, self.dsub), dtype=np.float32)
+        self.codebooks[:, :self.ksub] = kmeans_subspaces(residuals, self.m, self.ksub, n_iter)
+
+    def _reserve(self, capacity):
+        if capacity <= len(self.labels):
+            return
+        capacity = max(capacity, 2 * len(self.labels))
+
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            return grown
+
+        self.codes, self.labels, self.lists = grow(self.codes), grow(self.labels), grow(self.lists)
+        if self.vector_rows is not None:
+            self.vector_rows = grow(self.vector_rows)
+        if self.vector_scales is not None:
+            self.vector_scales = grow(self.vector_scales)
+
+    def _store_vectors(self, rows, embeddings):
+        if self.vectors == 'int8':
+            scales = np.maximum(np.abs(embeddings).max(1), 1e-12) / 127.0
+            self.vector_rows[rows] = np.rint(embeddings / scales[:, None])
+            self.vector_scales[rows] = scales
+        elif self.vector_rows is not None:
+            self.vector_rows[rows] = embeddings
+
+    def add(self, labels, embeddings):
+        if not self.is_trained:
+            raise RuntimeError("IVFPQIndex.train() must be called before add()")
+        labels = np.atleast_1d(np.asarray(labels, dtype=np.int64))
+        embeddings = l2_normalize(np.reshape(embeddings, (len(labels), self.dim)))
+        # a label repeated within the call keeps its last embedding, as in FaceGallery.add
+        _, last = np.unique(labels[::-1], return_index=True)
+        if len(last) < len(labels):
+            keep = np.sort(len(labels) - 1 - last)
+            labels = labels[keep]
+            embeddings = embeddings[keep]
+        lists = assign(embeddings, self.centroids)
+        codes = assign_subspaces(embeddings - self.centroids[lists], self.codebooks[:, :self.ksub])
+        self._reserve(self.size + len(labels))
+        rows = np.empty(len(labels), dtype=np.int64)
+        for i, label in enumerate(labels.tolist()):
+            row = self.rows.get(label)
+            if row is None:
+                row = self.size
+                self.rows[label] = row
+                self.labels[row] = label
+                self.size += 1
+            rows[i] = row
+        self.codes[rows] = codes
+        self.lists[rows] = lists
+        self._store_vectors(rows, embeddings)
+        self._list_index = None
+
+    def remove(self, label):
+        row = self.rows.pop(label, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.codes[row] = self.codes[last]
+            self.lists[row] = self.lists[last]
+            if self.vector_rows is not None:
+                self.vector_rows[row] = self.vector_rows[last]
+            if self.vector_scales is not None:
+                self.vector_scales[row] = self.vector_scales[last]
+            self.labels[row] = self.labels[last]
+            self.rows[int(self.labels[row])] = row
+        self.size = last
+        self._list_index = None
+        return True
+
+    def _list_order(self):
+        list_index = self._list_index
+        if list_index is None:
+            lists = self.lists[:self.size]
+            order = np.argsort(lists, kind='stable')
+            offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+            np.cumsum(np.bincount(lists, minlength=self.nlist), out=offsets[1:])
+            list_index = self._list_index = (order, offsets)
+        return list_index
+
+    def _exact_scores(self, queries, rows):
+        """Scores of queries (Q, dim) against their rows (Q, S) from the rerank vectors."""
+        vectors = self.vector_rows[rows].astype(np.float32)
+        scores = np.matmul(vectors, queries[:, :, None])[..., 0]
+        if self.vector_scales is not None:
+            scores *= self.vector_scales[rows]
+        return scores
+
+    def _search_chunk(self, queries, k, order, offsets):
+        n = len(queries)
+        nprobe = min(self.nprobe, self.nlist)
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        # (n, m * 256) lookup tables: entry j * 256 + c is q_j . codebook_j[c]
+        luts = np.matmul(queries.reshape(n, self.m, self.dsub).transpose(1, 0, 2),
+                         self.codebooks.transpose(0, 2, 1)).transpose(1, 0, 2).reshape(n, -1)
+        # every candidate of every (query, probed list) pair, query-major
+        starts = offsets[probes].ravel()
+        lengths = offsets[probes + 1].ravel() - starts
+        total = int(lengths.sum())
+        labels_out = np.full((n, k), -1, dtype=np.int64)
+        scores_out = np.full((n, k), -np.inf, dtype=np.float32)
+        if total == 0:
+            return labels_out, scores_out
+        pair_first = np.cumsum(lengths) - lengths
+        rows = order[np.arange(total) + np.repeat(starts - pair_first, lengths)]
+        scores = np.repeat(np.take_along_axis(coarse, probes, axis=1).ravel(), lengths)
+        per_query = lengths.reshape(n, nprobe).sum(1)
+        query_first = np.cumsum(per_query) - per_query
+        # code c of subspace j is entry j * 256 + c of a query's lookup table
+        codes = self.codes[rows].astype(np.uint16)
+        codes += self._code_offsets
+        # One gather per query over all its probed lists: its 64 KB table
+        # stays in cache, where a single gather over the tables of the
+        # whole batch is several times slower.
+        for i, (first, count) in enumerate(zip(query_first.tolist(), per_query.tolist())):
+            scores[first:first + count] += np.take(luts[i], codes[first:first + count]).sum(1)
+        # segmented top-k: one padded row of candidates per query
+        query_of = np.repeat(np.arange(n), per_query)
+        column = np.arange(total) - np.repeat(query_first, per_query)
+        width = int(per_query.max())
+        grid_scores = np.full((n, width), -np.inf, dtype=np.float32)
+        grid_rows = np.zeros((n, width), dtype=np.int64)
+        grid_scores[query_of, column] = scores
+        grid_rows[query_of, column] = rows
+        rerank = self.rerank if self.vector_rows is not None else 0
+        short = min(k * rerank if rerank else k, width)
+        if short < width:
+            top = np.argpartition(-grid_scores, short - 1, axis=1)[:, :short]
+            grid_scores = np.take_along_axis(grid_scores, top, axis=1)
+            grid_rows = np.take_along_axis(grid_rows, top, axis=1)
+        valid = np.isfinite(grid_scores)
+        if rerank:
+            grid_scores = np.where(valid, self._exact_scores(queries, grid_rows), -np.inf).astype(np.float32)
+        kk = min(k, grid_scores.shape[1])
+        top = np.argpartition(-grid_scores, kk - 1, axis=1)[:, :kk] if kk < grid_scores.shape[1] else \
+            np.broadcast_to(np.arange(kk), (n, kk))
+        top_scores = np.take_along_axis(grid_scores, top, axis=1)
+        order_k = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order_k, axis=1)
+        top_scores = np.take_along_axis(top_scores, order_k, axis=1)
+        found = np.isfinite(top_scores)
+        labels_out[:, :kk] = np.where(found, self.labels[np.take_along_axis(grid_rows, top, axis=1)], -1)
+        scores_out[:, :kk] = top_scores
+        return labels_out, scores_out
+
+    def search(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, self.size)
+        if k == 0:
+            return (np.full((len(queries), 0), -1, dtype=np.int64),
+                    np.full((len(queries), 0), -np.inf, dtype=np.float32))
+        order, offsets = self._list_order()
+        # queries per step so a step scores about SEARCH_CANDIDATES candidates
+        expected = min(self.nprobe, self.nlist) * self.size / self.nlist
+        step = max(1, int(SEARCH_CANDIDATES // max(expected, 1.0)))
+        results = [self._search_chunk(queries[start:start + step], k, order, offsets)
+                   for start in range(0, len(queries), step)]
+        if len(results) == 1:
+            return results[0]
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+if __name__ == '__main__':
+    import sys
+    import threading
+    import time
+    from common.gallery import FaceGallery
+
+    # usage: python -m common.ann [size] — recall@k and latency vs exact search
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = np.random.default_rng(0)
+    # identities enrolled with 4 embeddings each; a query is a fresh
+    # embedding of an enrolled identity, as far from its enrolled ones as
+    # two faces of one person are (cosine about 0.65), not a copy of a row
+    per_identity = 4
+    sigma = 0.75
+
+    def faces_of(identities):
+        noise = rng.standard_normal((len(identities), 512), dtype=np.float32)
+        return l2_normalize(centres[identities] + sigma * noise / np.sqrt(512))
+
+    centres = l2_normalize(rng.standard_normal((max(size // per_identity, 1), 512), dtype=np.float32))
+    owners = np.arange(size) // per_identity
+    data = faces_of(owners)
+    query_owners = rng.integers(0, len(centres), 256)
+    queries = faces_of(query_owners)
+    labels = np.arange(size)
+
+    exact = FaceGallery(capacity=size)
+    exact.add(labels, data)
+    t0 = time.perf_counter()
+    truth, truth_scores = exact.search(queries, k=10)
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    same = (data[query_owners[:, None] * per_identity + np.arange(per_identity)] * queries[:, None]).sum(-1)
+
+    index = IVFPQIndex(nlist=int(np.sqrt(size)) * 4, m=64)
+    t0 = time.perf_counter()
+    index.train(data[rng.choice(size, min(size, 50000), replace=False)])
+    trained = time.perf_counter()
+    index.add(labels, data)
+    print("ivfpq build: train %.1fs, add %.1fs" % (trained - t0, time.perf_counter() - trained))
+    # same quantizers, rerank vectors stored as int8
+    compact = IVFPQIndex(nlist=index.nlist, m=index.m, vectors='int8')
+    compact.centroids, compact.codebooks, compact.ksub = index.centroids, index.codebooks, index.ksub
+    compact.add(labels, data)
+    # the vectorized ADC must rank the probed rows as their PQ reconstructions do
+    rerank = index.rerank
+    index.rerank, index.nprobe = 0, 4
+    check = queries[:16]
+    found, found_scores = index.search(check, k=5)
+    probed = np.argsort(-(check @ index.centroids.T), axis=1)[:, :4]
+    for query, probes, row_labels, row_scores in zip(check, probed, found, found_scores):
+        rows = np.flatnonzero(np.isin(index.lists[:size], probes))
+        decoded = index.centroids[index.lists[rows]] + index.codebooks[np.arange(index.m), index.codes[rows]].reshape(len(rows), -1)
+        expected = np.sort(decoded @ query)[::-1][:5]
+        assert np.allclose(row_scores, expected, atol=1e-4), (row_scores, expected)
+    index.rerank = rerank
+    # two threads searching right after a change rebuild the list order
+    # concurrently, as the post-probe workers do; neither sees a half-built one
+    expected_labels, _ = index.search(check, k=4)
+    mismatches = []
+
+    def search_after_reset():
+        for _ in range(200):
+            index._list_index = None
+            if not (index.search(check, k=4)[0] == expected_labels).all():
+                mismatches.append(1)
+
+    workers = [threading.Thread(target=search_after_reset) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not mismatches, len(mismatches)
+    flat_bytes = 512 * 4 + 8
+    for name, built in (("float16", index), ("int8", compact)):
+        print("memory per vector, %s rerank vectors: %d bytes, %.0f%% of flat float32 (%d bytes); codes only %d" % (
+            name, built.memory_bytes(), 100.0 * built.memory_bytes() / flat_bytes, flat_bytes, index.m + 16))
+    print("query to own identity cosine %.2f, best other identity %.2f" % (
+        same.mean(), np.mean([max(score for label, score in zip(row, scores) if owners[label] != owner)
+                              for row, owner, scores in zip(truth, query_owners, truth_scores)])))
+    print("exact      : %.3f ms/query identity@1 %.3f" % (exact_ms, np.mean(owners[truth[:, 0]] == query_owners)))
+    for name, built, reranks in (("float16", index, (0, rerank)), ("int8", compact, (rerank,))):
+        for built.rerank in reranks:
+            for nprobe in (1, 4, 16, 64):
+                built.nprobe = nprobe
+                built.search(queries[:8], k=10)
+                t0 = time.perf_counter()
+                found, _ = built.search(queries, k=10)
+                ms = (time.perf_counter() - t0) * 1000 / len(queries)
+                recall1 = np.mean(found[:, 0] == truth[:, 0])
+                # the exact top 4 are the identity's enrolled faces; the rest of
+                # the exact top 10 are unrelated faces at cosine ~0.2, spread over
+                # every list, which no probing finds
+                recall4 = np.mean([len(set(f[:4]) & set(t[:4])) / 4.0 for f, t in zip(found, truth)])
+                recall10 = np.mean([len(set(f) & set(t)) / 10.0 for f, t in zip(found, truth)])
+                print("%-7s rerank %2d nprobe %3d : %.3f ms/query recall@1 %.3f recall@4 %.3f recall@10 %.3f "
+                      "identity@1 %.3f" % (name, built.rerank, nprobe, ms, recall1, recall4, recall10,
+                                           np.mean(owners[found[:, 0]] == query_owners)))
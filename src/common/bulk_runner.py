@@ -0,0 +1,416 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.avi', '.h264', '.h265', '.264', '.265', '.ts', '.webm')
+
+# gst-nvevent.h: GST_EVENT_MAKE_TYPE(402, DOWNSTREAM | SERIALIZED), posted by
+# nvstreammux after the last buffer of a source, with a "source-id" field
+GST_NVEVENT_STREAM_EOS = (402 << 8) | (1 << 1) | (1 << 2)
+
+
+def parse_stream_eos(event):
+    """Stream id of an nvstreammux stream-eos event, None for any other event."""
+    if int(event.type) != GST_NVEVENT_STREAM_EOS:
+        return None
+    found, source_id = event.get_structure().get_uint("source-id")
+    return source_id if found else None
+
+
+def load_manifest(path):
+    """Video files under a directory (sorted, recursive) or listed in a file, one per line."""
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files += [os.path.join(root, name) for name in sorted(names)
+                      if name.lower().endswith(VIDEO_EXTENSIONS)]
+    else:
+        base = os.path.dirname(os.path.abspath(path))
+        with open(path) as f:
+            files = [os.path.join(base, line.strip()) for line in f
+                     if line.strip() and not line.startswith('#')]
+    return [os.path.abspath(name) for name in files]
+
+
+def result_name(path):
+    """Result file of a video: its name plus a hash of the full path, unique across directories."""
+    digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return "{}.{}.jsonl".format(os.path.basename(path), digest)
+
+
+class Checkpoint:
+    """Append-only JSON lines of finished files, fsynced per file."""
+    def __init__(self, path):
+        self.path = path
+        self.finished = {}
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                # torn last line of a crash
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+        for line in data.decode().splitlines():
+            entry = json.loads(line)
+            self.finished[entry['file']] = entry
+
+    def __contains__(self, path):
+        return path in self.finished
+
+    def record(self, entry):
+        self.finished[entry['file']] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Job:
+    __slots__ = ('path', 'stream_id', 'results', 'started', 'first_frame', 'frames', 'objects')
+
+    def __init__(self, path, stream_id, results, started):
+        self.path = path
+        self.stream_id = stream_id
+        self.results = results
+        self.started = started
+        self.first_frame = None
+        self.frames = 0
+        self.objects = 0
+
+
+class BulkRunner:
+    '''
+    Process a list of files with every source slot of a SourceManager busy:
+    a slot whose file ended gets the next file as soon as its bin is gone.
+
+    record_frame() appends a frame's objects to the file's results
+    (<results_dir>/<name>.<hash>.jsonl, written as .part and renamed when
+    complete). stream_finished(), called when nvstreammux signals the end
+    of a source in-band (after its last frame), closes the results, adds
+    the file to the checkpoint and removes the source. Files already in the
+    checkpoint are skipped, so a crashed run resumes where it stopped.
+
+    Source errors fail the file rather than the run: on_error() and
+    on_stream_eos() take the reconnector's place in bus_call. on_done()
+    is called once every file is finished.
+    '''
+    def __init__(self, files, manager, results_dir, checkpoint, on_done=None, clock=time.monotonic):
+        self.manager = manager
+        self.results_dir = results_dir
+        self.checkpoint = checkpoint
+        self.on_done = on_done
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.queue = deque(path for path in files if path not in checkpoint)
+        self.skipped = len(files) - len(self.queue)
+        self.jobs = {}
+        self.done = 0
+        self.failed = 0
+        self.frames = 0
+        # slot idle: from the end of one file to the first frame of the next
+        self.freed_at = {}
+        self.slot_idle = 0.0
+        self.started = None
+        self.first_frame = None
+        os.makedirs(results_dir, exist_ok=True)
+        manager.on_remove.append(self.slot_freed)
+
+    def start(self):
+        self.started = self.clock()
+        for _ in range(self.manager.max_sources):
+            if not self._next():
+                break
+        if not self.jobs:
+            self._finish_run()
+        return self
+
+    def record_frame(self, frame):
+        """Results of one frame (FrameColumns with boxes) leaving inference."""
+        with self.lock:
+            job = self.jobs.get(frame.stream_id)
+            if job is None:
+                return
+            now = self.clock()
+            if job.first_frame is None:
+                job.first_frame = now
+                if self.first_frame is None:
+                    self.first_frame = now
+                freed = self.freed_at.pop(frame.stream_id, None)
+                if freed is not None:
+                    self.slot_idle += now - freed
+            job.frames += 1
+            job.objects += len(frame)
+            self.frames += 1
+            objects = [[component, class_id, object_id] + [round(v, 1) for v in box] + [round(confidence, 3)]
+                       for component, class_id, object_id, box, confidence in zip(
+                           frame.component_ids, frame.class_ids, frame.object_ids, frame.boxes, frame.confidences)]
+            job.results.write(json.dumps({'frame': frame.frame_num, 'pts': frame.frame_meta.buf_pts,
+                                          'objects': objects}) + "\n")
+
+    def job(self, stream_id):
+        """The Job of the file a stream is playing, None between files."""
+        with self.lock:
+            return self.jobs.get(stream_id)
+
+    def record_match(self, job, object_id, identity, score):
+        """A gallery match of a track of job; dropped if that file already finished.
+
+        Faces are matched on worker threads, possibly after the file ended
+        and its stream id went to the next file, so the match is tied to
+        the Job its frame was seen in, not to the stream id.
+        """
+        with self.lock:
+            if job is not None and self.jobs.get(job.stream_id) is job:
+                job.results.write(json.dumps({'match': {'object_id': object_id, 'identity': str(identity),
+                                                        'score': round(float(score), 4)}}) + "\n")
+
+    def stream_finished(self, stream_id):
+        self._end(stream_id, 'done')
+
+    def on_error(self, element, error, debug=None):
+        stream_id = self.manager.find_source(element)
+        if stream_id is None:
+            return False
+        self._end(stream_id, 'failed', str(error))
+        return True
+
+    def on_stream_eos(self, stream_id):
+        # handled in-band by stream_finished
+        return True
+
+    def slot_freed(self, stream_id):
+        with self.lock:
+            self.freed_at[stream_id] = self.clock()
+        if not self._next() and not self.jobs:
+            self._finish_run()
+
+    def _next(self):
+        with self.lock:
+            if not self.queue:
+                return False
+            path = self.queue.popleft()
+        results = open(os.path.join(self.results_dir, result_name(path) + ".part"), 'w')
+        # slot_freed runs on the main loop, where the graph may change right away
+        stream_id = self.manager.add("file://" + path, immediate=True)
+        with self.lock:
+            self.jobs[stream_id] = Job(path, stream_id, results, self.clock())
+        return True
+
+    def _end(self, stream_id, status, error=None):
+        with self.lock:
+            job = self.jobs.pop(stream_id, None)
+            if job is None:
+                return
+            job.results.close()
+            name = os.path.join(self.results_dir, result_name(job.path))
+            entry = {'file': job.path, 'status': status, 'frames': job.frames, 'objects': job.objects,
+                     'seconds': round(self.clock() - job.started, 3), 'time': time.time()}
+            if status == 'done':
+                os.replace(name + ".part", name)
+                entry['results'] = name
+                self.done += 1
+            else:
+                entry['error'] = error
+                self.failed += 1
+            self.checkpoint.record(entry)
+        print("{} {} ({} frames)".format(status, job.path, job.frames))
+        self.manager.remove(stream_id)
+
+    def _finish_run(self):
+        if self.on_done is not None:
+            self.on_done()
+
+    def stats(self):
+        now = self.clock()
+        elapsed = now - self.started if self.started is not None else 0.0
+        startup = self.first_frame - self.started if self.first_frame is not None else None
+        return {
+            'done': self.done,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'remaining': len(self.queue) + len(self.jobs),
+            'frames': self.frames,
+            'elapsed': elapsed,
+            'files_per_hour': self.done / elapsed * 3600 if elapsed else 0.0,
+            'startup': startup,
+            'slot_idle': self.slot_idle,
+        }
+
+    def report(self):
+        stats = self.stats()
+        lines = ["{done} files done, {failed} failed, {skipped} skipped from the checkpoint, {remaining} left".format(**stats),
+                 "{:.1f} files/hour, {:.0f} frames/s over {:.0f} s".format(
+                     stats['files_per_hour'], stats['frames'] / max(stats['elapsed'], 1e-9), stats['elapsed'])]
+        if stats['startup'] is not None:
+            slots = self.manager.max_sources
+            lines.append("GPU idle: {:.1f} s startup to the first frame, source slots idle {:.1f} s between files "
+                         "({:.1%} of {} slots)".format(stats['startup'], stats['slot_idle'],
+                                                       stats['slot_idle'] / max(stats['elapsed'] * slots, 1e-9), slots))
+            lines.append("main.py once per file would pay the startup {} times: {:.1f} h".format(
+                stats['done'], stats['done'] * stats['startup'] / 3600))
+        return "\n".join(lines)
+
+
+def simulate(frames, slots, startup=20.0, batch_cost=0.008, frame_cost=0.004, attach=0.3, refill=True,
+             batch_per_run=None):
+    '''
+    Wall time and GPU-idle time to process files of the given frame counts.
+
+    A batch takes batch_cost + frame_cost per frame in it, so a full batch
+    is cheapest per frame. refill=True is BulkRunner (one startup, a slot
+    gets the next file attach seconds after its file ends); refill=False
+    runs groups of `slots` files to EOS, a new process per group, like
+    main.py with a fixed uri list (slots=1: main.py once per file).
+    '''
+    pending = deque(frames)
+    clock = 0.0
+    idle = 0.0
+    while pending:
+        clock += startup
+        idle += startup
+        remaining = [pending.popleft() for _ in range(min(slots, len(pending)))]
+        ready = [clock] * len(remaining)
+        while any(remaining):
+            active = [i for i, left in enumerate(remaining) if left and ready[i] <= clock]
+            if not active:
+                wake = min(ready[i] for i, left in enumerate(remaining) if left)
+                idle += wake - clock
+                clock = wake
+                continue
+            clock += batch_cost + frame_cost * len(active)
+            for i in active:
+                remaining[i] -= 1
+                if not remaining[i] and refill and pending:
+                    remaining[i] = pending.popleft()
+                    ready[i] = clock + attach
+        if refill:
+            break
+    return clock, idle
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import random
+    import shutil
+    import tempfile
+
+    from common import fake_gst
+    from common.meta_walker import FrameColumns, use_pyds
+    from common import fake_pyds
+    from common.source_manager import SourceManager, use_gst
+
+    # Scheduling and resume against fake sources: 5 files, 2 slots, a
+    # "crash" after 3 files, then a second run on the same checkpoint.
+    use_gst(fake_gst)
+    use_pyds(fake_pyds)
+    work = tempfile.mkdtemp()
+    videos = os.path.join(work, "videos")
+    for index in range(5):
+        os.makedirs(os.path.join(videos, "day%d" % (index % 2)), exist_ok=True)
+        open(os.path.join(videos, "day%d" % (index % 2), "cam%d.mp4" % index), 'w').close()
+    open(os.path.join(videos, "notes.txt"), 'w').close()
+    files = load_manifest(videos)
+    assert len(files) == 5 and files[0].endswith("day0/cam0.mp4")
+
+    def make_manager():
+        pipeline = fake_gst.FakePipeline()
+        streammux = fake_gst.ElementFactory.make("nvstreammux", "Stream-muxer")
+        pipeline.add(streammux)
+        pipeline.state = fake_gst.State.PLAYING
+        return SourceManager(pipeline, streammux, lambda index, uri: fake_gst.FakeBin("source-bin-%02d" % index),
+                             2, schedule=lambda callback, *args: callback(*args))
+
+    def play(runner, stream_id, frames):
+        for n in range(frames):
+            frame_meta = fake_pyds.NvDsFrameMeta(frame_num=n, pad_index=stream_id, buf_pts=n * 40000000, objects=[
+                fake_pyds.NvDsObjectMeta(class_id=0, object_id=7, confidence=0.9,
+                                         rect_params=fake_pyds.NvOSD_RectParams(10, 20, 30, 60))])
+            runner.record_frame(FrameColumns(frame_meta, with_parents=False))
+
+    results = os.path.join(work, "results")
+    checkpoint_path = os.path.join(results, "checkpoint.jsonl")
+    os.makedirs(results)
+    finished = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = make_manager()
+        runner = BulkRunner(files, manager, results, Checkpoint(checkpoint_path),
+                            on_done=lambda: finished.append(True)).start()
+        assert sorted(job.path for job in runner.jobs.values()) == files[:2]
+        play(runner, 0, 10)
+        play(runner, 1, 5)
+        runner.stream_finished(1)           # slot 1 refilled at once
+        assert runner.jobs[1].path == files[2]
+        play(runner, 1, 3)
+        job = runner.job(1)
+        runner.record_match(job, 7, "alice", 0.93)
+        runner.stream_finished(1)
+        assert runner.job(1).path == files[3]
+        # a face of the finished file matched late stays out of the next file's results
+        runner.record_match(job, 7, "bob", 0.91)
+        runner.stream_finished(0)
+        assert sorted(job.path for job in runner.jobs.values()) == files[3:5]
+        play(runner, 0, 4)
+        # crash: files[3] and files[4] are mid-way, their .part files stay
+    assert runner.done == 3 and not finished
+    with open(os.path.join(results, result_name(files[2]))) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 4 and lines[0]['objects'] == [[1, 0, 7, 10.0, 20.0, 30.0, 60.0, 0.9]]
+    assert lines[-1] == {'match': {'object_id': 7, 'identity': 'alice', 'score': 0.93}}
+    with open(os.path.join(results, result_name(files[3]) + ".part")) as f:
+        assert 'bob' not in f.read()
+    with open(checkpoint_path, 'a') as f:
+        f.write('{"file": "torn')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = make_manager()
+        runner = BulkRunner(files, manager, results, Checkpoint(checkpoint_path),
+                            on_done=lambda: finished.append(True)).start()
+        assert runner.skipped == 3 and sorted(job.path for job in runner.jobs.values()) == files[3:5]
+        play(runner, 0, 6)
+        play(runner, 1, 2)
+        # a decode error fails one file, not the run
+        error = fake_gst.FakeMessage(fake_gst.MessageType.ERROR, manager.pipeline.get_by_name("source-bin-01"),
+                                     fake_gst.FakeGError("Internal data stream error."), "")
+        assert runner.on_error(error.src, *error.parse_error())
+        runner.stream_finished(0)
+    assert finished == [True] and len(manager) == 0
+    entries = Checkpoint(checkpoint_path).finished
+    assert [entries[path]['status'] for path in files] == ['done'] * 4 + ['failed']
+    assert entries[files[3]]['frames'] == 6
+    assert sorted(os.listdir(results)) == sorted([result_name(path) for path in files[:4]] +
+                                                 [result_name(files[4]) + ".part", "checkpoint.jsonl"])
+    shutil.rmtree(work)
+
+    # Throughput of the three ways to run an archive: 500 files of 10 s to
+    # 10 min at 25 fps, 20 s pipeline startup (engines, decoders).
+    rng = random.Random(0)
+    archive = [int(rng.uniform(10, 600) * 25) for _ in range(500)]
+    print("{:34} {:>12} {:>10}".format("", "files/hour", "GPU idle"))
+    for name, slots, refill in (("main.py once per file", 1, False),
+                                ("main.py, 8 files per run", 8, False),
+                                ("bulk mode, 8 slots kept full", 8, True)):
+        wall, idle = simulate(archive, slots, refill=refill)
+        print("{:34} {:12.1f} {:9.1%}".format(name, len(archive) / wall * 3600, idle / wall))
@@ -15,11 +15,28 @@
 # limitations under the License.
 ################################################################################
 
-import gi
 import sys
-gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst
-def bus_call(bus, message, loop):
+
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    # common.fake_gst can be installed with use_gst() for CPU-only runs
+    Gst = None
+
+# Error that stopped the main loop, so the app can exit non-zero
+fatal_error = None
+
+
+def use_gst(module):
+    """Swap the Gst implementation used by bus_call (e.g. fake_gst)."""
+    global Gst
+    Gst = module
+
+
+def bus_call(bus, message, loop, reconnector=None):
+    global fatal_error
     t = message.type
     if t == Gst.MessageType.EOS:
         sys.stdout.write("End-of-stream\n")
@@ -30,5 +47,13 @@ def bus_call(bus, message, loop):
     elif t == Gst.MessageType.ERROR:
         err, debug = message.parse_error()
         sys.stderr.write("Error: %s: %s\n" % (err, debug))
-        loop.quit()
+        # errors of a single source bin reconnect that source only
+        if reconnector is None or not reconnector.on_error(message.src, err, debug):
+            fatal_error = err
+            loop.quit()
+    elif t == Gst.MessageType.ELEMENT and reconnector is not None:
+        struct = message.get_structure()
+        if struct is not None and struct.has_name("stream-eos"):
+            # posted by nvstreammux when one of its sources ends
+            reconnector.on_stream_eos(struct.get_value("stream-id"))
     return True
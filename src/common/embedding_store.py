@@ -0,0 +1,411 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import mmap
+import os
+import struct
+import numpy as np
+
+from common.tensor_reader import l2_normalize
+
+# <path>      : 64-byte header + fixed-size embedding rows, zero-filled
+#               beyond the committed ones up to the capacity
+# <path>.ids  : one (label int64, flags int64) record per committed row
+MAGIC = b'FACEEMB1'
+VERSION = 1
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+DTYPE_CODES = {0: np.float32, 1: np.float16}
+ID_DTYPE = np.dtype([('label', '<i8'), ('flags', '<i8')])
+FLAG_DELETED = 1
+SEARCH_CHUNK = 65536
+# Rows the embedding file grows by, so that an append rarely remaps it
+GROW_ROWS = 65536
+
+
+class EmbeddingStore:
+    """Append-only, memory-mapped embedding file usable as a face gallery.
+
+    Every add/remove appends a row (removals append a tombstone); the last
+    record of a label wins. Rows are written before their id record, so the
+    number of committed rows is the length of the id file and a torn append
+    is truncated on the next open. The embedding file is grown GROW_ROWS at
+    a time and only remapped then; the id records and the mask of live rows
+    are kept in memory and updated by each append. compact() rewrites live
+    rows into new files, commits them with a marker file and swaps them in
+    with os.replace.
+    """
+    def __init__(self, path, dim=512, dtype=np.float32, durable=True):
+        self.path = path
+        self.ids_path = path + '.ids'
+        self.durable = durable
+        self._finish_compaction()
+        if os.path.exists(path):
+            self.dim, self.dtype = self._read_header()
+        else:
+            self.dim, self.dtype = dim, np.dtype(dtype)
+            self._write_header(path)
+            open(self.ids_path, 'wb').close()
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self._open()
+
+    def _finish_compaction(self):
+        tmp = self.path + '.compact'
+        if os.path.exists(tmp + '.done'):
+            # both new files were complete when the marker was written:
+            # roll forward whatever was not swapped in yet
+            for src, dst in ((tmp + '.ids', self.ids_path), (tmp, self.path)):
+                if os.path.exists(src):
+                    os.replace(src, dst)
+            os.remove(tmp + '.done')
+        else:
+            # crashed before the commit marker: the old files are untouched
+            for leftover in (tmp, tmp + '.ids'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def _read_header(self):
+        with open(self.path, 'rb') as f:
+            magic, version, dim, code = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an embedding store" % self.path)
+        return dim, np.dtype(DTYPE_CODES[code])
+
+    def _write_header(self, path):
+        code = [c for c, t in DTYPE_CODES.items() if np.dtype(t) == self.dtype][0]
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.dim, code).ljust(HEADER_SIZE, b'\0'))
+            self._sync(f)
+
+    def _sync(self, f):
+        f.flush()
+        if self.durable:
+            os.fsync(f.fileno())
+
+    def _open(self):
+        self._recover()
+        self._ids = np.fromfile(self.ids_path, dtype=ID_DTYPE, count=self.count)
+        self.ids = self._ids
+        self._live = None
+        self._rows = None
+        self._map()
+
+    def _recover(self):
+        # rows past the committed ones are spare capacity, not a torn append
+        rows = (os.path.getsize(self.path) - HEADER_SIZE) // self.row_bytes
+        ids = os.path.getsize(self.ids_path) // ID_DTYPE.itemsize
+        self.count = min(rows, ids)
+        for path, size in ((self.path, HEADER_SIZE + rows * self.row_bytes),
+                           (self.ids_path, self.count * ID_DTYPE.itemsize)):
+            if os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def _map(self):
+        self.capacity = (os.path.getsize(self.path) - HEADER_SIZE) // self.row_bytes
+        self._mmap = None
+        if self.capacity:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped = np.frombuffer(self._mmap, dtype=self.dtype, count=self.capacity * self.dim,
+                                         offset=HEADER_SIZE).reshape(self.capacity, self.dim)
+        else:
+            self._mapped = np.empty((0, self.dim), dtype=self.dtype)
+        self.vectors = self._mapped[:self.count]
+
+    def _release(self, start, stop):
+        """Drop rows [start, stop) from the resident set, they stay in the page cache."""
+        if self._mmap is not None and hasattr(mmap, 'MADV_DONTNEED'):
+            begin = (HEADER_SIZE + start * self.row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_DONTNEED, begin, HEADER_SIZE + stop * self.row_bytes - begin)
+
+    def _live_rows(self):
+        """Mask of the rows holding the latest, non-deleted record of their label."""
+        if self._live is None:
+            labels = self.ids['label'][::-1]
+            _, first = np.unique(labels, return_index=True)
+            latest = self.count - 1 - first
+            latest = latest[(self.ids['flags'][latest] & FLAG_DELETED) == 0]
+            self._live = np.zeros(len(self._ids), dtype=bool)
+            self._live[latest] = True
+            self._size = len(latest)
+        return self._live[:self.count]
+
+    def _index(self):
+        if self._rows is None:
+            live = np.flatnonzero(self._live_rows())
+            self._rows = dict(zip(self.ids['label'][live].tolist(), live.tolist()))
+        return self._rows
+
+    def __len__(self):
+        self._live_rows()
+        return self._size
+
+    def __contains__(self, label):
+        return label in self._index()
+
+    def _append(self, labels, flags, vectors):
+        index = self._index()
+        live = self._live
+        need = self.count + len(labels)
+        remap = need > self.capacity
+        if remap:
+            capacity = -(-need // GROW_ROWS) * GROW_ROWS
+            os.truncate(self.path, HEADER_SIZE + capacity * self.row_bytes)
+        with open(self.path, 'r+b') as f:
+            f.seek(HEADER_SIZE + self.count * self.row_bytes)
+            f.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+            self._sync(f)
+        ids = np.empty(len(labels), dtype=ID_DTYPE)
+        ids['label'] = labels
+        ids['flags'] = flags
+        with open(self.ids_path, 'ab') as f:
+            f.write(ids.tobytes())
+            self._sync(f)
+        if need > len(self._ids):
+            size = max(need, 2 * len(self._ids))
+            grown_ids = np.zeros(size, dtype=ID_DTYPE)
+            grown_ids[:self.count] = self._ids[:self.count]
+            grown_live = np.zeros(size, dtype=bool)
+            grown_live[:self.count] = live[:self.count]
+            self._ids, live = grown_ids, grown_live
+            self._live = live
+        self._ids[self.count:need] = ids
+        self.ids = self._ids[:need]
+        for row, (label, flag) in enumerate(zip(labels.tolist(), flags.tolist()), self.count):
+            previous = index.pop(label, None)
+            if previous is not None:
+                live[previous] = False
+                self._size -= 1
+            if not flag & FLAG_DELETED:
+                index[label] = row
+                live[row] = True
+                self._size += 1
+        self.count = need
+        if remap:
+            self._map()
+        else:
+            self.vectors = self._mapped[:need]
+
+    def add(self, labels, embeddings):
+        labels = np.atleast_1d(np.asarray(labels, dtype=np.int64))
+        embeddings = l2_normalize(np.reshape(embeddings, (len(labels), self.dim)))
+        self._append(labels, np.zeros(len(labels), dtype=np.int64), embeddings)
+
+    def remove(self, label):
+        if label not in self._index():
+            return False
+        self._append(np.array([label], dtype=np.int64), np.array([FLAG_DELETED]),
+                     np.zeros((1, self.dim), dtype=self.dtype))
+        return True
+
+    def get(self, label):
+        return np.asarray(self.vectors[self._index()[label]], dtype=np.float32)
+
+    def search(self, queries, k=1):
+        """Exact top-k cosine search over blocks of SEARCH_CHUNK contiguous rows.
+
+        A block is scored straight from the mapping and released from the
+        resident set afterwards, so memory stays bounded by one block.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        live = self._live_rows()
+        k = min(k, self._size)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, self.count, SEARCH_CHUNK):
+            stop = min(start + SEARCH_CHUNK, self.count)
+            rows = np.flatnonzero(live[start:stop])
+            if not len(rows):
+                continue
+            scores = queries @ np.asarray(self.vectors[start:stop], dtype=np.float32).T
+            self._release(start, stop)
+            if len(rows) < stop - start:
+                scores = scores[:, rows]
+            rows += start
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(queries), len(rows)))], axis=1)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else \
+                np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return self.ids['label'][best_rows], best_scores
+
+    def compact(self):
+        """Rewrite only live rows; safe to interrupt before the final replace."""
+        live = np.flatnonzero(self._live_rows())
+        tmp = self.path + '.compact'
+        self._write_header(tmp)
+        with open(tmp, 'ab') as f:
+            for start in range(0, len(live), SEARCH_CHUNK):
+                f.write(np.ascontiguousarray(self.vectors[live[start:start + SEARCH_CHUNK]]).tobytes())
+            self._sync(f)
+        with open(tmp + '.ids', 'wb') as f:
+            ids = np.zeros(len(live), dtype=ID_DTYPE)
+            ids['label'] = self.ids['label'][live]
+            f.write(ids.tobytes())
+            self._sync(f)
+        # commit marker: from here on a crash is rolled forward by
+        # _finish_compaction() on the next open, before it rolled back
+        with open(tmp + '.done', 'wb') as f:
+            self._sync(f)
+        self.vectors = self._mapped = self._mmap = None
+        os.replace(tmp + '.ids', self.ids_path)
+        os.replace(tmp, self.path)
+        os.remove(tmp + '.done')
+        self._open()
+
+
+def _check_appends(workdir):
+    """The incrementally kept live rows match a reopened store and exact search."""
+    rng = np.random.default_rng(2)
+    path = os.path.join(workdir, 'appends.store')
+    store = EmbeddingStore(path, dim=8, durable=False)
+    expected = {}
+    remaps = 0
+    for step in range(300):
+        labels = rng.integers(0, 400, rng.integers(1, 8))
+        vectors = l2_normalize(rng.standard_normal((len(labels), 8), dtype=np.float32))
+        mapping = store._mapped
+        store.add(labels, vectors)
+        remaps += store._mapped is not mapping
+        expected.update(zip(labels.tolist(), vectors))
+        for label in rng.integers(0, 400, 2).tolist():
+            assert store.remove(label) == (expected.pop(label, None) is not None)
+        if step % 50 == 0:
+            store.search(vectors, k=3)
+    assert remaps == 1, remaps
+    reopened = EmbeddingStore(path, durable=False)
+    queries = rng.standard_normal((16, 8), dtype=np.float32)
+    labels = np.array(sorted(expected))
+    truth = np.argsort(-(queries @ np.array([expected[label] for label in labels]).T), axis=1)[:, :5]
+    for opened in (store, reopened):
+        assert len(opened) == len(expected) and opened._index() == reopened._index()
+        found, _ = opened.search(queries, k=5)
+        assert (found == labels[truth]).all()
+    reopened.compact()
+    assert reopened.count == len(expected) and (reopened.search(queries, k=5)[0] == labels[truth]).all()
+    print("appends keep %d live rows of %d records in one mapping, as reopening finds them"
+          % (len(expected), store.count))
+
+
+def _check_compaction(workdir):
+    """A compaction interrupted at any step loses no identity."""
+    rng = np.random.default_rng(1)
+    path = os.path.join(workdir, 'crash.store')
+    # the crash hits after each sync of compact() or before each of its replaces
+    steps = ('header written', 'vectors written', 'ids written', 'marker written', 'before the ids swap',
+             'before the vectors swap')
+    for crash in range(len(steps)):
+        for leftover in (path, path + '.ids'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        store = EmbeddingStore(path, dim=8, durable=False)
+        store.add(np.arange(100), rng.standard_normal((100, 8), dtype=np.float32))
+        for label in range(0, 100, 3):
+            store.remove(label)
+        expected = {label: store.get(label) for label in range(100) if label in store}
+        calls = []
+        real_replace = os.replace
+        real_sync = store._sync
+
+        def step(*args):
+            calls.append(args)
+            if len(calls) > crash:
+                raise KeyboardInterrupt(steps[crash])
+
+        def sync(f):
+            real_sync(f)
+            step(f)
+
+        def replace(src, dst):
+            step(src)
+            real_replace(src, dst)
+
+        store._sync = sync
+        os.replace = replace
+        try:
+            store.compact()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.replace = real_replace
+        del store
+        reopened = EmbeddingStore(path, durable=False)
+        assert len(reopened) == len(expected), (steps[crash], len(reopened))
+        for label, vector in expected.items():
+            assert np.allclose(reopened.get(label), vector), (steps[crash], label)
+        assert not [name for name in os.listdir(workdir) if '.compact' in name], os.listdir(workdir)
+    print("compaction survives a crash at each step: %s" % ", ".join(steps))
+
+
+if __name__ == '__main__':
+    import shutil
+    import sys
+    import tempfile
+    import time
+
+    def rss_mb():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS'):
+                    return int(line.split()[1]) / 1024.0
+
+    # usage: python -m common.embedding_store [size]
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workdir = tempfile.mkdtemp()
+    try:
+        _check_compaction(workdir)
+        _check_appends(workdir)
+        path = os.path.join(workdir, 'gallery.store')
+        npz = os.path.join(workdir, 'gallery.npz')
+        rng = np.random.default_rng(0)
+        writer = EmbeddingStore(path, durable=False)
+        for start in range(0, size, 100000):
+            n = min(100000, size - start)
+            writer.add(np.arange(start, start + n), rng.standard_normal((n, 512), dtype=np.float32))
+        del writer
+        np.savez(npz, labels=np.arange(size), embeddings=np.memmap(path, dtype=np.float32, mode='r',
+                                                                    offset=HEADER_SIZE, shape=(size, 512)))
+
+        before = rss_mb()
+        t0 = time.perf_counter()
+        store = EmbeddingStore(path)
+        opened = time.perf_counter() - t0
+        print("store open   : %8.1f ms, rss %+.1f MB" % (opened * 1000, rss_mb() - before))
+        t0 = time.perf_counter()
+        store.search(rng.standard_normal((1, 512), dtype=np.float32), k=5)
+        print("first search : %8.1f ms, rss %+.1f MB" % ((time.perf_counter() - t0) * 1000, rss_mb() - before))
+        t0 = time.perf_counter()
+        for label in range(size, size + 100):
+            store.add(label, rng.standard_normal(512, dtype=np.float32))
+        print("add one      : %8.1f ms, fsync'd" % ((time.perf_counter() - t0) * 1000 / 100))
+        t0 = time.perf_counter()
+        store.search(rng.standard_normal((1, 512), dtype=np.float32), k=5)
+        print("next search  : %8.1f ms, rss %+.1f MB" % ((time.perf_counter() - t0) * 1000, rss_mb() - before))
+        del store
+
+        before = rss_mb()
+        t0 = time.perf_counter()
+        data = np.load(npz)
+        embeddings = data['embeddings']
+        print("npz load     : %8.1f ms, rss %+.1f MB" % ((time.perf_counter() - t0) * 1000, rss_mb() - before))
+        del data, embeddings
+    finally:
+        shutil.rmtree(workdir)
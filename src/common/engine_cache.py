@@ -0,0 +1,563 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+'''
+TensorRT engines of the nvinfer stages, one per (model, batch size, GPU,
+precision).
+
+nvinfer serializes an engine it had to build next to the model as
+<model>_b<batch>_gpu<id>_<precision>.engine, but only loads the
+model-engine-file of its config, so a config pinned to _b1_ rebuilds on
+every start once the batch size follows the number of sources. The
+resolver points model-engine-file at the variant for the resolved batch
+size instead, and a manifest (engines.json next to the engines) records
+the model and engine checksums of every variant: an engine whose model
+changed since it was built is moved aside so nvinfer rebuilds it.
+Resolution and the manifest only read files; TensorRT is only needed by
+prebuild, which has nvinfer build the missing variants for a list of
+batch sizes. The <id> of the resolver's variants is the physical GPU
+(see physical_gpu), so workers pinned to different GPUs with
+CUDA_VISIBLE_DEVICES, which all see their GPU as 0, keep apart engines.
+nvinfer still writes what it builds under the gpu-id it was given: a build
+holds a lock on that name (EngineCache.building) and the engine is renamed
+to its variant's path once built (EngineCache.adopt).
+
+    python -m common.engine_cache resolve configs/pipeline_person_face.txt --batch-sizes 1,4,8
+    python -m common.engine_cache prebuild configs/pipeline_person_face.txt --batch-sizes 1,4,8
+    python -m common.engine_cache verify weights
+'''
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+MANIFEST_NAME = "engines.json"
+# nvinfer network-mode
+PRECISIONS = {0: 'fp32', 1: 'int8', 2: 'fp16'}
+# Model keys of an nvinfer config, by precedence
+MODEL_KEYS = ('onnx-file', 'tlt-encoded-model', 'uff-file', 'model-file')
+
+CACHED = 'cached'            # built, recorded and its model unchanged
+MISSING = 'missing'          # nvinfer will build it on start (minutes)
+STALE = 'stale'              # the model changed since the engine was built
+UNRECORDED = 'unrecorded'    # present but not in the manifest
+
+
+def physical_gpu(gpu_id, environ=None):
+    '''
+    The device behind CUDA device gpu_id of this process, as it appears in
+    engine file names: its index among all GPUs, or the leading block of
+    its UUID when CUDA_VISIBLE_DEVICES lists UUIDs (GPU-... or MIG-...).
+    Without CUDA_VISIBLE_DEVICES this is gpu_id itself.
+    '''
+    visible = (os.environ if environ is None else environ).get('CUDA_VISIBLE_DEVICES')
+    if visible is None:
+        return str(gpu_id)
+    devices = [device.strip() for device in visible.split(',') if device.strip()]
+    if gpu_id >= len(devices):
+        return str(gpu_id)
+    device = devices[gpu_id]
+    if device.isdigit():
+        return device
+    # GPU-8f6c1a2b-.... -> GPU-8f6c1a2b
+    return "-".join(device.split("-")[:2])
+
+
+class EngineVariant:
+    '''
+    gpu_id is the CUDA device nvinfer is given (gpu-id), device the
+    physical GPU the engine is built for and named after (default gpu_id).
+    '''
+    __slots__ = ('model', 'batch_size', 'gpu_id', 'precision', 'device')
+
+    def __init__(self, model, batch_size, gpu_id=0, precision='fp32', device=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.gpu_id = gpu_id
+        self.precision = precision
+        self.device = str(gpu_id) if device is None else device
+
+    @property
+    def path(self):
+        return "{}_b{}_gpu{}_{}.engine".format(self.model, self.batch_size, self.device, self.precision)
+
+    @property
+    def built_path(self):
+        '''Where nvinfer serializes the engine it builds: named after gpu_id, not device.'''
+        return "{}_b{}_gpu{}_{}.engine".format(self.model, self.batch_size, self.gpu_id, self.precision)
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.path)
+
+    def __repr__(self):
+        return "EngineVariant({})".format(self.path)
+
+
+def resolve_engine(stage, number_sources):
+    '''
+    Variant of an nvinfer StageSpec for number_sources, None for stages
+    without a model file. Paths in the config are relative to it.
+    '''
+    if stage.type != 'nvinfer' or stage.infer_config is None:
+        return None
+    for key in MODEL_KEYS:
+        if key in stage.infer_config:
+            model = os.path.normpath(os.path.join(os.path.dirname(stage.config_file), stage.infer_config[key]))
+            break
+    else:
+        return None
+    mode = stage.infer_int('network-mode', 0)
+    gpu_id = stage.infer_int('gpu-id', 0)
+    return EngineVariant(model, stage.resolved_batch_size(number_sources), gpu_id,
+                         PRECISIONS.get(mode, 'mode%d' % mode), physical_gpu(gpu_id))
+
+
+def resolve_engines(spec, number_sources):
+    '''{stage name: EngineVariant} of the enabled stages of a PipelineSpec.'''
+    engines = {}
+    for stage in spec.enabled_stages:
+        variant = resolve_engine(stage, number_sources)
+        if variant is not None:
+            engines[stage.name] = variant
+    return engines
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EngineCache:
+    '''
+    Manifests of built engines, one engines.json per engine directory:
+    {"engines": {<engine file name>: {model, model_sha256, batch_size,
+    gpu_id, device, precision, engine_sha256, ...}}}. Checksums are
+    recomputed only when a file's size or mtime differs from the recorded
+    one. Several processes may share a directory: each writes the manifest
+    through its own temporary file, merging the entries it recorded into
+    the latest one on disk.
+    '''
+    def __init__(self, log=sys.stderr.write, checksum=file_sha256):
+        self.log = log
+        self.checksum = checksum
+        self.manifests = {}
+        self.recorded = {}
+        # built_paths nvinfer is building to under building()
+        self.pending = set()
+
+    def _load(self, directory):
+        path = os.path.join(directory, MANIFEST_NAME)
+        if not os.path.isfile(path):
+            return {'engines': {}}
+        with open(path) as f:
+            return json.load(f)
+
+    def manifest(self, directory):
+        if directory not in self.manifests:
+            self.manifests[directory] = self._load(directory)
+        return self.manifests[directory]
+
+    def _save(self, directory):
+        manifest = self._load(directory)
+        engines = self.manifest(directory)['engines']
+        for name in self.recorded.get(directory, ()):
+            manifest['engines'][name] = engines[name]
+        self.manifests[directory] = manifest
+        fd, tmp = tempfile.mkstemp(prefix=MANIFEST_NAME + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, os.path.join(directory, MANIFEST_NAME))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def entry(self, variant):
+        return self.manifest(variant.directory)['engines'].get(variant.name)
+
+    def _digest(self, path, entry, prefix):
+        '''Checksum of path, reusing the one of entry while size and mtime match.'''
+        stat = os.stat(path)
+        if (entry is not None and entry.get(prefix + '_size') == stat.st_size
+                and entry.get(prefix + '_mtime') == stat.st_mtime):
+            return entry[prefix + '_sha256'], stat
+        return self.checksum(path), stat
+
+    def status(self, variant):
+        if not os.path.isfile(variant.path):
+            return MISSING
+        entry = self.entry(variant)
+        if entry is None:
+            return UNRECORDED
+        if os.path.isfile(variant.model) and self._digest(variant.model, entry, 'model')[0] != entry['model_sha256']:
+            return STALE
+        return CACHED
+
+    def prepare(self, variant):
+        '''
+        Make variant.path safe to hand to nvinfer and return it: a stale
+        engine is renamed to .stale (nvinfer then rebuilds it), one built
+        outside the cache is recorded as is.
+        '''
+        status = self.status(variant)
+        if status == STALE:
+            os.replace(variant.path, variant.path + ".stale")
+            self.log("engine {}: model changed since it was built, rebuilding\n".format(variant.path))
+            status = MISSING
+        elif status == UNRECORDED:
+            self.record(variant)
+            status = CACHED
+        if status == MISSING:
+            self.log("engine {}: not built yet, nvinfer will build it (this can take minutes)\n".format(variant.path))
+        return variant.path
+
+    @contextlib.contextmanager
+    def building(self, variants):
+        '''
+        Hold the build locks of the variants that are not built yet while
+        nvinfer builds them: processes on different devices otherwise write
+        the same built_path at once. An engine already at a built_path
+        (that of gpu_id on an unpinned process) is set aside meanwhile.
+        '''
+        missing = [variant for variant in variants if not os.path.isfile(variant.path)]
+        with contextlib.ExitStack() as locks:
+            for path in sorted({variant.built_path for variant in missing}):
+                lock = locks.enter_context(open(path + ".lock", 'a'))
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if any(variant.built_path == path != variant.path for variant in missing):
+                    if os.path.isfile(path):
+                        os.replace(path, path + ".building")
+                    self.pending.add(path)
+                    locks.callback(self._restore, path)
+            yield
+
+    def _restore(self, path):
+        self.pending.discard(path)
+        if os.path.isfile(path + ".building"):
+            os.replace(path + ".building", path)
+
+    def adopt(self, variant):
+        '''
+        Move the engine nvinfer built for variant under building() from its
+        built_path to its path and record it; False if nothing was built.
+        '''
+        if not os.path.isfile(variant.path):
+            if variant.built_path not in self.pending or not os.path.isfile(variant.built_path):
+                return False
+            os.replace(variant.built_path, variant.path)
+        return self.record(variant)
+
+    def record(self, variant):
+        '''Add or refresh the manifest entry of a built engine; False if there is none.'''
+        if not os.path.isfile(variant.path):
+            return False
+        entry = self.entry(variant)
+        engine_sha256, engine_stat = self._digest(variant.path, entry, 'engine')
+        model_sha256, model_stat = self._digest(variant.model, entry, 'model') \
+            if os.path.isfile(variant.model) else (None, None)
+        if (entry is not None and entry['engine_sha256'] == engine_sha256
+                and entry['model_sha256'] == model_sha256):
+            return True
+        self.manifest(variant.directory)['engines'][variant.name] = {
+            'model': os.path.basename(variant.model),
+            'model_sha256': model_sha256,
+            'model_size': model_stat.st_size if model_stat else None,
+            'model_mtime': model_stat.st_mtime if model_stat else None,
+            'batch_size': variant.batch_size,
+            'gpu_id': variant.gpu_id,
+            'device': variant.device,
+            'precision': variant.precision,
+            'engine_sha256': engine_sha256,
+            'engine_size': engine_stat.st_size,
+            'engine_mtime': engine_stat.st_mtime,
+            'recorded': time.time(),
+        }
+        self.recorded.setdefault(variant.directory, set()).add(variant.name)
+        self._save(variant.directory)
+        return True
+
+    def verify(self, directory):
+        '''Problems with the engines recorded in directory: missing files and checksum mismatches.'''
+        problems = []
+        for name, entry in sorted(self.manifest(directory)['engines'].items()):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                problems.append("{}: missing".format(name))
+                continue
+            if self.checksum(path) != entry['engine_sha256']:
+                problems.append("{}: engine checksum mismatch".format(name))
+            model = os.path.join(directory, entry['model'])
+            if entry['model_sha256'] and os.path.isfile(model) and self.checksum(model) != entry['model_sha256']:
+                problems.append("{}: built from an older {}".format(name, entry['model']))
+        return problems
+
+
+def prebuild_launch(config_file, variant, width=640, height=480):
+    '''
+    gst-launch description of a one-buffer pipeline in which nvinfer builds
+    and serializes variant from config_file.
+    '''
+    return ("videotestsrc num-buffers=1 ! nvvideoconvert ! video/x-raw(memory:NVMM),format=NV12,width={w},height={h} "
+            "! mux.sink_0 nvstreammux name=mux batch-size={b} width={w} height={h} "
+            "! nvinfer config-file-path={config} batch-size={b} gpu-id={gpu} model-engine-file={engine} "
+            "! fakesink").format(w=width, h=height, b=variant.batch_size, gpu=variant.gpu_id,
+                                 config=os.path.abspath(config_file), engine=os.path.abspath(variant.path))
+
+
+def run_launch(description):
+    '''Run a gst-launch description to EOS; returns an error message or None.'''
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+
+    Gst.init(None)
+    pipeline = Gst.parse_launch(description)
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        error, debug = message.parse_error()
+        return "{} ({})".format(error.message, debug)
+    return None
+
+
+def prebuild(spec, batch_sizes, cache, run=run_launch, log=sys.stderr.write):
+    '''
+    Have nvinfer build every engine variant the stages of spec need for
+    each muxer batch size that is not cached yet. Returns (built, failed)
+    lists of engine paths.
+    '''
+    stages = {stage.name: stage for stage in spec.enabled_stages}
+    variants = {}
+    for number_sources in batch_sizes:
+        for name, variant in resolve_engines(spec, number_sources).items():
+            variants.setdefault(variant.path, (stages[name], variant))
+    built = []
+    failed = []
+    for path, (stage, variant) in sorted(variants.items()):
+        cache.prepare(variant)
+        if os.path.isfile(path):
+            continue
+        log("building {} for [{}]\n".format(path, stage.name))
+        started = time.monotonic()
+        with cache.building([variant]):
+            error = run(prebuild_launch(stage.config_file, variant))
+            adopted = error is None and cache.adopt(variant)
+        if adopted:
+            log("built {} in {:.0f}s\n".format(path, time.monotonic() - started))
+            built.append(path)
+        else:
+            log("failed to build {}: {}\n".format(path, error or "no engine written"))
+            failed.append(path)
+    return built, failed
+
+
+def _check():
+    import re
+    import shutil
+    import tempfile
+
+    from common.pipeline_builder import load_pipeline_spec
+
+    root = tempfile.mkdtemp()
+    # the paths below are those of a process that sees every GPU
+    visible = os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+    try:
+        configs = os.path.join(root, "configs")
+        weights = os.path.join(root, "weights")
+        os.makedirs(configs)
+        os.makedirs(weights)
+        for name, data in (("det.onnx", b"detector v1"), ("emb.onnx", b"embedder v1")):
+            with open(os.path.join(weights, name), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(configs, "det.txt"), 'w') as f:
+            f.write("[property]\ngie-unique-id=1\nonnx-file=../weights/det.onnx\n"
+                    "model-engine-file=../weights/det.onnx_b1_gpu0_fp32.engine\nbatch-size=1\nnetwork-mode=2\n")
+        with open(os.path.join(configs, "emb.txt"), 'w') as f:
+            f.write("[property]\ngie-unique-id=2\nonnx-file=../weights/emb.onnx\nbatch-size=4\ngpu-id=1\n"
+                    "process-mode=2\noperate-on-gie-id=1\n")
+        spec_path = os.path.join(configs, "pipeline.txt")
+        with open(spec_path, 'w') as f:
+            f.write("[pipeline]\nstages=pgie;sgie\n[pgie]\nconfig-file={}\nbatch-size=0\n"
+                    "[sgie]\nconfig-file={}\n".format(os.path.join(configs, "det.txt"), os.path.join(configs, "emb.txt")))
+        spec = load_pipeline_spec(spec_path)
+
+        # full-frame stages follow the sources, object stages keep their batch
+        engines = resolve_engines(spec, 6)
+        assert engines['pgie'].path == os.path.join(weights, "det.onnx_b6_gpu0_fp16.engine"), engines
+        assert engines['sgie'].path == os.path.join(weights, "emb.onnx_b4_gpu1_fp32.engine"), engines
+        assert resolve_engines(spec, 1)['pgie'].name == "det.onnx_b1_gpu0_fp16.engine"
+
+        hashed = []
+
+        def checksum(path):
+            hashed.append(os.path.basename(path))
+            return file_sha256(path)
+
+        logs = []
+        cache = EngineCache(log=logs.append, checksum=checksum)
+        pgie = engines['pgie']
+        assert cache.status(pgie) == MISSING and cache.prepare(pgie) == pgie.path
+        assert "not built yet" in logs[-1]
+
+        # prebuild 1, 2 and 6 sources: three detector variants, one embedder
+        launches = []
+
+        def fake_run(description):
+            # nvinfer loads model-engine-file, but serializes a build under
+            # the gpu-id it runs on
+            launches.append(description)
+            engine = description.split("model-engine-file=")[1].split()[0]
+            gpu_id = description.split("gpu-id=")[1].split()[0]
+            engine = re.sub(r"_gpu[^_]+_(\w+)\.engine$", r"_gpu{}_\1.engine".format(gpu_id), engine)
+            with open(engine, 'wb') as f:
+                f.write(b"engine for " + engine.encode())
+            return None
+
+        built, failed = prebuild(spec, [1, 2, 6], cache, run=fake_run, log=logs.append)
+        assert len(built) == 4 and not failed, (built, failed)
+        assert all("nvinfer config-file-path=" in launch and "batch-size=" in launch for launch in launches)
+        assert "batch-size=6" in launches[sorted(built).index(pgie.path)]
+        assert prebuild(spec, [1, 2, 6], cache, run=fake_run, log=logs.append) == ([], [])
+        assert len(launches) == 4
+        with open(os.path.join(weights, MANIFEST_NAME)) as f:
+            manifest = json.load(f)['engines']
+        assert manifest[pgie.name]['batch_size'] == 6 and manifest[pgie.name]['precision'] == 'fp16'
+        assert manifest[pgie.name]['model_sha256'] == file_sha256(pgie.model)
+        assert EngineCache().status(pgie) == CACHED
+
+        # nothing is rehashed while files keep their size and mtime
+        del hashed[:]
+        fresh = EngineCache(log=logs.append, checksum=checksum)
+        for variant in engines.values():
+            assert fresh.status(variant) == CACHED and fresh.prepare(variant) == variant.path
+        assert hashed == [], hashed
+
+        # a new model makes its engines stale: moved aside, rebuilt by nvinfer
+        with open(pgie.model, 'wb') as f:
+            f.write(b"detector v2")
+        assert fresh.status(pgie) == STALE
+        fresh.prepare(pgie)
+        assert not os.path.exists(pgie.path) and os.path.exists(pgie.path + ".stale")
+        assert fresh.status(engines['sgie']) == CACHED
+        assert fresh.verify(weights) == ["det.onnx_b1_gpu0_fp16.engine: built from an older det.onnx",
+                                         "det.onnx_b2_gpu0_fp16.engine: built from an older det.onnx",
+                                         "det.onnx_b6_gpu0_fp16.engine: missing"], fresh.verify(weights)
+        fake_run(prebuild_launch(spec.stages[0].config_file, pgie))
+        assert fresh.adopt(pgie) and fresh.status(pgie) == CACHED
+
+        # engines built outside the cache are adopted, tampering is found
+        adopted = EngineVariant(os.path.join(weights, "emb.onnx"), 8, 1, 'fp32')
+        fake_run("model-engine-file={} gpu-id=1".format(adopted.path))
+        assert fresh.status(adopted) == UNRECORDED and fresh.prepare(adopted) == adopted.path
+        assert fresh.status(adopted) == CACHED
+        with open(adopted.path, 'ab') as f:
+            f.write(b"!")
+        assert "emb.onnx_b8_gpu1_fp32.engine: engine checksum mismatch" in fresh.verify(weights)
+
+        # workers pinned by CUDA_VISIBLE_DEVICES all run on their device 0:
+        # engines are named after the physical GPU, nvinfer still gets gpu-id 0
+        assert physical_gpu(1, {}) == "1" and physical_gpu(0, {'CUDA_VISIBLE_DEVICES': "2,3"}) == "2"
+        assert physical_gpu(1, {'CUDA_VISIBLE_DEVICES': "2,3"}) == "3"
+        assert physical_gpu(0, {'CUDA_VISIBLE_DEVICES': "GPU-8f6c1a2b-4e5d-11ee-be56-0242ac120002"}) == "GPU-8f6c1a2b"
+        workers = []
+        for gpu in ("2", "3"):
+            os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+            workers.append(resolve_engines(spec, 6)['pgie'])
+        del os.environ['CUDA_VISIBLE_DEVICES']
+        assert [variant.name for variant in workers] == ["det.onnx_b6_gpu2_fp16.engine", "det.onnx_b6_gpu3_fp16.engine"]
+        assert all("gpu-id=0 " in prebuild_launch(spec.stages[0].config_file, variant) for variant in workers)
+        assert {variant.built_path for variant in workers} == {os.path.join(weights, "det.onnx_b6_gpu0_fp16.engine")}
+
+        # two processes recording into one directory keep each other's
+        # entries; each renames the _gpu0_ engine it built to its device
+        first, second = EngineCache(log=logs.append), EngineCache(log=logs.append)
+        first.manifest(weights), second.manifest(weights)
+        for cache, variant in zip((first, second), workers):
+            assert not cache.adopt(variant)
+            with cache.building([variant]):
+                fake_run(prebuild_launch(spec.stages[0].config_file, variant))
+                assert cache.adopt(variant)
+            assert cache.status(variant) == CACHED
+        # the unpinned process's own _gpu0_ engine was set aside meanwhile
+        assert EngineCache().status(resolve_engines(spec, 6)['pgie']) == CACHED
+        assert not [name for name in os.listdir(weights) if name.endswith(".building")]
+        recorded = EngineCache().manifest(weights)['engines']
+        assert all(variant.name in recorded for variant in workers)
+        assert recorded[workers[1].name]['device'] == "3" and recorded[workers[1].name]['gpu_id'] == 0
+        assert [name for name in os.listdir(weights) if name.endswith(".tmp")] == []
+    finally:
+        shutil.rmtree(root)
+        if visible is not None:
+            os.environ['CUDA_VISIBLE_DEVICES'] = visible
+    print("ok: engine paths, prebuild, manifest checksums, stale detection and per-GPU variants")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from common.pipeline_builder import PipelineSpecError, load_pipeline_spec
+
+    if len(sys.argv) == 1:
+        _check()
+        sys.exit(0)
+    parser = argparse.ArgumentParser(prog="python -m common.engine_cache")
+    commands = parser.add_subparsers(dest='command')
+    for command in ('resolve', 'prebuild'):
+        sub = commands.add_parser(command)
+        sub.add_argument('spec', help="pipeline spec, e.g. configs/pipeline_person_face.txt")
+        sub.add_argument('--batch-sizes', default='1',
+                         help="comma separated numbers of sources (muxer batch sizes) (default: %(default)s)")
+    sub = commands.add_parser('verify')
+    sub.add_argument('directory', help="directory of the engines and their " + MANIFEST_NAME)
+    options = parser.parse_args()
+
+    cache = EngineCache()
+    if options.command == 'verify':
+        problems = cache.verify(options.directory)
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    try:
+        spec = load_pipeline_spec(options.spec)
+    except PipelineSpecError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    batch_sizes = [int(value) for value in options.batch_sizes.split(',')]
+    if options.command == 'resolve':
+        for number_sources in batch_sizes:
+            for name, variant in resolve_engines(spec, number_sources).items():
+                print("{} sources [{}] {} {}".format(number_sources, name, variant.path, cache.status(variant)))
+        sys.exit(0)
+    built, failed = prebuild(spec, batch_sizes, cache)
+    print("built {}, failed {}".format(len(built), len(failed)))
+    sys.exit(1 if failed else 0)
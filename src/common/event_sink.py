@@ -0,0 +1,578 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from common.metrics import Histogram
+
+# Event types
+TRACK_STARTED = 1
+FACE_CAPTURED = 2
+IDENTITY_MATCHED = 3
+TRACK_ENDED = 4
+EVENT_NAMES = {TRACK_STARTED: 'track_started', FACE_CAPTURED: 'face_captured',
+               IDENTITY_MATCHED: 'identity_matched', TRACK_ENDED: 'track_ended'}
+# What value and label mean for each type, in JSON
+VALUE_FIELDS = {FACE_CAPTURED: 'quality', IDENTITY_MATCHED: 'score', TRACK_ENDED: 'frames'}
+LABEL_FIELDS = {IDENTITY_MATCHED: 'identity'}
+
+# An event is a tuple (type, time, stream_id, object_id, frame, value, label),
+# stored column by column in the binary format
+COLUMNS = (('type', '<u1'), ('time', '<f8'), ('stream_id', '<u4'), ('object_id', '<u8'),
+           ('frame', '<i8'), ('value', '<f4'), ('label', '<i8'))
+# <file>  : header, then blocks of a BLOCK header and one array per column
+MAGIC = b'FACEEVT1'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+BLOCK = struct.Struct('<4sI')
+BLOCK_MAGIC = b'EVTB'
+
+
+def event_dict(event):
+    kind, when, stream_id, object_id, frame, value, label = event
+    record = {'event': EVENT_NAMES.get(kind, kind), 'time': when, 'stream_id': stream_id,
+              'object_id': object_id, 'frame': frame}
+    if kind in VALUE_FIELDS:
+        record[VALUE_FIELDS[kind]] = round(float(value), 4)
+    if kind in LABEL_FIELDS:
+        record[LABEL_FIELDS[kind]] = label
+    return record
+
+
+def encode_json_lines(events):
+    return "".join(json.dumps(event_dict(event)) + "\n" for event in events).encode()
+
+
+def encode_columns(events):
+    """One binary block of events."""
+    columns = list(zip(*events))
+    parts = [BLOCK.pack(BLOCK_MAGIC, len(events))]
+    for (_, dtype), values in zip(COLUMNS, columns):
+        parts.append(np.asarray(values, dtype=dtype).tobytes())
+    return b"".join(parts)
+
+
+def read_columns(path):
+    """{column: array} of all complete blocks of a binary event file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s: not an event file" % path)
+    row_bytes = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+    chunks = {name: [] for name, _ in COLUMNS}
+    offset = HEADER.size
+    while offset + BLOCK.size <= len(data):
+        magic, count = BLOCK.unpack_from(data, offset)
+        end = offset + BLOCK.size + count * row_bytes
+        if magic != BLOCK_MAGIC or end > len(data):
+            # torn last block
+            break
+        offset += BLOCK.size
+        for name, dtype in COLUMNS:
+            chunks[name].append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += count * np.dtype(dtype).itemsize
+    return {name: np.concatenate(chunks[name]) if chunks[name] else np.empty(0, dtype=dtype)
+            for name, dtype in COLUMNS}
+
+
+class RotatingFile:
+    """Append-only files <prefix>-NNNNNN<suffix> in directory, rotated by size and age.
+
+    A file is closed and the next one started when it reaches max_bytes or
+    is max_seconds old (0 disables either); only the newest keep files are
+    left (0 keeps all). Numbering continues after existing files.
+    """
+    def __init__(self, directory, prefix, suffix, header=b'', max_bytes=64 << 20, max_seconds=3600.0, keep=0,
+                 clock=time.monotonic):
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+        self.header = header
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+        numbers = [number for number, _ in self.files()]
+        self.number = max(numbers) if numbers else 0
+        self.file = None
+        self.opened = 0.0
+        self.size = 0
+
+    def files(self):
+        """[(number, path)] of this rotation, oldest first."""
+        files = []
+        for name in os.listdir(self.directory):
+            number = name[len(self.prefix) + 1:-len(self.suffix)]
+            if name.startswith(self.prefix + "-") and name.endswith(self.suffix) and number.isdigit():
+                files.append((int(number), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "%s-%06d%s" % (self.prefix, self.number, self.suffix))
+
+    def write(self, data):
+        now = self.clock()
+        if self.file is not None and ((self.max_bytes and self.size >= self.max_bytes) or
+                                      (self.max_seconds and now - self.opened >= self.max_seconds)):
+            self.close()
+        if self.file is None:
+            self._open(now)
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def _open(self, now):
+        self.number += 1
+        self.file = open(self.path, 'wb')
+        self.file.write(self.header)
+        self.opened = now
+        self.size = len(self.header)
+        if self.keep:
+            for _, path in self.files()[:-self.keep]:
+                os.remove(path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class JsonLinesTransport:
+    """Rotating JSON lines files, one object per event."""
+    def __init__(self, directory, prefix='events', **rotation):
+        self.files = RotatingFile(directory, prefix, '.jsonl', **rotation)
+
+    def write(self, events):
+        self.files.write(encode_json_lines(events))
+
+    def close(self):
+        self.files.close()
+
+
+class ColumnarTransport:
+    """Rotating binary files, a block of columns per batch (see read_columns)."""
+    def __init__(self, directory, prefix='events', **rotation):
+        self.files = RotatingFile(directory, prefix, '.evt', header=HEADER.pack(MAGIC, VERSION, len(COLUMNS)),
+                                  **rotation)
+
+    def write(self, events):
+        self.files.write(encode_columns(events))
+
+    def close(self):
+        self.files.close()
+
+
+class StreamTransport:
+    """JSON lines to a text stream, stdout by default."""
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, events):
+        stream = self.stream or sys.stdout
+        stream.write(encode_json_lines(events).decode())
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """JSON lines over a Unix stream socket.
+
+    The connection is made on the first batch and again after a failure.
+    A batch has send_timeout seconds to go out; a peer that does not read
+    it in time is disconnected. After a failure the next attempt waits
+    retry_interval seconds, doubled on each further failure up to
+    max_retry_interval. Batches written while there is no connection raise
+    OSError at once and are counted as dropped by the sink, so a slow peer
+    costs at most one send_timeout per retry instead of holding the queue.
+    """
+    def __init__(self, path, timeout=1.0, send_timeout=0.25, retry_interval=1.0, max_retry_interval=30.0,
+                 clock=time.monotonic):
+        self.path = path
+        self.timeout = timeout
+        self.send_timeout = send_timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.clock = clock
+        self.sock = None
+        self.next_attempt = 0.0
+        self.backoff = retry_interval
+        self.timeouts = 0
+        self.skipped = 0
+
+    def _failed(self):
+        self.close()
+        self.next_attempt = self.clock() + self.backoff
+        self.backoff = min(2 * self.backoff, self.max_retry_interval)
+
+    def write(self, events):
+        if self.sock is None:
+            if self.clock() < self.next_attempt:
+                self.skipped += 1
+                raise OSError("%s: not connected" % self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                self._failed()
+                raise
+            self.sock = sock
+        # the timeout bounds the whole sendall, not each chunk
+        self.sock.settimeout(self.send_timeout)
+        try:
+            self.sock.sendall(encode_json_lines(events))
+        except socket.timeout:
+            self.timeouts += 1
+            self._failed()
+            raise
+        except OSError:
+            self._failed()
+            raise
+        self.backoff = self.retry_interval
+
+    def stats(self):
+        return {'send_timeouts': self.timeouts, 'skipped_batches': self.skipped}
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class EventReceiver:
+    """Unix socket server collecting the events of SocketTransports, e.g. for tests."""
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.cond = threading.Condition()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(4)
+        threading.Thread(target=self._accept, name="event-receiver", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        with conn, conn.makefile('rb') as stream:
+            for line in stream:
+                if not line.endswith(b'\n'):
+                    # the sender gave up on this batch mid-line
+                    break
+                with self.cond:
+                    self.events.append(json.loads(line))
+                    self.cond.notify_all()
+
+    def wait(self, count, timeout=5.0):
+        """True once count events arrived."""
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.events) >= count, timeout)
+
+    def close(self):
+        self.server.close()
+        os.remove(self.path)
+
+
+def open_transport(spec):
+    """Transport for stdout, jsonl:DIR, columnar:DIR or socket:PATH."""
+    kind, _, target = spec.partition(':')
+    if kind == 'stdout' and not target:
+        return StreamTransport()
+    if kind in ('jsonl', 'columnar', 'socket') and target:
+        return {'jsonl': JsonLinesTransport, 'columnar': ColumnarTransport, 'socket': SocketTransport}[kind](target)
+    raise ValueError("unknown event sink %r (stdout, jsonl:DIR, columnar:DIR or socket:PATH)" % spec)
+
+
+class EventSink:
+    """Buffer recognition events and hand them to a transport in batches.
+
+    emit() only appends a tuple under a lock, so it is safe to call from
+    pad probes and worker threads. A daemon thread writes the buffer when
+    batch_size events are waiting or every flush_interval seconds. Beyond
+    capacity buffered events (a stalled transport) new events are dropped,
+    as are the batches the transport fails to write. max_delay is for
+    transports whose reader may fall behind (socket): batches whose oldest
+    event waited longer than that by the time their turn comes are dropped
+    too (counted in expired as well); without it nothing is dropped for its
+    age. The age of the oldest event of every batch when its write
+    completes goes into flush_latency (buckets), flush_max and the mean.
+    """
+    def __init__(self, transport, batch_size=512, flush_interval=0.5, capacity=65536, max_delay=None,
+                 clock=time.time):
+        self.transport = transport
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.max_delay = max_delay
+        self.clock = clock
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.flush_latency = Histogram()
+        self.flush_max = 0.0
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.expired = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+        self.thread.start()
+        return self
+
+    def emit(self, kind, stream_id, object_id, frame, value=0.0, label=-1):
+        """Queue one event; False when it was dropped."""
+        event = (kind, self.clock(), stream_id, object_id, frame, value, label)
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                return False
+            self.buffer.append(event)
+            self.emitted += 1
+            full = len(self.buffer) == self.batch_size
+        if full:
+            self.wakeup.set()
+        return True
+
+    def flush(self):
+        """Write everything buffered so far."""
+        with self.flush_lock:
+            with self.lock:
+                events, self.buffer = self.buffer, []
+            for start in range(0, len(events), self.batch_size):
+                batch = events[start:start + self.batch_size]
+                if self.max_delay is not None and self.clock() - batch[0][1] > self.max_delay:
+                    self.expired += len(batch)
+                    self.dropped += len(batch)
+                    continue
+                try:
+                    self.transport.write(batch)
+                except OSError as e:
+                    self.errors += 1
+                    self.dropped += len(batch)
+                    if self.errors == 1:
+                        sys.stderr.write("event sink: %s\n" % e)
+                    continue
+                self.written += len(batch)
+                self.batches += 1
+                age = self.clock() - batch[0][1]
+                self.flush_latency.observe(age)
+                self.flush_max = max(self.flush_max, age)
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        self.transport.close()
+
+    def stats(self):
+        stats = {'emitted': self.emitted, 'written': self.written, 'dropped': self.dropped,
+                 'expired': self.expired, 'batches': self.batches, 'pending': len(self.buffer),
+                 'flush_p50': self.flush_latency.quantile(0.5), 'flush_p99': self.flush_latency.quantile(0.99),
+                 'flush_mean': self.flush_latency.sum / max(self.flush_latency.count, 1), 'flush_max': self.flush_max}
+        if hasattr(self.transport, 'stats'):
+            stats.update(self.transport.stats())
+        return stats
+
+
+if __name__ == '__main__':
+    import contextlib
+    import glob
+    import io
+    import random
+    import shutil
+    import tempfile
+
+    def synthetic(count, seed=0):
+        rng = random.Random(seed)
+        kinds = (TRACK_STARTED, FACE_CAPTURED, FACE_CAPTURED, FACE_CAPTURED, IDENTITY_MATCHED, TRACK_ENDED)
+        return [(rng.choice(kinds), rng.randrange(64), rng.randrange(1 << 20), n, rng.random(), rng.randrange(1000))
+                for n in range(count)]
+
+    root = tempfile.mkdtemp()
+    try:
+        # JSON lines: rotation by size and keep
+        sink = EventSink(JsonLinesTransport(os.path.join(root, "jsonl"), max_bytes=20000), batch_size=100)
+        for event in synthetic(2000):
+            sink.emit(*event)
+        sink.stop()
+        paths = sorted(glob.glob(os.path.join(root, "jsonl", "events-*.jsonl")))
+        assert len(paths) > 5, paths
+        lines = [json.loads(line) for path in paths for line in open(path)]
+        json_bytes = sum(os.path.getsize(path) for path in paths) / 2000.0
+        assert [line['frame'] for line in lines] == list(range(2000))
+        assert set(line['event'] for line in lines) == set(EVENT_NAMES.values())
+        assert all('identity' in line and 'score' in line for line in lines if line['event'] == 'identity_matched')
+        files = RotatingFile(os.path.join(root, "jsonl"), 'events', '.jsonl', max_bytes=1, keep=3)
+        for _ in range(5):
+            files.write(b"{}\n")
+        files.close()
+        assert len(files.files()) == 3 and files.files()[-1][0] == len(paths) + 5
+
+        # binary columns: round trip, torn last block ignored
+        events = synthetic(1000)
+        sink = EventSink(ColumnarTransport(os.path.join(root, "evt")), batch_size=300)
+        for event in events:
+            sink.emit(*event)
+        sink.stop()
+        path, = glob.glob(os.path.join(root, "evt", "*.evt"))
+        with open(path, 'ab') as f:
+            f.write(encode_columns([event[:1] + (0.0,) + event[1:] for event in events[:10]])[:-7])
+        columns = read_columns(path)
+        assert columns['frame'].tolist() == list(range(1000))
+        assert columns['label'].tolist() == [event[5] for event in events]
+        assert np.allclose(columns['value'], [event[4] for event in events])
+        binary_bytes = (os.path.getsize(path) - HEADER.size) / 1000.0
+
+        # socket: the receiver starts late, nothing is written before it
+        address = os.path.join(root, "events.sock")
+        transport = SocketTransport(address, retry_interval=0.05, max_retry_interval=0.05)
+        sink = EventSink(transport, batch_size=100, flush_interval=0.02).start()
+        with contextlib.redirect_stderr(io.StringIO()) as log:
+            for event in synthetic(50):
+                sink.emit(*event)
+            time.sleep(0.1)
+        assert "No such file" in log.getvalue()
+        assert sink.stats()['dropped'] == 50, sink.stats()
+        receiver = EventReceiver(address)
+        time.sleep(0.1)
+        for event in synthetic(500, seed=1):
+            sink.emit(*event)
+        assert receiver.wait(500), len(receiver.events)
+        sink.stop()
+        assert [event['frame'] for event in receiver.events] == list(range(500))
+        receiver.close()
+
+        # socket: a peer that accepts but never reads costs one send_timeout,
+        # then batches are dropped during the backoff instead of queueing
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.bind(address)
+        stalled.listen(4)
+        transport = SocketTransport(address, send_timeout=0.1, retry_interval=0.2)
+        sink = EventSink(transport, batch_size=1024, flush_interval=0.05, max_delay=0.5).start()
+        with contextlib.redirect_stderr(io.StringIO()):
+            for start in range(0, 100000, 5000):
+                for event in synthetic(5000):
+                    sink.emit(*event)
+                time.sleep(0.05)
+            t0 = time.perf_counter()
+            sink.stop()
+        stalled_stats = sink.stats()
+        assert time.perf_counter() - t0 < 0.5 and stalled_stats['send_timeouts'] >= 2, stalled_stats
+        assert stalled_stats['written'] + stalled_stats['dropped'] == 100000, stalled_stats
+        assert stalled_stats['skipped_batches'] > 0, stalled_stats
+        stalled.close()
+        os.remove(address)
+
+        # Firehose: 4 producer threads emitting as fast as they can; the socket
+        # sink drops what its reader cannot take within max_delay
+        results = []
+        for name, make in (('jsonl', lambda: JsonLinesTransport(os.path.join(root, "fh-jsonl"))),
+                           ('columnar', lambda: ColumnarTransport(os.path.join(root, "fh-evt"))),
+                           ('socket', lambda: SocketTransport(address))):
+            receiver = EventReceiver(address) if name == 'socket' else None
+            sink = EventSink(make(), batch_size=1024, flush_interval=0.05, capacity=1 << 22,
+                             max_delay=0.5 if receiver else None).start()
+            producers = 4
+            per_producer = 50000
+            batch = synthetic(per_producer)
+            emit_seconds = []
+
+            def produce():
+                emit = sink.emit
+                t0 = time.perf_counter()
+                for event in batch:
+                    emit(*event)
+                emit_seconds.append(time.perf_counter() - t0)
+
+            threads = [threading.Thread(target=produce) for _ in range(producers)]
+            t0 = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            sink.stop()
+            elapsed = time.perf_counter() - t0
+            stats = sink.stats()
+            total = producers * per_producer
+            assert stats['written'] == total - stats['expired'] and stats['dropped'] == stats['expired'], stats
+            if receiver is None:
+                assert stats['dropped'] == 0, stats
+            else:
+                assert receiver.wait(stats['written'], timeout=30)
+                # a batch starts at most max_delay old and has send_timeout to go out
+                assert stats['flush_max'] <= 0.5 + 0.25 + 0.1, stats
+                receiver.close()
+            results.append((name, stats['written'], total, elapsed, sum(emit_seconds) / total * 1e6, stats))
+
+        # Flush latency at a steady 5000 events/s: bounded by flush_interval
+        sink = EventSink(ColumnarTransport(os.path.join(root, "steady")), batch_size=1024, flush_interval=0.05).start()
+        for event in synthetic(5000):
+            sink.emit(*event)
+            time.sleep(0.0002)
+        sink.stop()
+        steady = sink.stats()
+        assert steady['flush_p99'] <= 0.1, steady
+    finally:
+        shutil.rmtree(root)
+
+    # flush times are the measured mean and max age of a batch when written;
+    # the p99 column is the upper bound of its histogram bucket
+    for name, written, total, elapsed, emit_us, stats in results:
+        print("{:9s} {:9.0f} events/s delivered, {:6d} of {} dropped, emit {:.2f} us/event, "
+              "flush mean {:.3f}s max {:.3f}s, p99 <= {}s".format(
+                  name, written / elapsed, total - written, total, emit_us, stats['flush_mean'], stats['flush_max'],
+                  stats['flush_p99']))
+    print("stalled socket peer: {send_timeouts} send timeouts, {skipped_batches} batches skipped in backoff, "
+          "{dropped} of 100000 events dropped, {written} delivered with flush max {flush_max:.3f}s".format(
+              **stalled_stats))
+    print("ok: {:.1f} bytes/event binary vs {:.1f} JSON; steady 5k events/s: flush mean {:.3f}s max {:.3f}s".format(
+        binary_bytes, json_bytes, steady['flush_mean'], steady['flush_max']))
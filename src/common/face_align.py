@@ -0,0 +1,290 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import numpy as np
+
+ALIGNED_FACE_SIZE = 112
+
+# arcface_src from insightface face_align.py, standard_face in
+# plugins/gst-nvinfer/align_functions.cpp
+ARCFACE_TEMPLATE = np.array([[38.2946, 51.6963],
+                             [73.5318, 51.5014],
+                             [56.0252, 71.7366],
+                             [41.5493, 92.3655],
+                             [70.7299, 92.2041]], dtype=np.float32)
+
+
+def similarity_transforms(landmarks, template=ARCFACE_TEMPLATE):
+    """(N, K, 2) landmarks -> (N, 2, 3) float32 similarity transforms onto template.
+
+    Umeyama's least-squares similarity in its 2D closed form: with demeaned
+    points as complex numbers, scale * rotation = sum(conj(src) * dst) /
+    sum(|src|^2). Same arithmetic and order as Aligner::AlignFaces in
+    align_functions.cpp (double accumulation, float32 result).
+    """
+    src = np.asarray(landmarks, dtype=np.float32).astype(np.float64)
+    if src.ndim == 2:
+        src = src[None]
+    dst = np.asarray(template, dtype=np.float32).astype(np.float64)
+    src_mean = src.sum(axis=1) / src.shape[1]
+    dst_mean = dst.sum(axis=0) / dst.shape[0]
+    s = src - src_mean[:, None]
+    d = dst - dst_mean
+    sx, sy = s[..., 0], s[..., 1]
+    dx, dy = d[:, 0], d[:, 1]
+    var = (sx * sx + sy * sy).sum(axis=1)
+    a = (sx * dx + sy * dy).sum(axis=1)
+    b = (sx * dy - sy * dx).sum(axis=1)
+    # all landmarks on one point: translation only
+    degenerate = var < 1e-12
+    a = np.where(degenerate, 1.0, a / np.where(degenerate, 1.0, var))
+    b = np.where(degenerate, 0.0, b / np.where(degenerate, 1.0, var))
+    matrices = np.empty((len(src), 2, 3), dtype=np.float32)
+    matrices[:, 0, 0] = a
+    matrices[:, 0, 1] = -b
+    matrices[:, 0, 2] = dst_mean[0] - (a * src_mean[:, 0] - b * src_mean[:, 1])
+    matrices[:, 1, 0] = b
+    matrices[:, 1, 1] = a
+    matrices[:, 1, 2] = dst_mean[1] - (b * src_mean[:, 0] + a * src_mean[:, 1])
+    return matrices
+
+
+def invert_affine(matrices):
+    """Inverse of (N, 2, 3) affine transforms."""
+    matrices = np.asarray(matrices, dtype=np.float64)
+    linear = np.linalg.inv(matrices[:, :, :2])
+    inverse = np.empty_like(matrices)
+    inverse[:, :, :2] = linear
+    inverse[:, :, 2] = -np.einsum('nij,nj->ni', linear, matrices[:, :, 2])
+    return inverse
+
+
+class FaceAligner:
+    """Batched 5-point alignment into a reusable (capacity, 112, 112, 3) buffer.
+
+    warp() behaves like cv2.warpAffine(frame, M, (112, 112)) with bilinear
+    interpolation and a black border, for every face at once: the output
+    grid is mapped back through the inverse transforms and the four
+    neighbours are gathered from the flattened, zero-padded frames. Faces
+    are processed in chunks of `chunk` so the temporaries stay small.
+    """
+    def __init__(self, capacity=64, size=ALIGNED_FACE_SIZE, template=ARCFACE_TEMPLATE, chunk=8):
+        self.size = size
+        self.template = np.asarray(template, dtype=np.float32) * (size / float(ALIGNED_FACE_SIZE))
+        self.chunk = chunk
+        self.buffer = np.zeros((capacity, size, size, 3), dtype=np.uint8)
+        ys, xs = np.mgrid[0:size, 0:size]
+        # homogeneous output pixel grid, (3, size * size)
+        self.grid = np.stack([xs.ravel(), ys.ravel(), np.ones(size * size)]).astype(np.float32)
+        self._padded = None
+
+    def reserve(self, count):
+        if count > len(self.buffer):
+            self.buffer = np.zeros((max(count, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype=np.uint8)
+
+    def transforms(self, landmarks):
+        return similarity_transforms(landmarks, self.template)
+
+    def padded(self, frames):
+        """Copy frames into a reused buffer with a 1-pixel black border, so
+        the four neighbours of every in-frame sample are in bounds."""
+        num_frames, height, width, channels = frames.shape
+        shape = (num_frames, height + 2, width + 2, channels)
+        if self._padded is None or self._padded.shape != shape:
+            self._padded = np.zeros(shape, dtype=np.uint8)
+        self._padded[:, 1:-1, 1:-1] = frames
+        return self._padded
+
+    def warp(self, frames, matrices, frame_index=None):
+        """Warp faces out of frames; returns a view of the first N buffer rows.
+
+        frames is one (H, W, 3) uint8 frame or an (F, H, W, 3) batch, in which
+        case frame_index gives the frame of every face. The view is
+        overwritten by the next call.
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 3:
+            frames = frames[None]
+        num_frames, height, width, channels = frames.shape
+        count = len(matrices)
+        if frame_index is None:
+            frame_index = np.zeros(count, dtype=np.int64)
+        frame_index = np.asarray(frame_index, dtype=np.int64)
+        self.reserve(count)
+        out = self.buffer[:count]
+        pixels = self.padded(frames).reshape(-1, channels)
+        stride = width + 2
+        inverse = invert_affine(matrices).astype(np.float32)
+        for start in range(0, count, self.chunk):
+            stop = min(start + self.chunk, count)
+            # source coordinates of every output pixel, (n, 2, size * size)
+            coords = inverse[start:stop] @ self.grid
+            x, y = coords[:, 0], coords[:, 1]
+            x0 = np.floor(x)
+            y0 = np.floor(y)
+            fx = x - x0
+            fy = y - y0
+            # samples with no in-frame neighbour read the black corner
+            outside = (x <= -1) | (x >= width) | (y <= -1) | (y >= height)
+            x0[outside] = -1
+            y0[outside] = -1
+            fx[outside] = 0
+            fy[outside] = 0
+            fx = fx[..., None]
+            fy = fy[..., None]
+            # np.take is several times faster than fancy indexing for row gathers
+            top_left = (frame_index[start:stop, None] * (height + 2) * stride
+                        + (y0.astype(np.int64) + 1) * stride + (x0.astype(np.int64) + 1))
+            p00 = np.take(pixels, top_left, axis=0).astype(np.float32)
+            p01 = np.take(pixels, top_left + 1, axis=0).astype(np.float32)
+            p10 = np.take(pixels, top_left + stride, axis=0).astype(np.float32)
+            p11 = np.take(pixels, top_left + stride + 1, axis=0).astype(np.float32)
+            p00 += (p01 - p00) * fx
+            p10 += (p11 - p10) * fx
+            p00 += (p10 - p00) * fy
+            np.rint(p00, out=p00)
+            np.clip(p00, 0, 255, out=p00)
+            out[start:stop] = p00.reshape(stop - start, self.size, self.size, channels)
+        return out
+
+    def align(self, frames, landmarks, frame_index=None):
+        """Transforms and crops in one go: ((N, 112, 112, 3) view, (N, 2, 3) matrices)."""
+        matrices = self.transforms(landmarks)
+        return self.warp(frames, matrices, frame_index), matrices
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    # usage: python -m common.face_align [faces] [--cpp tests/test_align_functions]
+    args = sys.argv[1:]
+    cpp = None
+    if '--cpp' in args:
+        cpp = args.pop(args.index('--cpp') + 1)
+        args.remove('--cpp')
+    faces = int(args[0]) if args else 256
+    rng = np.random.default_rng(0)
+
+    def legacy_similar_transform(src, dst):
+        # Aligner::Impl::SimilarTransform as it was before the batched
+        # version (cv::SVD returns vt, which the C++ code named V). Its
+        # rotation is Vt * D * U rather than Umeyama's U * D * Vt; the two
+        # agree when the SVD factors are proper rotations, which is the
+        # convention forced here. cv::SVD makes no such promise.
+        src = src.astype(np.float32)
+        dst = dst.astype(np.float32)
+        num, dim = src.shape
+        src_mean, dst_mean = src.mean(0), dst.mean(0)
+        src_demean, dst_demean = src - src_mean, dst - dst_mean
+        A = dst_demean.T @ src_demean / num
+        d = np.ones(dim, dtype=np.float32)
+        if np.linalg.det(A) < 0:
+            d[-1] = -1
+        U, S, V = np.linalg.svd(A)
+        if np.linalg.det(U) < 0:
+            U[:, -1] *= -1
+            V[-1] *= -1
+        T = np.eye(3, dtype=np.float32)
+        T[:2, :2] = -U.T @ np.diag(d) @ V.T
+        scale = (d * S).sum() / (src_demean ** 2).mean(0).sum()
+        T[:2, :2] = -T[:2, :2].T
+        T[:2, 2] = dst_mean - scale * T[:2, :2] @ src_mean
+        T[:2, :2] *= scale
+        return T[:2]
+
+    # landmarks: the template rotated, scaled, moved into a 1920x1080 frame
+    # and jittered like a detector would
+    angles = rng.uniform(-0.8, 0.8, faces)
+    scales = rng.uniform(0.3, 2.5, faces)
+    rotations = scales[:, None, None] * np.stack([np.stack([np.cos(angles), -np.sin(angles)], -1),
+                                                  np.stack([np.sin(angles), np.cos(angles)], -1)], 1)
+    landmarks = ((ARCFACE_TEMPLATE - 56.0) @ rotations.transpose(0, 2, 1)
+                 + rng.uniform([100, 100], [1800, 980], (faces, 1, 2))
+                 + rng.normal(0, 1.5, (faces, 5, 2))).astype(np.float32)
+
+    matrices = similarity_transforms(landmarks)
+    legacy = np.stack([legacy_similar_transform(lmk, ARCFACE_TEMPLATE) for lmk in landmarks])
+    linear_error = np.abs(matrices[:, :, :2] - legacy[:, :, :2]).max()
+    shift_error = (np.abs(matrices[:, :, 2] - legacy[:, :, 2]) / np.maximum(np.abs(legacy[:, :, 2]), 1)).max()
+    print("vs per-face SimilarTransform: max |dR| %.2e, max relative |dt| %.2e" % (linear_error, shift_error))
+    # independent check: solve [a, -b, tx; b, a, ty] by linear least squares
+    worst = 0.0
+    for lmk, M in zip(landmarks.astype(np.float64), matrices):
+        rows = np.zeros((10, 4))
+        rows[0::2] = np.c_[lmk[:, 0], -lmk[:, 1], np.ones(5), np.zeros(5)]
+        rows[1::2] = np.c_[lmk[:, 1], lmk[:, 0], np.zeros(5), np.ones(5)]
+        a, b, tx, ty = np.linalg.lstsq(rows, ARCFACE_TEMPLATE.astype(np.float64).ravel(), rcond=None)[0]
+        worst = max(worst, np.abs(np.array([[a, -b, tx], [b, a, ty]]) - M).max() / max(abs(tx), abs(ty), 1))
+    print("vs least squares: max relative error %.2e" % worst)
+    if cpp:
+        import subprocess
+        # Aligner::AlignFaces in the plugin must give the very same floats
+        out = subprocess.run([cpp, '--matrices'], input=landmarks.tobytes(), stdout=subprocess.PIPE, check=True).stdout
+        native = np.frombuffer(out, dtype=np.float32).reshape(matrices.shape)
+        mismatched = (native != matrices).any(axis=(1, 2)).sum()
+        print("vs Aligner::AlignFaces: %d of %d faces differ" % (mismatched, faces))
+        assert mismatched == 0
+        # the plugin's aligned batch: crop i from surface i with its own
+        # transform, on noise frames so any mix-up shows
+        batch, crop_height, crop_width = 4, 240, 320
+        surfaces = rng.integers(0, 256, (batch, crop_height, crop_width, 3), dtype=np.uint8)
+        centres = rng.uniform([100, 80], [220, 160], (batch, 1, 2))
+        crop_landmarks = ((ARCFACE_TEMPLATE - 56.0) @ rotations[:batch].transpose(0, 2, 1) * 0.5
+                          + centres).astype(np.float32)
+        header = np.array([batch, crop_width, crop_height], dtype=np.int32)
+        out = subprocess.run([cpp, '--warp'], input=header.tobytes() + surfaces.tobytes() + crop_landmarks.tobytes(),
+                             stdout=subprocess.PIPE, check=True).stdout
+        native = np.frombuffer(out, dtype=np.uint8).reshape(batch, ALIGNED_FACE_SIZE, ALIGNED_FACE_SIZE, 3)
+        reference, _ = FaceAligner(capacity=batch).align(surfaces, crop_landmarks, np.arange(batch))
+        diff = np.abs(native.astype(np.int16) - reference.astype(np.int16)).reshape(batch, -1)
+        print("vs Aligner::WarpFaces, batch of %d: max |d| per crop %s, %d of %d values differ"
+              % (batch, diff.max(axis=1).tolist(), (diff > 0).sum(), diff.size))
+        # float rounding may flip a value sitting on .5 by one level
+        assert diff.max() <= 1 and (diff > 0).mean() < 1e-3
+
+    # warp check: bilinear interpolation of a linear ramp is exact, so every
+    # in-frame output pixel must hold the ramp at its source coordinates
+    height, width = 1080, 1920
+    ys, xs = np.mgrid[0:height, 0:width]
+    frame = np.stack([xs * 255 // (width - 1), ys * 255 // (height - 1), np.full_like(xs, 128)], -1).astype(np.uint8)
+    ramp = np.stack([xs * 255.0 / (width - 1), ys * 255.0 / (height - 1)], -1)
+    aligner = FaceAligner(capacity=faces)
+    crops = aligner.warp(frame, matrices)
+    inverse = invert_affine(matrices)
+    grid = aligner.grid.astype(np.float64)
+    source = inverse @ grid
+    inside = (source[:, 0] >= 0) & (source[:, 0] <= width - 1) & (source[:, 1] >= 0) & (source[:, 1] <= height - 1)
+    expected = np.stack([source[:, 0] * 255.0 / (width - 1), source[:, 1] * 255.0 / (height - 1)], -1)
+    got = crops.reshape(faces, -1, 3)[..., :2].astype(np.float64)
+    # the frame itself is quantized (// 255), hence up to 1 level either way
+    error = np.abs(got - expected)[inside].max()
+    print("warp vs analytic ramp: max error %.2f levels over %d pixels" % (error, inside.sum()))
+    # the per-face version works in float32, so its translations are only good to ~1e-4
+    assert linear_error < 1e-4 and shift_error < 1e-4 and worst < 1e-5 and error <= 2.0
+
+    for name, run in (("transforms, per face", lambda: [similarity_transforms(lmk) for lmk in landmarks]),
+                      ("transforms, batched", lambda: similarity_transforms(landmarks)),
+                      ("warp, per face", lambda: [aligner.warp(frame, matrices[i:i + 1]) for i in range(faces)]),
+                      ("warp, batched", lambda: aligner.warp(frame, matrices))):
+        run()
+        t0 = time.perf_counter()
+        rounds = 5
+        for _ in range(rounds):
+            run()
+        elapsed = (time.perf_counter() - t0) / rounds
+        print("%-22s %10.0f faces/s" % (name, faces / elapsed))
@@ -0,0 +1,222 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import numpy as np
+
+from common.tensor_reader import l2_normalize
+
+# Face side (pixels) from which the embedding stops improving with size
+FULL_QUALITY_SIZE = 112.0
+# Input of the face detector on person crops (FACENET_WIDTH/HEIGHT in
+# plugins/gst-nvinfer/extractor.h) and its output layers
+DETECTOR_INPUT_SIZE = (160, 320)
+NUM_DETECTIONS_LAYER, BOXES_LAYER, LANDMARKS_LAYER = 0, 1, 4
+# Minimum IoU between a face object and a detection to take its landmarks
+# (FACE_MATCH_MIN_IOU in gstnvinfer.cpp)
+LANDMARK_MIN_IOU = 0.5
+
+
+def pose_score(landmarks):
+    """Frontalness in [0, 1] from 5 landmarks (eyes, nose, mouth corners).
+
+    A frontal face has the nose on the vertical line between the eyes and
+    the mouth corners; yaw moves the nose towards one side.
+    """
+    lmk = np.asarray(landmarks, dtype=np.float32).reshape(5, 2)
+    eye_dist = np.linalg.norm(lmk[1] - lmk[0])
+    if eye_dist < 1e-6:
+        return 0.0
+    centre_x = (lmk[0, 0] + lmk[1, 0] + lmk[3, 0] + lmk[4, 0]) / 4.0
+    yaw = abs(lmk[2, 0] - centre_x) / eye_dist
+    return float(max(0.0, 1.0 - 2.0 * yaw))
+
+
+def detector_landmarks(num_detections, boxes, landmarks, parent_box, input_size=DETECTOR_INPUT_SIZE):
+    """(N, 4) boxes (left, top, right, bottom) and (N, 5, 2) landmarks in
+    frame coordinates from the raw outputs of the face detector on the
+    person crop at parent_box (left, top, width, height).
+
+    The crop was resized keeping its aspect ratio (padding right/bottom),
+    as in add_landmark_detections() of gstnvinfer.cpp.
+    """
+    left, top, width, height = parent_box
+    n = int(num_detections)
+    if n <= 0 or width <= 0 or height <= 0:
+        return np.empty((0, 4), dtype=np.float32), np.empty((0, 5, 2), dtype=np.float32)
+    scale = min(input_size[0] / width, input_size[1] / height)
+    offset = np.array([left, top], dtype=np.float32)
+    boxes = np.asarray(boxes[:n * 4], dtype=np.float32).reshape(n, 2, 2) / scale + offset
+    landmarks = np.asarray(landmarks[:n * 10], dtype=np.float32).reshape(n, 5, 2) / scale + offset
+    return boxes.reshape(n, 4), landmarks
+
+
+def match_landmarks(face_box, boxes, landmarks, min_iou=LANDMARK_MIN_IOU):
+    """Landmarks of the detection overlapping face_box (left, top, width,
+    height) the most, None if none reaches min_iou."""
+    if not len(boxes):
+        return None
+    left, top, width, height = face_box
+    ix = np.minimum(boxes[:, 2], left + width) - np.maximum(boxes[:, 0], left)
+    iy = np.minimum(boxes[:, 3], top + height) - np.maximum(boxes[:, 1], top)
+    inter = np.clip(ix, 0, None) * np.clip(iy, 0, None)
+    union = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) + width * height - inter
+    iou = inter / np.maximum(union, 1e-6)
+    best = int(np.argmax(iou))
+    return landmarks[best] if iou[best] >= min_iou else None
+
+
+def face_quality(width, height, confidence=1.0, landmarks=None):
+    """Quality of a face crop in [0, 1]: size x detector confidence x pose."""
+    size = min(min(width, height) / FULL_QUALITY_SIZE, 1.0)
+    pose = 1.0 if landmarks is None else pose_score(landmarks)
+    return size * min(max(confidence, 0.0), 1.0) * pose
+
+
+class QualityPolicy:
+    """Keep the best-K embeddings of every track and fuse them for matching.
+
+    Tracks carry their faces in track.faces as (quality, embedding) pairs,
+    plus the person box side and frame of their last face. A track is worth
+    another SGIE pass only while the qualities of its faces sum to less than
+    enough_quality (one sharp frontal face, or several poorer ones to
+    average), and then once the person box has grown by `margin` since the
+    last face (a meaningfully better face is likely) or refresh_frames went
+    by (another view to fuse).
+    """
+    def __init__(self, top_k=8, enough_quality=1.0, margin=1.0, refresh_frames=30, fusion='mean'):
+        self.top_k = top_k
+        self.enough_quality = enough_quality
+        self.margin = margin
+        self.refresh_frames = refresh_frames
+        self.fusion = fusion
+
+    def best_quality(self, track):
+        return track.faces[0][0] if track.faces else 0.0
+
+    def total_quality(self, track):
+        return sum(quality for quality, _ in track.faces)
+
+    def wants_face(self, track, person_width, person_height, frame_num=None):
+        if not track.faces:
+            return True
+        if self.total_quality(track) >= self.enough_quality:
+            return False
+        if min(person_width, person_height) >= track.face_source_size * (1.0 + self.margin):
+            return True
+        return (self.refresh_frames is not None and frame_num is not None and track.face_frame is not None
+                and frame_num - track.face_frame >= self.refresh_frames)
+
+    def update(self, track, quality, embedding, person_width, person_height, frame_num=None):
+        """Record a new face; returns True if it made it into the best-K."""
+        # every face counts for re-admission, also one that is not kept:
+        # otherwise a track below the best face is re-admitted on every frame
+        track.face_source_size = min(person_width, person_height)
+        if frame_num is not None:
+            track.face_frame = frame_num
+        faces = track.faces
+        if len(faces) >= self.top_k and quality <= faces[-1][0]:
+            return False
+        # replace rather than sort in place: wants_face() reads the list from
+        # the streaming thread while a worker updates it
+        faces = sorted(faces + [(quality, embedding)], key=lambda face: face[0], reverse=True)
+        track.faces = faces[:self.top_k]
+        track.embedding = self.fuse(track.faces)
+        return True
+
+    def fuse(self, faces):
+        if len(faces) == 1 or self.fusion == 'best':
+            return faces[0][1]
+        embeddings = np.stack([embedding for _, embedding in faces])
+        if self.fusion == 'mean':
+            weights = np.ones(len(faces), dtype=np.float32)
+        else:
+            weights = np.array([quality for quality, _ in faces], dtype=np.float32) + 1e-6
+        return l2_normalize((weights[:, None] * embeddings).sum(0, keepdims=True))[0]
+
+
+if __name__ == '__main__':
+    from common.track_store import TrackState
+
+    # detector outputs on a 100x200 person crop at (50, 20): scale 1.6
+    boxes, landmarks = detector_landmarks(
+        2, np.array([16, 16, 80, 96, 0, 200, 8, 208], dtype=np.float32),
+        np.tile(np.array([32, 40], dtype=np.float32), 10), (50, 20, 100, 200))
+    assert np.allclose(boxes[0], [60, 30, 100, 80]) and np.allclose(landmarks[:, 0], [70, 45])
+    assert np.allclose(match_landmarks((61, 31, 40, 48), boxes, landmarks), [[70, 45]] * 5)
+    assert match_landmarks((0, 300, 40, 40), boxes, landmarks) is None
+    assert pose_score([[30, 40], [70, 40], [50, 60], [35, 80], [65, 80]]) == 1.0
+
+    # Replay benchmark: people walk towards the camera so the face grows;
+    # embedding noise shrinks with quality. Compare the old "first face
+    # only" rule and periodic re-extraction with the policy on SGIE
+    # inferences and rank-1 accuracy.
+    # Every strategy sees the same tracks and, on a frame it re-extracts, the
+    # same face: the comparison is paired, not up to sampling noise.
+    identities = l2_normalize(np.random.default_rng(0).standard_normal((2000, 512), dtype=np.float32))
+    tracks = 3000
+    frames = 100
+
+    def replay(policy, period=None, seed=1):
+        inferences = correct = 0
+        for t in range(tracks):
+            rng = np.random.default_rng([seed, t])
+            identity = rng.integers(len(identities))
+            track = TrackState(0, t, 0, 0.0)
+            start = rng.uniform(40, 120)
+            growth = rng.uniform(1.0, 4.0)
+            yaw = rng.uniform(-0.3, 0.3, frames)
+            confidence = rng.uniform(0.6, 1.0, frames)
+            for f in range(frames):
+                person = start * (1 + (growth - 1) * f / frames)
+                if policy is None:
+                    wanted = not track.faces or (period is not None and f % period == 0)
+                else:
+                    wanted = policy.wants_face(track, person, person * 2, f)
+                if not wanted:
+                    continue
+                inferences += 1
+                face = person * 0.4
+                lmk = np.array([[30, 40], [70, 40], [50 + 40 * yaw[f], 60], [35, 80], [65, 80]])
+                quality = face_quality(face, face, confidence[f], lmk)
+                noise = np.random.default_rng([seed, t, f]).standard_normal(512, dtype=np.float32)
+                embedding = l2_normalize((identities[identity] + noise * (0.02 + 0.4 * (1 - quality)))[None])[0]
+                if policy is None:
+                    track.faces.append((quality, embedding))
+                    track.embedding = l2_normalize(np.mean([e for _, e in track.faces], 0)[None])[0]
+                else:
+                    policy.update(track, quality, embedding, person, person * 2, f)
+            correct += int(np.argmax(identities @ track.embedding) == identity)
+        return inferences, correct / tracks
+
+    # The embedding noise of this replay is independent per face, so what
+    # mostly buys accuracy is the number of faces fused, and the mean of the
+    # normalized embeddings already favours the sharp ones (a noisy one is
+    # shrunk more by the normalization). The policy's gain is to stop once a
+    # track has enough quality and spend the inferences on the poor tracks
+    # that keep being refreshed: about 3.86 inferences/track against 4.00 for
+    # every 25 frames, and 0.1 to 0.4 points more accuracy on the seeds
+    # tried.
+    for name, policy, period in (("first face", None, None),
+                                 ("every 10 frames", None, 10),
+                                 ("every 25 frames", None, 25),
+                                 ("every 50 frames", None, 50),
+                                 ("policy", QualityPolicy(), None),
+                                 ("policy quality", QualityPolicy(fusion='quality'), None),
+                                 ("growth only", QualityPolicy(refresh_frames=None), None),
+                                 ("best-3, +25%", QualityPolicy(top_k=3, margin=0.25, refresh_frames=None), None)):
+        inferences, accuracy = replay(policy, period)
+        print("%-15s inferences/track %.2f  rank-1 accuracy %.3f" % (name, inferences / tracks, accuracy))
@@ -0,0 +1,283 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Pure-Python stand-ins for the subset of Gst used to manage the pipeline.
+
+Elements keep their properties, state and pads in plain attributes and log
+every structural operation (add, remove, link, request/release pad, state
+change, event) to the ops list of their FakePipeline, FakeMessage builds
+synthetic bus messages and FakeProbeInfo hands a FakeBuffer to pad probes,
+so source management and probes can be checked without GStreamer.
+"""
+
+CLOCK_TIME_NONE = 0xFFFFFFFFFFFFFFFF
+
+
+class State:
+    VOID_PENDING = 0
+    NULL = 1
+    READY = 2
+    PAUSED = 3
+    PLAYING = 4
+
+
+class StateChangeReturn:
+    FAILURE = 0
+    SUCCESS = 1
+    ASYNC = 2
+    NO_PREROLL = 3
+
+
+class MessageType:
+    EOS = 1 << 0
+    ERROR = 1 << 1
+    WARNING = 1 << 2
+    ELEMENT = 1 << 15
+
+
+class PadProbeType:
+    BUFFER = 1 << 4
+    EVENT_DOWNSTREAM = 1 << 6
+
+
+class PadProbeReturn:
+    DROP = 0
+    OK = 1
+    REMOVE = 2
+    PASS = 3
+    HANDLED = 4
+
+
+class FakeEvent:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "FakeEvent({})".format(self.name)
+
+
+class Event:
+    @staticmethod
+    def new_flush_stop(reset_time):
+        return FakeEvent('flush-stop')
+
+
+class FakePad:
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.peer = None
+        self.events = []
+
+    def get_name(self):
+        return self.name
+
+    def get_parent_element(self):
+        return self.parent
+
+    def link(self, other):
+        self.parent.log('link', "{}:{}".format(self.parent.name, self.name),
+                        "{}:{}".format(other.parent.name, other.name))
+        self.peer = other
+        other.peer = self
+        return 0
+
+    def unlink(self, other):
+        self.parent.log('unlink', "{}:{}".format(self.parent.name, self.name),
+                        "{}:{}".format(other.parent.name, other.name))
+        self.peer = None
+        other.peer = None
+        return True
+
+    def send_event(self, event):
+        self.parent.log('event', "{}:{}".format(self.parent.name, self.name), event.name)
+        self.events.append(event)
+        return True
+
+
+class FakeElement:
+    def __init__(self, factory, name, static_pads=('sink', 'src')):
+        self.factory = factory
+        self.name = name
+        self.props = {}
+        self.state = State.NULL
+        self.parent = None
+        self.pads = {pad: FakePad(pad, self) for pad in static_pads}
+        # set_state() result, e.g. StateChangeReturn.ASYNC or FAILURE
+        self.state_return = StateChangeReturn.SUCCESS
+
+    def log(self, *op):
+        pipeline = self
+        while pipeline.parent is not None:
+            pipeline = pipeline.parent
+        if isinstance(pipeline, FakePipeline):
+            pipeline.ops.append(op)
+
+    def get_name(self):
+        return self.name
+
+    def get_parent(self):
+        return self.parent
+
+    def set_property(self, name, value):
+        self.props[name] = value
+
+    def get_property(self, name):
+        return self.props.get(name)
+
+    def connect(self, signal, callback, *args):
+        return 1
+
+    def set_state(self, state):
+        self.log('set_state', self.name, state)
+        if self.state_return != StateChangeReturn.FAILURE:
+            self.state = state
+        return self.state_return
+
+    def get_state(self, timeout):
+        result = StateChangeReturn.FAILURE if self.state_return == StateChangeReturn.FAILURE \
+            else StateChangeReturn.SUCCESS
+        return result, self.state, State.VOID_PENDING
+
+    def sync_state_with_parent(self):
+        if self.parent is not None:
+            self.log('sync_state', self.name, self.parent.state)
+            self.state = self.parent.state
+        return True
+
+    def get_static_pad(self, name):
+        return self.pads.get(name)
+
+    def get_request_pad(self, name):
+        if name in self.pads:
+            return None
+        pad = self.pads[name] = FakePad(name, self)
+        self.log('request_pad', self.name, name)
+        return pad
+
+    def release_request_pad(self, pad):
+        self.log('release_pad', self.name, pad.name)
+        del self.pads[pad.name]
+
+    def link(self, other):
+        return self.pads['src'].link(other.pads['sink']) == 0
+
+
+class FakeBin(FakeElement):
+    def __init__(self, name, static_pads=('src',)):
+        super().__init__('bin', name, static_pads)
+        self.children = {}
+
+    def add(self, element):
+        if element.name in self.children or element.parent is not None:
+            return False
+        element.parent = self
+        self.children[element.name] = element
+        self.log('add', self.name, element.name)
+        return True
+
+    def remove(self, element):
+        if self.children.get(element.name) is not element:
+            return False
+        self.log('remove', self.name, element.name)
+        del self.children[element.name]
+        element.parent = None
+        return True
+
+    def get_by_name(self, name):
+        return self.children.get(name)
+
+    def set_state(self, state):
+        result = super().set_state(state)
+        if result != StateChangeReturn.FAILURE:
+            for child in self.children.values():
+                child.state = state
+        return result
+
+
+class FakePipeline(FakeBin):
+    def __init__(self, name='pipeline'):
+        super().__init__(name, static_pads=())
+        self.ops = []
+
+
+class ElementFactory:
+    @staticmethod
+    def make(factory, name):
+        if factory in ('bin', 'pipeline'):
+            return FakeBin(name)
+        return FakeElement(factory, name)
+
+
+class FakeGError:
+    def __init__(self, message, code=0):
+        self.message = message
+        self.code = code
+
+    def __str__(self):
+        return self.message
+
+
+class FakeStructure:
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def get_name(self):
+        return self.name
+
+    def has_name(self, name):
+        return self.name == name
+
+    def get_value(self, field):
+        return self.fields.get(field)
+
+
+class FakeMessage:
+    """Bus message posted by src; error and warning messages carry (err, debug)."""
+    def __init__(self, type, src, error=None, debug=None, structure=None):
+        self.type = type
+        self.src = src
+        self.error = error
+        self.debug = debug
+        self.structure = structure
+
+    def parse_error(self):
+        return self.error, self.debug
+
+    def parse_warning(self):
+        return self.error, self.debug
+
+    def get_structure(self):
+        return self.structure
+
+
+class FakeBuffer:
+    def __init__(self, pts=0):
+        self.pts = pts
+
+
+class FakeProbeInfo:
+    def __init__(self, buffer=None, event=None):
+        self.buffer = buffer
+        self.event = event
+
+    def get_buffer(self):
+        return self.buffer
+
+    def get_event(self):
+        return self.event
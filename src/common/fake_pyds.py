@@ -0,0 +1,178 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Pure-Python stand-ins for the subset of pyds used by the probes.
+
+Only host memory is involved: tensor outputs are tensor_reader.FakeLayerInfo
+objects and GLists are linked GList nodes, so probe code can run and be
+profiled on machines without DeepStream.
+"""
+
+import numpy as np
+
+from common.tensor_reader import FakeLayerInfo
+
+
+class GList:
+    __slots__ = ('data', 'next')
+
+    def __init__(self, data, next=None):
+        self.data = data
+        self.next = next
+
+
+def glist(items):
+    head = None
+    for item in reversed(items):
+        head = GList(item, head)
+    return head
+
+
+def glist_items(head):
+    items = []
+    while head is not None:
+        items.append(head.data)
+        head = head.next
+    return items
+
+
+class _Castable:
+    @classmethod
+    def cast(cls, data):
+        return data
+
+
+class NvDsMetaType:
+    NVDSINFER_TENSOR_OUTPUT_META = 12
+
+
+class NvDsBaseMeta:
+    def __init__(self, meta_type):
+        self.meta_type = meta_type
+
+
+class NvOSD_RectParams:
+    def __init__(self, left=0.0, top=0.0, width=0.0, height=0.0):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+
+class NvDsInferTensorMeta(_Castable):
+    def __init__(self, layers, unique_id=0):
+        self.output_layers_info = layers
+        self.num_output_layers = len(layers)
+        self.unique_id = unique_id
+
+
+class NvDsUserMeta(_Castable):
+    def __init__(self, meta_type, user_meta_data):
+        self.base_meta = NvDsBaseMeta(meta_type)
+        self.user_meta_data = user_meta_data
+
+
+class NvDsObjectMeta(_Castable):
+    def __init__(self, class_id=0, object_id=0xFFFFFFFFFFFFFFFF, unique_component_id=1,
+                 confidence=1.0, rect_params=None, parent=None, user_meta=()):
+        self.class_id = class_id
+        self.object_id = object_id
+        self.unique_component_id = unique_component_id
+        self.confidence = confidence
+        self.rect_params = rect_params or NvOSD_RectParams()
+        self.parent = parent
+        self.obj_user_meta_list = glist(list(user_meta))
+
+
+class NvDsFrameMeta(_Castable):
+    def __init__(self, frame_num=0, pad_index=0, source_id=None, buf_pts=0, ntp_timestamp=0, objects=()):
+        self.frame_num = frame_num
+        self.pad_index = pad_index
+        self.source_id = pad_index if source_id is None else source_id
+        self.buf_pts = buf_pts
+        self.ntp_timestamp = ntp_timestamp
+        self.obj_meta_list = glist(list(objects))
+        self.num_obj_meta = len(objects)
+
+
+class NvDsBatchMeta(_Castable):
+    def __init__(self, frames=()):
+        self.frame_meta_list = glist(list(frames))
+        self.num_frames_in_batch = len(frames)
+
+
+_batches = {}
+
+
+def attach_batch_meta(gst_buffer, batch_meta):
+    """Associate batch meta with a buffer object, as nvstreammux would."""
+    _batches[hash(gst_buffer)] = batch_meta
+
+
+def detach_batch_meta(gst_buffer):
+    _batches.pop(hash(gst_buffer), None)
+
+
+def gst_buffer_get_nvds_batch_meta(address):
+    return _batches.get(address)
+
+
+def get_nvds_LayerInfo(tensor_meta, index):
+    return tensor_meta.output_layers_info[index]
+
+
+def get_ptr(buffer):
+    return buffer.ctypes.data
+
+
+def get_detections(buffer, index):
+    return float(buffer[index])
+
+
+def nvds_remove_obj_meta_from_frame(frame_meta, obj_meta):
+    items = [item for item in glist_items(frame_meta.obj_meta_list) if item is not obj_meta]
+    frame_meta.obj_meta_list = glist(items)
+    frame_meta.num_obj_meta = len(items)
+
+
+def tensor_user_meta(array):
+    """User meta carrying one output layer, like output-tensor-meta=1."""
+    meta = NvDsInferTensorMeta([FakeLayerInfo(np.asarray(array, dtype=np.float32))])
+    return NvDsUserMeta(NvDsMetaType.NVDSINFER_TENSOR_OUTPUT_META, meta)
+
+
+def make_batch(frames, persons_per_frame, face_ratio=0.5, frame_num=0, dim=512, seed=0,
+               pgie=1, sgie=2):
+    """Synthetic batch: persons from the PGIE, faces from the SGIE with an
+    embedding tensor and the person as parent."""
+    rng = np.random.default_rng(seed)
+    frame_metas = []
+    for pad_index in range(frames):
+        objects = []
+        for i in range(persons_per_frame):
+            x, y = rng.uniform(0, 1600), rng.uniform(0, 700)
+            w, h = rng.uniform(20, 300), rng.uniform(40, 380)
+            person = NvDsObjectMeta(0, (pad_index << 32) | i, pgie, float(rng.uniform(0.4, 1.0)),
+                                    NvOSD_RectParams(x, y, w, h))
+            objects.append(person)
+            if rng.random() < face_ratio:
+                face = NvDsObjectMeta(0, 0xFFFFFFFFFFFFFFFF, sgie, float(rng.uniform(0.6, 1.0)),
+                                      NvOSD_RectParams(x + w * 0.3, y, w * 0.4, h * 0.2), person,
+                                      [tensor_user_meta(rng.standard_normal(dim))])
+                objects.append(face)
+        frame_metas.append(NvDsFrameMeta(frame_num, pad_index, objects=objects))
+    return NvDsBatchMeta(frame_metas)
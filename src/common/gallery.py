@@ -0,0 +1,188 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import os
+import numpy as np
+
+from common.tensor_reader import l2_normalize
+
+EMBEDDING_DIM = 512
+# Rows upcast to float32 per matrix multiply when the gallery stores float16
+SEARCH_CHUNK = 4096
+
+
+class FaceGallery:
+    """Enrolled face embeddings kept in one contiguous (capacity, dim) matrix.
+
+    Rows [0, size) are live. Removing an identity moves the last row into
+    the freed slot, so add/remove never rebuild the matrix and a query is a
+    single matrix multiply over the live rows. With dtype=float16 the rows
+    are stored in half precision but scored in float32, SEARCH_CHUNK rows at
+    a time: NumPy has no fast half-precision matrix multiply.
+    """
+    def __init__(self, dim=EMBEDDING_DIM, dtype=np.float32, capacity=1024):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.matrix = np.zeros((capacity, dim), dtype=self.dtype)
+        self.labels = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, label):
+        return label in self.rows
+
+    def _reserve(self, capacity):
+        if capacity <= self.matrix.shape[0]:
+            return
+        capacity = max(capacity, 2 * self.matrix.shape[0])
+        matrix = np.zeros((capacity, self.dim), dtype=self.dtype)
+        matrix[:self.size] = self.matrix[:self.size]
+        labels = np.zeros(capacity, dtype=np.int64)
+        labels[:self.size] = self.labels[:self.size]
+        self.matrix, self.labels = matrix, labels
+
+    def add(self, labels, embeddings):
+        """Enroll (or overwrite) identities. Embeddings are re-normalized."""
+        labels = np.atleast_1d(np.asarray(labels, dtype=np.int64))
+        embeddings = l2_normalize(np.reshape(embeddings, (len(labels), self.dim)))
+        self._reserve(self.size + len(labels))
+        for label, embedding in zip(labels.tolist(), embeddings):
+            row = self.rows.get(label)
+            if row is None:
+                row = self.size
+                self.rows[label] = row
+                self.labels[row] = label
+                self.size += 1
+            self.matrix[row] = embedding
+
+    def remove(self, label):
+        row = self.rows.pop(label, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.labels[row] = self.labels[last]
+            self.rows[int(self.labels[row])] = row
+        self.size = last
+        return True
+
+    def get(self, label):
+        return self.matrix[self.rows[label]].astype(np.float32)
+
+    def search(self, queries, k=1):
+        """Top-k cosine search for a batch of L2-normalized (N, dim) queries.
+
+        Returns (labels, scores), both (N, k') with k' = min(k, len(self)),
+        sorted by decreasing similarity.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, self.size)
+        if k == 0:
+            return (np.empty((len(queries), 0), dtype=np.int64),
+                    np.empty((len(queries), 0), dtype=np.float32))
+        if self.dtype == np.float32:
+            scores = queries @ self.matrix[:self.size].T
+        else:
+            scores = np.empty((len(queries), self.size), dtype=np.float32)
+            for start in range(0, self.size, SEARCH_CHUNK):
+                stop = min(start + SEARCH_CHUNK, self.size)
+                np.matmul(queries, self.matrix[start:stop].astype(np.float32).T, out=scores[:, start:stop])
+        if k < self.size:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(self.size), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return self.labels[top], top_scores
+
+    def save(self, path):
+        np.savez(path, labels=self.labels[:self.size], embeddings=self.matrix[:self.size])
+
+    @classmethod
+    def load(cls, path, dtype=np.float32):
+        data = np.load(path)
+        gallery = cls(dim=data['embeddings'].shape[1], dtype=dtype,
+                      capacity=max(len(data['labels']), 1))
+        gallery.add(data['labels'], data['embeddings'])
+        return gallery
+
+
+def create_gallery(config):
+    """Build the gallery described by a [gallery] config section.
+
+    See configs/config_gallery.txt for the keys. The gallery-file, if it
+    exists, is loaded and, for ivfpq, also used to train the index. The
+    store index is a memory-mapped EmbeddingStore opened from store-file.
+    """
+    index = config.get('index', 'flat')
+    if index == 'store':
+        from common.embedding_store import EmbeddingStore
+        return EmbeddingStore(config.get('store-file'), dtype=config.get('dtype', 'float32'))
+    path = config.get('gallery-file', '')
+    data = np.load(path) if path and os.path.exists(path) else None
+    if index == 'flat':
+        dtype = np.dtype(config.get('dtype', 'float32'))
+        gallery = FaceGallery(dtype=dtype)
+    elif index == 'ivfpq':
+        from common.ann import IVFPQIndex
+        vectors = config.get('vectors', 'float16')
+        gallery = IVFPQIndex(nlist=int(config.get('nlist', 1024)),
+                             m=int(config.get('m', 64)),
+                             nprobe=int(config.get('nprobe', 16)),
+                             rerank=int(config.get('rerank', 8)),
+                             vectors=None if vectors == 'none' else vectors)
+        if data is not None:
+            gallery.train(data['embeddings'])
+    else:
+        raise ValueError("unknown gallery index '%s'" % index)
+    if data is not None:
+        gallery.add(data['labels'], data['embeddings'])
+    return gallery
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    # usage: python -m common.gallery [max_size]
+    max_size = int(sys.argv[-1]) if sys.argv[-1].isdigit() else 1000000
+    batch = 32
+    size = 1000
+    while size <= max_size:
+        rng = np.random.default_rng(0)
+        queries = l2_normalize(rng.standard_normal((batch, EMBEDDING_DIM), dtype=np.float32))
+        rates = []
+        for dtype in (np.float32, np.float16):
+            gallery = FaceGallery(dtype=dtype, capacity=size)
+            rng = np.random.default_rng(1)
+            for start in range(0, size, 100000):
+                n = min(100000, size - start)
+                gallery.add(np.arange(start, start + n), rng.standard_normal((n, EMBEDDING_DIM), dtype=np.float32))
+            gallery.search(queries, k=5)
+            rounds = max(1, 2000000 // size)
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                gallery.search(queries, k=5)
+            rates.append(rounds * batch / (time.perf_counter() - t0))
+        print("gallery %8d: %10.1f queries/s float32, %10.1f queries/s float16" % (size, rates[0], rates[1]))
+        size *= 10
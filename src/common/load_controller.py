@@ -0,0 +1,281 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import sys
+
+from common.metrics import Histogram
+
+
+class Level:
+    """One step of the degradation ladder."""
+    __slots__ = ('interval', 'admission_scale', 'keep_every')
+
+    def __init__(self, interval, admission_scale, keep_every):
+        # PGIE skips interval batches between inferences (tracker fills in)
+        self.interval = interval
+        # fraction of the SGIE admission budget
+        self.admission_scale = admission_scale
+        # each stream keeps one frame out of keep_every
+        self.keep_every = keep_every
+
+    def __repr__(self):
+        return "Level(interval={}, admission={:g}, keep 1/{})".format(
+            self.interval, self.admission_scale, self.keep_every)
+
+
+# Cheapest first: skip detector frames, then crops, then whole frames
+DEFAULT_LEVELS = (
+    Level(0, 1.0, 1),
+    Level(1, 1.0, 1),
+    Level(2, 0.5, 1),
+    Level(3, 0.25, 2),
+    Level(4, 0.25, 3),
+)
+
+
+class LatencyWindow:
+    """q-quantile of a Metrics histogram (all labels) over the samples since the last call."""
+    def __init__(self, metrics, name='latency_seconds', q=0.95):
+        self.metrics = metrics
+        self.name = name
+        self.q = q
+        self.last = None
+
+    def counts(self):
+        bounds = self.metrics.histogram_bounds[self.name]
+        counts = [0] * (len(bounds) + 1)
+        with self.metrics.lock:
+            for (name, _), histogram in self.metrics.histograms.items():
+                if name == self.name:
+                    counts = [a + b for a, b in zip(counts, histogram.counts)]
+        return bounds, counts
+
+    def sample(self):
+        """None when no frame left the pipeline since the last sample."""
+        bounds, counts = self.counts()
+        last = self.last or [0] * len(counts)
+        self.last = counts
+        window = Histogram(bounds)
+        window.counts = [max(a - b, 0) for a, b in zip(counts, last)]
+        window.count = sum(window.counts)
+        if not window.count:
+            return None
+        return window.quantile(self.q)
+
+
+def gst_queue_fill(queues):
+    """Fullest of the given GStreamer queues, 0..1 (queues without a buffer limit are skipped)."""
+    fill = 0.0
+    for queue in queues:
+        limit = queue.get_property('max-size-buffers')
+        if limit:
+            fill = max(fill, queue.get_property('current-level-buffers') / limit)
+    return fill
+
+
+class FrameDropper:
+    """Per-stream frame decimation, asked by a pad probe in front of nvstreammux."""
+    def __init__(self):
+        self.keep_every = 1
+        self.counts = {}
+
+    def keep(self, stream_id):
+        every = self.keep_every
+        if every <= 1:
+            return True
+        count = (self.counts.get(stream_id, 0) + 1) % every
+        self.counts[stream_id] = count
+        return count == 0
+
+    def remove_stream(self, stream_id):
+        self.counts.pop(stream_id, None)
+
+
+class LoadController:
+    """Step along a degradation ladder to hold a latency SLO.
+
+    Every update() takes the window's latency quantile (None if no frame
+    came out) and the fill of the fullest queue (0..1). The pipeline is
+    overloaded when latency exceeds high * slo or a queue is over
+    queue_high, and has headroom when latency is under low * slo and
+    queues are under queue_low; in between nothing changes. up_after
+    overloaded windows in a row degrade one level, down_after windows with
+    headroom restore one. After a change the controller holds for hold
+    windows while queues drain or fill, unless latency keeps rising after
+    a degradation, which then goes one level further.
+
+    A restored level that overloads within retry_window windows is left
+    after a single overloaded window, and the headroom needed to restore it
+    again doubles (up to max_down_after), so a level that cannot hold the
+    load is not retried every few seconds. Once it held for retry_window
+    windows it is back to down_after.
+
+    apply(level) is called with the new Level on every change. tick()
+    samples latency() and queue_fill() for use from a main loop timer.
+    """
+    def __init__(self, slo, levels=DEFAULT_LEVELS, apply=None, latency=None, queue_fill=None,
+                 high=1.0, low=0.6, queue_high=0.8, queue_low=0.3, up_after=2, down_after=5,
+                 hold=3, retry_window=30, max_down_after=120):
+        self.slo = slo
+        self.levels = levels
+        self.apply = apply
+        self.latency = latency
+        self.queue_fill = queue_fill
+        self.high = high
+        self.low = low
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.up_after = up_after
+        self.down_after = down_after
+        self.hold = hold
+        self.retry_window = retry_window
+        self.max_down_after = max_down_after
+        self.index = 0
+        # windows of headroom needed to restore each level
+        self.restore_after = [down_after] * len(levels)
+        self.over = 0
+        self.under = 0
+        self.holding = 0
+        self.previous = None
+        # windows since the last change and direction of that change
+        self.age = 0
+        self.last_step = 0
+        self.changes = 0
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    def update(self, latency, queue_fill=0.0):
+        """Feed one window, returns the level index in effect."""
+        self.age += 1
+        retrying = self.last_step < 0 and self.age < self.retry_window
+        if self.age == self.retry_window:
+            self.restore_after[self.index] = self.down_after
+        over = (latency is not None and latency > self.slo * self.high) or queue_fill > self.queue_high
+        under = (latency is None or latency < self.slo * self.low) and queue_fill < self.queue_low
+        rising = latency is not None and self.previous is not None and latency > self.previous
+        self.previous = latency
+        if self.holding:
+            self.holding -= 1
+            if over and rising and self.index + 1 < len(self.levels):
+                # the backlog still grows: the last step was not enough or
+                # the restored level cannot take the load
+                self._degrade(retrying)
+            return self.index
+        self.over = self.over + 1 if over else 0
+        self.under = self.under + 1 if under else 0
+        if self.over >= (1 if retrying else self.up_after) and self.index + 1 < len(self.levels):
+            self._degrade(retrying)
+        elif self.index > 0 and self.under >= self.restore_after[self.index - 1]:
+            self._step(-1)
+        return self.index
+
+    def tick(self):
+        self.update(self.latency(), self.queue_fill() if self.queue_fill else 0.0)
+        return True
+
+    def _degrade(self, retrying):
+        if retrying:
+            self.restore_after[self.index] = min(self.restore_after[self.index] * 2, self.max_down_after)
+        self._step(1)
+
+    def _step(self, direction):
+        self.index += direction
+        self.over = self.under = 0
+        self.holding = self.hold
+        self.age = 0
+        self.last_step = direction
+        self.changes += 1
+        sys.stderr.write("load level {}: {}\n".format(self.index, self.level))
+        if self.apply is not None:
+            self.apply(self.level)
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import random
+
+    class LoadModel:
+        """
+        One GPU second of work per second. A frame costs other_cost plus
+        pgie_cost on the frames the detector runs on, an admitted crop
+        sgie_cost; work that does not fit queues up and adds to latency.
+        """
+        def __init__(self, fps=25.0, crops_per_stream=4.0, budget=30.0, other_cost=0.001, pgie_cost=0.006,
+                     sgie_cost=0.004, base_latency=0.05, queue_seconds=2.0, seed=0):
+            self.fps = fps
+            self.crops_per_stream = crops_per_stream
+            self.budget = budget
+            self.other_cost = other_cost
+            self.pgie_cost = pgie_cost
+            self.sgie_cost = sgie_cost
+            self.base_latency = base_latency
+            self.queue_seconds = queue_seconds
+            self.rng = random.Random(seed)
+            self.backlog = 0.0
+
+        def step(self, streams, level):
+            frames = streams * self.fps / level.keep_every
+            crops = min(self.budget * level.admission_scale, streams * self.crops_per_stream)
+            work = frames * (self.other_cost + self.pgie_cost / (level.interval + 1)) + crops * self.sgie_cost
+            work *= self.rng.uniform(0.9, 1.1)
+            self.backlog = max(self.backlog + work - 1.0, 0.0)
+            latency = self.base_latency + self.backlog + self.rng.uniform(0, 0.02)
+            return latency, min(self.backlog / self.queue_seconds, 1.0)
+
+    def simulate(make_controller, schedule):
+        model = LoadModel()
+        controller = make_controller()
+        trace = []
+        for streams, windows in schedule:
+            for _ in range(windows):
+                latency, fill = model.step(streams, controller.level)
+                controller.update(latency, fill)
+                trace.append((streams, latency, controller.index))
+        return controller, trace
+
+    # 4 streams fit at full quality, 12 need detector interval 2 and half
+    # the crops (96% busy), then back to 4.
+    slo = 0.5
+    schedule = [(4, 60), (12, 600), (4, 120)]
+    with contextlib.redirect_stderr(io.StringIO()):
+        controller, trace = simulate(lambda: LoadController(slo), schedule)
+        naive, naive_trace = simulate(lambda: LoadController(slo, low=1.0, up_after=1, down_after=1, hold=0,
+                                                             max_down_after=1), schedule)
+
+    assert all(index == 0 for _, _, index in trace[:60])
+    high = trace[60:660]
+    # overload is caught within a few windows and the backlog drained
+    assert any(latency <= slo for _, latency, _ in high[:20])
+    settled = high[60:]
+    within = sum(latency <= slo for _, latency, _ in settled) / len(settled)
+    assert within >= 0.95, within
+    level_changes = sum(a[2] != b[2] for a, b in zip(settled, settled[1:]))
+    naive_changes = sum(a[2] != b[2] for a, b in zip(naive_trace[120:660], naive_trace[121:660]))
+    assert level_changes <= naive_changes // 4, (level_changes, naive_changes)
+    # and full quality once the load is gone
+    assert trace[-1][2] == 0 and all(index == 0 for _, _, index in trace[-30:])
+
+    def p95(values):
+        return sorted(values)[int(len(values) * 0.95)]
+
+    print("12 streams, SLO {:.2f}s: p95 latency {:.3f}s, {:.1%} of windows within, {} level changes "
+          "(no hysteresis: p95 {:.3f}s, {} changes), settled at level {}".format(
+              slo, p95([latency for _, latency, _ in settled]), within, level_changes,
+              p95([latency for _, latency, _ in naive_trace[120:660]]), naive_changes, settled[-1][2]))
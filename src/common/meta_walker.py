@@ -0,0 +1,244 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import numpy as np
+
+try:
+    import pyds
+except ImportError:
+    # common.fake_pyds can be installed with use_pyds() for CPU-only runs
+    pyds = None
+
+UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+
+
+def use_pyds(module):
+    """Swap the pyds implementation used by the walkers (e.g. fake_pyds)."""
+    global pyds
+    pyds = module
+
+
+def iter_glist(l_item, cast):
+    """Yield cast(node.data) for every node of a GList.
+
+    The next pointer is read before yielding, so the consumer may remove the
+    current item from its list (nvds_remove_obj_meta_from_frame).
+    """
+    while l_item is not None:
+        try:
+            # The casting also keeps ownership of the underlying memory
+            # in the C code, so the Python garbage collector will leave
+            # it alone.
+            item = cast(l_item.data)
+        except StopIteration:
+            break
+        try:
+            l_item = l_item.next
+        except StopIteration:
+            l_item = None
+        yield item
+
+
+def iter_frames(batch_meta):
+    return iter_glist(batch_meta.frame_meta_list, pyds.NvDsFrameMeta.cast)
+
+
+def iter_objects(frame_meta):
+    return iter_glist(frame_meta.obj_meta_list, pyds.NvDsObjectMeta.cast)
+
+
+def iter_user_meta(l_user):
+    return iter_glist(l_user, pyds.NvDsUserMeta.cast)
+
+
+def iter_tensor_meta(obj_meta):
+    """Yield the NvDsInferTensorMeta attached to an object."""
+    for user_meta in iter_user_meta(obj_meta.obj_user_meta_list):
+        if user_meta and user_meta.base_meta.meta_type == pyds.NvDsMetaType.NVDSINFER_TENSOR_OUTPUT_META:
+            yield pyds.NvDsInferTensorMeta.cast(user_meta.user_meta_data)
+
+
+class FrameColumns:
+    """Object metadata of one frame, gathered in a single pass as columns.
+
+    Columns are plain lists aligned with objects (the NvDsObjectMeta
+    handles): boxes holds (left, top, width, height) tuples, and parent_ids
+    is UNTRACKED_OBJECT_ID for objects without a parent. Every field read is
+    a call into the bindings, so boxes/confidences and parent_ids are only
+    gathered when asked for (otherwise None). Per-frame object counts are
+    small, so lists beat NumPy for element access; box_array() gives an
+    (N, 4) float32 array for vectorized consumers.
+    """
+    __slots__ = ('frame_meta', 'stream_id', 'frame_num', 'objects', 'boxes', 'confidences',
+                 'class_ids', 'component_ids', 'object_ids', 'parent_ids', '_box_array')
+
+    def __init__(self, frame_meta, with_boxes=True, with_parents=True):
+        self.frame_meta = frame_meta
+        self.stream_id = frame_meta.pad_index
+        self.frame_num = frame_meta.frame_num
+        self.objects = objects = []
+        self.class_ids = class_ids = []
+        self.component_ids = component_ids = []
+        self.object_ids = object_ids = []
+        self.boxes = boxes = [] if with_boxes else None
+        self.confidences = confidences = [] if with_boxes else None
+        self.parent_ids = parent_ids = [] if with_parents else None
+        self._box_array = None
+        # the walk of iter_objects(), inlined, filling every column in one
+        # pass: this loop runs for every object of every batch
+        cast = pyds.NvDsObjectMeta.cast
+        l_obj = frame_meta.obj_meta_list
+        while l_obj is not None:
+            try:
+                obj_meta = cast(l_obj.data)
+            except StopIteration:
+                break
+            objects.append(obj_meta)
+            class_ids.append(obj_meta.class_id)
+            component_ids.append(obj_meta.unique_component_id)
+            object_ids.append(obj_meta.object_id)
+            if with_boxes:
+                rect = obj_meta.rect_params
+                boxes.append((rect.left, rect.top, rect.width, rect.height))
+                confidences.append(obj_meta.confidence)
+            if with_parents:
+                parent = obj_meta.parent
+                parent_ids.append(UNTRACKED_OBJECT_ID if parent is None else parent.object_id)
+            try:
+                l_obj = l_obj.next
+            except StopIteration:
+                break
+
+    def __len__(self):
+        return len(self.objects)
+
+    def select(self, component_id, class_id):
+        """Row indices of the objects from one GIE and class."""
+        return [i for i, component, cls in zip(range(len(self.objects)), self.component_ids, self.class_ids)
+                if component == component_id and cls == class_id]
+
+    def box_array(self):
+        if self._box_array is None:
+            self._box_array = np.array(self.boxes, dtype=np.float32).reshape(-1, 4)
+        return self._box_array
+
+
+def collect(batch_meta, with_boxes=True, with_parents=True):
+    """Walk the batch once and return a FrameColumns per frame."""
+    return [FrameColumns(frame_meta, with_boxes, with_parents) for frame_meta in iter_frames(batch_meta)]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from common import fake_pyds
+
+    # usage: python -m common.meta_walker [frames_per_batch] [objects_per_frame]
+    use_pyds(fake_pyds)
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    per_frame = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    batch_meta = fake_pyds.make_batch(frames, per_frame)
+
+    def legacy_walk(batch_meta):
+        # loop structure of the original tiler probe: one pass for persons,
+        # one for faces, with a cast and try/except per node
+        persons = []
+        faces = []
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try:
+                frame_meta = fake_pyds.NvDsFrameMeta.cast(l_frame.data)
+            except StopIteration:
+                break
+            l_obj = frame_meta.obj_meta_list
+            while l_obj is not None:
+                try:
+                    obj_meta = fake_pyds.NvDsObjectMeta.cast(l_obj.data)
+                except StopIteration:
+                    break
+                if obj_meta.unique_component_id == 1 and obj_meta.class_id == 0:
+                    persons.append(obj_meta.object_id)
+                try:
+                    l_obj = l_obj.next
+                except StopIteration:
+                    break
+            l_obj = frame_meta.obj_meta_list
+            while l_obj is not None:
+                try:
+                    obj_meta = fake_pyds.NvDsObjectMeta.cast(l_obj.data)
+                except StopIteration:
+                    break
+                if obj_meta.unique_component_id == 2 and obj_meta.class_id == 0:
+                    rect = obj_meta.rect_params
+                    faces.append((obj_meta.parent.object_id, rect.width, rect.height, obj_meta.confidence))
+                try:
+                    l_obj = l_obj.next
+                except StopIteration:
+                    break
+            try:
+                l_frame = l_frame.next
+            except StopIteration:
+                break
+        return persons, faces
+
+    def columnar_walk(batch_meta):
+        persons = []
+        faces = []
+        for frame in collect(batch_meta, with_boxes=False):
+            persons.extend(frame.object_ids[i] for i in frame.select(1, 0))
+            for i in frame.select(2, 0):
+                obj_meta = frame.objects[i]
+                rect = obj_meta.rect_params
+                faces.append((frame.parent_ids[i], rect.width, rect.height, obj_meta.confidence))
+        return persons, faces
+
+    # Attribute reads and casts are what cost time with the real bindings:
+    # each goes through the pybind11 dispatcher into C++, where a fake read
+    # is a dict lookup. Count them on the fake objects, and time the walks
+    # a second time with every read made a Python call, roughly the cost of
+    # a bound getter.
+    calls = [0]
+
+    def counting(cls):
+        getattribute = cls.__getattribute__
+
+        def __getattribute__(self, name):
+            calls[0] += 1
+            return getattribute(self, name)
+        cls.__getattribute__ = __getattribute__
+        return getattribute
+
+    def timed(walk, rounds):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            walk(batch_meta)
+        return (time.perf_counter() - t0) / rounds * 1e6
+
+    counted = (fake_pyds.GList, fake_pyds.NvDsFrameMeta, fake_pyds.NvDsObjectMeta, fake_pyds.NvOSD_RectParams)
+    rounds = 2000
+    for name, walk in (("legacy loops", legacy_walk), ("collect()", columnar_walk)):
+        assert walk(batch_meta) == legacy_walk(batch_meta)
+        elapsed = timed(walk, rounds)
+        originals = [counting(cls) for cls in counted]
+        calls[0] = 0
+        walk(batch_meta)
+        reads = calls[0]
+        bound = timed(walk, rounds)
+        for cls, getattribute in zip(counted, originals):
+            cls.__getattribute__ = getattribute
+        print("%-13s %6.1f us/batch, %6.1f us/batch at a call per read, %5d binding reads/batch (%d frames x %d objects)"
+              % (name, elapsed, bound, reads, frames, per_frame))
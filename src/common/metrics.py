@@ -0,0 +1,448 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Help text of the counters the pipeline updates
+PIPELINE_COUNTERS = {
+    'frames': "Frames that left inference",
+    'objects': "Objects in the frames that left inference",
+    'faces': "Faces detected by the face SGIE",
+    'embeddings': "Face embeddings handed to the post-probe workers",
+    'sgie_admitted': "Person crops admitted to the face SGIE",
+    'matches': "Tracks matched to a gallery identity",
+}
+
+# Upper bounds in seconds, 1 us (pad probes take a few) to 10 s
+DEFAULT_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf past the last bound)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _drop_oldest(pending, keep):
+    # Frames dropped between ingress and egress are never popped: keep the
+    # newest stamps, the sort runs once per (max_pending - keep) stamps
+    for key in sorted(pending, key=pending.get)[:len(pending) - keep]:
+        del pending[key]
+
+
+class _StreamFrames:
+    __slots__ = ('pending', 'frames', 'objects', 'latency')
+
+    def __init__(self):
+        self.pending = {}
+        self.frames = 0
+        self.objects = 0
+        self.latency = None
+
+
+class Metrics:
+    """Counters, histograms and gauges for the pipeline.
+
+    Counters are keyed by (name, stream_id) and histograms by (name, label),
+    where the label name is given when the histogram is defined (stage for
+    probe timings, stream for latency). Updates are a dict lookup and an
+    add under one uncontended lock; probes handling a whole batch use
+    inc_many() and the *_frames() calls, which take each lock once per
+    batch instead of once per frame and counter.
+    Gauges are callables sampled on export (e.g. queue depth).
+
+    End-to-end latency: mark_ingress() records when a frame (stream, PTS)
+    left the streammux, mark_egress() (the egress pad of the output branch,
+    ahead of any tiler/OSD) observes the time since then into
+    latency_seconds{stream=...}. The stamps and the frames/objects counts
+    of the egress probe live in one _StreamFrames per stream, so a frame
+    costs one lookup; at most max_pending stamps are kept per stream.
+    """
+    def __init__(self, clock=time.perf_counter, max_pending=4096):
+        self.clock = clock
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.histogram_labels = {}
+        self.histogram_bounds = {}
+        self.gauges = {}
+        # stream_id: _StreamFrames, the frames and objects counters and
+        # latency stamps of mark_ingress/mark_egress
+        self.streams = {}
+        self.started = clock()
+        self.last_frames = {}
+        self.last_report = self.started
+        for name, help in PIPELINE_COUNTERS.items():
+            self.define_counter(name, help)
+        self.define_histogram('probe_seconds', 'stage', "Pad probe execution time")
+        self.define_histogram('latency_seconds', 'stream',
+                              "Time per frame from the streammux to the egress probe after the last GIE "
+                              "(before the tiler/OSD, no OSD with --output=none)")
+
+    def define_counter(self, name, help):
+        self.help[name] = help
+
+    def define_histogram(self, name, label, help, bounds=DEFAULT_BUCKETS):
+        self.help[name] = help
+        self.histogram_labels[name] = label
+        self.histogram_bounds[name] = bounds
+
+    def define_gauge(self, name, help, sample):
+        self.help[name] = help
+        self.gauges[name] = sample
+
+    def inc(self, name, stream_id=None, value=1):
+        key = (name, stream_id)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def inc_many(self, updates):
+        """inc() for every (name, stream_id, value) of updates, under one lock."""
+        counters = self.counters
+        with self.lock:
+            for name, stream_id, value in updates:
+                key = (name, stream_id)
+                counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, label, value):
+        with self.lock:
+            self._histogram(name, label).observe(value)
+
+    def _histogram(self, name, label):
+        # with self.lock held
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[(name, label)] = Histogram(self.histogram_bounds[name])
+        return histogram
+
+    def timed(self, stage, probe):
+        """Wrap a pad probe so its execution time lands in probe_seconds{stage}."""
+        clock = self.clock
+
+        def timed_probe(pad, info, u_data):
+            t0 = clock()
+            try:
+                return probe(pad, info, u_data)
+            finally:
+                self.observe('probe_seconds', stage, clock() - t0)
+        return timed_probe
+
+    def _stream(self, stream_id):
+        # with self.lock held
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            stream = self.streams[stream_id] = _StreamFrames()
+        return stream
+
+    def mark_ingress(self, stream_id, pts):
+        self.mark_ingress_frames(((stream_id, pts),))
+
+    def mark_ingress_frames(self, keys):
+        """mark_ingress() for every (stream_id, pts) of a batch."""
+        now = self.clock()
+        streams = self.streams
+        with self.lock:
+            for stream_id, pts in keys:
+                pending = (streams.get(stream_id) or self._stream(stream_id)).pending
+                pending[pts] = now
+                if len(pending) > self.max_pending:
+                    _drop_oldest(pending, self.max_pending // 2)
+
+    def mark_egress(self, stream_id, pts):
+        now = self.clock()
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            start = stream.pending.pop(pts, None) if stream is not None else None
+            if start is not None:
+                (stream.latency or self._latency(stream, stream_id)).observe(now - start)
+
+    def mark_egress_frames(self, frames):
+        """For every (stream_id, pts, num_objects) of a batch: mark_egress()
+        and the frames and objects counters, in one pass under the lock."""
+        now = self.clock()
+        streams = self.streams
+        with self.lock:
+            for stream_id, pts, objects in frames:
+                stream = streams.get(stream_id) or self._stream(stream_id)
+                stream.frames += 1
+                stream.objects += objects
+                start = stream.pending.pop(pts, None)
+                if start is not None:
+                    (stream.latency or self._latency(stream, stream_id)).observe(now - start)
+
+    def _latency(self, stream, stream_id):
+        # with self.lock held: the stream's latency_seconds histogram
+        stream.latency = self._histogram('latency_seconds', stream_id)
+        return stream.latency
+
+    def remove_stream(self, stream_id):
+        """Drop the per-stream counters, latency and fps state of a removed source."""
+        with self.lock:
+            for key in [key for key in self.counters if key[1] == stream_id]:
+                del self.counters[key]
+            self.histograms.pop(('latency_seconds', stream_id), None)
+            self.streams.pop(stream_id, None)
+        self.last_frames.pop(stream_id, None)
+
+    def snapshot(self, reset_rates=True):
+        """Plain-dict copy of every metric, plus per-stream fps since the last
+        rate reset (scrapes pass reset_rates=False to leave the window alone)."""
+        now = self.clock()
+        with self.lock:
+            counters = dict(self.counters)
+            for stream_id, stream in self.streams.items():
+                if stream.frames:
+                    for key, value in ((('frames', stream_id), stream.frames),
+                                       (('objects', stream_id), stream.objects)):
+                        counters[key] = counters.get(key, 0) + value
+            histograms = {key: (h.bounds, list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+        elapsed = max(now - self.last_report, 1e-9)
+        fps = {}
+        for (name, stream_id), value in counters.items():
+            if name == 'frames':
+                fps[stream_id] = (value - self.last_frames.get(stream_id, 0)) / elapsed
+                if reset_rates:
+                    self.last_frames[stream_id] = value
+        if reset_rates:
+            self.last_report = now
+        return {
+            'uptime': now - self.started,
+            'fps': fps,
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': {name: sample() for name, sample in self.gauges.items()},
+        }
+
+    def to_json(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        counters = {}
+        for (name, stream_id), value in snapshot['counters'].items():
+            counters.setdefault(name, {})[str(stream_id)] = value
+        histograms = {}
+        for (name, label), (bounds, counts, total, count) in snapshot['histograms'].items():
+            histograms.setdefault(name, {})[str(label)] = {
+                'count': count,
+                'mean': total / count if count else 0.0,
+                'p50': _quantile(bounds, counts, count, 0.5),
+                'p99': _quantile(bounds, counts, count, 0.99),
+            }
+        return json.dumps({
+            'time': time.time(),
+            'uptime': round(snapshot['uptime'], 3),
+            'fps': {str(s): round(fps, 2) for s, fps in snapshot['fps'].items()},
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': snapshot['gauges'],
+        })
+
+    def render_prometheus(self, prefix='facepipe_'):
+        snapshot = self.snapshot(reset_rates=False)
+        lines = []
+        by_name = {}
+        for (name, stream_id), value in sorted(snapshot['counters'].items(), key=str):
+            by_name.setdefault(name, []).append((stream_id, value))
+        for name, values in by_name.items():
+            metric = prefix + name + '_total'
+            lines.append("# HELP {} {}".format(metric, self.help.get(name, name)))
+            lines.append("# TYPE {} counter".format(metric))
+            for stream_id, value in values:
+                labels = '' if stream_id is None else '{stream="%s"}' % stream_id
+                lines.append("{}{} {}".format(metric, labels, value))
+        by_name = {}
+        for (name, label), data in sorted(snapshot['histograms'].items(), key=str):
+            by_name.setdefault(name, []).append((label, data))
+        for name, values in by_name.items():
+            metric = prefix + name
+            label_name = self.histogram_labels[name]
+            lines.append("# HELP {} {}".format(metric, self.help.get(name, name)))
+            lines.append("# TYPE {} histogram".format(metric))
+            for label, (bounds, counts, total, count) in values:
+                cumulative = 0
+                for bound, bucket in zip(bounds + (float('inf'),), counts):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label_name, label, le, cumulative))
+                lines.append('%s_sum{%s="%s"} %r' % (metric, label_name, label, total))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label_name, label, count))
+        for name, value in snapshot['gauges'].items():
+            metric = prefix + name
+            lines.append("# HELP {} {}".format(metric, self.help.get(name, name)))
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(bounds, counts, count, q):
+    histogram = Histogram(bounds)
+    histogram.counts = counts
+    histogram.count = count
+    return histogram.quantile(q)
+
+
+class JsonLinesReporter:
+    """Write a JSON snapshot line every interval seconds from a daemon thread."""
+    def __init__(self, metrics, path=None, interval=5.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+        self.thread.start()
+        return self
+
+    def report(self):
+        line = self.metrics.to_json()
+        if self.path is None:
+            print(line)
+            sys.stdout.flush()
+        else:
+            with open(self.path, 'a') as f:
+                f.write(line + "\n")
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+
+def serve_prometheus(metrics, port, address=''):
+    """Expose metrics.render_prometheus() on http://address:port/metrics."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    from common import fake_pyds
+    from common.meta_walker import iter_frames, use_pyds
+
+    # Per-frame cost of the OSD-probe bookkeeping: ingress/egress latency
+    # tracking, frame and object counters and the timed() probe wrapper.
+    use_pyds(fake_pyds)
+    frames = 4
+    batch = fake_pyds.make_batch(frames, 20)
+    frame_metas = list(iter_frames(batch))
+    rounds = 20000
+    metrics = Metrics()
+
+    def bare_probe(pad, info, u_data):
+        for frame_meta in frame_metas:
+            pass
+
+    def metrics_probe(pad, info, u_data):
+        metrics.mark_egress_frames([(frame_meta.pad_index, frame_meta.buf_pts, frame_meta.num_obj_meta)
+                                    for frame_meta in frame_metas])
+
+    def run(probe, ingress):
+        t0 = time.perf_counter()
+        for n in range(rounds):
+            for frame_meta in frame_metas:
+                frame_meta.buf_pts = n
+            if ingress:
+                metrics.mark_ingress_frames([(frame_meta.pad_index, n) for frame_meta in frame_metas])
+            probe(None, None, None)
+        return (time.perf_counter() - t0) / rounds / frames * 1e6
+
+    # best of 9 interleaved runs, as timeit does: the slower ones measure other processes
+    timed_probe = metrics.timed('osd', metrics_probe)
+    runs = [(run(bare_probe, False), run(timed_probe, True)) for _ in range(9)]
+    bare = min(bare for bare, _ in runs)
+    instrumented = min(instrumented for _, instrumented in runs)
+    print("metrics overhead per frame: %.2f us" % (instrumented - bare))
+    # stamps of frames that never reach egress stay bounded, the newest kept
+    for n in range(10000):
+        metrics.mark_ingress_frames([(7, n)])
+    pending = metrics.streams[7].pending
+    assert metrics.max_pending // 2 <= len(pending) <= metrics.max_pending and 9999 in pending and 0 not in pending
+    print(metrics.to_json())
+
+    # ingress on one thread, egress and stream removal on another
+    metrics = Metrics()
+    errors = []
+
+    def ingress():
+        for n in range(200000):
+            metrics.mark_ingress(n % 8, n)
+
+    def egress():
+        try:
+            for n in range(200000):
+                metrics.mark_egress(n % 8, n)
+                if n % 1000 == 0:
+                    metrics.remove_stream(n % 8)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ingress), threading.Thread(target=egress)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    print("ok: concurrent ingress/egress/remove_stream")
@@ -0,0 +1,243 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import math
+import sys
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from common.is_aarch_64 import is_aarch64
+
+# none: metadata only, the pipeline ends in a fakesink after the last GIE
+# file: tiled OSD view encoded to an mp4 file
+# rtsp: tiled OSD view served over RTSP
+OUTPUT_NONE = 'none'
+OUTPUT_FILE = 'file'
+OUTPUT_RTSP = 'rtsp'
+OUTPUT_MODES = (OUTPUT_NONE, OUTPUT_FILE, OUTPUT_RTSP)
+
+TILED_OUTPUT_WIDTH = 1280
+TILED_OUTPUT_HEIGHT = 720
+OSD_PROCESS_MODE = 0
+OSD_DISPLAY_TEXT = 1
+RTSP_UDP_PORT = 5400
+RTSP_MOUNT = "/ds-test"
+RTSP_BITRATE = 4000000
+
+
+def add_output_arguments(parser):
+    group = parser.add_argument_group('output')
+    group.add_argument('--output', choices=OUTPUT_MODES, default=OUTPUT_FILE,
+                       help="where the annotated video goes (default: %(default)s)")
+    group.add_argument('--output-file', default="output.mp4",
+                       help="mp4 written in the file mode (default: %(default)s)")
+    group.add_argument('--output-width', type=int, default=TILED_OUTPUT_WIDTH,
+                       help="width of the tiled view (default: %(default)s)")
+    group.add_argument('--output-height', type=int, default=TILED_OUTPUT_HEIGHT,
+                       help="height of the tiled view (default: %(default)s)")
+    group.add_argument('--output-interval', type=int, default=1,
+                       help="encode one batch out of N, the others skip tiling, OSD and encoding "
+                            "(default: %(default)s)")
+    group.add_argument('--rtsp-port', type=int, default=8554,
+                       help="port of the RTSP server in the rtsp mode (default: %(default)s)")
+    return group
+
+
+def make_element(factory, name):
+    element = Gst.ElementFactory.make(factory, name)
+    if not element:
+        sys.stderr.write(" Unable to create %s \n" % name)
+    return element
+
+
+class FrameSampler:
+    '''
+    Pad probe passing one buffer out of interval and dropping the rest.
+    '''
+    def __init__(self, interval):
+        self.interval = max(1, interval)
+        self.count = 0
+
+    def __call__(self, pad, info, u_data):
+        self.count += 1
+        if (self.count - 1) % self.interval:
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+
+class OutputBranch:
+    '''
+    The elements after the last GIE. Upstream links into head; egress_pad
+    sees every batch that leaves inference, whatever the mode, so frame
+    counters and end-to-end latency are measured at the same place.
+    tiler and nvosd are None in the none mode.
+    '''
+    def __init__(self, mode, head, egress_pad, tiler=None, nvosd=None, rtsp_server=None):
+        self.mode = mode
+        self.head = head
+        self.egress_pad = egress_pad
+        self.tiler = tiler
+        self.nvosd = nvosd
+        self.rtsp_server = rtsp_server
+
+
+def _encoder_elements(options):
+    if options.output == OUTPUT_FILE:
+        print("Creating FileSink \n")
+        videoconvert = make_element("videoconvert", "video-converter")
+        x264enc = make_element("x264enc", "h264 encoder")
+        qtmux = make_element("qtmux", "muxer")
+        sink = make_element("filesink", "filesink")
+        sink.set_property("location", options.output_file)
+        sink.set_property("qos", 0)
+        sink.set_property("sync", 0)
+        return [videoconvert, x264enc, qtmux, sink]
+
+    print("Creating RTSP sink \n")
+    capsfilter = make_element("capsfilter", "encoder-caps")
+    capsfilter.set_property("caps", Gst.Caps.from_string("video/x-raw(memory:NVMM), format=I420"))
+    encoder = make_element("nvv4l2h264enc", "h264 encoder")
+    encoder.set_property("bitrate", RTSP_BITRATE)
+    if is_aarch64():
+        encoder.set_property("preset-level", 1)
+        encoder.set_property("insert-sps-pps", 1)
+    rtppay = make_element("rtph264pay", "rtppay")
+    sink = make_element("udpsink", "udpsink")
+    sink.set_property("host", "224.224.255.255")
+    sink.set_property("port", RTSP_UDP_PORT)
+    sink.set_property("async", False)
+    sink.set_property("sync", 1)
+    sink.set_property("qos", 0)
+    return [capsfilter, encoder, rtppay, sink]
+
+
+def start_rtsp_server(port):
+    gi.require_version('GstRtspServer', '1.0')
+    from gi.repository import GstRtspServer
+
+    server = GstRtspServer.RTSPServer.new()
+    server.props.service = str(port)
+    server.attach(None)
+    factory = GstRtspServer.RTSPMediaFactory.new()
+    factory.set_launch(
+        '( udpsrc name=pay0 port=%d buffer-size=524288 caps="application/x-rtp, media=video, '
+        'clock-rate=90000, encoding-name=(string)H264, payload=96 " )' % RTSP_UDP_PORT)
+    factory.set_shared(True)
+    server.get_mount_points().add_factory(RTSP_MOUNT, factory)
+    print("\n *** RTSP stream ready at rtsp://localhost:%d%s ***\n\n" % (port, RTSP_MOUNT))
+    return server
+
+
+def build_output_branch(pipeline, options, number_sources):
+    '''
+    Create, add and link the output elements for options.output (see
+    add_output_arguments). The caller links the last GIE to branch.head.
+    '''
+    head = make_element("queue", "output-queue")
+    if options.output == OUTPUT_NONE:
+        print("Creating FakeSink \n")
+        sink = make_element("fakesink", "fakesink")
+        sink.set_property("sync", 0)
+        sink.set_property("qos", 0)
+        sink.set_property("enable-last-sample", 0)
+        elements = [head, sink]
+        branch = OutputBranch(options.output, head, sink.get_static_pad("sink"))
+    else:
+        print("Creating tiler \n ")
+        tiler = make_element("nvmultistreamtiler", "nvtiler")
+        tiler_rows = int(math.sqrt(number_sources))
+        tiler_columns = int(math.ceil((1.0 * number_sources) / tiler_rows))
+        tiler.set_property("rows", tiler_rows)
+        tiler.set_property("columns", tiler_columns)
+        tiler.set_property("width", options.output_width)
+        tiler.set_property("height", options.output_height)
+        print("Creating nvvidconv \n ")
+        nvvidconv = make_element("nvvideoconvert", "convertor")
+        print("Creating nvosd \n ")
+        nvosd = make_element("nvdsosd", "onscreendisplay")
+        nvosd.set_property('process-mode', OSD_PROCESS_MODE)
+        nvosd.set_property('display-text', OSD_DISPLAY_TEXT)
+        nvvidconv1 = make_element("nvvideoconvert", "convertor1")
+        elements = [head, tiler, make_element("queue", "tiler-queue"), nvvidconv,
+                    make_element("queue", "osd-queue"), nvosd, nvvidconv1] + _encoder_elements(options)
+        rtsp_server = start_rtsp_server(options.rtsp_port) if options.output == OUTPUT_RTSP else None
+        branch = OutputBranch(options.output, head, head.get_static_pad("sink"), tiler, nvosd, rtsp_server)
+        if options.output_interval > 1:
+            # sampled batches are dropped before the tiler, the metadata
+            # probes upstream still see every one of them
+            tiler.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER,
+                                                   FrameSampler(options.output_interval), 0)
+
+    for element in elements:
+        pipeline.add(element)
+    for upstream, downstream in zip(elements, elements[1:]):
+        if not upstream.link(downstream):
+            sys.stderr.write(" Unable to link %s to %s \n" % (upstream.get_name(), downstream.get_name()))
+    return branch
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from gi.repository import GLib
+
+    # usage: python -m common.output_branch <uri> [seconds]
+    # Decode -> nvstreammux -> output branch, without inference, for every
+    # mode: the gap to the none mode is what the output costs the pipeline.
+    uri = sys.argv[1]
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    Gst.init(None)
+
+    runs = [(OUTPUT_NONE, 1), (OUTPUT_FILE, 1), (OUTPUT_FILE, 5), (OUTPUT_RTSP, 1)]
+    results = []
+    for mode, interval in runs:
+        parser = argparse.ArgumentParser()
+        add_output_arguments(parser)
+        options = parser.parse_args(['--output', mode, '--output-interval', str(interval),
+                                     '--output-file', '/tmp/output_branch_bench.mp4'])
+        pipeline = Gst.parse_launch(
+            'uridecodebin uri=%s ! queue ! nvvideoconvert ! m.sink_0 '
+            'nvstreammux name=m width=1920 height=1080 batch-size=1 batched-push-timeout=4000000' % uri)
+        streammux = pipeline.get_by_name("m")
+        branch = build_output_branch(pipeline, options, 1)
+        streammux.link(branch.head)
+        frames = [0]
+
+        def on_buffer(pad, info, u_data):
+            frames[0] += 1
+            return Gst.PadProbeReturn.OK
+
+        branch.egress_pad.add_probe(Gst.PadProbeType.BUFFER, on_buffer, 0)
+        loop = GLib.MainLoop()
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::eos", lambda *_: loop.quit())
+        bus.connect("message::error", lambda bus, message: (print(message.parse_error()), loop.quit()))
+        GLib.timeout_add(int(seconds * 1000), loop.quit)
+        start = time.perf_counter()
+        pipeline.set_state(Gst.State.PLAYING)
+        loop.run()
+        elapsed = time.perf_counter() - start
+        pipeline.set_state(Gst.State.NULL)
+        results.append((mode, interval, frames[0], frames[0] / elapsed))
+
+    print("%-6s %8s %8s %10s" % ("mode", "interval", "frames", "fps"))
+    for mode, interval, count, fps in results:
+        print("%-6s %8d %8d %10.1f" % (mode, interval, count, fps))
@@ -0,0 +1,478 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+'''
+Inference part of the pipeline (nvstreammux -> queue -> stage -> queue ->
+stage ...) built from a topology spec such as configs/pipeline_person_face.txt:
+
+    [pipeline]
+    stages=pgie;tracker;sgie;tgie
+    muxer-width=1920
+
+    [pgie]
+    type=nvinfer
+    config-file=configs/config_yolor.txt
+    batch-size=0
+
+Stage keys: type (nvinfer or nvtracker), name (element name), config-file,
+enable, batch-size and interval (nvinfer properties overriding the config
+file; batch-size 0 means one frame per source), queue-max-buffers and
+queue-leaky (no, upstream or downstream) for the queue in front of the stage.
+
+The probes find their objects through the roles of the [pipeline] section:
+person=<stage>:<class id> (persons, whose crops go to the face detector;
+none for topologies detecting faces on full frames), face=<stage>:<class id>
+and embedding=<stage> (whose tensor output on a face is its embedding).
+Without these keys a spec reads as the person -> face -> embedding topology.
+Loading and validation only read files, so the spec can be checked and
+described without GStreamer or DeepStream; Gst is imported by build_pipeline.
+'''
+
+import configparser
+import os
+import sys
+
+MUXER_OUTPUT_WIDTH = 1920
+MUXER_OUTPUT_HEIGHT = 1080
+MUXER_BATCH_TIMEOUT_USEC = 4000000
+
+STAGE_TYPES = ('nvinfer', 'nvtracker')
+QUEUE_LEAKY = {'no': 0, 'upstream': 1, 'downstream': 2}
+# nvinfer process-mode
+PROCESS_MODE_FULL_FRAME = 1
+PROCESS_MODE_OBJECTS = 2
+# Stage roles of the probes when a spec does not name them
+DEFAULT_ROLES = {'person': 'pgie:0', 'face': 'sgie:1', 'embedding': 'tgie'}
+# nvtracker keys read from the tracker config file
+TRACKER_INT_KEYS = {'tracker-width': 'tracker-width', 'tracker-height': 'tracker-height',
+                    'gpu-id': 'gpu_id', 'enable-past-frame': 'enable_past_frame',
+                    'enable-batch-process': 'enable_batch_process'}
+TRACKER_STR_KEYS = {'ll-lib-file': 'll-lib-file', 'll-config-file': 'll-config-file'}
+
+
+class PipelineSpecError(ValueError):
+    def __init__(self, path, problems):
+        super().__init__("invalid pipeline spec {}:\n  {}".format(path, "\n  ".join(problems)))
+        self.problems = problems
+
+
+class StageSpec:
+    __slots__ = ('name', 'type', 'element_name', 'config_file', 'enable', 'batch_size', 'interval',
+                 'queue_max_buffers', 'queue_leaky', 'infer_config')
+
+    def __init__(self, name, section):
+        self.name = name
+        self.type = section.get('type', 'nvinfer')
+        self.element_name = section.get('name', name)
+        self.config_file = section.get('config-file')
+        self.enable = section.getboolean('enable', fallback=True)
+        self.batch_size = section.getint('batch-size', fallback=None)
+        self.interval = section.getint('interval', fallback=None)
+        self.queue_max_buffers = section.getint('queue-max-buffers', fallback=None)
+        self.queue_leaky = section.get('queue-leaky', 'no')
+        # [property] of the nvinfer config file, filled by load_pipeline_spec
+        self.infer_config = None
+
+    def infer_int(self, key, default=None):
+        if self.infer_config is None or key not in self.infer_config:
+            return default
+        return int(self.infer_config[key])
+
+    def operates_on_class(self, class_id):
+        '''Whether operate-on-class-ids lets class_id in; unset means all classes.'''
+        classes = (self.infer_config or {}).get('operate-on-class-ids', '').replace(';', ' ').split()
+        return not classes or str(class_id) in classes
+
+    @property
+    def gie_id(self):
+        return self.infer_int('gie-unique-id')
+
+    @property
+    def process_mode(self):
+        return self.infer_int('process-mode', PROCESS_MODE_FULL_FRAME)
+
+    def resolved_batch_size(self, number_sources):
+        '''
+        Full-frame stages batch one frame per source; object stages keep the
+        config file value unless the spec overrides it.
+        '''
+        if self.batch_size:
+            return self.batch_size
+        if self.process_mode == PROCESS_MODE_FULL_FRAME:
+            return number_sources
+        return self.infer_int('batch-size', 1)
+
+
+class PipelineSpec:
+    def __init__(self, path, muxer_width, muxer_height, muxer_timeout, stages, roles=None):
+        self.path = path
+        self.muxer_width = muxer_width
+        self.muxer_height = muxer_height
+        self.muxer_timeout = muxer_timeout
+        self.stages = stages
+        self.roles = dict(DEFAULT_ROLES, **(roles or {}))
+
+    @property
+    def enabled_stages(self):
+        return [stage for stage in self.stages if stage.enable]
+
+    def _role(self, role):
+        '''(stage, class id or None) of a role, or None for person=none.'''
+        value = self.roles[role].strip()
+        if value.lower() == 'none':
+            return None
+        name, _, class_id = value.partition(':')
+        stage = next((stage for stage in self.enabled_stages if stage.name == name.strip()), None)
+        return stage, int(class_id) if class_id.strip() else None
+
+    def role_stage(self, role):
+        '''Name of the stage of a role, None for person=none.'''
+        resolved = self._role(role)
+        return resolved[0].name if resolved is not None else None
+
+    def min_object_size(self, role):
+        '''
+        (input-object-min-width, input-object-min-height) of the stage of a
+        role, (0, 0) when unset: nvinfer skips smaller objects.
+        '''
+        resolved = self._role(role)
+        if resolved is None or resolved[0] is None:
+            return 0, 0
+        stage = resolved[0]
+        return stage.infer_int('input-object-min-width', 0), stage.infer_int('input-object-min-height', 0)
+
+    def role(self, role):
+        '''
+        (gie-unique-id, class id) of the person or face detections, the
+        gie-unique-id of the embedding stage, None without a person stage.
+        '''
+        resolved = self._role(role)
+        if resolved is None:
+            return None
+        stage, class_id = resolved
+        return stage.gie_id if role == 'embedding' else (stage.gie_id, class_id)
+
+    def validate(self, number_sources):
+        '''
+        Raise PipelineSpecError listing every problem found: missing files,
+        duplicate gie-unique-ids, object stages operating on a GIE that is
+        not upstream, batch sizes the muxer cannot feed, stages that need a
+        tracker or a parent object they will not get, and roles naming a
+        class the next stage does not operate on.
+        '''
+        problems = []
+        stages = self.enabled_stages
+        if not stages:
+            problems.append("no enabled stages")
+        upstream = {}
+        tracked = False
+        for stage in stages:
+            where = "[{}]".format(stage.name)
+            if stage.type not in STAGE_TYPES:
+                problems.append("{} unknown type {!r}, expected one of {}".format(where, stage.type, ", ".join(STAGE_TYPES)))
+                continue
+            if stage.queue_leaky not in QUEUE_LEAKY:
+                problems.append("{} queue-leaky must be one of {}".format(where, ", ".join(QUEUE_LEAKY)))
+            if stage.queue_max_buffers is not None and stage.queue_max_buffers < 1:
+                problems.append("{} queue-max-buffers must be positive".format(where))
+            if not stage.config_file or not os.path.isfile(stage.config_file):
+                problems.append("{} config-file {!r} not found".format(where, stage.config_file))
+                continue
+            if stage.type == 'nvtracker':
+                if tracked:
+                    problems.append("{} more than one tracker".format(where))
+                if not upstream:
+                    problems.append("{} tracker before any detector".format(where))
+                tracked = True
+                continue
+
+            gie_id = stage.gie_id
+            if gie_id is None:
+                problems.append("{} {} has no gie-unique-id".format(where, stage.config_file))
+                continue
+            if gie_id in upstream:
+                problems.append("{} gie-unique-id {} already used by [{}]".format(where, gie_id, upstream[gie_id].name))
+            batch_size = stage.resolved_batch_size(number_sources)
+            if batch_size < 1:
+                problems.append("{} batch-size must be positive".format(where))
+            if stage.process_mode == PROCESS_MODE_FULL_FRAME:
+                if batch_size != number_sources:
+                    problems.append("{} full-frame batch-size {} does not match the {} sources batched by the muxer"
+                                    .format(where, batch_size, number_sources))
+            else:
+                operate_on = stage.infer_int('operate-on-gie-id', -1)
+                if operate_on not in upstream:
+                    problems.append("{} operate-on-gie-id {} is not an upstream GIE (upstream: {})"
+                                    .format(where, operate_on, sorted(upstream) or "none"))
+                elif (stage.infer_int('alignments', 0) == 1
+                      and upstream[operate_on].process_mode != PROCESS_MODE_OBJECTS):
+                    problems.append("{} alignments=1 needs the landmarks of parent objects, but [{}] is a full-frame "
+                                    "detector (use alignments=2)".format(where, upstream[operate_on].name))
+                if stage.infer_int('classifier-async-mode', 0) and not tracked:
+                    problems.append("{} classifier-async-mode needs a tracker upstream".format(where))
+            upstream[gie_id] = stage
+        problems += self._role_problems()
+        if problems:
+            raise PipelineSpecError(self.path, problems)
+
+    def _role_problems(self):
+        problems = []
+        resolved = {}
+        for role in ('person', 'face', 'embedding'):
+            where = "[pipeline] {}={}".format(role, self.roles[role])
+            try:
+                value = self._role(role)
+            except ValueError:
+                problems.append("{}: expected <stage>:<class id>".format(where))
+                continue
+            if value is None:
+                if role != 'person':
+                    problems.append("{}: a {} stage is required".format(where, role))
+                continue
+            stage, class_id = value
+            if stage is None or stage.type != 'nvinfer' or stage.gie_id is None:
+                problems.append("{}: not an enabled nvinfer stage".format(where))
+            elif (role == 'embedding') != (class_id is None):
+                problems.append("{}: expected {}".format(where, "<stage>" if role == 'embedding' else "<stage>:<class id>"))
+            else:
+                resolved[role] = value
+        # each stage works on the objects of the role before it, and on
+        # their class, so the objects the probes pick are the ones it infers on
+        for role, source in (('face', 'person'), ('embedding', 'face')):
+            if role not in resolved or source not in resolved:
+                continue
+            stage, (source_stage, source_class) = resolved[role][0], resolved[source]
+            if stage.process_mode != PROCESS_MODE_OBJECTS or \
+                    stage.infer_int('operate-on-gie-id', -1) != source_stage.gie_id:
+                problems.append("[{}] is the {} stage but does not operate on the {}s of [{}]"
+                                .format(stage.name, role, source, source_stage.name))
+            elif not stage.operates_on_class(source_class):
+                problems.append("[{}] is the {} stage but its operate-on-class-ids {} does not list the {} class {}"
+                                .format(stage.name, role, stage.infer_config.get('operate-on-class-ids'),
+                                        source, source_class))
+        # admission keeps a person from the face stage by moving it out of
+        # the classes the stage operates on, which an unset list cannot do
+        if 'face' in resolved and 'person' in resolved:
+            stage, person_class = resolved['face'][0], resolved['person'][1]
+            if not (stage.infer_config or {}).get('operate-on-class-ids', '').replace(';', ' ').split():
+                problems.append("[{}] is the face stage but its operate-on-class-ids does not list the person "
+                                "class {}".format(stage.name, person_class))
+        return problems
+
+    def describe(self, number_sources):
+        '''
+        Text form of the graph build_pipeline would create, one element per line.
+        '''
+        lines = ["pipeline {} ({} sources)".format(self.path, number_sources),
+                 "  nvstreammux Stream-muxer width={} height={} batch-size={} batched-push-timeout={}"
+                 .format(self.muxer_width, self.muxer_height, number_sources, self.muxer_timeout),
+                 "  roles " + " ".join("{}={}".format(role, self.roles[role]) for role in DEFAULT_ROLES)]
+        for stage in self.enabled_stages:
+            lines.append("  queue queue-{} max-size-buffers={} leaky={}".format(
+                stage.name, stage.queue_max_buffers or "default", stage.queue_leaky))
+            line = "  {} {} config={}".format(stage.type, stage.element_name, stage.config_file)
+            if stage.type == 'nvinfer':
+                line += " gie-id={}".format(stage.gie_id)
+                if stage.process_mode == PROCESS_MODE_OBJECTS:
+                    line += " operate-on-gie-id={}".format(stage.infer_int('operate-on-gie-id'))
+                else:
+                    line += " full-frame"
+                line += " batch-size={}".format(stage.resolved_batch_size(number_sources))
+                interval = stage.interval if stage.interval is not None else stage.infer_int('interval')
+                if interval:
+                    line += " interval={}".format(interval)
+                if stage.infer_int('alignments', 0):
+                    line += " alignments={}".format(stage.infer_int('alignments'))
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def _read_config(path):
+    # the nvinfer configs repeat keys (model-color-format)
+    config = configparser.ConfigParser(strict=False)
+    config.read(path)
+    return config
+
+
+def load_pipeline_spec(path):
+    if not os.path.isfile(path):
+        raise PipelineSpecError(path, ["file not found"])
+    config = _read_config(path)
+    if not config.has_section('pipeline'):
+        raise PipelineSpecError(path, ["missing [pipeline] section"])
+    section = config['pipeline']
+    names = [name.strip() for name in section.get('stages', '').split(';') if name.strip()]
+    missing = [name for name in names if not config.has_section(name)]
+    if missing:
+        raise PipelineSpecError(path, ["stage [{}] listed in stages but not defined".format(name) for name in missing])
+    stages = [StageSpec(name, config[name]) for name in names]
+    roles = {role: section[role] for role in DEFAULT_ROLES if role in section}
+    for stage in stages:
+        if stage.type == 'nvinfer' and stage.config_file and os.path.isfile(stage.config_file):
+            infer_config = _read_config(stage.config_file)
+            if infer_config.has_section('property'):
+                stage.infer_config = infer_config['property']
+    return PipelineSpec(path,
+                        section.getint('muxer-width', fallback=MUXER_OUTPUT_WIDTH),
+                        section.getint('muxer-height', fallback=MUXER_OUTPUT_HEIGHT),
+                        section.getint('muxer-batched-push-timeout', fallback=MUXER_BATCH_TIMEOUT_USEC),
+                        stages, roles)
+
+
+class PipelineGraph:
+    '''
+    Elements created by build_pipeline. Sources link to streammux, the
+    output branch links from tail; stages and queues are keyed by stage name
+    (queues[name] feeds stages[name]).
+    '''
+    def __init__(self, streammux):
+        self.streammux = streammux
+        self.stages = {}
+        self.queues = {}
+        self.tail = streammux
+
+
+def _configure_tracker(tracker, path):
+    config = _read_config(path)
+    for key, value in config['tracker'].items():
+        if key in TRACKER_INT_KEYS:
+            tracker.set_property(TRACKER_INT_KEYS[key], int(value))
+        elif key in TRACKER_STR_KEYS:
+            tracker.set_property(TRACKER_STR_KEYS[key], value)
+
+
+def build_pipeline(pipeline, spec, number_sources, is_live=False, engine_files=None):
+    '''
+    Validate spec, then create, add and link nvstreammux and the stages.
+    engine_files ({stage name: path}, see common.engine_cache) override the
+    model-engine-file of the nvinfer configs.
+    '''
+    from gi.repository import Gst
+
+    spec.validate(number_sources)
+
+    def make(factory, name):
+        element = Gst.ElementFactory.make(factory, name)
+        if not element:
+            sys.stderr.write(" Unable to create %s \n" % name)
+        pipeline.add(element)
+        return element
+
+    print("Creating streamux \n ")
+    streammux = make("nvstreammux", "Stream-muxer")
+    if is_live:
+        print("Atleast one of the sources is live")
+        streammux.set_property('live-source', 1)
+    streammux.set_property('width', spec.muxer_width)
+    streammux.set_property('height', spec.muxer_height)
+    streammux.set_property('batch-size', number_sources)
+    streammux.set_property('batched-push-timeout', spec.muxer_timeout)
+
+    graph = PipelineGraph(streammux)
+    for stage in spec.enabled_stages:
+        queue = make("queue", "queue-" + stage.name)
+        if stage.queue_max_buffers:
+            queue.set_property('max-size-buffers', stage.queue_max_buffers)
+            queue.set_property('max-size-bytes', 0)
+            queue.set_property('max-size-time', 0)
+        queue.set_property('leaky', QUEUE_LEAKY[stage.queue_leaky])
+
+        print("Creating {} \n ".format(stage.element_name))
+        element = make(stage.type, stage.element_name)
+        if stage.type == 'nvtracker':
+            _configure_tracker(element, stage.config_file)
+        else:
+            element.set_property('config-file-path', stage.config_file)
+            batch_size = stage.resolved_batch_size(number_sources)
+            if batch_size != stage.infer_int('batch-size', 1):
+                print("Overriding infer-config batch-size {} of {} with {}".format(
+                    stage.infer_int('batch-size', 1), stage.element_name, batch_size))
+            element.set_property('batch-size', batch_size)
+            if engine_files and stage.name in engine_files:
+                element.set_property('model-engine-file', os.path.abspath(engine_files[stage.name]))
+            if stage.interval is not None:
+                element.set_property('interval', stage.interval)
+
+        for upstream, downstream in ((graph.tail, queue), (queue, element)):
+            if not upstream.link(downstream):
+                sys.stderr.write(" Unable to link %s to %s \n" % (upstream.get_name(), downstream.get_name()))
+        graph.queues[stage.name] = queue
+        graph.stages[stage.name] = element
+        graph.tail = element
+    return graph
+
+
+def _check():
+    import shutil
+    import tempfile
+
+    # the shipped specs are valid for the sources they are run with
+    for path in ("configs/pipeline_person_face.txt", "configs/pipeline_fullframe_face.txt"):
+        load_pipeline_spec(path).validate(4)
+    # person crops the face stage skips are not worth admitting
+    assert load_pipeline_spec("configs/pipeline_person_face.txt").min_object_size('face') == (64, 64)
+    root = tempfile.mkdtemp()
+    try:
+        configs = {
+            "det": "gie-unique-id=1\n",
+            "face": "gie-unique-id=2\nprocess-mode=2\noperate-on-gie-id=1\noperate-on-class-ids=0\n",
+            "emb": "gie-unique-id=3\nprocess-mode=2\noperate-on-gie-id=2\noperate-on-class-ids=1\n",
+            "emb_all": "gie-unique-id=3\nprocess-mode=2\noperate-on-gie-id=2\n",
+        }
+        for name, body in configs.items():
+            with open(os.path.join(root, name + ".txt"), 'w') as f:
+                f.write("[property]\n" + body)
+
+        def spec(face, embedder="emb"):
+            path = os.path.join(root, "pipeline.txt")
+            with open(path, 'w') as f:
+                f.write("[pipeline]\nstages=pgie;sgie;tgie\nface={}\n".format(face))
+                for stage, config in (("pgie", "det"), ("sgie", "face"), ("tgie", embedder)):
+                    f.write("[{}]\nconfig-file={}\n".format(stage, os.path.join(root, config + ".txt")))
+            return load_pipeline_spec(path)
+
+        spec("sgie:1").validate(1)
+        # no operate-on-class-ids: the embedder runs on every face class
+        spec("sgie:0", "emb_all").validate(1)
+        # the embedder never runs on class 0, so those faces have no embedding
+        try:
+            spec("sgie:0").validate(1)
+        except PipelineSpecError as e:
+            assert e.problems == ["[tgie] is the embedding stage but its operate-on-class-ids 1 does not list "
+                                  "the face class 0"], e.problems
+        else:
+            raise AssertionError("face class 0 passed validation")
+    finally:
+        shutil.rmtree(root)
+    print("ok: shipped specs, role classes checked against operate-on-class-ids, face stage minimum size")
+
+
+if __name__ == '__main__':
+    # usage: python -m common.pipeline_builder [<spec> [number_sources]]
+    # Validate a spec and print the graph it describes, no GStreamer needed.
+    # Without arguments, run the checks (from src/).
+    if len(sys.argv) < 2:
+        _check()
+        sys.exit(0)
+    spec = load_pipeline_spec(sys.argv[1])
+    number_sources = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    try:
+        spec.validate(number_sources)
+    except PipelineSpecError as e:
+        print(e)
+        sys.exit(1)
+    print(spec.describe(number_sources))
@@ -0,0 +1,298 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Scaling benchmark of the Python side of main.py.
+
+Synthetic batches with a given number of streams, persons per frame, face
+rate and track lifetime are replayed through the probes and state stores
+(common.replay). Every scenario runs in a fresh interpreter so its peak
+RSS is its own. For every scenario the per-batch latency percentiles of
+each probe, the streaming-thread and post-probe worker utilization at the
+frame rate, the memory allocated by the app code (tracemalloc) and the
+peak RSS are reported; --json writes them for tracking across versions and
+--compare flags regressions against such a file.
+
+    cd src && python -m common.probe_bench --streams 1,4,16,32 --persons 5,20 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from common.recording import FRAME_DTYPE, OBJECT_DTYPE, TENSOR_DTYPE, RecordedBatch
+
+SCENARIO_DEFAULTS = {'streams': 4, 'persons': 10, 'face_rate': 0.5, 'lifetime': 100, 'batches': 300,
+                     'warmup': 50, 'fps': 25.0, 'identities': 1000, 'dim': 512, 'admission': True, 'seed': 0}
+# Files of the code under test, for the allocation figures
+APP_FILES = ('main.py', 'track_store.py', 'admission.py', 'face_quality.py', 'metrics.py', 'event_sink.py',
+             'gallery.py', 'meta_walker.py', 'tensor_reader.py', 'work_queue.py')
+PERSON_GIE = 1
+FACE_GIE = 2
+# class of the faces, the one the embedder operates on
+FACE_CLASS = 1
+
+
+def synthetic_batches(streams, persons, face_rate, lifetime, batches, identities, dim=512, fps=25.0, seed=0,
+                      noise=0.3):
+    """Yield RecordedBatches of streams frames with persons persons each.
+
+    A person keeps its id for lifetime frames (staggered, so a
+    persons/lifetime share of each frame's persons is new), and has a face
+    with an embedding near one of identities vectors in face_rate of the
+    frames (see identity_vectors).
+    """
+    vectors = identity_vectors(identities, dim, seed)
+    rng = np.random.default_rng(seed + 1)
+    noise_rows = (noise * rng.standard_normal((1024, dim))).astype(np.float32)
+    slots = np.arange(persons)
+    stagger = slots * lifetime // max(persons, 1)
+    for n in range(batches):
+        person_ids = ((n + stagger) // lifetime) * persons + slots
+        has_face = rng.random((streams, persons)) < face_rate
+        faces_per_frame = has_face.sum(axis=1)
+        counts = persons + faces_per_frame
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        frames = np.zeros(streams, dtype=FRAME_DTYPE)
+        frames['pad_index'] = frames['source_id'] = np.arange(streams)
+        frames['frame_num'] = n
+        frames['buf_pts'] = int(n * 1e9 / fps)
+        frames['num_objects'] = counts
+
+        objects = np.zeros(int(counts.sum()), dtype=OBJECT_DTYPE)
+        person_rows = (starts[:, None] + slots[None, :]).ravel()
+        boxes = np.empty((streams * persons, 4), dtype=np.float32)
+        boxes[:, 0] = rng.uniform(0, 1600, len(boxes))
+        boxes[:, 1] = rng.uniform(0, 700, len(boxes))
+        boxes[:, 2] = rng.uniform(40, 300, len(boxes))
+        boxes[:, 3] = rng.uniform(80, 380, len(boxes))
+        objects['object_id'][person_rows] = ((np.arange(streams, dtype=np.uint64)[:, None] << np.uint64(32)) |
+                                             person_ids[None, :].astype(np.uint64)).ravel()
+        objects['component_id'][person_rows] = PERSON_GIE
+        objects['confidence'][person_rows] = rng.uniform(0.4, 1.0, len(person_rows))
+        objects['rect'][person_rows] = boxes
+        objects['parent'][person_rows] = -1
+
+        stream_of_face, slot_of_face = np.nonzero(has_face)
+        rank = np.arange(len(slot_of_face)) - np.concatenate(([0], np.cumsum(faces_per_frame)[:-1]))[stream_of_face]
+        face_rows = starts[stream_of_face] + persons + rank
+        parents = person_rows[stream_of_face * persons + slot_of_face]
+        parent_boxes = boxes[stream_of_face * persons + slot_of_face]
+        objects['object_id'][face_rows] = 0xFFFFFFFFFFFFFFFF
+        objects['component_id'][face_rows] = FACE_GIE
+        objects['class_id'][face_rows] = FACE_CLASS
+        objects['confidence'][face_rows] = rng.uniform(0.6, 1.0, len(face_rows))
+        objects['rect'][face_rows] = parent_boxes * np.array([1, 1, 0.4, 0.2], dtype=np.float32) + \
+            parent_boxes[:, 2:3] * np.array([0.3, 0, 0, 0], dtype=np.float32)
+        objects['parent'][face_rows] = parents
+
+        tensors = np.zeros(len(face_rows), dtype=TENSOR_DTYPE)
+        tensors['object'] = face_rows
+        tensors['unique_id'] = FACE_GIE
+        tensors['length'] = dim
+        identity = person_ids[slot_of_face] % identities
+        data = vectors[identity] + noise_rows[rng.integers(0, len(noise_rows), len(face_rows))]
+        yield RecordedBatch(frames, objects, tensors, data.ravel())
+
+
+def identity_vectors(identities, dim=512, seed=0):
+    """The vectors synthetic_batches draws faces around, for the gallery."""
+    return np.random.default_rng(seed).standard_normal((identities, dim)).astype(np.float32)
+
+
+def peak_rss_kib():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_scenario(scenario):
+    """Replay one scenario in this process; returns its results."""
+    from common.gallery import FaceGallery
+    from common.replay import Replay, load_app
+
+    s = dict(SCENARIO_DEFAULTS, **scenario)
+    app = load_app()
+    gallery = FaceGallery(dim=s['dim'], capacity=s['identities'])
+    gallery.add(np.arange(s['identities']), identity_vectors(s['identities'], s['dim'], s['seed']))
+    rss_start = peak_rss_kib()
+
+    def batches(count):
+        return synthetic_batches(s['streams'], s['persons'], s['face_rate'], s['lifetime'], count,
+                                 s['identities'], s['dim'], s['fps'], s['seed'])
+
+    replay = Replay(app, gallery, admission=s['admission'])
+    result = replay.run(batches(s['batches']), warmup=s['warmup'])
+    tracks = len(app.TRACKS)
+
+    # Allocations of the app code over a shorter run, with the batches
+    # built up front so the generator does not count
+    prebuilt = list(batches(min(s['batches'], s['warmup'] + 50)))
+    replay.reset()
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    replay.run(prebuilt)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    app_filter = [tracemalloc.Filter(True, "*" + os.sep + name) for name in APP_FILES]
+    diff = snapshot.filter_traces(app_filter).compare_to(base.filter_traces(app_filter), 'filename')
+    retained = sum(stat.size_diff for stat in diff)
+    blocks = sum(stat.count_diff for stat in diff)
+
+    latency = result['latency_us']
+    frame_interval_us = 1e6 / s['fps']
+    streaming = latency['batch']['mean'] - latency['post_probe']['mean']
+    return {
+        'scenario': s,
+        'latency_us': latency,
+        # share of the frame interval the probes take on the streaming
+        # thread, and the post-probe work spread over its workers
+        'streaming_utilization': round(streaming / frame_interval_us, 4),
+        'worker_utilization': round(latency['post_probe']['mean'] / frame_interval_us / app.POST_PROBE_WORKERS, 4),
+        'events': result['events'],
+        'tracks': tracks,
+        'memory': {'app_retained_kib': round(retained / 1024.0, 1), 'app_retained_blocks': blocks,
+                   'traced_peak_kib': round(traced_peak / 1024.0, 1),
+                   'peak_rss_kib': peak_rss_kib(), 'start_rss_kib': rss_start},
+    }
+
+
+def run_isolated(scenario, python=sys.executable):
+    """run_scenario() in a fresh interpreter, from the directory of main.py."""
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([python, "-m", "common.probe_bench", "--scenario", json.dumps(scenario)],
+                            cwd=src, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def max_streams(results, limit=1.0):
+    """{persons: largest streams count with both utilizations under limit}."""
+    best = {}
+    for result in results:
+        s = result['scenario']
+        fits = result['streaming_utilization'] < limit and result['worker_utilization'] < limit
+        if fits:
+            best[s['persons']] = max(best.get(s['persons'], 0), s['streams'])
+        else:
+            best.setdefault(s['persons'], 0)
+    return best
+
+
+def scenario_key(scenario):
+    return tuple(sorted((name, value) for name, value in scenario.items() if name in SCENARIO_DEFAULTS))
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing the scenarios whose mean or p99 batch latency grew by more than tolerance."""
+    previous = {scenario_key(result['scenario']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(scenario_key(result['scenario']))
+        if before is None:
+            continue
+        for stat in ('mean', 'p99'):
+            old, new = before['latency_us']['batch'][stat], result['latency_us']['batch'][stat]
+            if old and new > old * (1.0 + tolerance):
+                regressions.append("streams {} persons {}: batch {} {:.0f} -> {:.0f} us (+{:.0%})".format(
+                    result['scenario']['streams'], result['scenario']['persons'], stat, old, new, new / old - 1))
+    return regressions
+
+
+def report(results):
+    lines = ["streams persons  batch p50/p99 us   streaming  workers  app KiB  peak RSS MiB"]
+    for result in results:
+        s = result['scenario']
+        batch = result['latency_us']['batch']
+        lines.append("{:7d} {:7d} {:8.0f}/{:<8.0f} {:9.1%} {:8.1%} {:8.1f} {:13.1f}".format(
+            s['streams'], s['persons'], batch['p50'], batch['p99'], result['streaming_utilization'],
+            result['worker_utilization'], result['memory']['app_retained_kib'],
+            result['memory']['peak_rss_kib'] / 1024.0))
+    measured = max(result['scenario']['streams'] for result in results)
+    for persons, streams in sorted(max_streams(results).items()):
+        lines.append("{} persons per frame: {} streams fit in the frame interval at {:g} fps{}".format(
+            persons, streams, results[0]['scenario']['fps'], " (the most measured)" if streams == measured else ""))
+    return "\n".join(lines)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="python -m common.probe_bench",
+                                     description="Scaling benchmark of the probes and state stores of main.py")
+    parser.add_argument('--streams', default='1,4,16',
+                        help="comma separated stream counts (default: %(default)s)")
+    parser.add_argument('--persons', default='5,20',
+                        help="comma separated persons per frame (default: %(default)s)")
+    parser.add_argument('--face-rate', type=float, default=SCENARIO_DEFAULTS['face_rate'],
+                        help="share of the persons with a face per frame (default: %(default)s)")
+    parser.add_argument('--lifetime', type=int, default=SCENARIO_DEFAULTS['lifetime'],
+                        help="frames a person id lives, the track churn (default: %(default)s)")
+    parser.add_argument('--batches', type=int, default=SCENARIO_DEFAULTS['batches'],
+                        help="batches per scenario, after --warmup more (default: %(default)s)")
+    parser.add_argument('--warmup', type=int, default=SCENARIO_DEFAULTS['warmup'],
+                        help="batches replayed before timing (default: %(default)s)")
+    parser.add_argument('--fps', type=float, default=SCENARIO_DEFAULTS['fps'],
+                        help="frame rate of every stream (default: %(default)s)")
+    parser.add_argument('--no-admission', action='store_true',
+                        help="skip the SGIE admission probe, every recorded face reaches the tiler probe")
+    parser.add_argument('--json', metavar='FILE', default=None,
+                        help="write the results as JSON")
+    parser.add_argument('--compare', metavar='FILE', default=None,
+                        help="JSON of an earlier run: exit 1 if a scenario got slower than --tolerance")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed batch latency growth for --compare (default: %(default)s)")
+    parser.add_argument('--scenario', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.scenario:
+        print(json.dumps(run_scenario(json.loads(options.scenario))))
+        return 0
+
+    results = []
+    for persons in [int(value) for value in options.persons.split(',')]:
+        for streams in [int(value) for value in options.streams.split(',')]:
+            scenario = {'streams': streams, 'persons': persons, 'face_rate': options.face_rate,
+                        'lifetime': options.lifetime, 'batches': options.batches + options.warmup,
+                        'warmup': options.warmup, 'fps': options.fps, 'admission': not options.no_admission}
+            results.append(run_isolated(scenario))
+            sys.stderr.write("streams {} persons {}: {:.0f} us per batch\n".format(
+                streams, persons, results[-1]['latency_us']['batch']['mean']))
+    print(report(results))
+    output = {'time': time.time(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+              'results': results}
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(output, f, indent=1)
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for line in regressions:
+            print("regression: " + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,190 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import struct
+
+import numpy as np
+
+from common import fake_pyds, meta_walker
+from common.meta_walker import UNTRACKED_OBJECT_ID, iter_frames, iter_objects, iter_tensor_meta
+
+# <file> : header, then a block per batch: BLOCK header, the frame, object
+# and tensor records, then the tensor outputs as one float32 array
+MAGIC = b'FACEREC1'
+VERSION = 1
+HEADER = struct.Struct('<8sI')
+BLOCK = struct.Struct('<4sIIII')
+BLOCK_MAGIC = b'BTCH'
+FRAME_DTYPE = np.dtype([('pad_index', '<u4'), ('source_id', '<u4'), ('frame_num', '<i8'), ('buf_pts', '<u8'),
+                        ('ntp_timestamp', '<u8'), ('num_objects', '<u4')])
+# parent is the index of the parent object in the batch, -1 for none
+OBJECT_DTYPE = np.dtype([('class_id', '<i4'), ('object_id', '<u8'), ('component_id', '<i4'),
+                         ('confidence', '<f4'), ('rect', '<f4', (4,)), ('parent', '<i4')])
+# layer 0 of each tensor meta of an object, length floats each
+TENSOR_DTYPE = np.dtype([('object', '<u4'), ('unique_id', '<i4'), ('length', '<u4')])
+
+
+class RecordedBatch:
+    """The metadata of one batch, as recorded."""
+    __slots__ = ('frames', 'objects', 'tensors', 'data', '_outputs')
+
+    def __init__(self, frames, objects, tensors, data):
+        self.frames = frames
+        self.objects = objects
+        self.tensors = tensors
+        self.data = data
+        self._outputs = None
+
+    @property
+    def pts(self):
+        """Latest buffer PTS of the batch, in ns."""
+        return int(self.frames['buf_pts'].max()) if len(self.frames) else 0
+
+    def tensor_outputs(self, index):
+        """[(unique_id, array)] of the object at index."""
+        if self._outputs is None:
+            self._outputs = outputs = {}
+            offset = 0
+            for index_, unique_id, length in self.tensors.tolist():
+                outputs.setdefault(index_, []).append((unique_id, self.data[offset:offset + length]))
+                offset += length
+        return self._outputs.get(index, [])
+
+    def build(self, keep=None):
+        """A fresh fake_pyds.NvDsBatchMeta of the batch.
+
+        keep(frame, row) selects objects by their frame and object records;
+        objects whose parent was left out are left out too.
+        """
+        pyds = fake_pyds
+        metas = {}
+        frame_metas = []
+        start = 0
+        for frame in self.frames:
+            end = start + int(frame['num_objects'])
+            objects = []
+            for index in range(start, end):
+                row = self.objects[index]
+                parent = int(row['parent'])
+                if parent >= 0 and parent not in metas:
+                    continue
+                if keep is not None and not keep(frame, row):
+                    continue
+                left, top, width, height = row['rect'].tolist()
+                user_meta = [pyds.NvDsUserMeta(pyds.NvDsMetaType.NVDSINFER_TENSOR_OUTPUT_META,
+                                               pyds.NvDsInferTensorMeta([pyds.FakeLayerInfo(array)], unique_id))
+                             for unique_id, array in self.tensor_outputs(index)]
+                meta = pyds.NvDsObjectMeta(int(row['class_id']), int(row['object_id']), int(row['component_id']),
+                                           float(row['confidence']), pyds.NvOSD_RectParams(left, top, width, height),
+                                           metas.get(parent), user_meta)
+                metas[index] = meta
+                objects.append(meta)
+            frame_metas.append(pyds.NvDsFrameMeta(int(frame['frame_num']), int(frame['pad_index']),
+                                                  int(frame['source_id']), int(frame['buf_pts']),
+                                                  int(frame['ntp_timestamp']), objects))
+            start = end
+        return pyds.NvDsBatchMeta(frame_metas)
+
+
+class Recorder:
+    """Append the metadata of every batch seen by a pad probe to a file.
+
+    Per batch the frames, the objects (class, ids, box, confidence, parent)
+    and layer 0 of their tensor outputs are written as packed NumPy
+    records, ~50 bytes per object plus the tensors. read_recording() gives
+    them back and RecordedBatch.build() turns them into fake_pyds metadata
+    for common.replay. reader is the TensorReader used on the layers.
+    """
+    def __init__(self, path, reader=None):
+        if reader is None:
+            from common.tensor_reader import TensorReader
+            reader = TensorReader()
+        self.reader = reader
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.batches = 0
+
+    def record(self, batch_meta):
+        pyds = meta_walker.pyds
+        frames = []
+        objects = []
+        tensors = []
+        outputs = []
+        for frame_meta in iter_frames(batch_meta):
+            first = len(objects)
+            indices = {}
+            for obj_meta in iter_objects(frame_meta):
+                index = len(objects)
+                object_id = obj_meta.object_id
+                if object_id != UNTRACKED_OBJECT_ID:
+                    indices.setdefault(object_id, index)
+                parent = obj_meta.parent
+                rect = obj_meta.rect_params
+                objects.append((obj_meta.class_id, object_id, obj_meta.unique_component_id, obj_meta.confidence,
+                                (rect.left, rect.top, rect.width, rect.height),
+                                -1 if parent is None else indices.get(parent.object_id, -1)))
+                for tensor_meta in iter_tensor_meta(obj_meta):
+                    output = self.reader.layer_view(pyds.get_nvds_LayerInfo(tensor_meta, 0))
+                    tensors.append((index, tensor_meta.unique_id, len(output)))
+                    outputs.append(output)
+            frames.append((frame_meta.pad_index, frame_meta.source_id, frame_meta.frame_num, frame_meta.buf_pts,
+                           frame_meta.ntp_timestamp, len(objects) - first))
+        data = np.concatenate(outputs).astype(np.float32) if outputs else np.empty(0, dtype=np.float32)
+        self.file.write(BLOCK.pack(BLOCK_MAGIC, len(frames), len(objects), len(tensors), len(data)))
+        for records, dtype in ((frames, FRAME_DTYPE), (objects, OBJECT_DTYPE), (tensors, TENSOR_DTYPE)):
+            self.file.write(np.array(records, dtype=dtype).tobytes())
+        self.file.write(data.tobytes())
+        self.batches += 1
+
+    def probe(self, ok):
+        """Buffer probe recording every batch; returns ok (Gst.PadProbeReturn.OK)."""
+        record = self.record
+
+        def record_probe(pad, info, u_data):
+            gst_buffer = info.get_buffer()
+            if gst_buffer:
+                record(meta_walker.pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer)))
+            return ok
+        return record_probe
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(path):
+    """List of the RecordedBatches of a file, up to a torn last block."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s: not a metadata recording" % path)
+    batches = []
+    offset = HEADER.size
+    while offset + BLOCK.size <= len(data):
+        magic, num_frames, num_objects, num_tensors, num_floats = BLOCK.unpack_from(data, offset)
+        sizes = (num_frames * FRAME_DTYPE.itemsize, num_objects * OBJECT_DTYPE.itemsize,
+                 num_tensors * TENSOR_DTYPE.itemsize, num_floats * 4)
+        if magic != BLOCK_MAGIC or offset + BLOCK.size + sum(sizes) > len(data):
+            break
+        offset += BLOCK.size
+        arrays = []
+        for dtype, count, size in zip((FRAME_DTYPE, OBJECT_DTYPE, TENSOR_DTYPE, np.float32),
+                                      (num_frames, num_objects, num_tensors, num_floats), sizes):
+            arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += size
+        batches.append(RecordedBatch(*arrays))
+    return batches
@@ -0,0 +1,388 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import hashlib
+import importlib
+import sys
+import time
+import types
+
+from common import fake_gst, fake_pyds
+from common.admission import AdmissionScheduler
+from common.event_sink import EVENT_NAMES, EventSink
+from common.face_quality import QualityPolicy
+from common.meta_walker import iter_frames, iter_objects, use_pyds
+from common.metrics import Metrics
+from common.track_store import TrackStore
+
+PROBES = ('sgie', 'tiler', 'post_probe', 'egress', 'batch')
+
+
+def install_fakes():
+    """Make `import pyds` and `import gi` resolve to the stand-ins where they are missing."""
+    try:
+        import pyds
+    except ImportError:
+        sys.modules['pyds'] = fake_pyds
+    try:
+        import gi
+    except ImportError:
+        gi = types.ModuleType('gi')
+        gi.require_version = lambda namespace, version: None
+        repository = types.ModuleType('gi.repository')
+        repository.Gst = fake_gst
+        repository.GLib = types.ModuleType('GLib')
+        repository.GObject = types.ModuleType('GObject')
+        gi.repository = repository
+        sys.modules['gi'] = gi
+        sys.modules['gi.repository'] = repository
+
+
+def load_app(name='main'):
+    """Import the pipeline script (main.py) with its probes reading fake_pyds metadata."""
+    install_fakes()
+    app = importlib.import_module(name)
+    app.pyds = fake_pyds
+    use_pyds(fake_pyds)
+    return app
+
+
+class MediaClock:
+    """Clock of the state stores during a replay: the PTS of the current batch."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class InlineWorkers:
+    """FACE_WORKERS stand-in running the post-probe handler in the probe, timed."""
+    def __init__(self, handler):
+        self.handler = handler
+        self.elapsed = 0.0
+
+    def submit(self, records):
+        t0 = time.perf_counter()
+        self.handler(records)
+        self.elapsed += time.perf_counter() - t0
+        return len(records)
+
+    def stats(self):
+        return {'depth': 0, 'dropped': 0}
+
+
+class CollectingTransport:
+    def __init__(self):
+        self.events = []
+
+    def write(self, events):
+        self.events.extend(events)
+
+    def close(self):
+        pass
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Replay:
+    """Feed recorded batches through the probes of main.py at full speed.
+
+    Every batch goes through sgie_sink_pad_buffer_probe with the metadata
+    ahead of the face SGIE (the objects of other GIEs) and through
+    sgie_src_pad_buffer_probe, then through tiler_sink_pad_buffer_probe and
+    egress_sink_pad_buffer_probe with what the pipeline would have produced
+    after it: every object plus the recorded faces of the persons the SGIE
+    probe admitted. With
+    admission=False, or for an app without a person stage (faces from a
+    full-frame detector), the SGIE probe is skipped and every batch is
+    replayed as recorded.
+
+    reset() gives the app fresh state stores clocked by the batch PTS, an
+    event sink collecting in memory and post-probe work run inline, so a
+    replay does not depend on wall time or thread scheduling: the same
+    recording always yields the same events (see digest in run()).
+    """
+    def __init__(self, app, gallery=None, admission=True):
+        self.app = app
+        self.gallery = gallery
+        self.admission = admission and app.PERSONS is not None
+        self.downstream = (app.FACES[0], app.EMBEDDER)
+        self.reset()
+
+    def reset(self):
+        app = self.app
+        self.clock = MediaClock()
+        app.TRACKS = TrackStore(ttl_frames=app.TRACK_TTL_FRAMES, on_evict=app.end_track, clock=self.clock)
+        app.ADMISSION = AdmissionScheduler(global_rate=app.SGIE_BUDGET_PER_SEC,
+                                           stream_rate=app.SGIE_STREAM_BUDGET_PER_SEC, clock=self.clock)
+        app.QUALITY_POLICY = QualityPolicy(top_k=app.FACES_PER_TRACK)
+        app.METRICS = Metrics(clock=self.clock)
+        app.BULK = None
+        self.transport = CollectingTransport()
+        app.EVENTS = EventSink(self.transport)
+        app.FACE_WORKERS = self.workers = InlineWorkers(app.process_faces)
+        if self.gallery is not None:
+            app.FACE_GALLERY = self.gallery
+
+    def run(self, batches, warmup=0):
+        """Replay batches; returns the event counts, their digest and per-probe
+        latencies in us, leaving out the first warmup batches."""
+        app = self.app
+        downstream = self.downstream
+        sgie_probe = app.sgie_sink_pad_buffer_probe
+        sgie_src_probe = app.sgie_src_pad_buffer_probe
+        skip_class = app.SKIP_CLASS_OFFSET
+        tiler_probe = app.tiler_sink_pad_buffer_probe
+        egress_probe = app.egress_sink_pad_buffer_probe
+        clock = time.perf_counter
+        timings = {probe: [] for probe in PROBES}
+        frames = objects = 0
+        started = clock()
+        for index, batch in enumerate(batches):
+            if index == warmup:
+                started = clock()
+            self.clock.now = batch.pts / 1e9
+            gst_buffer = fake_gst.FakeBuffer(batch.pts)
+            info = fake_gst.FakeProbeInfo(gst_buffer)
+            sgie_time = 0.0
+            if self.admission:
+                batch_meta = batch.build(keep=lambda frame, row: row['component_id'] not in downstream)
+                fake_pyds.attach_batch_meta(gst_buffer, batch_meta)
+                t0 = clock()
+                sgie_probe(None, info, None)
+                sgie_time = clock() - t0
+                skipped = {(frame_meta.pad_index, obj_meta.object_id)
+                           for frame_meta in iter_frames(batch_meta) for obj_meta in iter_objects(frame_meta)
+                           if obj_meta.class_id >= skip_class}
+                t0 = clock()
+                sgie_src_probe(None, info, None)
+                sgie_time += clock() - t0
+                rows = batch.objects
+                batch_meta = batch.build(keep=lambda frame, row: row['component_id'] != downstream[0] or
+                                         (int(frame['pad_index']), int(rows[int(row['parent'])]['object_id']))
+                                         not in skipped)
+            else:
+                batch_meta = batch.build()
+            fake_pyds.attach_batch_meta(gst_buffer, batch_meta)
+            post_probe = self.workers.elapsed
+            t0 = clock()
+            tiler_probe(None, info, None)
+            t1 = clock()
+            egress_probe(None, info, None)
+            t2 = clock()
+            fake_pyds.detach_batch_meta(gst_buffer)
+            post_probe = self.workers.elapsed - post_probe
+            app.EVENTS.flush()
+            if index < warmup:
+                continue
+            for probe, seconds in zip(PROBES, (sgie_time, t1 - t0 - post_probe, post_probe, t2 - t1,
+                                               sgie_time + t2 - t0)):
+                timings[probe].append(seconds * 1e6)
+            frames += len(batch.frames)
+            objects += len(batch.objects)
+        elapsed = clock() - started
+
+        counts = {name: 0 for name in EVENT_NAMES.values()}
+        digest = hashlib.sha1()
+        for kind, _, stream_id, object_id, frame, value, label in self.transport.events:
+            counts[EVENT_NAMES[kind]] += 1
+            digest.update(repr((kind, stream_id, object_id, frame, round(float(value), 4), int(label))).encode())
+        return {
+            'batches': len(timings['batch']),
+            'frames': frames,
+            'objects': objects,
+            'seconds': round(elapsed, 6),
+            'events': counts,
+            'digest': digest.hexdigest(),
+            'latency_us': {probe: {'p50': round(percentile(values, 0.5), 2), 'p99': round(percentile(values, 0.99), 2),
+                                   'mean': round(sum(values) / len(values), 2) if values else 0.0}
+                           for probe, values in timings.items()},
+        }
+
+
+def synthetic_recording(path, batches=200, streams=4, persons=10, face_ratio=0.5, lifetime=100, identities=16,
+                        dim=512, noise=0.3, seed=0, full_frame=False):
+    """Record synthetic batches: persons (PGIE) living lifetime frames, each
+    with a face (SGIE class 1, embedding of one of identities plus noise) in a
+    face_ratio of the frames. Returns the identity vectors, row k of person
+    k % identities. With full_frame, as pipeline_fullframe_face.txt: tracked
+    faces of class 1 from the first GIE, without persons."""
+    import numpy as np
+    from common.recording import Recorder
+    from common.tensor_reader import FakeTensorReader
+
+    use_pyds(fake_pyds)
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((identities, dim)).astype(np.float32)
+    recorder = Recorder(path, FakeTensorReader())
+    for n in range(batches):
+        frame_metas = []
+        for stream_id in range(streams):
+            objects = []
+            for slot in range(persons):
+                # person ids move on every lifetime frames, staggered per slot
+                generation = (n + slot * lifetime // persons) // lifetime
+                person_id = (stream_id << 32) | (generation * persons + slot)
+                x, y = rng.uniform(0, 1600), rng.uniform(0, 700)
+                w, h = rng.uniform(40, 300), rng.uniform(80, 380)
+                if full_frame:
+                    if rng.random() < face_ratio:
+                        embedding = vectors[(person_id & 0xFFFFFFFF) % identities] + noise * rng.standard_normal(dim)
+                        objects.append(fake_pyds.NvDsObjectMeta(
+                            1, person_id, 1, float(rng.uniform(0.6, 1.0)),
+                            fake_pyds.NvOSD_RectParams(x + w * 0.3, y, w * 0.4, h * 0.2), None,
+                            [fake_pyds.tensor_user_meta(embedding)]))
+                    continue
+                person = fake_pyds.NvDsObjectMeta(0, person_id, 1, float(rng.uniform(0.4, 1.0)),
+                                                  fake_pyds.NvOSD_RectParams(x, y, w, h))
+                objects.append(person)
+                if rng.random() < face_ratio:
+                    embedding = vectors[(person_id & 0xFFFFFFFF) % identities] + noise * rng.standard_normal(dim)
+                    objects.append(fake_pyds.NvDsObjectMeta(
+                        1, 0xFFFFFFFFFFFFFFFF, 2, float(rng.uniform(0.6, 1.0)),
+                        fake_pyds.NvOSD_RectParams(x + w * 0.3, y, w * 0.4, h * 0.2), person,
+                        [fake_pyds.tensor_user_meta(embedding)]))
+            frame_metas.append(fake_pyds.NvDsFrameMeta(n, stream_id, buf_pts=n * 40000000, objects=objects))
+        recorder.record(fake_pyds.NvDsBatchMeta(frame_metas))
+    recorder.close()
+    return vectors
+
+
+if __name__ == '__main__':
+    import json
+    import os
+    import tempfile
+
+    import numpy as np
+
+    from common.gallery import FaceGallery
+    from common.recording import read_recording
+
+    app = load_app()
+    if len(sys.argv) > 1:
+        # python -m common.replay recording.bin [--no-admission], with the
+        # gallery main.py would load
+        import configparser
+        from common.gallery import create_gallery
+        config = configparser.ConfigParser()
+        config.read(app.GALLERY_CONFIG)
+        gallery = create_gallery(config['gallery']) if config.has_section('gallery') else None
+        replay = Replay(app, gallery, admission='--no-admission' not in sys.argv[2:])
+        print(json.dumps(replay.run(read_recording(sys.argv[1])), indent=2))
+        sys.exit(0)
+
+    path = tempfile.NamedTemporaryFile(suffix='.rec', delete=False).name
+    try:
+        identities = 16
+        vectors = synthetic_recording(path, batches=500, streams=4, persons=10, identities=identities)
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write(b'BTCH' + b'\0' * 9)
+        batches = read_recording(path)
+    finally:
+        os.remove(path)
+    assert len(batches) == 500
+    first = batches[0]
+    assert len(first.frames) == 4 and first.frames['num_objects'].sum() == len(first.objects)
+    faces = np.flatnonzero(first.objects['component_id'] == 2)
+    assert (first.objects['parent'][faces] >= 0).all()
+    assert len(first.tensor_outputs(int(faces[0]))[0][1]) == 512
+    # build() gives back the recorded metadata
+    rebuilt = [(frame_meta.pad_index, frame_meta.frame_num, obj_meta.object_id, obj_meta.unique_component_id,
+                obj_meta.parent is not None) for frame_meta in iter_frames(first.build())
+               for obj_meta in iter_objects(frame_meta)]
+    pads = np.repeat(first.frames['pad_index'], first.frames['num_objects'])
+    assert rebuilt == [(int(pad), 0, int(row['object_id']), int(row['component_id']), int(row['parent']) >= 0)
+                       for pad, row in zip(pads, first.objects)]
+
+    gallery = FaceGallery(capacity=identities)
+    gallery.add(np.arange(identities), vectors)
+    results = [Replay(app, gallery).run(batches) for _ in range(2)]
+    everything = Replay(app, gallery, admission=False).run(batches)
+    # same recording, same events
+    assert results[0]['digest'] == results[1]['digest'] and results[0]['events'] == results[1]['events']
+    persons = {(int(pad), int(row['object_id'])) for batch in batches
+               for pad, row in zip(np.repeat(batch.frames['pad_index'], batch.frames['num_objects']), batch.objects)
+               if row['component_id'] == 1}
+    assert everything['events']['track_started'] == len(persons), (everything['events'], len(persons))
+    assert 0 < everything['events']['track_ended'] == len(persons) - len(app.TRACKS)
+    assert 0 < results[0]['events']['identity_matched']
+    # persons the SGIE probe does not admit still reach the tracks downstream
+    assert results[0]['events']['track_started'] == len(persons)
+    # a --bulk run writes each reported match to the file's results
+    class BulkResults:
+        def __init__(self):
+            self.matches = []
+
+        def record_frame(self, frame):
+            pass
+
+        def job(self, stream_id):
+            return stream_id
+
+        def record_match(self, job, object_id, identity, score):
+            self.matches.append((object_id, identity))
+
+    replay = Replay(app, gallery)
+    app.BULK = bulk = BulkResults()
+    replay.run(batches)
+    app.BULK = None
+    matches = [(object_id, label) for kind, _, _, object_id, _, _, label in replay.transport.events if kind == 3]
+    assert bulk.matches == matches
+    assert all(label == (object_id & 0xFFFFFFFF) % identities for object_id, label in matches)
+    # every track keeps its identity here: it is reported once, on its first match
+    assert len(matches) == len({object_id for object_id, _ in matches})
+    assert everything['events']['identity_matched'] <= everything['events']['track_started']
+
+    # pipeline_fullframe_face.txt: tracked faces from the first GIE, no persons to admit
+    path = tempfile.NamedTemporaryFile(suffix='.rec', delete=False).name
+    try:
+        vectors = synthetic_recording(path, batches=500, streams=4, persons=10, identities=identities, full_frame=True)
+        fullframe = read_recording(path)
+    finally:
+        os.remove(path)
+    gallery = FaceGallery(capacity=identities)
+    gallery.add(np.arange(identities), vectors)
+    roles = app.PERSONS, app.FACES, app.EMBEDDER
+    app.PERSONS, app.FACES, app.EMBEDDER = None, (1, 1), 2
+    try:
+        replay = Replay(app, gallery)
+        faces_only = replay.run(fullframe)
+    finally:
+        app.PERSONS, app.FACES, app.EMBEDDER = roles
+    assert not replay.admission
+    faces = {(int(pad), int(row['object_id'])) for batch in fullframe
+             for pad, row in zip(np.repeat(batch.frames['pad_index'], batch.frames['num_objects']), batch.objects)}
+    assert faces_only['events']['track_started'] == len(faces), (faces_only['events'], len(faces))
+    matches = [(object_id, label) for kind, _, _, object_id, _, _, label in replay.transport.events if kind == 3]
+    assert 0 < len(matches) and all(label == (object_id & 0xFFFFFFFF) % identities for object_id, label in matches)
+
+    objects = sum(len(batch.objects) for batch in batches)
+    print("recording: {} batches, {:.0f} bytes per object with 512-d embeddings".format(len(batches), size / objects))
+    for name, result in (("admission", results[1]), ("no admission", everything), ("full frame", faces_only)):
+        latency = result['latency_us']
+        print("{:12s} {:6.0f} batches/s, events {}, per batch p50/p99 us: {}".format(
+            name, result['batches'] / result['seconds'], result['events'],
+            ", ".join("{} {:.0f}/{:.0f}".format(probe, latency[probe]['p50'], latency[probe]['p99'])
+                      for probe in PROBES)))
+    print("ok: deterministic replay, digest {}".format(results[0]['digest'][:12]))
@@ -0,0 +1,343 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import random
+import sys
+import threading
+import time
+
+# Health states
+CONNECTING = 'connecting'   # bin (re)created, no frame yet
+HEALTHY = 'healthy'         # frames are flowing
+BACKOFF = 'backoff'         # failed, waiting for the reconnect timer
+
+
+def glib_call_later(delay, callback, *args):
+    from gi.repository import GLib
+
+    def once():
+        callback(*args)
+        return False
+    GLib.timeout_add(int(delay * 1000), once)
+
+
+class SourceHealth:
+    __slots__ = ('source_id', 'live', 'state', 'since', 'failures', 'errors', 'reconnects',
+                 'downtime', 'down_since', 'last_error', 'generation')
+
+    def __init__(self, source_id, live, now):
+        self.source_id = source_id
+        self.live = live
+        self.state = CONNECTING
+        self.since = now
+        # consecutive failures, drive the backoff; reset once stable
+        self.failures = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.down_since = None
+        self.last_error = None
+        # bumped on every failure so stale reconnect timers do nothing
+        self.generation = 0
+
+
+class Reconnector:
+    '''
+    Per-source fault isolation on top of a SourceManager.
+
+    A bus ERROR from an element inside a source bin, a stream-eos of a live
+    source, no frame for stall_timeout while healthy, or no frame within
+    connect_timeout of a (re)connect marks that source failed: it goes to
+    BACKOFF and its bin is re-created after base_delay * 2^(failures - 1)
+    seconds, capped at max_delay and shortened by up to jitter so cameras
+    dropped together do not reconnect in lockstep. The first frame after a
+    reconnect makes it HEALTHY again; failures reset once it stayed healthy
+    for stable_after seconds. Other sources keep running throughout.
+
+    frame_seen() is the only call made from streaming threads (a dict
+    store); transitions happen in on_error/on_stream_eos (bus watch) and
+    check(), which the main loop runs every check_interval seconds.
+    clock and call_later(delay, callback, *args) are injectable for tests.
+    '''
+    def __init__(self, manager, base_delay=1.0, max_delay=60.0, jitter=0.3, stall_timeout=10.0,
+                 connect_timeout=30.0, stable_after=30.0, clock=time.monotonic,
+                 call_later=glib_call_later, rng=None):
+        self.manager = manager
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.stall_timeout = stall_timeout
+        self.connect_timeout = connect_timeout
+        self.stable_after = stable_after
+        self.clock = clock
+        self.call_later = call_later
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+        self.health = {}
+        self.last_frame = {}
+
+    def watch(self, source_id, uri):
+        '''Start tracking a source; rtsp sources also reconnect on end of stream.'''
+        live = uri.startswith("rtsp://")
+        with self.lock:
+            self.health[source_id] = SourceHealth(source_id, live, self.clock())
+            self.last_frame.pop(source_id, None)
+
+    def forget(self, source_id):
+        with self.lock:
+            self.health.pop(source_id, None)
+            self.last_frame.pop(source_id, None)
+
+    def frame_seen(self, stream_id):
+        self.last_frame[stream_id] = self.clock()
+
+    def backoff(self, failures):
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return delay * (1.0 - self.jitter * self.rng.random())
+
+    def on_error(self, element, error, debug=None):
+        '''
+        Handle a bus error. True if it came from a tracked source, which
+        will be reconnected; False means the error is not a source's and
+        the caller should treat it as fatal.
+        '''
+        source_id = self.manager.find_source(element)
+        if source_id is None or source_id not in self.health:
+            return False
+        self._fail(source_id, str(error))
+        return True
+
+    def on_stream_eos(self, stream_id):
+        '''
+        nvstreammux stream-eos: a live source ended, which means it dropped.
+        A file that ended is done and no longer watched for stalls.
+        '''
+        health = self.health.get(stream_id)
+        if health is None:
+            return False
+        if not health.live:
+            self.forget(stream_id)
+            return False
+        self._fail(stream_id, "end of stream")
+        return True
+
+    def check(self):
+        '''Promote sources that produce frames, fail stalled ones. Returns True to keep a GLib timer.'''
+        now = self.clock()
+        failed = []
+        with self.lock:
+            for source_id, health in self.health.items():
+                last = self.last_frame.get(source_id)
+                if health.state == CONNECTING:
+                    if last is not None and last >= health.since:
+                        self._set_state(health, HEALTHY, now)
+                        if health.down_since is not None:
+                            health.downtime += now - health.down_since
+                            health.down_since = None
+                    elif now - health.since > self.connect_timeout:
+                        failed.append((source_id, "no frame within {:.0f}s".format(self.connect_timeout)))
+                elif health.state == HEALTHY:
+                    if last is not None and now - last > self.stall_timeout:
+                        failed.append((source_id, "stalled for {:.0f}s".format(now - last)))
+                    elif health.failures and now - health.since > self.stable_after:
+                        health.failures = 0
+        for source_id, reason in failed:
+            self._fail(source_id, reason)
+        return True
+
+    def _set_state(self, health, state, now):
+        print("source {}: {} -> {}".format(health.source_id, health.state, state))
+        health.state = state
+        health.since = now
+
+    def _fail(self, source_id, reason):
+        now = self.clock()
+        with self.lock:
+            health = self.health.get(source_id)
+            if health is None or health.state == BACKOFF:
+                # the rest of an error burst from the same bin
+                return
+            health.errors += 1
+            health.failures += 1
+            health.generation += 1
+            health.last_error = reason
+            if health.down_since is None:
+                health.down_since = now
+            delay = self.backoff(health.failures)
+            generation = health.generation
+            sys.stderr.write("source %d failed (%s), reconnecting in %.1fs\n" % (source_id, reason, delay))
+            self._set_state(health, BACKOFF, now)
+        self.call_later(delay, self._reconnect, source_id, generation)
+
+    def _reconnect(self, source_id, generation):
+        with self.lock:
+            health = self.health.get(source_id)
+            if health is None or health.generation != generation or health.state != BACKOFF:
+                return
+            health.reconnects += 1
+            self._set_state(health, CONNECTING, self.clock())
+        if not self.manager.restart(source_id):
+            self.forget(source_id)
+
+    def stats(self):
+        now = self.clock()
+        with self.lock:
+            sources = {}
+            for source_id, health in self.health.items():
+                downtime = health.downtime
+                if health.down_since is not None:
+                    downtime += now - health.down_since
+                sources[source_id] = {'state': health.state, 'errors': health.errors,
+                                      'reconnects': health.reconnects, 'downtime': downtime,
+                                      'last_error': health.last_error}
+        return {
+            'reconnects': sum(source['reconnects'] for source in sources.values()),
+            'downtime': sum(source['downtime'] for source in sources.values()),
+            'unhealthy': sum(source['state'] != HEALTHY for source in sources.values()),
+            'sources': sources,
+        }
+
+
+if __name__ == '__main__':
+    import contextlib
+    import heapq
+    import io
+
+    from common import fake_gst
+    from common import bus_call as bus_module
+    from common import source_manager
+    from common.bus_call import bus_call
+    from common.source_manager import SourceManager
+
+    class FakeClock:
+        '''Monotonic time that only moves in advance(), running due timers.'''
+        def __init__(self):
+            self.now = 0.0
+            self.timers = []
+            self.delays = []
+            self.seq = 0
+
+        def __call__(self):
+            return self.now
+
+        def call_later(self, delay, callback, *args):
+            self.delays.append(delay)
+            self.seq += 1
+            heapq.heappush(self.timers, (self.now + delay, self.seq, callback, args))
+
+        def advance(self, seconds):
+            end = self.now + seconds
+            while self.timers and self.timers[0][0] <= end:
+                due, _, callback, args = heapq.heappop(self.timers)
+                self.now = due
+                callback(*args)
+            self.now = end
+
+    class FakeLoop:
+        def __init__(self):
+            self.quit_called = False
+
+        def quit(self):
+            self.quit_called = True
+
+    # Synthetic bus messages and a fake clock drive the state machine:
+    # fault isolation, exponential backoff with jitter, stalls, stable reset.
+    bus_module.use_gst(fake_gst)
+    source_manager.use_gst(fake_gst)
+    clock = FakeClock()
+    pipeline = fake_gst.FakePipeline()
+    streammux = fake_gst.ElementFactory.make("nvstreammux", "Stream-muxer")
+    pipeline.add(streammux)
+    pipeline.state = fake_gst.State.PLAYING
+
+    def make_source_bin(index, uri):
+        source_bin = fake_gst.FakeBin("source-bin-%02d" % index)
+        decoder = fake_gst.FakeBin("uri-decode-bin", static_pads=())
+        source_bin.add(decoder)
+        decoder.add(fake_gst.ElementFactory.make("rtspsrc", "source"))
+        return source_bin
+
+    inline = lambda callback, *args: callback(*args)
+    manager = SourceManager(pipeline, streammux, make_source_bin, 4, schedule=inline)
+    reconnector = Reconnector(manager, base_delay=1.0, max_delay=8.0, jitter=0.25, stall_timeout=5.0,
+                              connect_timeout=20.0, stable_after=30.0, clock=clock,
+                              call_later=clock.call_later, rng=random.Random(0))
+    manager.on_add.append(reconnector.watch)
+    manager.on_remove.append(reconnector.forget)
+    loop = FakeLoop()
+
+    def error_from(source_id):
+        rtspsrc = pipeline.get_by_name("source-bin-%02d" % source_id).get_by_name("uri-decode-bin").get_by_name("source")
+        return fake_gst.FakeMessage(fake_gst.MessageType.ERROR, rtspsrc,
+                                    fake_gst.FakeGError("Could not read from resource."), "rtspsrc.c: timeout")
+
+    def run(seconds, streams, step=0.5):
+        # frames from the given streams every step, watchdog every step
+        for _ in range(int(seconds / step)):
+            for stream_id in streams:
+                reconnector.frame_seen(stream_id)
+            clock.advance(step)
+            reconnector.check()
+
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for uri in ("rtsp://cam0", "rtsp://cam1", "file:///clip.mp4"):
+            manager.add(uri, immediate=True)
+        run(2, [0, 1, 2])
+        assert all(h['state'] == HEALTHY for h in reconnector.stats()['sources'].values())
+
+        # an error inside source 1 is isolated: the loop keeps running
+        bus_call(None, error_from(1), loop, reconnector)
+        assert not loop.quit_called
+        assert reconnector.stats()['sources'][1]['state'] == BACKOFF
+        bus_call(None, error_from(1), loop, reconnector)    # same burst, no second timer
+        assert len(clock.timers) == 1
+        run(1.5, [0, 2])
+        assert manager.restarted == 1 and reconnector.stats()['sources'][1]['state'] == CONNECTING
+        run(1, [0, 1, 2])
+        stats = reconnector.stats()['sources'][1]
+        assert stats['state'] == HEALTHY and stats['reconnects'] == 1 and 0.75 <= stats['downtime'] <= 2.5, stats
+
+        # camera 0 stays down: delays double up to max_delay, with jitter
+        del clock.delays[:]
+        run(6, [1, 2])                      # stall detected after 5 s
+        while len(clock.delays) < 6:
+            run(0.5, [1, 2])                # backoff, then no frame within connect_timeout
+        restarts = list(clock.delays)
+        assert len(restarts) == 6 and reconnector.health[0].failures == 6, restarts
+        for failures, delay in enumerate(restarts, 1):
+            ceiling = min(8.0, 2.0 ** (failures - 1))
+            assert 0.75 * ceiling <= delay <= ceiling, restarts
+        # it comes back, and its failure count resets once stable
+        while reconnector.stats()['sources'][0]['state'] != CONNECTING:
+            run(0.5, [1, 2])
+        run(1, [0, 1, 2])
+        assert reconnector.stats()['sources'][0]['state'] == HEALTHY
+        run(31, [0, 1, 2])
+        assert reconnector.health[0].failures == 0
+
+        # a file source ending is not a failure, a camera ending is
+        assert not reconnector.on_stream_eos(2) and 2 not in reconnector.health
+        assert reconnector.on_stream_eos(0)
+
+        # errors outside any source bin are still fatal
+        bus_call(None, fake_gst.FakeMessage(fake_gst.MessageType.ERROR, streammux,
+                                            fake_gst.FakeGError("Internal data stream error."), ""), loop, reconnector)
+        assert loop.quit_called
+
+    stats = reconnector.stats()
+    print("ok: restart delays {} s, {} reconnects, {:.1f} s downtime".format(
+        ", ".join("{:.1f}".format(delay) for delay in restarts), stats['reconnects'], stats['downtime']))
@@ -0,0 +1,389 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import GLib, Gst
+except (ImportError, ValueError):
+    # common.fake_gst can be installed with use_gst() for CPU-only runs
+    GLib = None
+    Gst = None
+
+# Source states
+ATTACHING = 'attaching'
+PLAYING = 'playing'
+DETACHING = 'detaching'
+
+
+def use_gst(module):
+    """Swap the Gst implementation used by the manager (e.g. fake_gst)."""
+    global Gst
+    Gst = module
+
+
+def idle_add(callback, *args):
+    """Run callback on the GLib main loop, which owns the pipeline graph."""
+    def once():
+        callback(*args)
+        return False
+    GLib.idle_add(once)
+
+
+class SourceError(Exception):
+    pass
+
+
+class Source:
+    __slots__ = ('source_id', 'uri', 'bin', 'state')
+
+    def __init__(self, source_id, uri):
+        self.source_id = source_id
+        self.uri = uri
+        self.bin = None
+        self.state = ATTACHING
+
+
+class SourceManager:
+    '''
+    Attach and detach source bins on nvstreammux request pads while the
+    pipeline is PLAYING, so a camera change does not reload the engines.
+
+    nvstreammux and the full-frame GIEs are sized for max_sources up front;
+    a source takes the lowest free slot, which is both its sink_%u pad and
+    its stream id (frame_meta.pad_index), so the ids of removed sources are
+    reused. add()/remove() may be called from any thread: they reserve or
+    release the slot under a lock and schedule the graph changes on the
+    main loop. on_add callbacks get (stream id, uri) when a slot is taken,
+    on_remove callbacks get the stream id once its bin is gone. on_retire
+    callbacks run in between, while the slot is still reserved, so per-stream
+    state is dropped before a new source can take the same stream id.
+    '''
+    def __init__(self, pipeline, streammux, make_source_bin, max_sources, schedule=idle_add, on_add=(),
+                 on_remove=(), on_retire=()):
+        self.pipeline = pipeline
+        self.streammux = streammux
+        self.make_source_bin = make_source_bin
+        self.max_sources = max_sources
+        self.schedule = schedule
+        self.on_add = list(on_add)
+        self.on_remove = list(on_remove)
+        self.on_retire = list(on_retire)
+        self.lock = threading.Lock()
+        self.slots = [None] * max_sources
+        self.added = 0
+        self.removed = 0
+        self.restarted = 0
+
+    def __len__(self):
+        with self.lock:
+            return sum(source is not None for source in self.slots)
+
+    def sources(self):
+        with self.lock:
+            return [{'id': source.source_id, 'uri': source.uri, 'state': source.state}
+                    for source in self.slots if source is not None]
+
+    def add(self, uri, immediate=False):
+        '''
+        Reserve a stream id for uri and attach its source bin, right away
+        when immediate (before the main loop runs) or on the main loop.
+        '''
+        with self.lock:
+            try:
+                source_id = self.slots.index(None)
+            except ValueError:
+                raise SourceError("all {} source slots are in use".format(self.max_sources))
+            self.slots[source_id] = Source(source_id, uri)
+        for callback in self.on_add:
+            callback(source_id, uri)
+        if immediate:
+            self._attach(source_id)
+        else:
+            self.schedule(self._attach, source_id)
+        return source_id
+
+    def remove(self, source_id):
+        with self.lock:
+            source = self.slots[source_id] if 0 <= source_id < self.max_sources else None
+            if source is None:
+                raise SourceError("no source {}".format(source_id))
+            if source.state == DETACHING:
+                return
+            source.state = DETACHING
+        self.schedule(self._detach, source_id)
+
+    def restart(self, source_id):
+        '''
+        Tear down the bin of a source and create a new one for the same uri
+        and stream id, e.g. to reconnect a camera. False if the source is
+        gone or being removed.
+        '''
+        with self.lock:
+            source = self.slots[source_id] if 0 <= source_id < self.max_sources else None
+            if source is None or source.state == DETACHING:
+                return False
+            source.state = ATTACHING
+        self.schedule(self._restart, source_id)
+        return True
+
+    def find_source(self, element):
+        '''
+        Stream id of the source bin element belongs to (bus messages come
+        from elements deep inside uridecodebin), or None.
+        '''
+        with self.lock:
+            sources = [source for source in self.slots if source is not None and source.bin is not None]
+        while element is not None and sources:
+            for source in sources:
+                if source.bin == element:
+                    return source.source_id
+            element = element.get_parent()
+        return None
+
+    def _attach(self, source_id, keep_slot=False):
+        source = self.slots[source_id]
+        print("Attaching source {}: {}".format(source_id, source.uri))
+        source_bin = self.make_source_bin(source_id, source.uri)
+        if not source_bin or not self.pipeline.add(source_bin):
+            sys.stderr.write("Unable to create source bin for %s \n" % source.uri)
+            if not keep_slot:
+                self._release(source_id)
+            return
+        sinkpad = self.streammux.get_request_pad("sink_%u" % source_id)
+        if not sinkpad:
+            sys.stderr.write("Unable to create sink pad bin \n")
+            self.pipeline.remove(source_bin)
+            if not keep_slot:
+                self._release(source_id)
+            return
+        source_bin.get_static_pad("src").link(sinkpad)
+        source.bin = source_bin
+        with self.lock:
+            if source.state == ATTACHING:
+                source.state = PLAYING
+        source_bin.sync_state_with_parent()
+        self.added += 1
+
+    def _restart(self, source_id):
+        source = self.slots[source_id]
+        if source is None or source.state == DETACHING:
+            return
+        if source.bin is not None and not self._teardown(source):
+            return
+        self._attach(source_id, keep_slot=True)
+        self.restarted += 1
+
+    def _detach(self, source_id):
+        source = self.slots[source_id]
+        if source.bin is not None and not self._teardown(source):
+            return
+        self.removed += 1
+        for callback in self.on_retire:
+            callback(source_id)
+        self._release(source_id)
+        for callback in self.on_remove:
+            callback(source_id)
+
+    def _teardown(self, source):
+        print("Detaching source {}: {}".format(source.source_id, source.uri))
+        state_return = source.bin.set_state(Gst.State.NULL)
+        if state_return == Gst.StateChangeReturn.ASYNC:
+            state_return = source.bin.get_state(Gst.CLOCK_TIME_NONE)[0]
+        if state_return == Gst.StateChangeReturn.FAILURE:
+            sys.stderr.write("Unable to stop source bin %d \n" % source.source_id)
+            with self.lock:
+                source.state = PLAYING
+            return False
+        sinkpad = self.streammux.get_static_pad("sink_%u" % source.source_id)
+        if sinkpad:
+            # nvstreammux keeps waiting for the pad's batch slot until flushed
+            sinkpad.send_event(Gst.Event.new_flush_stop(False))
+            self.streammux.release_request_pad(sinkpad)
+        self.pipeline.remove(source.bin)
+        source.bin = None
+        return True
+
+    def _release(self, source_id):
+        with self.lock:
+            self.slots[source_id] = None
+
+
+def serve_control(manager, port, address='127.0.0.1'):
+    '''
+    JSON control API on http://address:port:
+        GET    /sources       list the sources
+        POST   /sources       {"uri": ...} add a source, returns {"id": ...}
+        DELETE /sources/<id>  remove a source
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/sources':
+                self.send_error(404)
+                return
+            self.reply(200, manager.sources())
+
+        def do_POST(self):
+            if self.path.split('?')[0] != '/sources':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                uri = json.loads(self.rfile.read(length) or b'{}')['uri']
+            except (ValueError, KeyError, TypeError):
+                self.reply(400, {'error': 'expected {"uri": ...}'})
+                return
+            try:
+                self.reply(201, {'id': manager.add(uri)})
+            except SourceError as e:
+                self.reply(409, {'error': str(e)})
+
+        def do_DELETE(self):
+            parts = self.path.split('?')[0].strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'sources' or not parts[1].isdigit():
+                self.send_error(404)
+                return
+            try:
+                manager.remove(int(parts[1]))
+            except SourceError as e:
+                self.reply(404, {'error': str(e)})
+                return
+            self.reply(202, {'id': int(parts[1])})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, name="source-control", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import queue
+    import time
+    import urllib.request
+
+    from common import fake_gst
+
+    # Checks attach/detach against a fake pipeline that records every pad
+    # operation, then drives the same manager through the HTTP control API.
+    use_gst(fake_gst)
+
+    def make_source_bin(index, uri):
+        source_bin = fake_gst.FakeBin("source-bin-%02d" % index)
+        source_bin.set_property('uri', uri)
+        return source_bin
+
+    pipeline = fake_gst.FakePipeline()
+    streammux = fake_gst.ElementFactory.make("nvstreammux", "Stream-muxer")
+    pipeline.add(streammux)
+    pipeline.state = fake_gst.State.PLAYING
+    removed = []
+    retired = []
+
+    def retire(stream_id):
+        # the slot must still be taken: nothing can reuse the stream id yet
+        retired.append((stream_id, manager.slots[stream_id] is not None))
+
+    manager = SourceManager(pipeline, streammux, make_source_bin, max_sources=4,
+                            schedule=lambda callback, *args: callback(*args), on_remove=[removed.append],
+                            on_retire=[retire])
+
+    assert [manager.add("file:///cam%d.mp4" % i) for i in range(3)] == [0, 1, 2]
+    assert pipeline.ops[-3:] == [('request_pad', 'Stream-muxer', 'sink_2'),
+                                 ('link', 'source-bin-02:src', 'Stream-muxer:sink_2'),
+                                 ('sync_state', 'source-bin-02', fake_gst.State.PLAYING)]
+    del pipeline.ops[:]
+    manager.remove(1)
+    assert pipeline.ops == [('set_state', 'source-bin-01', fake_gst.State.NULL),
+                            ('event', 'Stream-muxer:sink_1', 'flush-stop'),
+                            ('release_pad', 'Stream-muxer', 'sink_1'),
+                            ('remove', 'pipeline', 'source-bin-01')], pipeline.ops
+    assert removed == [1] and retired == [(1, True)] and 'sink_1' not in streammux.pads
+    # the freed stream id is reused, then the manager is full
+    assert manager.add("rtsp://cam9") == 1
+    assert manager.add("rtsp://cam10") == 3
+    try:
+        manager.add("rtsp://cam11")
+        raise AssertionError("expected a full manager")
+    except SourceError:
+        pass
+    # a bin that cannot be stopped stays attached
+    pipeline.get_by_name("source-bin-00").state_return = fake_gst.StateChangeReturn.FAILURE
+    manager.remove(0)
+    assert manager.sources()[0]['state'] == PLAYING and removed == [1] and len(retired) == 1
+    pipeline.get_by_name("source-bin-00").state_return = fake_gst.StateChangeReturn.ASYNC
+    manager.remove(0)
+    assert removed == [1, 0] and len(manager) == 3
+
+    # control API, with graph changes run by a "main loop" thread
+    pending = queue.Queue()
+    manager.schedule = lambda callback, *args: pending.put((callback, args))
+
+    def main_loop():
+        while True:
+            callback, args = pending.get()
+            callback(*args)
+            pending.task_done()
+
+    threading.Thread(target=main_loop, daemon=True).start()
+    server = serve_control(manager, 0)
+    base = "http://127.0.0.1:%d/sources" % server.server_address[1]
+
+    def call(method, url, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(url, data=data, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    assert call('POST', base, {'uri': "rtsp://cam12"}) == (201, {'id': 0})
+    assert call('POST', base, {'uri': "rtsp://cam13"})[0] == 409
+    assert call('DELETE', base + "/2") == (202, {'id': 2})
+    assert call('DELETE', base + "/7")[0] == 404
+    pending.join()
+    status, listed = call('GET', base)
+    assert status == 200 and [source['id'] for source in listed] == [0, 1, 3], listed
+
+    # cost of one add + remove cycle on the fake graph
+    manager.schedule = lambda callback, *args: callback(*args)
+    cycles = 20000
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(cycles):
+            manager.remove(manager.add("rtsp://cam"))
+            del pipeline.ops[:]
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+    print("ok: {:.1f} us per add/remove cycle".format(elapsed / cycles * 1e6))
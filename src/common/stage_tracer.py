@@ -0,0 +1,245 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import json
+import time
+from collections import OrderedDict, deque
+
+from common.metrics import Metrics
+
+# Points of a batch at every stage
+QUEUED = 0      # queue sink pad
+STARTED = 1     # queue src pad, into the element
+DONE = 2        # element src pad
+POINTS = 3
+
+
+class StageTracer:
+    """Per-stage latency of batches from pad probes.
+
+    For every stage (queue + element, as built by build_pipeline) a batch
+    is stamped when it enters the queue, leaves it and leaves the element,
+    keyed by the batch PTS. The queue wait ("<stage> queue") and the
+    element time ("<stage>") go into the stage_seconds histogram of
+    metrics, and the number of batches between a queue's pads (its pending
+    queue stamps) is tracked as its occupancy. Each span and occupancy
+    change is also kept, up to max_events, for write_chrome_trace().
+
+    Probes only run mark(): a clock read, a few dict operations and a
+    tuple append. Stamps whose batch never reaches the next point (e.g.
+    dropped by a leaky queue) are evicted past max_pending per point.
+    """
+    def __init__(self, stages, metrics=None, clock=time.perf_counter, max_pending=256, max_events=200000):
+        self.stages = list(stages)
+        self.metrics = metrics or Metrics(clock=clock)
+        self.metrics.define_histogram('stage_seconds', 'stage', "Queue wait and element time per batch")
+        self.clock = clock
+        self.max_pending = max_pending
+        self.segments = []
+        for stage in self.stages:
+            self.segments += [stage + " queue", stage]
+        self.pending = [OrderedDict() for _ in range(len(self.stages) * POINTS)]
+        self.max_occupancy = [0] * len(self.stages)
+        # ('X', segment, start, duration, key) and ('C', stage, time, occupancy)
+        self.events = deque(maxlen=max_events)
+        self.started = clock()
+
+    def mark(self, point, key):
+        now = self.clock()
+        stage, phase = divmod(point, POINTS)
+        if phase != QUEUED:
+            start = self.pending[point - 1].pop(key, None)
+            if start is not None:
+                segment = stage * 2 + phase - 1
+                self.metrics.observe('stage_seconds', self.segments[segment], now - start)
+                self.events.append(('X', segment, start, now - start, key))
+        if phase != DONE:
+            pending = self.pending[point]
+            pending[key] = now
+            if len(pending) > self.max_pending:
+                pending.popitem(last=False)
+            # the queue's sink and src pads run on different threads: the
+            # batches in the queue are its pending QUEUED stamps, not a
+            # counter both would read-modify-write
+            occupancy = len(self.pending[stage * POINTS + QUEUED])
+            if occupancy > self.max_occupancy[stage]:
+                self.max_occupancy[stage] = occupancy
+            self.events.append(('C', stage, now, occupancy))
+
+    def probe(self, point, ok):
+        """Buffer probe stamping point with the buffer PTS; returns ok (Gst.PadProbeReturn.OK)."""
+        mark = self.mark
+
+        def stage_probe(pad, info, u_data):
+            gst_buffer = info.get_buffer()
+            if gst_buffer:
+                mark(point, gst_buffer.pts)
+            return ok
+        return stage_probe
+
+    def install(self, graph, Gst):
+        """Probe the queue sink/src and element src pads of every traced stage of graph."""
+        buffer = Gst.PadProbeType.BUFFER
+        ok = Gst.PadProbeReturn.OK
+        for index, stage in enumerate(self.stages):
+            queue = graph.queues[stage]
+            pads = (queue.get_static_pad("sink"), queue.get_static_pad("src"),
+                    graph.stages[stage].get_static_pad("src"))
+            for phase, pad in enumerate(pads):
+                pad.add_probe(buffer, self.probe(index * POINTS + phase, ok), 0)
+
+    def summary(self):
+        """{segment: {count, mean, p50, p99}} plus the max occupancy of every queue."""
+        snapshot = json.loads(self.metrics.to_json(self.metrics.snapshot(reset_rates=False)))
+        stages = snapshot['histograms'].get('stage_seconds', {})
+        summary = {segment: stages[segment] for segment in self.segments if segment in stages}
+        summary['max_occupancy'] = dict(zip(self.stages, self.max_occupancy))
+        return summary
+
+    def chrome_trace(self):
+        """Trace Event Format dict: one thread per segment, a counter per queue."""
+        trace = []
+        for segment, name in enumerate(self.segments):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': segment, 'args': {'name': name}})
+        for event in list(self.events):
+            if event[0] == 'X':
+                _, segment, start, duration, key = event
+                trace.append({'name': self.segments[segment], 'ph': 'X', 'pid': 0, 'tid': segment,
+                              'ts': (start - self.started) * 1e6, 'dur': duration * 1e6, 'args': {'pts': key}})
+            else:
+                _, stage, now, occupancy = event
+                trace.append({'name': "queue-" + self.stages[stage], 'ph': 'C', 'pid': 0,
+                              'ts': (now - self.started) * 1e6, 'args': {'buffers': occupancy}})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        """Write the trace for chrome://tracing or ui.perfetto.dev."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+if __name__ == '__main__':
+    import heapq
+    import os
+    import random
+    import tempfile
+
+    class FakeClock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    # A synthetic timestamp stream: batches every 40 ms through three
+    # single-server stages with jittered service times. pgie is the
+    # bottleneck at 45 ms, so its queue must fill up.
+    clock = FakeClock()
+    tracer = StageTracer(["pgie", "tracker", "sgie"], clock=clock, max_pending=1024)
+    service = {0: 0.045, 1: 0.002, 2: 0.010}
+    rng = random.Random(0)
+    batches = 200
+    events = []
+    free_at = [0.0] * 3
+    arrivals = [n * 0.040 for n in range(batches)]
+    # event-driven: (time, seq, point, pts)
+    seq = 0
+    for pts, t in enumerate(arrivals):
+        heapq.heappush(events, (t, seq, 0, pts))
+        seq += 1
+    expected = {segment: [] for segment in tracer.segments}
+    while events:
+        t, _, point, pts = heapq.heappop(events)
+        clock.now = t
+        tracer.mark(point, pts)
+        stage, phase = divmod(point, POINTS)
+        if phase == QUEUED:
+            start = max(t, free_at[stage])
+            duration = service[stage] * rng.uniform(0.9, 1.1)
+            free_at[stage] = start + duration
+            expected[tracer.stages[stage] + " queue"].append(start - t)
+            expected[tracer.stages[stage]].append(duration)
+            heapq.heappush(events, (start, seq, point + 1, pts))
+            heapq.heappush(events, (start + duration, seq + 1, point + 2, pts))
+            seq += 2
+        elif phase == DONE and stage + 1 < len(tracer.stages):
+            heapq.heappush(events, (t, seq, point + 1, pts))
+            seq += 1
+
+    summary = tracer.summary()
+    for segment, values in expected.items():
+        mean = sum(values) / len(values)
+        assert summary[segment]['count'] == batches, (segment, summary[segment])
+        assert abs(summary[segment]['mean'] - mean) < 1e-9, (segment, summary[segment]['mean'], mean)
+    assert summary['pgie queue']['mean'] > 10 * summary['tracker queue']['mean']
+    assert summary['max_occupancy']['pgie'] > 10 and summary['max_occupancy']['sgie'] == 1
+    assert all(pending == {} for pending in tracer.pending), "stamps left behind"
+
+    path = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+    tracer.write_chrome_trace(path)
+    with open(path) as f:
+        trace = json.load(f)['traceEvents']
+    os.remove(path)
+    spans = [event for event in trace if event['ph'] == 'X']
+    assert len(spans) == batches * len(tracer.segments)
+    assert all(event['dur'] >= 0 and event['ts'] >= 0 for event in spans)
+
+    # The sink and src pads of a queue mark from two threads; whatever the
+    # interleaving, an empty queue ends at occupancy 0
+    import threading
+    tracer = StageTracer(["pgie"], max_pending=1 << 20)
+    handed = threading.Semaphore(0)
+
+    def upstream():
+        for pts in range(100000):
+            tracer.mark(QUEUED, pts)
+            handed.release()
+
+    def queue_thread():
+        for pts in range(100000):
+            handed.acquire()
+            tracer.mark(STARTED, pts)
+            tracer.mark(DONE, pts)
+
+    threads = [threading.Thread(target=upstream), threading.Thread(target=queue_thread)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counters = [event[3] for event in tracer.events if event[0] == 'C']
+    assert counters[-1] == 0 and min(counters) >= 0 and tracer.max_occupancy[0] <= 100000
+
+    # Probe overhead with the real clock: batches through 4 stages (12 probes)
+    class Info:
+        def __init__(self, pts):
+            self.buffer = type('Buffer', (), {'pts': pts})()
+
+        def get_buffer(self):
+            return self.buffer
+
+    tracer = StageTracer(["pgie", "tracker", "sgie", "tgie"])
+    probes = [tracer.probe(point, 1) for point in range(len(tracer.stages) * POINTS)]
+    infos = [Info(pts) for pts in range(20000)]
+    t0 = time.perf_counter()
+    for info in infos:
+        for probe in probes:
+            probe(None, info, 0)
+    elapsed = time.perf_counter() - t0
+    print("ok: pgie queue mean {:.1f} ms (max {} batches queued), probe overhead {:.2f} us per pad, "
+          "{:.1f} us per batch through {} stages".format(
+              summary['pgie queue']['mean'] * 1e3, summary['max_occupancy']['pgie'],
+              elapsed / len(infos) / len(probes) * 1e6, elapsed / len(infos) * 1e6, len(tracer.stages)))
@@ -0,0 +1,465 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque
+
+# Worker states
+RUNNING = 'running'
+RESTARTING = 'restarting'
+DONE = 'done'           # exited cleanly, its files ended
+RETIRED = 'retired'     # failed too often, streams moved to other workers
+
+
+class ShardingError(Exception):
+    pass
+
+
+class Shard:
+    __slots__ = ('worker_id', 'gpu_id', 'control_port', 'uris', 'streams', 'unsent', 'process', 'state',
+                 'exits', 'restarts', 'restart_at', 'metrics')
+
+    def __init__(self, worker_id, gpu_id, control_port=0):
+        self.worker_id = worker_id
+        self.gpu_id = gpu_id
+        self.control_port = control_port
+        self.uris = []
+        # stream id inside the worker -> uri
+        self.streams = {}
+        # uris assigned while running, not yet added through the control API
+        self.unsent = []
+        self.process = None
+        self.state = RESTARTING
+        self.exits = deque()
+        self.restarts = 0
+        self.restart_at = 0.0
+        self.metrics = None
+
+
+def plan_shards(uris, gpu_ids, workers_per_gpu, streams_per_worker, control_base_port=0):
+    '''
+    Split uris over the fewest workers that keep each at or under
+    streams_per_worker, but at least one per GPU. Worker k runs on
+    gpu_ids[k % len(gpu_ids)] and streams are dealt round-robin, so shard
+    sizes differ by one at most. Raises ShardingError when the streams do
+    not fit in workers_per_gpu workers per GPU.
+    '''
+    capacity = len(gpu_ids) * workers_per_gpu
+    count = max(-(-len(uris) // streams_per_worker), min(len(gpu_ids), len(uris)), 1)
+    if count > capacity:
+        raise ShardingError("{} streams need {} workers of {} streams, GPUs {} take {}".format(
+            len(uris), count, streams_per_worker, ",".join(map(str, gpu_ids)), capacity))
+    shards = [Shard(k, gpu_ids[k % len(gpu_ids)], control_base_port + k if control_base_port else 0)
+              for k in range(count)]
+    for index, uri in enumerate(uris):
+        shards[index % count].uris.append(uri)
+    return shards
+
+
+def rebalance(uris, shards, streams_per_worker):
+    '''
+    Deal uris one by one to the running or restarting shard with the
+    fewest streams. Returns the [(shard, uri)] moves and the uris that fit
+    nowhere.
+    '''
+    live = [shard for shard in shards if shard.state in (RUNNING, RESTARTING)]
+    moves = []
+    left = []
+    for uri in uris:
+        shard = min(live, key=lambda shard: (len(shard.uris), shard.worker_id), default=None)
+        if shard is None or len(shard.uris) >= streams_per_worker:
+            left.append(uri)
+            continue
+        shard.uris.append(uri)
+        moves.append((shard, uri))
+    return moves, left
+
+
+def worker_command(script, streams_per_worker, extra_args=(), python=sys.executable):
+    '''
+    command(shard) for main.py-like workers: every slot up front, sources
+    added through the control API, the GPU selected by CUDA_VISIBLE_DEVICES.
+    '''
+    def command(shard):
+        argv = [python, script, '--max-sources', str(streams_per_worker)]
+        if shard.control_port:
+            argv += ['--control-port', str(shard.control_port)]
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(shard.gpu_id), PYTHONUNBUFFERED='1')
+        return argv + list(extra_args) + shard.uris, env
+    return command
+
+
+def post_source(shard, uri, timeout=2.0):
+    '''Add uri to a running worker through its control API, returns the stream id.'''
+    request = urllib.request.Request("http://127.0.0.1:{}/sources".format(shard.control_port),
+                                     data=json.dumps({'uri': uri}).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())['id']
+
+
+class Supervisor:
+    '''
+    Run the streams of one camera list in several worker pipelines.
+
+    plan_shards() assigns the streams, start() launches one subprocess per
+    shard and poll() watches them: a worker that exits with an error is
+    restarted after restart_delay, doubling per exit; after more than
+    max_restarts exits within restart_window its GPU slot is retired and
+    its streams move to the live workers with room (added at runtime via
+    add_stream, by default the control API), then to new workers on GPU
+    slots that are still free. What fits nowhere waits in pending.
+
+    Worker stdout is read on one thread per worker: JSON lines are metric
+    snapshots (common.metrics.JsonLinesReporter) or, with an "event" key,
+    recognition events (common.event_sink.StreamTransport), the rest is
+    passed to log prefixed with the worker. report() writes one JSON line with the metrics of all workers,
+    fps keyed by uri; events are written as they arrive.
+    '''
+    def __init__(self, uris, gpu_ids, workers_per_gpu, streams_per_worker, command, control_base_port=0,
+                 max_restarts=3, restart_window=300.0, restart_delay=2.0, add_stream=post_source,
+                 output=None, log=sys.stderr.write, clock=time.monotonic, popen=subprocess.Popen):
+        self.gpu_ids = list(gpu_ids)
+        self.workers_per_gpu = workers_per_gpu
+        self.streams_per_worker = streams_per_worker
+        self.control_base_port = control_base_port
+        self.shards = plan_shards(uris, self.gpu_ids, workers_per_gpu, streams_per_worker, control_base_port)
+        self.command = command
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.restart_delay = restart_delay
+        self.add_stream = add_stream
+        self.output = output
+        self.log = log
+        self.clock = clock
+        self.popen = popen
+        self.lock = threading.Lock()
+        self.pending = []
+        self.events = 0
+        self.started = clock()
+
+    def start(self):
+        for shard in self.shards:
+            self._launch(shard)
+        return self
+
+    def running(self):
+        '''False once every worker finished or retired.'''
+        return any(shard.state in (RUNNING, RESTARTING) for shard in self.shards)
+
+    def poll(self):
+        now = self.clock()
+        for shard in list(self.shards):
+            if shard.state == RUNNING:
+                code = shard.process.poll()
+                if code is None:
+                    self._send(shard)
+                elif code == 0:
+                    self.log("worker {} finished\n".format(shard.worker_id))
+                    shard.state = DONE
+                else:
+                    self._exited(shard, code, now)
+            elif shard.state == RESTARTING and now >= shard.restart_at:
+                shard.restarts += 1
+                self._launch(shard)
+        if self.pending:
+            self._place(self.pending)
+
+    def stop(self, timeout=5.0):
+        for shard in self.shards:
+            if shard.process is not None and shard.process.poll() is None:
+                shard.process.terminate()
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            try:
+                shard.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                shard.process.kill()
+                shard.process.wait()
+
+    def run(self, interval=5.0, poll_interval=0.5):
+        next_report = self.clock() + interval
+        try:
+            while self.running():
+                time.sleep(poll_interval)
+                self.poll()
+                if self.clock() >= next_report:
+                    self.report()
+                    next_report += interval
+        finally:
+            self.stop()
+            self.report()
+
+    def _launch(self, shard):
+        argv, env = self.command(shard)
+        self.log("worker {} on GPU {}: {} streams\n".format(shard.worker_id, shard.gpu_id, len(shard.uris)))
+        process = self.popen(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True, bufsize=1)
+        with self.lock:
+            shard.process = process
+            shard.streams = dict(enumerate(shard.uris))
+            shard.unsent = []
+            shard.metrics = None
+            shard.state = RUNNING
+        threading.Thread(target=self._read, args=(shard, process), name="worker-%d" % shard.worker_id,
+                         daemon=True).start()
+
+    def _exited(self, shard, code, now):
+        shard.exits.append(now)
+        while shard.exits and now - shard.exits[0] > self.restart_window:
+            shard.exits.popleft()
+        if len(shard.exits) <= self.max_restarts:
+            delay = self.restart_delay * 2 ** (len(shard.exits) - 1)
+            self.log("worker {} exited with {}, restarting in {:.1f}s\n".format(shard.worker_id, code, delay))
+            shard.state = RESTARTING
+            shard.restart_at = now + delay
+            return
+        self.log("worker {} exited {} times in {:.0f}s, moving its {} streams\n".format(
+            shard.worker_id, len(shard.exits), self.restart_window, len(shard.uris)))
+        with self.lock:
+            shard.state = RETIRED
+            uris, shard.uris, shard.streams = shard.uris, [], {}
+        self._place(uris)
+
+    def _place(self, uris):
+        moves, left = rebalance(uris, self.shards, self.streams_per_worker)
+        for shard, uri in moves:
+            # a restarting worker gets it on its command line
+            if shard.state == RUNNING:
+                shard.unsent.append(uri)
+                self._send(shard)
+        while left:
+            gpu_id = self._free_gpu()
+            if gpu_id is None:
+                break
+            worker_id = len(self.shards)
+            shard = Shard(worker_id, gpu_id, self.control_base_port + worker_id if self.control_base_port else 0)
+            shard.uris, left = left[:self.streams_per_worker], left[self.streams_per_worker:]
+            self.shards.append(shard)
+            self._launch(shard)
+        self.pending = left
+
+    def _free_gpu(self):
+        '''GPU with a free worker slot, away from retired workers; retired slots stay used.'''
+        candidates = []
+        for gpu_id in self.gpu_ids:
+            shards = [shard for shard in self.shards if shard.gpu_id == gpu_id]
+            if len(shards) < self.workers_per_gpu:
+                retired = sum(shard.state == RETIRED for shard in shards)
+                candidates.append((retired, len(shards), gpu_id))
+        return min(candidates)[2] if candidates else None
+
+    def _send(self, shard):
+        while shard.unsent:
+            uri = shard.unsent[0]
+            try:
+                stream_id = self.add_stream(shard, uri)
+            except (OSError, ValueError, KeyError):
+                # not serving yet, retried on the next poll
+                return
+            with self.lock:
+                shard.streams[stream_id] = uri
+            shard.unsent.pop(0)
+            self.log("worker {} took over {} as stream {}\n".format(shard.worker_id, uri, stream_id))
+
+    def _read(self, shard, process):
+        for line in process.stdout:
+            line = line.rstrip('\n')
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if isinstance(record, dict) and 'event' in record:
+                    with self.lock:
+                        record['uri'] = shard.streams.get(record.get('stream_id'))
+                        self.events += 1
+                    record['worker'] = shard.worker_id
+                    record['gpu'] = shard.gpu_id
+                    self._write(json.dumps(record))
+                    continue
+                if record is not None:
+                    with self.lock:
+                        if shard.process is process:
+                            shard.metrics = record
+                    continue
+            self.log("[worker {}] {}\n".format(shard.worker_id, line))
+
+    def aggregate(self):
+        '''Metrics of all workers: counters and gauges summed, fps per uri.'''
+        workers = {}
+        fps = {}
+        counters = {}
+        gauges = {}
+        with self.lock:
+            for shard in self.shards:
+                workers[shard.worker_id] = {'gpu': shard.gpu_id, 'state': shard.state, 'restarts': shard.restarts,
+                                            'streams': len(shard.uris)}
+                metrics = shard.metrics
+                if metrics is None or shard.state != RUNNING:
+                    continue
+                for stream_id, value in metrics.get('fps', {}).items():
+                    uri = shard.streams.get(int(stream_id)) if stream_id.isdigit() else None
+                    if uri is not None:
+                        fps[uri] = value
+                for name, values in metrics.get('counters', {}).items():
+                    counters[name] = counters.get(name, 0) + sum(values.values())
+                for name, value in metrics.get('gauges', {}).items():
+                    if isinstance(value, (int, float)):
+                        gauges[name] = gauges.get(name, 0) + value
+            pending = list(self.pending)
+            events = self.events
+        return {
+            'time': time.time(),
+            'uptime': round(self.clock() - self.started, 3),
+            'workers': workers,
+            'pending': pending,
+            'fps': fps,
+            'counters': counters,
+            'gauges': gauges,
+            'events': events,
+        }
+
+    def report(self):
+        self._write(json.dumps(self.aggregate()))
+
+    def _write(self, line):
+        with self.lock:
+            if self.output is None:
+                print(line)
+                sys.stdout.flush()
+            else:
+                with open(self.output, 'a') as f:
+                    f.write(line + "\n")
+
+
+STUB_WORKER = '''
+import argparse, json, os, sys, time
+from common import fake_gst
+from common.source_manager import SourceManager, serve_control, use_gst
+
+parser = argparse.ArgumentParser()
+parser.add_argument('uris', nargs='*')
+parser.add_argument('--max-sources', type=int)
+parser.add_argument('--control-port', type=int)
+options = parser.parse_args()
+if os.environ['CUDA_VISIBLE_DEVICES'] == os.environ['STUB_BAD_GPU']:
+    time.sleep(0.1)
+    sys.exit(1)
+use_gst(fake_gst)
+pipeline = fake_gst.FakePipeline()
+streammux = fake_gst.ElementFactory.make("nvstreammux", "Stream-muxer")
+pipeline.add(streammux)
+manager = SourceManager(pipeline, streammux, lambda index, uri: fake_gst.FakeBin("source-bin-%02d" % index),
+                        options.max_sources, schedule=lambda callback, *args: callback(*args))
+for uri in options.uris:
+    manager.add(uri, immediate=True)
+serve_control(manager, options.control_port)
+frames = 0
+while True:
+    frames += 1
+    streams = [source['id'] for source in manager.sources()]
+    print(json.dumps({'fps': {str(i): 25.0 for i in streams}, 'counters': {'frames': {str(i): frames for i in streams}},
+                      'gauges': {'tracks': len(streams)}}))
+    for i in streams:
+        print(json.dumps({'event': 'identity_matched', 'time': time.time(), 'stream_id': i, 'object_id': 7,
+                          'frame': frames, 'score': 0.91, 'identity': 3}))
+    time.sleep(0.05)
+'''
+
+
+if __name__ == '__main__':
+    import socket
+    import tempfile
+
+    # Scheduling and rebalancing, first on plain shards, then with stub
+    # workers (fake_gst pipelines behind the real control API) where every
+    # worker on GPU 1 crashes on start.
+    shards = plan_shards(["cam%d" % i for i in range(10)], [0, 1], 2, 3)
+    assert [shard.gpu_id for shard in shards] == [0, 1, 0, 1]
+    assert [len(shard.uris) for shard in shards] == [3, 3, 2, 2]
+    assert [len(shard.uris) for shard in plan_shards(["cam0"], [0, 1], 1, 4)] == [1]
+    assert [shard.gpu_id for shard in plan_shards(["cam0", "cam1"], [0, 1], 1, 4)] == [0, 1]
+    try:
+        plan_shards(["cam%d" % i for i in range(13)], [0, 1], 2, 3)
+        raise AssertionError("expected too many streams")
+    except ShardingError:
+        pass
+    for shard in shards:
+        shard.state = RUNNING
+    shards[1].state = RETIRED
+    moves, left = rebalance(shards[1].uris, shards, 3)
+    assert [(shard.worker_id, uri) for shard, uri in moves] == [(2, "cam1"), (3, "cam5")] and left == ["cam9"]
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        base_port = s.getsockname()[1]
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    uris = ["rtsp://cam%d" % i for i in range(4)]
+
+    command = worker_command('-c', 3)
+
+    def stub_command(shard):
+        # python -c STUB_WORKER --max-sources 3 --control-port P uri...
+        argv, env = command(shard)
+        argv.insert(2, STUB_WORKER)
+        env.update(PYTHONPATH=src, STUB_BAD_GPU='1')
+        return argv, env
+
+    logs = []
+    output = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False).name
+    supervisor = Supervisor(uris, gpu_ids=[0, 1], workers_per_gpu=2, streams_per_worker=3, command=stub_command,
+                            control_base_port=base_port, max_restarts=2, restart_window=60.0, restart_delay=0.05,
+                            output=output, log=logs.append).start()
+    try:
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            supervisor.poll()
+            aggregate = supervisor.aggregate()
+            if len(aggregate['fps']) == 4 and all(not shard.unsent for shard in supervisor.shards):
+                break
+            time.sleep(0.02)
+        aggregate = supervisor.aggregate()
+        # worker 1 (GPU 1) retired after 3 crashes; cam1 moved to worker 0,
+        # cam3 to a new worker on GPU 0, GPU 1's other slot left alone
+        assert aggregate['workers'][1] == {'gpu': 1, 'state': RETIRED, 'restarts': 2, 'streams': 0}, aggregate
+        assert [(shard.gpu_id, shard.uris) for shard in supervisor.shards] == [
+            (0, ["rtsp://cam0", "rtsp://cam2", "rtsp://cam1"]), (1, []), (0, ["rtsp://cam3"])]
+        assert sorted(aggregate['fps']) == uris and not aggregate['pending'], aggregate
+        with urllib.request.urlopen("http://127.0.0.1:%d/sources" % base_port) as response:
+            assert [source['uri'] for source in json.loads(response.read())] == \
+                ["rtsp://cam0", "rtsp://cam2", "rtsp://cam1"]
+        # the taken-over stream's events carry its uri
+        time.sleep(0.2)
+        supervisor.report()
+    finally:
+        supervisor.stop()
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    os.remove(output)
+    events = [line for line in lines if line.get('event') == 'identity_matched']
+    assert set(uris) <= {event['uri'] for event in events}
+    assert lines[-1]['counters']['frames'] > 0 and lines[-1]['gauges']['tracks'] == 4
+    print("ok: {} workers, {} events, {}".format(len(supervisor.shards), len(events),
+                                                 ", ".join(line for line in logs if 'moving' in line).strip()))
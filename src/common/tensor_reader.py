@@ -0,0 +1,119 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import ctypes
+import numpy as np
+
+# NvDsInferDataType -> (ctypes element, numpy dtype)
+# FLOAT=0, HALF=1, INT8=2, INT32=3
+INFER_DATA_TYPES = {
+    0: (ctypes.c_float, np.float32),
+    1: (ctypes.c_uint16, np.float16),
+    2: (ctypes.c_int8, np.int8),
+    3: (ctypes.c_int32, np.int32),
+}
+
+
+class TensorReader:
+    """Expose NvDsInferLayerInfo buffers as NumPy views without copying.
+
+    get_ptr turns layer.buffer into an integer address. The default uses
+    pyds.get_ptr; FakeTensorReader swaps it for plain host arrays so the
+    same code path can run on CPU without DeepStream.
+    """
+    def __init__(self, get_ptr=None):
+        if get_ptr is None:
+            import pyds
+            get_ptr = pyds.get_ptr
+        self.get_ptr = get_ptr
+
+    def layer_view(self, layer):
+        """Return a flat read-only view over the layer output buffer."""
+        c_type, dtype = INFER_DATA_TYPES[int(layer.dataType)]
+        num_elements = layer.inferDims.numElements
+        ptr = ctypes.cast(self.get_ptr(layer.buffer), ctypes.POINTER(c_type))
+        view = np.ctypeslib.as_array(ptr, shape=(num_elements,))
+        if view.dtype != dtype:
+            view = view.view(dtype)
+        view.flags.writeable = False
+        return view
+
+    def batch(self, layers):
+        """Stack the outputs of several layers into an (N, D) array (copy)."""
+        if not layers:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([self.layer_view(layer) for layer in layers])
+
+
+def l2_normalize(batch, eps=1e-12):
+    """Row-wise L2 normalization of an (N, D) batch, returned as float32."""
+    batch = np.asarray(batch, dtype=np.float32)
+    norms = np.linalg.norm(batch, axis=1, keepdims=True)
+    np.maximum(norms, eps, out=norms)
+    return batch / norms
+
+
+class FakeInferDims:
+    def __init__(self, shape):
+        self.numDims = len(shape)
+        self.d = list(shape)
+        self.numElements = int(np.prod(shape))
+
+
+class FakeLayerInfo:
+    """Stand-in for pyds.NvDsInferLayerInfo backed by a host NumPy array."""
+    def __init__(self, array, layer_name="output"):
+        self.array = np.ascontiguousarray(array)
+        self.buffer = self.array
+        self.layerName = layer_name
+        self.inferDims = FakeInferDims(self.array.shape)
+        for data_type, (_, dtype) in INFER_DATA_TYPES.items():
+            if self.array.dtype == dtype:
+                self.dataType = data_type
+                break
+        else:
+            raise ValueError("unsupported dtype %s" % self.array.dtype)
+
+
+class FakeTensorReader(TensorReader):
+    def __init__(self):
+        TensorReader.__init__(self, get_ptr=lambda buffer: buffer.ctypes.data)
+
+
+if __name__ == '__main__':
+    import time
+
+    reader = FakeTensorReader()
+    layers = [FakeLayerInfo(np.random.rand(512).astype(np.float32)) for _ in range(64)]
+
+    def get_detections(buffer, i):
+        # Python-side equivalent of one pyds.get_detections call
+        return ctypes.cast(buffer.ctypes.data, ctypes.POINTER(ctypes.c_float))[i]
+
+    rounds = 50
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for layer in layers:
+            res = np.reshape([get_detections(layer.buffer, i) for i in range(512)], (512, -1))
+            res / np.linalg.norm(res)
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        l2_normalize(reader.batch(layers))
+    t2 = time.perf_counter()
+    faces = rounds * len(layers)
+    print("per-element: %.1f faces/s" % (faces / (t1 - t0)))
+    print("view+batch : %.1f faces/s" % (faces / (t2 - t1)))
@@ -0,0 +1,214 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import threading
+import time
+from collections import OrderedDict
+
+EVICT_TTL = 'ttl'
+EVICT_CAPACITY = 'capacity'
+EVICT_STREAM = 'stream'
+
+
+class TrackState:
+    __slots__ = ('stream_id', 'object_id', 'first_frame', 'last_frame',
+                 'last_seen', 'face_frame', 'embedding', 'faces', 'face_source_size', 'label')
+
+    def __init__(self, stream_id, object_id, frame_num, now):
+        self.stream_id = stream_id
+        self.object_id = object_id
+        self.first_frame = frame_num
+        self.last_frame = frame_num
+        self.last_seen = now
+        self.face_frame = None
+        self.embedding = None
+        self.faces = []
+        self.face_source_size = 0.0
+        # gallery identity of the last match, None until the first one
+        self.label = None
+
+    def __repr__(self):
+        return "TrackState(stream={}, object={}, frames={}-{})".format(
+            self.stream_id, self.object_id, self.first_frame, self.last_frame)
+
+
+class TrackStore:
+    """Per-stream track state with LRU capacity and TTL eviction.
+
+    Each stream owns an OrderedDict kept in last-seen order, so expiring
+    stale tracks only ever looks at the front of the dict. A track expires
+    when it has not been seen for ttl_frames frames of its stream or for
+    ttl_seconds of wall time (either may be None), or when its stream's
+    frame numbers went back past it (a new source on a reused stream id).
+    on_evict(state, reason) is called for every evicted track.
+
+    Stream partitions are created and removed under a lock, so len() can be
+    sampled from another thread. A stream removed with remove_stream stays
+    retired, its late frames creating no tracks, until add_stream hands the
+    id to a new source.
+    """
+    def __init__(self, max_tracks_per_stream=4096, ttl_frames=300, ttl_seconds=None,
+                 on_evict=None, clock=time.monotonic):
+        self.max_tracks_per_stream = max_tracks_per_stream
+        self.ttl_frames = ttl_frames
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self.clock = clock
+        self.streams = {}
+        self.retired = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(tracks) for tracks in self.streams.values())
+
+    def __contains__(self, key):
+        stream_id, object_id = key
+        tracks = self.streams.get(stream_id)
+        return tracks is not None and object_id in tracks
+
+    def get(self, stream_id, object_id):
+        tracks = self.streams.get(stream_id)
+        if tracks is None:
+            return None
+        return tracks.get(object_id)
+
+    def touch(self, stream_id, object_id, frame_num):
+        """Mark a track as seen; returns (state, created), (None, False) on a retired stream."""
+        tracks = self.streams.get(stream_id)
+        if tracks is None:
+            with self.lock:
+                if stream_id in self.retired:
+                    return None, False
+                tracks = self.streams.setdefault(stream_id, OrderedDict())
+        now = self.clock()
+        state = tracks.get(object_id)
+        if state is not None:
+            state.last_frame = frame_num
+            state.last_seen = now
+            tracks.move_to_end(object_id)
+            return state, False
+        state = tracks[object_id] = TrackState(stream_id, object_id, frame_num, now)
+        if len(tracks) > self.max_tracks_per_stream:
+            self._evict(tracks, EVICT_CAPACITY)
+        return state, True
+
+    def _evict(self, tracks, reason):
+        _, state = tracks.popitem(last=False)
+        if self.on_evict is not None:
+            self.on_evict(state, reason)
+
+    def expire(self, stream_id, frame_num):
+        """Evict the stream's tracks that fell out of the TTL window."""
+        tracks = self.streams.get(stream_id)
+        if not tracks:
+            return 0
+        min_frame = None if self.ttl_frames is None else frame_num - self.ttl_frames
+        min_seen = None if self.ttl_seconds is None else self.clock() - self.ttl_seconds
+        evicted = 0
+        while tracks:
+            state = next(iter(tracks.values()))
+            if (min_frame is not None and state.last_frame < min_frame) or \
+                    (min_seen is not None and state.last_seen < min_seen) or state.last_frame > frame_num:
+                self._evict(tracks, EVICT_TTL)
+                evicted += 1
+            else:
+                break
+        return evicted
+
+    def add_stream(self, stream_id):
+        """Track stream_id again after remove_stream, e.g. when a new source takes it."""
+        with self.lock:
+            self.retired.discard(stream_id)
+
+    def remove_stream(self, stream_id):
+        """Evict every track of a stream and retire it, e.g. when the source goes away."""
+        with self.lock:
+            tracks = self.streams.pop(stream_id, None)
+            self.retired.add(stream_id)
+        while tracks:
+            self._evict(tracks, EVICT_STREAM)
+
+
+if __name__ == '__main__':
+    import resource
+    import sys
+
+    # usage: python -m common.track_store [lifecycles]
+    lifecycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    streams = 16
+    frames_per_track = 20
+    live_per_stream = 50
+    evicted = [0]
+
+    def count(state, reason):
+        evicted[0] += 1
+
+    # a new source on a reused stream id restarts its frame numbers: tracks
+    # left by the old source's last buffers go on the new stream's first frame
+    store = TrackStore(ttl_frames=30, on_evict=count)
+    store.touch(0, 1, 5000)
+    store.touch(0, 2, 3)
+    assert store.expire(0, 3) == 1 and (0, 2) in store and (0, 1) not in store
+
+    # frames of a detached source still in the queues after remove_stream
+    # must not leave tracks for the next source on that stream id
+    store.remove_stream(0)
+    assert store.touch(0, 2, 4) == (None, False) and len(store) == 0 and store.expire(0, 4) == 0
+    store.add_stream(0)
+    state, created = store.touch(0, 7, 0)
+    assert created and state.first_frame == 0 and len(store) == 1
+
+    # len() from another thread while streams come and go
+    stop = []
+
+    def churn():
+        for n in range(20000):
+            store.touch(n % 64, n, n)
+            if n % 3 == 0:
+                store.remove_stream(n % 64)
+                store.add_stream(n % 64)
+        stop.append(True)
+
+    worker = threading.Thread(target=churn)
+    worker.start()
+    while not stop:
+        len(store)
+    worker.join()
+    evicted[0] = 0
+
+    store = TrackStore(ttl_frames=30, on_evict=count)
+    t0 = time.perf_counter()
+    frame = 0
+    object_id = 0
+    # every stream keeps live_per_stream overlapping tracks; each lives
+    # frames_per_track frames, then is left to expire
+    while object_id < lifecycles:
+        for stream_id in range(streams):
+            base = (frame // frames_per_track) * live_per_stream
+            for i in range(live_per_stream):
+                store.touch(stream_id, (stream_id << 40) | (base + i), frame)
+            store.expire(stream_id, frame)
+        if frame % frames_per_track == 0:
+            object_id += streams * live_per_stream
+        frame += 1
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    touches = frame * streams * live_per_stream
+    print("lifecycles %d, evicted %d, live %d" % (object_id, evicted[0], len(store)))
+    print("%.2f s, %.0f touches/s, %.0f lifecycles/s, peak rss %.1f MB" % (
+        elapsed, touches / elapsed, object_id / elapsed, peak))
@@ -0,0 +1,258 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import threading
+import time
+from collections import deque
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class FaceRecord:
+    """What a probe hands over for one face.
+
+    The embedding must not alias DeepStream memory (the buffer is recycled
+    once the probe returns), so probes pass rows of an array they own.
+    job is the --bulk file the frame belongs to (common.bulk_runner.Job):
+    a stream id is handed to the next file while faces of the previous
+    one can still be queued.
+    """
+    __slots__ = ('stream_id', 'frame_num', 'object_id', 'bbox', 'quality', 'embedding', 'track', 'job')
+
+    def __init__(self, stream_id, frame_num, object_id, bbox, quality, embedding, track=None, job=None):
+        self.stream_id = stream_id
+        self.frame_num = frame_num
+        self.object_id = object_id
+        self.bbox = bbox
+        self.quality = quality
+        self.embedding = embedding
+        self.track = track
+        self.job = job
+
+
+class WorkQueue:
+    """Bounded FIFO between the streaming thread and a worker.
+
+    When full, put() applies the policy: DROP_OLDEST evicts the oldest
+    records, DROP_NEWEST rejects the incoming ones and BLOCK waits up to
+    block_timeout seconds for room (then drops the newest). Producers take
+    the lock once per put(), so probes should submit a whole batch at a
+    time.
+    """
+    def __init__(self, capacity=4096, policy=DROP_OLDEST, block_timeout=0.01):
+        if policy not in POLICIES:
+            raise ValueError("unknown queue policy: {}".format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_watermark = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, records):
+        """Enqueue records; returns how many were accepted."""
+        with self.lock:
+            if self.closed:
+                self.dropped += len(records)
+                return 0
+            items = self.items
+            room = self.capacity - len(items)
+            if room < len(records) and self.policy == BLOCK:
+                deadline = time.monotonic() + self.block_timeout
+                while room < len(records) and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.not_full.wait(remaining):
+                        break
+                    room = self.capacity - len(items)
+            if room < len(records):
+                if self.policy == DROP_OLDEST:
+                    overflow = min(len(records) - room, len(items))
+                    for _ in range(overflow):
+                        items.popleft()
+                    self.dropped += overflow
+                    if len(records) > self.capacity:
+                        self.dropped += len(records) - self.capacity
+                        records = records[-self.capacity:]
+                else:
+                    self.dropped += len(records) - max(room, 0)
+                    records = records[:max(room, 0)]
+            items.extend(records)
+            self.enqueued += len(records)
+            if len(items) > self.high_watermark:
+                self.high_watermark = len(items)
+            if records:
+                self.not_empty.notify()
+            return len(records)
+
+    def get(self, max_items=256, timeout=None):
+        """Dequeue up to max_items, waiting for at least one; [] on timeout or close."""
+        with self.lock:
+            if not self.items and not self.closed:
+                self.not_empty.wait(timeout)
+            items = self.items
+            count = min(max_items, len(items))
+            batch = [items.popleft() for _ in range(count)]
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+
+class WorkerPool:
+    """Worker threads draining sharded WorkQueues into handler(records).
+
+    Records are routed by (stream_id, object_id), so one track is always
+    handled by the same worker, in order, and per-track state needs no
+    locking. handler is called with up to batch_size records at once so it
+    can vectorize (normalization, gallery search). NumPy and the gallery
+    release the GIL for the heavy parts, so threads are enough here.
+    """
+    def __init__(self, handler, workers=2, capacity=4096, policy=DROP_OLDEST, batch_size=256,
+                 block_timeout=0.01):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.queues = [WorkQueue(capacity, policy, block_timeout) for _ in range(workers)]
+        self.threads = []
+        self.processed = 0
+        self.errors = 0
+        self.stats_lock = threading.Lock()
+
+    def start(self):
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(queue,), name="post-probe-%d" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def submit(self, records):
+        """Hand records to the workers; returns how many were accepted."""
+        queues = self.queues
+        if len(queues) == 1:
+            return queues[0].put(records)
+        shards = [[] for _ in queues]
+        for record in records:
+            shards[hash((record.stream_id, record.object_id)) % len(queues)].append(record)
+        return sum(queue.put(shard) for queue, shard in zip(queues, shards) if shard)
+
+    def _run(self, queue):
+        while True:
+            batch = queue.get(self.batch_size, timeout=0.5)
+            if not batch:
+                if queue.closed and not queue.items:
+                    return
+                continue
+            try:
+                self.handler(batch)
+            except Exception as e:
+                # a bad record must not kill the worker
+                with self.stats_lock:
+                    self.errors += 1
+                print("post-probe handler failed: {}".format(e))
+            with self.stats_lock:
+                self.processed += len(batch)
+
+    def stop(self, timeout=5.0):
+        """Close the queues and wait for the workers to drain them."""
+        for queue in self.queues:
+            queue.close()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def stats(self):
+        return {
+            'depth': sum(len(queue) for queue in self.queues),
+            'high_watermark': max(queue.high_watermark for queue in self.queues),
+            'enqueued': sum(queue.enqueued for queue in self.queues),
+            'dropped': sum(queue.dropped for queue in self.queues),
+            'processed': self.processed,
+            'errors': self.errors,
+        }
+
+
+if __name__ == '__main__':
+    import sys
+
+    import numpy as np
+
+    from common.gallery import FaceGallery
+    from common.tensor_reader import l2_normalize
+
+    # usage: python -m common.work_queue [faces_per_sec] [seconds] [workers] [policy]
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    policy = sys.argv[4] if len(sys.argv) > 4 else DROP_OLDEST
+
+    rng = np.random.default_rng(0)
+    gallery = FaceGallery()
+    gallery.add(np.arange(10000), l2_normalize(rng.standard_normal((10000, 512), dtype=np.float32)))
+    matches = [0]
+
+    def handler(records):
+        features = l2_normalize(np.stack([record.embedding for record in records]))
+        _, scores = gallery.search(features, k=1)
+        matches[0] += int((scores[:, 0] >= 0.4).sum())
+
+    pool = WorkerPool(handler, workers=workers, policy=policy).start()
+    # the producer mimics the tiler probe: 4 streams at 25 fps, faces split
+    # evenly over the frames, one submit per batched buffer
+    buffers_per_sec = 25.0
+    faces_per_buffer = max(1, int(rate / buffers_per_sec))
+    embeddings = rng.standard_normal((faces_per_buffer, 512), dtype=np.float32)
+    put_times = []
+    start = time.perf_counter()
+    frame = 0
+    while time.perf_counter() - start < seconds:
+        t0 = time.perf_counter()
+        copy = embeddings.copy()
+        records = [FaceRecord(i % 4, frame, (i % 4, frame // 50, i), (0, 0, 50, 50), 1.0, copy[i])
+                   for i in range(faces_per_buffer)]
+        pool.submit(records)
+        put_times.append(time.perf_counter() - t0)
+        frame += 1
+        sleep = start + frame / buffers_per_sec - time.perf_counter()
+        if sleep > 0:
+            time.sleep(sleep)
+    produced = time.perf_counter() - start
+    pool.stop()
+    drained = time.perf_counter() - start
+    stats = pool.stats()
+    put_times = np.array(put_times) * 1e6
+    print("offered %.0f faces/s for %.1f s with %d worker(s), policy %s" % (
+        faces_per_buffer * frame / produced, produced, workers, policy))
+    print("probe-side submit per buffer: p50 %.0f us, p99 %.0f us (%d faces)" % (
+        np.percentile(put_times, 50), np.percentile(put_times, 99), faces_per_buffer))
+    print("processed %d (%.0f faces/s), dropped %d, errors %d, max depth %d, drained in %.2f s" % (
+        stats['processed'], stats['processed'] / drained, stats['dropped'], stats['errors'],
+        stats['high_watermark'], drained - produced))
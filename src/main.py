@@ -20,51 +20,119 @@
 import sys
 sys.path.append('../')
 import gi
+import argparse
 import configparser
+import os
 gi.require_version('Gst', '1.0')
 from gi.repository import GObject, Gst
 from gi.repository import GLib
 from ctypes import *
 import sys
-import math
 import numpy as np
-import time
+import threading
 
-from common.is_aarch_64 import is_aarch64
+import common.bus_call
 from common.bus_call import bus_call
-from common.FPS import GETFPS
+from common.tensor_reader import TensorReader, l2_normalize
+from common.gallery import FaceGallery, create_gallery
+from common.embedding_store import EmbeddingStore
+from common.track_store import TrackStore
+from common.admission import AdmissionScheduler
+from common.face_quality import (QualityPolicy, face_quality, detector_landmarks, match_landmarks,
+                                 NUM_DETECTIONS_LAYER, BOXES_LAYER, LANDMARKS_LAYER)
+from common.meta_walker import collect, iter_frames, iter_objects, iter_tensor_meta
+from common.work_queue import FaceRecord, WorkerPool, DROP_OLDEST
+from common.metrics import Metrics, JsonLinesReporter, serve_prometheus
+from common.output_branch import OUTPUT_NONE, add_output_arguments, build_output_branch
+from common.engine_cache import EngineCache, resolve_engines
+from common.pipeline_builder import PipelineSpecError, build_pipeline, load_pipeline_spec
+from common.source_manager import SourceManager, serve_control
+from common.source_health import Reconnector
+from common.stage_tracer import StageTracer
+from common.recording import Recorder
+from common.bulk_runner import BulkRunner, Checkpoint, load_manifest, parse_stream_eos
+from common.load_controller import FrameDropper, LatencyWindow, LoadController, gst_queue_fill
+from common.event_sink import (EventSink, SocketTransport, open_transport, TRACK_STARTED, FACE_CAPTURED, IDENTITY_MATCHED,
+                               TRACK_ENDED)
 import pyds
 
 
 
 MAX_DISPLAY_LEN=64
 
-MUXER_OUTPUT_WIDTH=1920
-MUXER_OUTPUT_HEIGHT=1080
-MUXER_BATCH_TIMEOUT_USEC=4000000
-TILED_OUTPUT_WIDTH=1280
-TILED_OUTPUT_HEIGHT=720
 GST_CAPS_FEATURES_NVMM="memory:NVMM"
-OSD_PROCESS_MODE= 0
-OSD_DISPLAY_TEXT= 1
 
-PGIE = 1
-SGIE = 2
-TGIE = 3
-
-PERSON_DETECTED = {}
-fps_streams={}
-RFACE_POOL=[]
-RFACE_POOL_MAX = 4
-start_time=0
-end_time=0
-is_first=True
+# (gie-unique-id, class id) of the person and face detections and the
+# gie-unique-id of the face embedder, set from the roles of the pipeline
+# spec; PERSONS is None when faces are detected on full frames
+PERSONS = (1, 0)
+FACES = (2, 1)
+EMBEDDER = 3
+
+# Stages, config files, batch sizes and queues, see common/pipeline_builder.py
+PIPELINE_SPEC = "configs/pipeline_person_face.txt"
+GALLERY_CONFIG = "configs/config_gallery.txt"
+MATCH_THRESHOLD = 0.4
+
+TRACK_TTL_FRAMES = 300
+# Face SGIE admissions (person crops per second)
+SGIE_BUDGET_PER_SEC = 30
+SGIE_STREAM_BUDGET_PER_SEC = 10
+# (width, height) below which the face SGIE skips a person crop, set from
+# its input-object-min-width/height; smaller persons are not admitted
+MIN_PERSON_SIZE = (64, 64)
+# Persons not admitted cross the face SGIE with their class shifted by this,
+# out of its operate-on-class-ids, and get it back behind it
+SKIP_CLASS_OFFSET = 1 << 16
+# Best faces kept (and fused) per track
+FACES_PER_TRACK = 8
+# Matching and storage run off the streaming thread
+POST_PROBE_WORKERS = 2
+POST_PROBE_QUEUE_SIZE = 4096
+POST_PROBE_POLICY = DROP_OLDEST
+# JSON lines every METRICS_INTERVAL_SEC to METRICS_JSON_FILE (None: stdout);
+# Prometheus text on http://0.0.0.0:METRICS_PORT/metrics if METRICS_PORT
+METRICS_INTERVAL_SEC = 5
+METRICS_JSON_FILE = None
+METRICS_PORT = 0
+# Failed sources are re-created after RECONNECT_BASE_SEC, doubling up to
+# RECONNECT_MAX_SEC; a source without frames for STALL_TIMEOUT_SEC has failed
+RECONNECT_BASE_SEC = 1
+RECONNECT_MAX_SEC = 60
+STALL_TIMEOUT_SEC = 10
+HEALTH_CHECK_SEC = 1
+# Live sources: detector interval, SGIE budget and frame dropping follow the
+# load to keep the p95 ingress-to-egress latency under LATENCY_SLO_SEC
+LATENCY_SLO_SEC = 0.5
+LOAD_CONTROL_SEC = 1
+# Source slots of --bulk runs without --max-sources
+BULK_SOURCES = 8
+# Recognition events are written in batches of up to this many, at least every flush interval
+EVENT_BATCH_SIZE = 512
+EVENT_FLUSH_SEC = 0.5
+# --events=socket: batches whose oldest event waited longer than this for a slow
+# reader are dropped, not delivered late (files and stdout never drop for age)
+EVENT_SOCKET_MAX_DELAY_SEC = 2.0
+
+TRACKS = TrackStore(ttl_frames=TRACK_TTL_FRAMES)
+TENSOR_READER = TensorReader()
+FACE_GALLERY = FaceGallery()
+CAPTURE_STORE = None
+CAPTURE_LOCK = threading.Lock()
+FACE_WORKERS = None
+SOURCES = None
+RECONNECTOR = None
+FRAME_DROPPER = FrameDropper()
+LOAD_CONTROLLER = None
+BULK = None
+EVENTS = None
+METRICS = Metrics()
+QUALITY_POLICY = QualityPolicy(top_k=FACES_PER_TRACK)
+ADMISSION = AdmissionScheduler(global_rate=SGIE_BUDGET_PER_SEC, stream_rate=SGIE_STREAM_BUDGET_PER_SEC)
 
 
 
 def tiler_sink_pad_buffer_probe(pad,info,u_data):
-    frame_number=0
-    num_rects=0
     gst_buffer = info.get_buffer()
     if not gst_buffer:
         print("Unable to get GstBuffer ")
@@ -74,98 +142,162 @@ def tiler_sink_pad_buffer_probe(pad,info,u_data):
     # Note that pyds.gst_buffer_get_nvds_batch_meta() expects the
     # C address of gst_buffer as input, which is obtained with hash(gst_buffer)
     batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
-    l_frame = batch_meta.frame_meta_list
-    while l_frame is not None:
-        try:
-            # Note that l_frame.data needs a cast to pyds.NvDsFrameMeta
-            # The casting is done by pyds.NvDsFrameMeta.cast()
-            # The casting also keeps ownership of the underlying memory
-            # in the C code, so the Python garbage collector will leave
-            # it alone.
-            frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
-        except StopIteration:
-            break
-        frame_number=frame_meta.frame_num
-        num_rects = frame_meta.num_obj_meta
-        l_obj=frame_meta.obj_meta_list
-        while l_obj is not None:
-            try:
-                # Casting l_obj.data to pyds.NvDsObjectMeta
-                #obj_meta=pyds.glist_get_nvds_object_meta(l_obj.data)
-                obj_meta=pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            if obj_meta.unique_component_id==PGIE and obj_meta.class_id==0 and (obj_meta.object_id in PERSON_DETECTED)==False:
-                print("new person {} detected in frame {}.".format(obj_meta.object_id, frame_number))
-                PERSON_DETECTED[obj_meta.object_id] = [None, None]
-            try: 
-                l_obj=l_obj.next
-            except StopIteration:
-                break
-            
-        l_obj=frame_meta.obj_meta_list
-        while l_obj is not None:
-            try:
-                # Casting l_obj.data to pyds.NvDsObjectMeta
-                #obj_meta=pyds.glist_get_nvds_object_meta(l_obj.data)
-                obj_meta=pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            if obj_meta.unique_component_id==SGIE and obj_meta.class_id==0:
-                # print(obj_meta.object_id, "  ", obj_meta.parent.object_id)
-                if obj_meta.parent.object_id in PERSON_DETECTED:
-                    if PERSON_DETECTED[obj_meta.parent.object_id][0] is None:
-                        print("face of person-{} detected in frame{}".format(obj_meta.parent.object_id, frame_number))
-                        PERSON_DETECTED[obj_meta.parent.object_id][0] = frame_number
-                        
-                        l_user = obj_meta.obj_user_meta_list
-                        while l_user is not None:
-                            try:
-                                # Note that l_user.data needs a cast to pyds.NvDsUserMeta
-                                # The casting is done by pyds.NvDsUserMeta.cast()
-                                # The casting also keeps ownership of the underlying memory
-                                # in the C code, so the Python garbage collector will leave
-                                # it alone
-                                user_meta=pyds.NvDsUserMeta.cast(l_user.data) 
-                            except StopIteration:
-                                break
-                            
-                            # Check data type of user_meta 
-                            if(user_meta and user_meta.base_meta.meta_type==pyds.NvDsMetaType.NVDSINFER_TENSOR_OUTPUT_META): 
-                                try:
-                                    tensor_meta = pyds.NvDsInferTensorMeta.cast(user_meta.user_meta_data)
-                                except StopIteration:
-                                    break
-                                
-                                layer = pyds.get_nvds_LayerInfo(tensor_meta, 0)
-                                output = []
-                                for i in range(512):
-                                    output.append(pyds.get_detections(layer.buffer, i))
-                                
-                                res = np.reshape(output,(512,-1))
-                                norm=np.linalg.norm(res)
-                                normal_array = res / norm
-                                PERSON_DETECTED[obj_meta.parent.object_id][1] = normal_array
-                                print("get facial features of person {}".format(obj_meta.parent.object_id))
-                                try:
-                                    l_user=l_user.next
-                                except StopIteration:
-                                    break 
-                                   
-            try: 
-                l_obj=l_obj.next
-            except StopIteration:
-                break
-        try:
-            l_frame=l_frame.next
-        except StopIteration:
-            break
+    embeddings = []
+    records = []
+    counts = []
+    for frame in collect(batch_meta, with_boxes=False, with_parents=PERSONS is not None):
+        stream_id = frame.stream_id
+        frame_number = frame.frame_num
+        # the --bulk file of this frame, its matches must not land in the next file on this stream
+        job = BULK.job(stream_id) if BULK is not None else None
+        # a track is a person, or the face itself without a person stage
+        for i in frame.select(*(PERSONS or FACES)):
+            track, created = TRACKS.touch(stream_id, frame.object_ids[i], frame_number)
+            if created:
+                EVENTS.emit(TRACK_STARTED, stream_id, track.object_id, frame_number)
+
+        faces = frame.select(*FACES)
+        counts.append(('faces', stream_id, len(faces)))
+        detections = {}
+        for i in faces:
+            obj_meta = frame.objects[i]
+            rect = obj_meta.rect_params
+            landmarks = None
+            if PERSONS is None:
+                track = TRACKS.get(stream_id, frame.object_ids[i])
+                if track is None:
+                    continue
+                person_rect = rect
+            else:
+                track = TRACKS.get(stream_id, frame.parent_ids[i])
+                if track is None:
+                    continue
+                ADMISSION.completed(stream_id, track.object_id)
+                person_rect = obj_meta.parent.rect_params
+                if track.object_id not in detections:
+                    detections[track.object_id] = person_face_detections(obj_meta.parent)
+                if detections[track.object_id] is not None:
+                    landmarks = match_landmarks((rect.left, rect.top, rect.width, rect.height),
+                                                *detections[track.object_id])
+            quality = face_quality(rect.width, rect.height, obj_meta.confidence, landmarks)
+            person_box = (person_rect.left, person_rect.top, person_rect.width, person_rect.height)
+            for tensor_meta in iter_tensor_meta(obj_meta):
+                # Zero-copy view over the output layer, copied out
+                # together with the rest of the batch below
+                layer = pyds.get_nvds_LayerInfo(tensor_meta, 0)
+                embeddings.append(TENSOR_READER.layer_view(layer))
+                records.append(FaceRecord(stream_id, frame_number, track.object_id, person_box, quality, None, track,
+                                          job))
+        TRACKS.expire(stream_id, frame_number)
+
+    if records:
+        # The tensor memory is recycled with the buffer: copy it out before
+        # handing the faces to the workers
+        for record, embedding in zip(records, np.stack(embeddings)):
+            record.embedding = embedding
+            counts.append(('embeddings', record.stream_id, 1))
+        FACE_WORKERS.submit(records)
+    METRICS.inc_many(counts)
+
+    return Gst.PadProbeReturn.OK
+
+def person_face_detections(person_meta):
+    '''
+    Boxes and landmarks of the SGIE face detections on a person crop, in
+    frame coordinates; None without the detector's tensor output.
+    '''
+    for tensor_meta in iter_tensor_meta(person_meta):
+        if tensor_meta.unique_id != FACES[0] or tensor_meta.num_output_layers <= LANDMARKS_LAYER:
+            continue
+        layers = [TENSOR_READER.layer_view(pyds.get_nvds_LayerInfo(tensor_meta, index))
+                  for index in (NUM_DETECTIONS_LAYER, BOXES_LAYER, LANDMARKS_LAYER)]
+        rect = person_meta.rect_params
+        return detector_landmarks(layers[0][0], layers[1], layers[2],
+                                  (rect.left, rect.top, rect.width, rect.height))
+    return None
+
+def process_faces(records):
+    '''
+    Post-probe work for a batch of faces, run on a FACE_WORKERS thread.
+    A track always goes to the same worker, so its state needs no lock.
+    '''
+    features = l2_normalize(np.stack([record.embedding for record in records]))
+    tracks = []
+    for record, feature in zip(records, features):
+        track = record.track
+        _, _, person_width, person_height = record.bbox
+        if QUALITY_POLICY.update(track, record.quality, feature, person_width, person_height, record.frame_num):
+            EVENTS.emit(FACE_CAPTURED, record.stream_id, track.object_id, record.frame_num, record.quality)
+        tracks.append(track)
+    if CAPTURE_STORE is not None:
+        with CAPTURE_LOCK:
+            CAPTURE_STORE.add([track.object_id for track in tracks], features)
+    if len(FACE_GALLERY):
+        # match the fused per-track embeddings, not the single faces
+        labels, scores = FACE_GALLERY.search(np.stack([track.embedding for track in tracks]), k=1)
+        for record, label, score in zip(records, labels[:, 0].tolist(), scores[:, 0].tolist()):
+            track = record.track
+            # a track is reported on its first match and when its identity changes
+            if score >= MATCH_THRESHOLD and label != track.label:
+                track.label = label
+                METRICS.inc('matches', track.stream_id)
+                if BULK is not None:
+                    BULK.record_match(record.job, track.object_id, label, score)
+                EVENTS.emit(IDENTITY_MATCHED, track.stream_id, track.object_id, record.frame_num, score, label)
+
+def end_track(track, reason):
+    '''TRACKS eviction: the track timed out, was pushed out or its stream went away.'''
+    ADMISSION.forget(track.stream_id, track.object_id)
+    EVENTS.emit(TRACK_ENDED, track.stream_id, track.object_id, track.last_frame,
+                track.last_frame - track.first_frame + 1)
+
+def admit_stream(stream_id, uri):
+    '''SOURCES on_add: a new source took stream_id, track its frames again.'''
+    TRACKS.add_stream(stream_id)
+
+def retire_stream(stream_id):
+    '''
+    SOURCES on_retire: drop the per-stream state of a detached source. Runs
+    on the main loop after its bin stopped and before the stream id can be
+    handed to a new source, so the new stream never inherits or loses state;
+    TRACKS ignores the old source's frames still in the queues until
+    admit_stream.
+    '''
+    TRACKS.remove_stream(stream_id)
+    ADMISSION.remove_stream(stream_id)
+    METRICS.remove_stream(stream_id)
+    FRAME_DROPPER.remove_stream(stream_id)
+
+def ingress_src_pad_buffer_probe(pad,info,u_data):
+    '''
+    Stamp every frame entering the pipeline for the end-to-end latency.
+    '''
+    gst_buffer = info.get_buffer()
+    if not gst_buffer:
+        print("Unable to get GstBuffer ")
+        return
+
+    batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
+    frames = [(frame_meta.pad_index, frame_meta.buf_pts) for frame_meta in iter_frames(batch_meta)]
+    METRICS.mark_ingress_frames(frames)
+    for stream_id, _ in frames:
+        RECONNECTOR.frame_seen(stream_id)
 
     return Gst.PadProbeReturn.OK
 
-def osd_sink_pad_buffer_probe(pad,info,u_data):
-    frame_number=0
-    num_rects=0
+def source_drop_probe(pad,info,stream_id):
+    '''
+    Drop frames of a source ahead of nvstreammux when the load controller
+    asks for it.
+    '''
+    if FRAME_DROPPER.keep(stream_id):
+        return Gst.PadProbeReturn.OK
+    return Gst.PadProbeReturn.DROP
+
+def egress_sink_pad_buffer_probe(pad,info,u_data):
+    '''
+    Count the frames leaving inference, before any output sampling.
+    '''
     gst_buffer = info.get_buffer()
     if not gst_buffer:
         print("Unable to get GstBuffer ")
@@ -175,48 +307,31 @@ def osd_sink_pad_buffer_probe(pad,info,u_data):
     # Note that pyds.gst_buffer_get_nvds_batch_meta() expects the
     # C address of gst_buffer as input, which is obtained with hash(gst_buffer)
     batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
-    l_frame = batch_meta.frame_meta_list
-    while l_frame is not None:
-        try:
-            # Note that l_frame.data needs a cast to pyds.NvDsFrameMeta
-            # The casting is done by pyds.NvDsFrameMeta.cast()
-            # The casting also keeps ownership of the underlying memory
-            # in the C code, so the Python garbage collector will leave
-            # it alone.
-            frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
-        except StopIteration:
-            break
-    
-        l_obj=frame_meta.obj_meta_list
-        while l_obj is not None:
-            try:
-                # Casting l_obj.data to pyds.NvDsObjectMeta
-                #obj_meta=pyds.glist_get_nvds_object_meta(l_obj.data)
-                obj_meta=pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            # obj_meta.rect_params.border_color.set(0.0, 0.0, 1.0, 0.0)
-            # print(obj_meta.class_id," ", obj_meta.confidence)
-            try: 
-                l_obj=l_obj.next
-            except StopIteration:
-                break
-
-        # Get frame rate through this probe
-        fps_streams["stream{0}".format(frame_meta.pad_index)].get_fps()
-        try:
-            l_frame=l_frame.next
-        except StopIteration:
-            break
+    METRICS.mark_egress_frames([(frame_meta.pad_index, frame_meta.buf_pts, frame_meta.num_obj_meta)
+                                for frame_meta in iter_frames(batch_meta)])
+    if BULK is not None:
+        for frame in collect(batch_meta, with_parents=False):
+            BULK.record_frame(frame)
+
+    return Gst.PadProbeReturn.OK
 
+def egress_event_probe(pad,info,u_data):
+    '''
+    nvstreammux marks the end of each source in-band, behind its last
+    frame: in bulk mode that file is complete.
+    '''
+    stream_id = parse_stream_eos(info.get_event())
+    if stream_id is not None:
+        BULK.stream_finished(stream_id)
     return Gst.PadProbeReturn.OK
 
 def sgie_sink_pad_buffer_probe(pad,info,u_data):
     '''
+    Keep the persons ADMISSION does not admit under the SGIE budget away
+    from the face SGIE: their class is moved out of its operate-on-class-ids
+    until sgie_src_pad_buffer_probe restores it, so the tracks, the OSD and
+    the bulk results downstream still see every person.
     '''
-    global RFACE_POOL_MAX, RFACE_POOL
-    global start_time, end_time
-    global is_first
     gst_buffer = info.get_buffer()
     if not gst_buffer:
         print("Unable to get GstBuffer ")
@@ -226,77 +341,133 @@ def sgie_sink_pad_buffer_probe(pad,info,u_data):
     # Note that pyds.gst_buffer_get_nvds_batch_meta() expects the
     # C address of gst_buffer as input, which is obtained with hash(gst_buffer)
     batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
-    l_frame = batch_meta.frame_meta_list
-    while l_frame is not None:
-        if is_first==True:
-            start_time=time.time()
-            is_first = False
-        if (end_time - start_time)>=1:
-            RFACE_POOL.clear()
-            start_time = end_time
-        try:
-            # Note that l_frame.data needs a cast to pyds.NvDsFrameMeta
-            # The casting is done by pyds.NvDsFrameMeta.cast()
-            # The casting also keeps ownership of the underlying memory
-            # in the C code, so the Python garbage collector will leave
-            # it alone.
-            frame_meta = pyds.NvDsFrameMeta.cast(l_frame.data)
-            # print(start_time, "  ", end_time)
-        except StopIteration:
-            break
-        l_obj=frame_meta.obj_meta_list
-        while l_obj is not None:
-            remove_flag = 1
-            try:
-                # Casting l_obj.data to pyds.NvDsObjectMeta
-                obj_meta=pyds.NvDsObjectMeta.cast(l_obj.data)
-            except StopIteration:
-                break
-            #if obj_meta.class_id!=0:
-                #remove_flag = 0      
-            if obj_meta.class_id ==0 and obj_meta.unique_component_id == PGIE and (obj_meta.rect_params.width < 20 or obj_meta.rect_params.height < 20):
-                remove_flag =1
-            elif obj_meta.class_id==0 and (obj_meta.object_id in PERSON_DETECTED) and (PERSON_DETECTED[obj_meta.object_id][0] is not None):
-                if obj_meta.object_id in RFACE_POOL:
-                    RFACE_POOL.remove(obj_meta.object_id)
-                remove_flag = 1
-                
-            elif obj_meta.class_id==0 and (obj_meta.object_id in PERSON_DETECTED)==False:
-                if obj_meta.object_id in RFACE_POOL:
-                    remove_flag = 1
-                if obj_meta.object_id not in RFACE_POOL:
-                    if len(RFACE_POOL) >= RFACE_POOL_MAX:
-                        remove_flag = 1
-                    else:
-                        RFACE_POOL.append(obj_meta.object_id)
-                        #print(RFACE_POOL)
-                        remove_flag = 0 
-            try:
-                l_obj=l_obj.next
-                if remove_flag:
-                    pyds.nvds_remove_obj_meta_from_frame(frame_meta, obj_meta)
-            except StopIteration:
-                break
-            
-        try:
-            end_time = time.time()
-            l_frame=l_frame.next
-        except StopIteration:
-            break
+    for frame in collect(batch_meta, with_parents=False):
+        candidates = []
+        for i in frame.select(*PERSONS):
+            _, _, width, height = frame.boxes[i]
+            if width < MIN_PERSON_SIZE[0] or height < MIN_PERSON_SIZE[1]:
+                continue
+            object_id = frame.object_ids[i]
+            track = TRACKS.get(frame.stream_id, object_id)
+            if track is None:
+                candidates.append((object_id, width, height, False))
+            elif QUALITY_POLICY.wants_face(track, width, height, frame.frame_num):
+                candidates.append((object_id, width, height, track.embedding is not None))
+
+        admitted = ADMISSION.select(frame.stream_id, candidates) if candidates else ()
+        METRICS.inc('sgie_admitted', frame.stream_id, len(admitted))
+        for i in frame.select(*PERSONS):
+            if frame.object_ids[i] not in admitted:
+                frame.objects[i].class_id += SKIP_CLASS_OFFSET
+
+    return Gst.PadProbeReturn.OK
+
+def sgie_src_pad_buffer_probe(pad,info,u_data):
+    '''
+    Give the persons the SGIE skipped their class back.
+    '''
+    gst_buffer = info.get_buffer()
+    if not gst_buffer:
+        print("Unable to get GstBuffer ")
+        return
+
+    batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(gst_buffer))
+    for frame_meta in iter_frames(batch_meta):
+        for obj_meta in iter_objects(frame_meta):
+            if obj_meta.class_id >= SKIP_CLASS_OFFSET:
+                obj_meta.class_id -= SKIP_CLASS_OFFSET
 
     return Gst.PadProbeReturn.OK
 
 
-def main(args):
-    # Check input arguments
-    if len(args) < 2:
-        sys.stderr.write("usage: %s <uri1> [uri2] ... [uriN]\n" % args[0])
-        sys.exit(1)
+def main(args, pipeline_spec=PIPELINE_SPEC):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('uris', nargs='*', metavar='uri')
+    parser.add_argument('--pipeline', default=pipeline_spec,
+                        help="topology spec of the inference stages (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="validate the spec, print the graph and exit")
+    parser.add_argument('--max-sources', type=int, default=0,
+                        help="source slots, for sources added at runtime (default: one per uri)")
+    parser.add_argument('--control-port', type=int, default=0,
+                        help="HTTP port of the source control API, 0 disables it (default: %(default)s)")
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="probe every stage, export stage_seconds and write a Chrome trace to FILE on exit")
+    parser.add_argument('--record', metavar='FILE', default=None,
+                        help="record the metadata of every batch leaving inference, for python -m common.replay FILE")
+    parser.add_argument('--events', metavar='SINK', default='stdout',
+                        help="recognition events to stdout, jsonl:DIR, columnar:DIR or socket:PATH "
+                             "(default: %(default)s)")
+    bulk = parser.add_argument_group('bulk')
+    bulk.add_argument('--bulk', metavar='PATH', default=None,
+                      help="process every video under a directory or listed in a manifest file, "
+                           "refilling source slots as files end (no uris)")
+    bulk.add_argument('--results-dir', default='results',
+                      help="per-file results of --bulk (default: %(default)s)")
+    bulk.add_argument('--checkpoint', default=None,
+                      help="finished files, skipped when resuming (default: RESULTS_DIR/checkpoint.jsonl)")
+    add_output_arguments(parser)
+    options = parser.parse_args(args[1:])
+    uris = options.uris
+    if options.bulk:
+        if uris:
+            parser.error("--bulk takes no uris")
+        bulk_files = load_manifest(options.bulk)
+        # nothing to look at, and no reason to wait for anyone
+        options.output = OUTPUT_NONE
+        options.max_sources = options.max_sources or BULK_SOURCES
+    elif not uris and not options.control_port:
+        parser.error("at least one uri is required without --control-port")
+    # muxer and full-frame batches are sized for every slot up front
+    number_sources=max(len(uris), options.max_sources, 1)
 
-    for i in range(0,len(args)-1):
-        fps_streams["stream{0}".format(i)]=GETFPS(i)
-    print(fps_streams)
-    number_sources=len(args)-1
+    try:
+        spec = load_pipeline_spec(options.pipeline)
+        spec.validate(number_sources)
+        events_transport = open_transport(options.events)
+    except (PipelineSpecError, ValueError) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    engines = resolve_engines(spec, number_sources)
+    engine_cache = EngineCache()
+    if options.dry_run:
+        print(spec.describe(number_sources))
+        for name, variant in engines.items():
+            print("  engine [{}] {} {}".format(name, variant.path, engine_cache.status(variant)))
+        print("  output {}".format(options.output))
+        return 0
+
+    global FACE_GALLERY, MATCH_THRESHOLD, CAPTURE_STORE, FACE_WORKERS, SOURCES, RECONNECTOR, LOAD_CONTROLLER, BULK, EVENTS
+    global PERSONS, FACES, EMBEDDER, MIN_PERSON_SIZE
+    PERSONS, FACES, EMBEDDER = spec.role('person'), spec.role('face'), spec.role('embedding')
+    MIN_PERSON_SIZE = spec.min_object_size('face')
+    gallery_config = configparser.ConfigParser()
+    gallery_config.read(GALLERY_CONFIG)
+    if gallery_config.has_section('gallery'):
+        FACE_GALLERY = create_gallery(gallery_config['gallery'])
+        MATCH_THRESHOLD = gallery_config.getfloat('gallery', 'match-threshold', fallback=MATCH_THRESHOLD)
+        print("Loaded {} identities into the face gallery".format(len(FACE_GALLERY)))
+        capture_file = gallery_config.get('gallery', 'capture-file', fallback=None)
+        if capture_file:
+            # fsync per batch would back up the post-probe queue
+            CAPTURE_STORE = EmbeddingStore(capture_file, durable=False)
+    EVENTS = EventSink(events_transport, batch_size=EVENT_BATCH_SIZE, flush_interval=EVENT_FLUSH_SEC,
+                       max_delay=EVENT_SOCKET_MAX_DELAY_SEC if isinstance(events_transport, SocketTransport)
+                       else None).start()
+    TRACKS.on_evict = end_track
+    FACE_WORKERS = WorkerPool(process_faces, workers=POST_PROBE_WORKERS, capacity=POST_PROBE_QUEUE_SIZE,
+                              policy=POST_PROBE_POLICY).start()
+
+    METRICS.define_gauge('tracks', "Live tracks", lambda: len(TRACKS))
+    METRICS.define_gauge('post_probe_queue_depth', "Faces waiting for the post-probe workers",
+                         lambda: FACE_WORKERS.stats()['depth'])
+    METRICS.define_gauge('post_probe_dropped', "Faces dropped by the post-probe queue",
+                         lambda: FACE_WORKERS.stats()['dropped'])
+    METRICS.define_gauge('events_dropped', "Recognition events the event sink could not deliver",
+                         lambda: EVENTS.stats()['dropped'])
+    reporter = JsonLinesReporter(METRICS, METRICS_JSON_FILE, METRICS_INTERVAL_SEC).start()
+    if METRICS_PORT:
+        serve_prometheus(METRICS, METRICS_PORT)
 
     # Standard GStreamer initialization
     GObject.threads_init()
@@ -306,226 +477,127 @@ def main(args):
     # Create Pipeline element that will form a connection of other elements
     print("Creating Pipeline \n ")
     pipeline = Gst.Pipeline()
-    is_live = False
+    # sources added through the control API are cameras
+    is_live = options.control_port or any(uri.find("rtsp://") == 0 for uri in uris)
 
     if not pipeline:
         sys.stderr.write(" Unable to create Pipeline \n")
-    print("Creating streamux \n ")
-
-    # Create nvstreammux instance to form batches from one or more sources.
-    streammux = Gst.ElementFactory.make("nvstreammux", "Stream-muxer")
-    if not streammux:
-        sys.stderr.write(" Unable to create NvStreamMux \n")
-
-    pipeline.add(streammux)
-    for i in range(number_sources):
-        print("Creating source_bin ",i," \n ")
-        uri_name=args[i+1]
-        if uri_name.find("rtsp://") == 0 :
-            is_live = True
-        source_bin=create_source_bin(i, uri_name)
-        if not source_bin:
-            sys.stderr.write("Unable to create source bin \n")
-        pipeline.add(source_bin)
-        padname="sink_%u" %i
-        sinkpad= streammux.get_request_pad(padname) 
-        if not sinkpad:
-            sys.stderr.write("Unable to create sink pad bin \n")
-        srcpad=source_bin.get_static_pad("src")
-        if not srcpad:
-            sys.stderr.write("Unable to create src pad bin \n")
-        srcpad.link(sinkpad)
-    queue1=Gst.ElementFactory.make("queue","queue1")
-    queue2=Gst.ElementFactory.make("queue","queue2")
-    queue3=Gst.ElementFactory.make("queue","queue3")
-    queue4=Gst.ElementFactory.make("queue","queue4")
-    queue5=Gst.ElementFactory.make("queue","queue5")
-    queue6=Gst.ElementFactory.make("queue","queue6")
-    queue7=Gst.ElementFactory.make("queue","queue7")
-    queue8=Gst.ElementFactory.make("queue","queue8")
-    pipeline.add(queue1)
-    pipeline.add(queue2)
-    pipeline.add(queue3)
-    pipeline.add(queue4)
-    pipeline.add(queue5)
-    pipeline.add(queue6)
-    pipeline.add(queue7)
-    pipeline.add(queue8)
-    print("Creating Pgie \n ")
-    pgie = Gst.ElementFactory.make("nvinfer", "primary-inference")
-    if not pgie:
-        sys.stderr.write(" Unable to create pgie \n")
-    print("Creating sgie \n ")
-    sgie = Gst.ElementFactory.make("nvinfer", "Secondary-inference")
-    if not sgie:
-        sys.stderr.write(" Unable to create sgie \n")
-
-    print("Creating tgie \n ")
-    tgie = Gst.ElementFactory.make("nvinfer", "Third-inference")
-    if not tgie:
-        sys.stderr.write(" Unable to create tgie \n")
-    print("Creating tracker \n ")
-    tracker = Gst.ElementFactory.make("nvtracker", "tracker")
-    if not tracker:
-        sys.stderr.write(" Unable to create tracker \n")
-    print("Creating tiler \n ")
-    tiler=Gst.ElementFactory.make("nvmultistreamtiler", "nvtiler")
-    if not tiler:
-        sys.stderr.write(" Unable to create tiler \n")
-    print("Creating nvvidconv \n ")
-    nvvidconv = Gst.ElementFactory.make("nvvideoconvert", "convertor")
-    if not nvvidconv:
-        sys.stderr.write(" Unable to create nvvidconv \n")
-    print("Creating nvosd \n ")
-    nvosd = Gst.ElementFactory.make("nvdsosd", "onscreendisplay")
-    if not nvosd:
-        sys.stderr.write(" Unable to create nvosd \n")
-    nvosd.set_property('process-mode',OSD_PROCESS_MODE)
-    nvosd.set_property('display-text',OSD_DISPLAY_TEXT)
-    if(is_aarch64()):
-        print("Creating transform \n ")
-        transform=Gst.ElementFactory.make("nvegltransform", "nvegl-transform")
-        if not transform:
-            sys.stderr.write(" Unable to create transform \n")
-
-
-    print("Creating FileSink \n")
-    nvvidconv1 = Gst.ElementFactory.make("nvvideoconvert", "convertor1")
-    videoconvert = Gst.ElementFactory.make("videoconvert", "video-converter")
-    x264enc = Gst.ElementFactory.make("x264enc", "h264 encoder")
-    qtmux = Gst.ElementFactory.make("qtmux", "muxer")
-
-    sink = Gst.ElementFactory.make("filesink", "filesink")
-    sink.set_property("location", "output.mp4")
-        
-    if not sink:
-        sys.stderr.write(" Unable to create egl sink \n")
-
-    if is_live:
-        print("Atleast one of the sources is live")
-        streammux.set_property('live-source', 1)
-
-    streammux.set_property('width', 1920)
-    streammux.set_property('height', 1080)
-    streammux.set_property('batch-size', number_sources)
-    streammux.set_property('batched-push-timeout', 4000000)
-
-    pgie.set_property('config-file-path', "configs/config_yolor.txt")
-    pgie_batch_size=pgie.get_property("batch-size")
-    if(pgie_batch_size != number_sources):
-        print("WARNING: Overriding infer-config batch-size",pgie_batch_size," with number of sources ", number_sources," \n")
-        pgie.set_property("batch-size",number_sources)
-
-    sgie.set_property('config-file-path', "configs/config_scrfd.txt")
-    tgie.set_property('config-file-path', "configs/config_face_embedding.txt")
-
-    tiler_rows=int(math.sqrt(number_sources))
-    tiler_columns=int(math.ceil((1.0*number_sources)/tiler_rows))
-    tiler.set_property("rows",tiler_rows)
-    tiler.set_property("columns",tiler_columns)
-    tiler.set_property("width", TILED_OUTPUT_WIDTH)
-    tiler.set_property("height", TILED_OUTPUT_HEIGHT)
-    sink.set_property("qos",0)
-    sink.set_property("sync",0)
-
-    #Set properties of tracker
-    config = configparser.ConfigParser()
-    config.read('configs/config_tracker.txt')
-    config.sections()
-
-    for key in config['tracker']:
-        if key == 'tracker-width' :
-            tracker_width = config.getint('tracker', key)
-            tracker.set_property('tracker-width', tracker_width)
-        if key == 'tracker-height' :
-            tracker_height = config.getint('tracker', key)
-            tracker.set_property('tracker-height', tracker_height)
-        if key == 'gpu-id' :
-            tracker_gpu_id = config.getint('tracker', key)
-            tracker.set_property('gpu_id', tracker_gpu_id)
-        if key == 'll-lib-file' :
-            tracker_ll_lib_file = config.get('tracker', key)
-            tracker.set_property('ll-lib-file', tracker_ll_lib_file)
-        if key == 'll-config-file' :
-            tracker_ll_config_file = config.get('tracker', key)
-            tracker.set_property('ll-config-file', tracker_ll_config_file)
-        if key == 'enable-past-frame' :
-            tracker_enable_past_frame = config.getint('tracker', key)
-            tracker.set_property('enable_past_frame', tracker_enable_past_frame)
-
-    print("Adding elements to Pipeline \n")
-    pipeline.add(pgie)
-    pipeline.add(sgie)
-    pipeline.add(tgie)
-    pipeline.add(tracker)
-    pipeline.add(tiler)
-    pipeline.add(nvvidconv)
-    pipeline.add(nvosd)
-    pipeline.add(nvvidconv1)
-    pipeline.add(videoconvert)
-    pipeline.add(x264enc)
-    pipeline.add(qtmux)
-    pipeline.add(sink)
-
-    print("Linking elements in the Pipeline \n")
-    streammux.link(queue1)
-    queue1.link(pgie)
-    pgie.link(queue2)
-    queue2.link(tracker)
-    tracker.link(queue3)
-    queue3.link(sgie)
-    sgie.link(queue4)
-    queue4.link(tgie)
-    tgie.link(queue5)
-    queue5.link(tiler)
-    tiler.link(queue6)
-    queue6.link(nvvidconv)
-    nvvidconv.link(queue7)
-    queue7.link(nvosd)
-    
-    nvosd.link(nvvidconv1)
-    nvvidconv1.link(videoconvert) 
-    videoconvert.link(x264enc)
-    x264enc.link(qtmux)
-    qtmux.link(sink)     
+
+    # nvstreammux, then a queue and an element per stage of the spec
+    # engines for the resolved batch sizes, not the _b1_ pinned in the configs
+    engine_files = {name: engine_cache.prepare(variant) for name, variant in engines.items()}
+    graph = build_pipeline(pipeline, spec, number_sources, is_live, engine_files)
+    streammux = graph.streammux
+    SOURCES = SourceManager(pipeline, streammux, create_source_bin, number_sources,
+                            on_add=[admit_stream], on_retire=[retire_stream])
+    RECONNECTOR = Reconnector(SOURCES, base_delay=RECONNECT_BASE_SEC, max_delay=RECONNECT_MAX_SEC,
+                              stall_timeout=STALL_TIMEOUT_SEC)
+    SOURCES.on_add.append(RECONNECTOR.watch)
+    SOURCES.on_remove.append(RECONNECTOR.forget)
+    METRICS.define_gauge('source_reconnects', "Source bins re-created after a failure",
+                         lambda: RECONNECTOR.stats()['reconnects'])
+    METRICS.define_gauge('source_downtime_seconds', "Time sources spent failed or reconnecting",
+                         lambda: RECONNECTOR.stats()['downtime'])
+    METRICS.define_gauge('sources_unhealthy', "Sources not producing frames",
+                         lambda: RECONNECTOR.stats()['unhealthy'])
+    for uri_name in uris:
+        SOURCES.add(uri_name, immediate=True)
+    if options.control_port:
+        serve_control(SOURCES, options.control_port)
+        print("Source control API on http://127.0.0.1:{}/sources".format(options.control_port))
+
+    branch = build_output_branch(pipeline, options, number_sources)
+    graph.tail.link(branch.head)
 
     # create an event loop and feed gstreamer bus mesages to it
     loop = GObject.MainLoop()
     bus = pipeline.get_bus()
     bus.add_signal_watch()
-    bus.connect ("message", bus_call, loop)
+    if options.bulk:
+        # the run ends when the last file does, not when all slots are at EOS
+        streammux.set_property('drop-pipeline-eos', 1)
+        checkpoint = Checkpoint(options.checkpoint or os.path.join(options.results_dir, "checkpoint.jsonl"))
+        BULK = BulkRunner(bulk_files, SOURCES, options.results_dir, checkpoint,
+                          on_done=lambda: GLib.idle_add(loop.quit)).start()
+        bus.connect ("message", bus_call, loop, BULK)
+    else:
+        bus.connect ("message", bus_call, loop, RECONNECTOR)
+        GLib.timeout_add(HEALTH_CHECK_SEC * 1000, RECONNECTOR.check)
+
+    if is_live and LATENCY_SLO_SEC:
+        pgie = graph.stages.get('pgie')
+        base_interval = pgie.get_property('interval') if pgie else 0
+
+        def apply_load_level(level):
+            if pgie:
+                pgie.set_property('interval', max(base_interval, level.interval))
+            ADMISSION.set_rate(SGIE_BUDGET_PER_SEC * level.admission_scale,
+                               SGIE_STREAM_BUDGET_PER_SEC * level.admission_scale)
+            FRAME_DROPPER.keep_every = level.keep_every
+
+        LOAD_CONTROLLER = LoadController(LATENCY_SLO_SEC, apply=apply_load_level, latency=LatencyWindow(METRICS).sample,
+                                         queue_fill=lambda: max(gst_queue_fill(graph.queues.values()),
+                                                                FACE_WORKERS.stats()['depth'] / POST_PROBE_QUEUE_SIZE))
+        METRICS.define_gauge('load_level', "Degradation level of the load controller", lambda: LOAD_CONTROLLER.index)
+        GLib.timeout_add(LOAD_CONTROL_SEC * 1000, LOAD_CONTROLLER.tick)
     
-    # tiler_sink_pad = tiler.get_static_pad("sink")
-    # if not tiler_sink_pad:
-    #     sys.stderr.write(" Unable to get sink pad of tiler \n")
-    # else:
-    #     i =1
-    #     tiler_sink_pad.add_probe(Gst.PadProbeType.BUFFER, tiler_sink_pad_buffer_probe, 0)
+    tiler_sink_pad = branch.egress_pad
+    if not tiler_sink_pad:
+        sys.stderr.write(" Unable to get sink pad of the output branch \n")
+    else:
+        i =1
+        tiler_sink_pad.add_probe(Gst.PadProbeType.BUFFER, METRICS.timed('tiler', tiler_sink_pad_buffer_probe), 0)
     
-    # sgie_sink_pad = queue3.get_static_pad("sink")
-    # if not sgie_sink_pad:
-    #     sys.stderr.write(" Unable to get sink pad of tiler \n")
-    # else:
-    #     i=2
-    #     sgie_sink_pad.add_probe(Gst.PadProbeType.BUFFER, sgie_sink_pad_buffer_probe, 0)
+    # person crops are admitted in front of the face detector; a full-frame
+    # face detector has no crops to admit
+    if PERSONS is not None:
+        sgie_queue = graph.queues.get(spec.role_stage('face'))
+        sgie_sink_pad = sgie_queue.get_static_pad("sink") if sgie_queue is not None else None
+        if not sgie_sink_pad:
+            sys.stderr.write(" Unable to get sink pad of the face detector queue, every person crop goes to it \n")
+        else:
+            sgie_sink_pad.add_probe(Gst.PadProbeType.BUFFER, METRICS.timed('sgie', sgie_sink_pad_buffer_probe), 0)
+            sgie_src_pad = graph.stages[spec.role_stage('face')].get_static_pad("src")
+            sgie_src_pad.add_probe(Gst.PadProbeType.BUFFER, METRICS.timed('sgie_src', sgie_src_pad_buffer_probe), 0)
 
 
-    osd_sink_pad=nvosd.get_static_pad("sink")
-    if not osd_sink_pad:
-        sys.stderr.write(" Unable to get sink pad of osd \n")
+    # Same pad in every output mode, ahead of the output sampling
+    egress_sink_pad=branch.egress_pad
+    recorder = None
+    if not egress_sink_pad:
+        sys.stderr.write(" Unable to get sink pad of the output branch \n")
+    else:
+        egress_sink_pad.add_probe(Gst.PadProbeType.BUFFER, METRICS.timed('egress', egress_sink_pad_buffer_probe), 0)
+        if options.record:
+            recorder = Recorder(options.record, TENSOR_READER)
+            egress_sink_pad.add_probe(Gst.PadProbeType.BUFFER, recorder.probe(Gst.PadProbeReturn.OK), 0)
+        if BULK is not None:
+            egress_sink_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, egress_event_probe, 0)
+
+    ingress_src_pad=streammux.get_static_pad("src")
+    if not ingress_src_pad:
+        sys.stderr.write(" Unable to get src pad of streammux \n")
     else:
-        i=3
-        osd_sink_pad.add_probe(Gst.PadProbeType.BUFFER, osd_sink_pad_buffer_probe, 0)
+        ingress_src_pad.add_probe(Gst.PadProbeType.BUFFER, ingress_src_pad_buffer_probe, 0)
+
+    tracer = None
+    if options.trace:
+        tracer = StageTracer(graph.stages, metrics=METRICS)
+        tracer.install(graph, Gst)
 
     # List the sources
     print("Now playing...")
-    for i, source in enumerate(args):
-        if (i != 0):
-            print(i, ": ", source)
+    for i, source in enumerate(uris):
+        print(i + 1, ": ", source)
 
     print("Starting pipeline \n")
     # start play back and listed to events      
-    pipeline.set_state(Gst.State.PLAYING)
+    # nvinfer builds the missing engines while starting, under the gpu-id
+    # it was given: they are moved to their device's names right after
+    with engine_cache.building(engines.values()):
+        pipeline.set_state(Gst.State.PLAYING)
+        for variant in engines.values():
+            engine_cache.adopt(variant)
     try:
         loop.run()
     except:
@@ -533,6 +605,19 @@ def main(args):
     # cleanup
     print("Exiting app\n")
     pipeline.set_state(Gst.State.NULL)
+    FACE_WORKERS.stop()
+    EVENTS.stop()
+    reporter.stop()
+    if BULK is not None:
+        print(BULK.report())
+    if recorder is not None:
+        recorder.close()
+        print("Recorded {} batches to {}".format(recorder.batches, options.record))
+    if tracer is not None:
+        tracer.write_chrome_trace(options.trace)
+        for segment, stats in tracer.summary().items():
+            print("{}: {}".format(segment, stats))
+    return 1 if common.bus_call.fatal_error is not None else 0
 
 def cb_newpad(decodebin, decoder_src_pad,data):
     print("In cb_newpad\n")
@@ -600,6 +685,7 @@ def create_source_bin(index,uri):
     if not bin_pad:
         sys.stderr.write(" Failed to add ghost pad in source bin \n")
         return None
+    nbin.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, source_drop_probe, index)
     return nbin
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+################################################################################
+# SPDX-FileCopyrightText: Copyright (c) 2019-2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+import argparse
+import os
+import sys
+
+from common.supervisor import ShardingError, Supervisor, worker_command
+
+# Worker pipeline, any options not known here are passed on to it
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0],
+                                     epilog="other options go to every worker, as --option=value (e.g. --output=none)")
+    parser.add_argument('uris', nargs='+', metavar='uri')
+    parser.add_argument('--gpus', default='0',
+                        help="comma separated GPU ids (default: %(default)s)")
+    parser.add_argument('--workers-per-gpu', type=int, default=1,
+                        help="worker pipelines per GPU (default: %(default)s)")
+    parser.add_argument('--streams-per-worker', type=int, default=8,
+                        help="stream budget (muxer and batch size) of a worker (default: %(default)s)")
+    parser.add_argument('--control-base-port', type=int, default=9100,
+                        help="worker k serves its source control API on this port + k (default: %(default)s)")
+    parser.add_argument('--max-restarts', type=int, default=3,
+                        help="restarts within --restart-window before a worker's streams move (default: %(default)s)")
+    parser.add_argument('--restart-window', type=float, default=300.0,
+                        help="seconds (default: %(default)s)")
+    parser.add_argument('--report-file', default=None,
+                        help="JSON lines of merged metrics and recognition events (default: stdout)")
+    parser.add_argument('--report-interval', type=float, default=5.0,
+                        help="seconds between merged metrics lines (default: %(default)s)")
+    options, worker_args = parser.parse_known_args(args[1:])
+
+    try:
+        gpu_ids = [int(gpu_id) for gpu_id in options.gpus.split(',')]
+        supervisor = Supervisor(options.uris, gpu_ids, options.workers_per_gpu, options.streams_per_worker,
+                                worker_command(WORKER_SCRIPT, options.streams_per_worker, worker_args),
+                                control_base_port=options.control_base_port, max_restarts=options.max_restarts,
+                                restart_window=options.restart_window, output=options.report_file)
+    except (ValueError, ShardingError) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    for shard in supervisor.shards:
+        print("worker {} GPU {}: {}".format(shard.worker_id, shard.gpu_id, " ".join(shard.uris)))
+
+    supervisor.start()
+    try:
+        supervisor.run(options.report_interval)
+    except KeyboardInterrupt:
+        pass
+    return 0 if not supervisor.pending else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))